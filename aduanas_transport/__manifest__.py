@@ -27,7 +27,7 @@
         "python": ["requests"],
     },
     "external_dependencies_optional": {
-        "python": ["pdfplumber", "PyPDF2", "openai", "PyMuPDF", "lxml"],
+        "python": ["pdfplumber", "PyPDF2", "openai", "PyMuPDF", "lxml", "pytesseract"],
     },
     "assets": {
         "web.assets_backend": [
@@ -1,6 +1,10 @@
 from . import (
     aduana_expediente_factura,
     aduana_expediente,
+    aduana_expediente_declaracion,
+    aduana_bandeja_cursor,
+    aduana_aeat_archive,
+    aduana_ocr_cache,
     aduanas_config_settings,
     res_company,
     res_config_settings,
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import logging
+import zlib
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Días de conservación por servicio (0 = indefinido). Se sobrescriben con
+# ir.config_parameter aduanas_transport.archive.retention_days.<SERVICIO>.
+ARCHIVE_DEFAULT_RETENTION_DAYS = {
+    "BANDEJA": 30,
+}
+ARCHIVE_COMPRESS_LEVEL = 6
+
+
+class AduanaAeatPayload(models.Model):
+    """
+    Contenido XML comprimido (zlib) y direccionado por su SHA-256: una misma respuesta
+    (p.ej. una bandeja vacía o un rechazo repetido) se guarda una sola vez aunque la
+    referencien muchos mensajes. Se almacena en base de datos, no en el filestore.
+    """
+    _name = "aduana.aeat.payload"
+    _description = "Contenido XML AEAT (comprimido)"
+    _rec_name = "sha256"
+
+    sha256 = fields.Char(string="SHA-256", required=True, index=True, readonly=True)
+    data = fields.Binary(string="Contenido comprimido", attachment=False, readonly=True)
+    size_raw = fields.Integer(string="Tamaño (bytes)", readonly=True)
+    size_compressed = fields.Integer(string="Tamaño comprimido (bytes)", readonly=True)
+
+    _sql_constraints = [
+        ("sha256_uniq", "unique(sha256)", "El contenido ya está archivado."),
+    ]
+
+    @api.model
+    def _store(self, xml_text):
+        """Devuelve el payload del texto, creándolo solo si su hash no existe aún."""
+        raw = (xml_text or "").encode("utf-8")
+        digest = hashlib.sha256(raw).hexdigest()
+        Payload = self.sudo()
+        payload = Payload.search([("sha256", "=", digest)], limit=1)
+        if payload:
+            return payload
+        compressed = zlib.compress(raw, ARCHIVE_COMPRESS_LEVEL)
+        vals = {
+            "sha256": digest,
+            "data": base64.b64encode(compressed),
+            "size_raw": len(raw),
+            "size_compressed": len(compressed),
+        }
+        try:
+            with self.env.cr.savepoint():
+                return Payload.create(vals)
+        except Exception:
+            # Otro proceso archivó el mismo contenido a la vez (unique sha256)
+            payload = Payload.search([("sha256", "=", digest)], limit=1)
+            if payload:
+                return payload
+            raise
+
+    def _get_text(self):
+        self.ensure_one()
+        if not self.data:
+            return ""
+        return zlib.decompress(base64.b64decode(self.data)).decode("utf-8", errors="replace")
+
+
+class AduanaAeatMessage(models.Model):
+    """
+    Registro de cada petición/respuesta intercambiada con AEAT (metadatos + referencia al
+    contenido comprimido). Sustituye a los ir.attachment de log; los XML generados que
+    se reutilizan (DUA_CUSDEC_EX1.xml, *_CC511C.xml, *_CC415A.xml...) siguen como adjuntos.
+    """
+    _name = "aduana.aeat.message"
+    _description = "Mensaje AEAT archivado"
+    _order = "create_date desc, id desc"
+    _rec_name = "filename"
+
+    expediente_id = fields.Many2one("aduana.expediente", string="Expediente", index=True, ondelete="cascade")
+    bandeja_cursor_id = fields.Many2one("aduana.bandeja.cursor", string="Cursor bandeja", index=True, ondelete="cascade")
+    company_id = fields.Many2one("res.company", string="Compañía", default=lambda self: self.env.company, index=True)
+    service = fields.Char(string="Servicio", required=True, index=True)
+    direction = fields.Selection([
+        ("request", "Petición"),
+        ("response", "Respuesta"),
+    ], string="Sentido", required=True)
+    http_status = fields.Integer(string="HTTP")
+    duration_ms = fields.Integer(string="Duración (ms)")
+    endpoint = fields.Char(string="Endpoint")
+    filename = fields.Char(string="Fichero")
+    payload_id = fields.Many2one("aduana.aeat.payload", string="Contenido", required=True, ondelete="restrict")
+    sha256 = fields.Char(related="payload_id.sha256", string="SHA-256")
+    size_raw = fields.Integer(related="payload_id.size_raw", string="Tamaño (bytes)")
+    size_compressed = fields.Integer(related="payload_id.size_compressed", string="Comprimido (bytes)")
+    # Solo se descomprimen al abrir el formulario o descargar (no están en la vista lista)
+    payload_text = fields.Text(string="XML", compute="_compute_payload", store=False)
+    payload_file = fields.Binary(string="Descargar", compute="_compute_payload", store=False)
+
+    @api.depends("payload_id")
+    def _compute_payload(self):
+        for rec in self:
+            text = rec.payload_id._get_text() if rec.payload_id else ""
+            rec.payload_text = text
+            rec.payload_file = base64.b64encode(text.encode("utf-8")) if text else False
+
+    @api.model
+    def _archive(self, service, direction, xml_text, expediente=None, cursor=None, filename=None,
+                 endpoint=None, http_status=None, duration_ms=None):
+        """Archiva un XML de petición/respuesta y devuelve el aduana.aeat.message creado."""
+        payload = self.env["aduana.aeat.payload"]._store(xml_text)
+        company = (cursor.company_id if cursor else None) or self.env.company
+        return self.sudo().create({
+            "expediente_id": expediente.id if expediente else False,
+            "bandeja_cursor_id": cursor.id if cursor else False,
+            "company_id": company.id,
+            "service": service,
+            "direction": direction,
+            "http_status": http_status or 0,
+            "duration_ms": int(duration_ms or 0),
+            "endpoint": endpoint or False,
+            "filename": filename or "%s_%s.xml" % (service, direction),
+            "payload_id": payload.id,
+        })
+
+    def action_download(self):
+        self.ensure_one()
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content?model=%s&id=%s&field=payload_file&filename_field=filename&download=true"
+                   % (self._name, self.id),
+            "target": "self",
+        }
+
+    @api.model
+    def _retention_days(self, service):
+        icp = self.env["ir.config_parameter"].sudo()
+        value = icp.get_param("aduanas_transport.archive.retention_days.%s" % service)
+        if value in (None, False, ""):
+            return ARCHIVE_DEFAULT_RETENTION_DAYS.get(service, 0)
+        try:
+            return max(int(value), 0)
+        except ValueError:
+            return ARCHIVE_DEFAULT_RETENTION_DAYS.get(service, 0)
+
+    @api.model
+    def cron_purge_archive(self):
+        """
+        Elimina los mensajes caducados según la retención de su servicio, los contenidos huérfanos
+        y los PDF combinados de impresión en lote del DUA caducados.
+        """
+        Message = self.sudo()
+        self.env.cr.execute("SELECT DISTINCT service FROM aduana_aeat_message")
+        services = [row[0] for row in self.env.cr.fetchall()]
+        removed = 0
+        for service in services:
+            days = self._retention_days(service)
+            if not days:
+                continue
+            limit_date = fields.Datetime.now() - timedelta(days=days)
+            expired = Message.search([("service", "=", service), ("create_date", "<", limit_date)])
+            removed += len(expired)
+            expired.unlink()
+        self.env.cr.execute("""
+            DELETE FROM aduana_aeat_payload p
+             WHERE NOT EXISTS (SELECT 1 FROM aduana_aeat_message m WHERE m.payload_id = p.id)
+        """)
+        orphans = self.env.cr.rowcount
+        self.env["aduana.aeat.payload"].invalidate_model()
+        dua_pdfs = self.env["aduana.expediente"]._purge_dua_batch_pdfs()
+        _logger.info(
+            "Archivo AEAT: %s mensajes caducados, %s contenidos huérfanos y %s PDF de DUA en lote eliminados",
+            removed, orphans, dua_pdfs,
+        )
+        return True
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from odoo import api, fields, models, _
+
+from odoo.addons.aduanas_transport.models.aduana_expediente_declaracion import DECLARACION_POLL_STATES
+
+_logger = logging.getLogger(__name__)
+
+# Estados de expediente que esperan mensajes de la bandeja AEAT
+BANDEJA_ACTIVE_STATES = ["predeclared", "presented", "accepted", "released"]
+BANDEJA_DEFAULT_PAGE_SIZE = 50
+BANDEJA_DEFAULT_MAX_PAGES = 20
+
+
+class AduanaBandejaCursor(models.Model):
+    """
+    Cursor de lectura de la bandeja AEAT por compañía y código de bandeja.
+    Una sola pasada pagina la bandeja desde last_num y reparte los mensajes por MRN
+    (búsquedas indexadas sobre aduana.expediente.mrn y el MRN de cada declaración parcial),
+    en lugar de descargar la bandeja completa una vez por expediente.
+    """
+    _name = "aduana.bandeja.cursor"
+    _description = "Cursor Bandeja AEAT"
+    _order = "company_id, codigo_bandeja"
+
+    company_id = fields.Many2one("res.company", string="Compañía", required=True, ondelete="cascade", index=True)
+    codigo_bandeja = fields.Selection([
+        ("EXPORAES", "EXPORAES (Exportación)"),
+        ("IMPORAES", "IMPORAES (Importación)"),
+    ], string="Bandeja", required=True)
+    last_num = fields.Integer(string="Último mensaje leído", default=0)
+    last_poll_date = fields.Datetime(string="Última consulta", readonly=True)
+    last_message_count = fields.Integer(string="Mensajes última consulta", readonly=True)
+    last_routed_count = fields.Integer(string="Mensajes asignados", readonly=True)
+    last_unrouted_count = fields.Integer(string="Mensajes sin expediente", readonly=True)
+    last_error = fields.Text(string="Último error", readonly=True)
+
+    _sql_constraints = [
+        ("company_bandeja_uniq", "unique(company_id, codigo_bandeja)",
+         "Solo puede existir un cursor por compañía y bandeja."),
+    ]
+
+    @api.model
+    def _direction_for_codigo(self, codigo):
+        return "export" if codigo == "EXPORAES" else "import"
+
+    @api.model
+    def _get_cursor(self, company, codigo):
+        """Devuelve (o crea) el cursor de la compañía/bandeja."""
+        cursor = self.sudo().search([("company_id", "=", company.id), ("codigo_bandeja", "=", codigo)], limit=1)
+        if cursor:
+            return cursor
+        # Primer uso: arrancar desde el menor número procesado por los expedientes activos,
+        # para no perder mensajes que los expedientes aún no habían leído.
+        Expediente = self.env["aduana.expediente"].sudo()
+        domain = [
+            ("state", "in", BANDEJA_ACTIVE_STATES),
+            ("direction", "=", self._direction_for_codigo(codigo)),
+        ]
+        nums = Expediente.search(domain).mapped("bandeja_last_num")
+        return self.sudo().create({
+            "company_id": company.id,
+            "codigo_bandeja": codigo,
+            "last_num": min(nums) if nums else 0,
+        })
+
+    @api.model
+    def _bandeja_limits(self):
+        icp = self.env["ir.config_parameter"].sudo()
+        try:
+            page_size = int(icp.get_param("aduanas_transport.bandeja.page_size") or BANDEJA_DEFAULT_PAGE_SIZE)
+        except ValueError:
+            page_size = BANDEJA_DEFAULT_PAGE_SIZE
+        try:
+            max_pages = int(icp.get_param("aduanas_transport.bandeja.max_pages") or BANDEJA_DEFAULT_MAX_PAGES)
+        except ValueError:
+            max_pages = BANDEJA_DEFAULT_MAX_PAGES
+        return max(page_size, 1), max(max_pages, 1)
+
+    def _route_messages(self, messages, page_last_num):
+        """
+        Reparte los mensajes de una página por MRN: una búsqueda indexada de expedientes y otra
+        de declaraciones parciales (cuyo MRN tiene prioridad). Devuelve (asignados, sin_expediente).
+        """
+        self.ensure_one()
+        mrns = {m.get("mrn") for m in messages if m.get("mrn")}
+        if not mrns:
+            return 0, len(messages)
+        direction = self._direction_for_codigo(self.codigo_bandeja)
+        expedientes = self.env["aduana.expediente"].search([
+            ("mrn", "in", list(mrns)),
+            ("direction", "=", direction),
+            ("state", "in", BANDEJA_ACTIVE_STATES),
+        ])
+        by_mrn = {exp.mrn: exp for exp in expedientes}
+        parts = self.env["aduana.expediente.declaracion"].search([
+            ("mrn", "in", list(mrns)),
+            ("state", "in", DECLARACION_POLL_STATES),
+            ("expediente_id.direction", "=", direction),
+        ])
+        by_mrn.update({part.mrn: part.expediente_id for part in parts})
+        routed = unrouted = 0
+        touched = self.env["aduana.expediente"]
+        for msg in messages:
+            exp = by_mrn.get(msg.get("mrn"))
+            if not exp:
+                unrouted += 1
+                continue
+            # El expediente ya había leído esta página con el sondeo individual
+            if page_last_num and exp.bandeja_last_num >= page_last_num:
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    exp._route_bandeja_message(msg)
+                routed += 1
+                touched |= exp
+            except Exception as e:
+                _logger.exception("Bandeja %s: error aplicando mensaje a %s: %s", self.codigo_bandeja, exp.name, e)
+        if touched:
+            now = fields.Datetime.now()
+            for exp in touched:
+                exp.write({
+                    "last_response_date": now,
+                    "bandeja_last_num": max(exp.bandeja_last_num, page_last_num or 0),
+                })
+            # Un mensaje recibido equivale a una consulta: reprogramar según el backoff
+            touched._schedule_aeat_poll()
+        return routed, unrouted
+
+    def action_poll(self):
+        """Pagina la bandeja desde last_num hasta vaciarla (o max_pages) y reparte los mensajes."""
+        parser = self.env["aduanas.xml.parser"]
+        Archive = self.env["aduana.aeat.message"]
+        page_size, max_pages = self._bandeja_limits()
+        for cursor in self:
+            client = self.env["aduanas.aeat.client"].with_company(cursor.company_id)
+            endpoint = cursor.company_id._get_aeat_param("aeat_endpoint_bandeja")
+            total = routed = unrouted = 0
+            errors = []
+            for _page in range(max_pages):
+                xml = self.env["ir.ui.view"]._render_template(
+                    "aduanas_transport.tpl_bandeja_req",
+                    {"codigo_bandeja": cursor.codigo_bandeja, "ultimo": cursor.last_num, "maxm": page_size},
+                )
+                start = time.monotonic()
+                status_code, resp = client.send_xml(endpoint, xml, service="BANDEJA")
+                # Archivo comprimido y deduplicado (las páginas vacías comparten contenido)
+                Archive._archive(
+                    "BANDEJA", "response", resp or "", cursor=cursor,
+                    filename="BANDEJA_%s_response_%s.xml" % (cursor.codigo_bandeja, cursor.last_num + 1),
+                    endpoint=endpoint, http_status=status_code, duration_ms=(time.monotonic() - start) * 1000.0,
+                )
+                if status_code != 200:
+                    errors.append(_("Bandeja AEAT respondió HTTP %s.") % status_code)
+                    break
+                bandeja = parser.parse_bandeja_response(resp or "")
+                messages = bandeja.get("messages") or []
+                page_last = bandeja.get("last_message_num") or 0
+                errors.extend(bandeja.get("errors") or [])
+                if messages and not page_last:
+                    # Sin número de mensaje el cursor no avanzaría y se reaplicarían en cada consulta
+                    errors.append(_(
+                        "Bandeja %s: %s mensajes sin NumUltimoMensaje ni NumMensaje desde %s; página no procesada."
+                    ) % (cursor.codigo_bandeja, len(messages), cursor.last_num))
+                    break
+                page_routed, page_unrouted = cursor._route_messages(messages, page_last)
+                total += len(messages)
+                routed += page_routed
+                unrouted += page_unrouted
+                advanced = page_last > cursor.last_num
+                if advanced:
+                    cursor.last_num = page_last
+                if not advanced or len(messages) < page_size:
+                    break
+            cursor.write({
+                "last_poll_date": fields.Datetime.now(),
+                "last_message_count": total,
+                "last_routed_count": routed,
+                "last_unrouted_count": unrouted,
+                "last_error": "\n".join(errors) or False,
+            })
+            _logger.info(
+                "Bandeja %s (compañía %s): %s mensajes, %s asignados, %s sin expediente, cursor=%s",
+                cursor.codigo_bandeja, cursor.company_id.name, total, routed, unrouted, cursor.last_num,
+            )
+        return True
+
+    @api.model
+    def _companies_to_poll(self):
+        """Una compañía por certificado distinto (las que comparten el global se consultan una vez)."""
+        seen = set()
+        companies = self.env["res.company"]
+        for company in self.env["res.company"].sudo().search([]):
+            cert_key = company._get_aeat_param("aeat_cert_attachment_id") or "0"
+            if cert_key in seen:
+                continue
+            seen.add(cert_key)
+            companies |= company
+        return companies
+
+    @api.model
+    def cron_poll_all(self):
+        """Lee cada bandeja solo si algún expediente de esa dirección tiene la consulta vencida."""
+        Expediente = self.env["aduana.expediente"].sudo()
+        due_domain = Expediente._aeat_poll_due_domain()
+        for codigo in ("EXPORAES", "IMPORAES"):
+            direction = self._direction_for_codigo(codigo)
+            if not Expediente.search_count(due_domain + [("direction", "=", direction)]):
+                continue
+            for company in self._companies_to_poll():
+                cursor = self._get_cursor(company, codigo)
+                try:
+                    with self.env.cr.savepoint():
+                        cursor.action_poll()
+                except Exception as e:
+                    _logger.exception("Error al consultar bandeja %s (%s): %s", codigo, company.name, e)
+                    cursor.last_error = str(e)
+        return True
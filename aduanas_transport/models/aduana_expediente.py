@@ -1,14 +1,87 @@
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
 from odoo.tools import html_escape
+from odoo.tools.pdf import merge_pdf
 import base64
+import hashlib
 import logging
 import re
 import time
 import xml.etree.ElementTree as ET
+from datetime import timedelta
 from xml.sax.saxutils import escape as xml_escape
+
+from odoo.addons.aduanas_transport.models.aduana_bandeja_cursor import BANDEJA_ACTIVE_STATES
+from odoo.addons.aduanas_transport.models.aduana_expediente_declaracion import (
+    DECLARACION_POLL_STATES,
+    DECLARACION_SENT_STATES,
+)
+from odoo.addons.aduanas_transport.services.xml_fragments import (
+    ITEMS_MARKER,
+    _party_values,
+    compile_fragment,
+    memoize_partner_fragment,
+    stream_document,
+)
 _logger = logging.getLogger(__name__)
 
+# Planificador de consultas AEAT por expediente:
+# (horas desde el último cambio de estado, intervalo en minutos); None = resto
+AEAT_POLL_BACKOFF = [
+    (1, 3),
+    (6, 10),
+    (24, 30),
+    (72, 120),
+    (None, 720),
+]
+# Circuito AES: rojo/naranja implican reconocimiento y la respuesta tarda más
+AEAT_POLL_CIRCUIT_FACTOR = {"V": 1.0, "N": 2.0, "R": 4.0}
+AEAT_POLL_DEFAULT_LIMIT = 50
+# Avance del expediente: el estado agregado de las declaraciones parciales no lo hace retroceder
+EXPEDIENTE_STATE_ORDER = ["draft", "predeclared", "presented", "accepted", "released", "exited", "closed"]
+
+# Versión de cada generador XML: incrementarla al cambiar su salida invalida las huellas guardadas
+XML_BUILDER_VERSIONS = {
+    "CUSDEC_EX1": 1,
+    "CC515C": 1,
+    "CC511C": 1,
+    "CC415A": 1,
+    "IE615": 1,
+    "G4_DEC": 1,
+    "DUA_PDF": 1,
+}
+# Máximo de partidas por declaración (XSD); por encima el expediente se divide en varias
+# declaraciones enlazadas. Se puede bajar con aduanas_transport.max_goods_items.<servicio>.
+XML_MAX_GOODS_ITEMS = {
+    "CC415A": 999,
+    "CC515C": 999,
+    "G4_DEC": 9999,
+}
+# PDF del DUA: expedientes por llamada a wkhtmltopdf en la impresión en lote
+DUA_PDF_BATCH_SIZE = 50
+# Horas que se conserva el PDF combinado de una impresión en lote
+DUA_PDF_MERGED_KEEP_HOURS = 24
+# Campos que cambian con el seguimiento del envío y no son entrada de ningún XML
+XML_FINGERPRINT_SKIP_FIELDS = {
+    "create_date", "create_uid", "write_date", "write_uid", "message_main_attachment_id",
+    "state", "error_message", "last_response_date", "bandeja_last_num",
+    "aeat_state_change_date", "aeat_last_poll_date", "aeat_next_poll_date",
+    "incidencias_count", "incidencias_pendientes_count", "msoft_ultima_sincronizacion",
+    "factura_estado_procesamiento", "factura_mensaje_error", "factura_en_cola_at",
+    "request_xml", "response_xml", "request_fingerprint",
+}
+# Campos de la compañía y de los interlocutores que leen los generadores (además de _party_values)
+XML_FINGERPRINT_COMPANY_FIELDS = ("name", "vat", "phone", "email", "street", "street2", "zip", "city")
+XML_FINGERPRINT_PARTY_FIELDS = ("vat", "phone", "mobile")
+# Claves de la instantánea AEAT y prefijos de parámetros que leen los generadores;
+# el resto (ocr.*, bandeja.*, archive.*...) no invalida la huella
+XML_FINGERPRINT_SETTINGS = (
+    "endpoints", "nif_firmante", "is_preproduction", "preprod_test_office", "preprod_import_office",
+    "preprod_allow_real_office", "preprod_allow_real_import_office", "preprod_location_authorisation",
+    "imp_allow_foreign_seller_eori",
+)
+XML_FINGERPRINT_PARAM_PREFIXES = ("aduanas_transport.g4_", "aduanas_transport.max_goods_items.")
+
 # Queue job support (opcional)
 try:
     from odoo.addons.queue_job.job import job
@@ -182,6 +255,14 @@ class AduanaExpediente(models.Model):
     lrn = fields.Char(string="LRN")
     mrn = fields.Char(string="MRN", index=True)
     bandeja_last_num = fields.Integer(string="Último mensaje bandeja procesado", default=0)
+    aeat_message_ids = fields.One2many("aduana.aeat.message", "expediente_id", string="Mensajes AEAT")
+    aeat_state_change_date = fields.Datetime(string="Último cambio de estado", readonly=True, copy=False)
+    aeat_last_poll_date = fields.Datetime(string="Última consulta AEAT", readonly=True, copy=False)
+    aeat_next_poll_date = fields.Datetime(
+        string="Próxima consulta AEAT", readonly=True, copy=False, index=True,
+        help="Calculada según el tiempo desde el último cambio de estado y el circuito AES. "
+             "Vacía cuando el expediente ya no necesita seguimiento (salida confirmada, cerrado...).",
+    )
     
     # Campos adicionales
     fecha_salida_real = fields.Datetime(string="Fecha Salida Real")
@@ -251,6 +332,12 @@ class AduanaExpediente(models.Model):
         "expediente_id",
         string="Presentaciones G4",
     )
+    declaracion_ids = fields.One2many(
+        "aduana.expediente.declaracion",
+        "expediente_id",
+        string="Declaraciones parciales",
+        help="Declaraciones en que se divide el expediente cuando supera el máximo de partidas por declaración.",
+    )
     g3_presentation_ids = fields.One2many(
         "aeat.import.g3.presentation",
         "expediente_id",
@@ -442,7 +529,13 @@ class AduanaExpediente(models.Model):
             vals.setdefault("ddt_type", "none")
             vals.setdefault("mrn_ddt", False)
 
+        state_changed = self.filtered(lambda r: r.state != vals["state"]) if "state" in vals else self.browse()
         result = super().write(vals)
+        if state_changed:
+            state_changed.write({"aeat_state_change_date": fields.Datetime.now()})
+        to_schedule = self if "aes_circuito" in vals else state_changed
+        if to_schedule:
+            to_schedule._schedule_aeat_poll()
         if any(k in vals for k in ("requiere_ddt", "mrn_ddt", "ddt_type", "import_previous_document_ref")):
             self._sync_ddt_legacy_fields()
         if 'factura_pdf' in vals or 'factura_pdf_filename' in vals:
@@ -809,6 +902,22 @@ class AduanaExpediente(models.Model):
             subtype_xmlid="mail.mt_note",
         )
 
+    def action_generate_g4_batch(self):
+        """Crea (o reutiliza) el G4 de los expedientes de importación seleccionados y genera su XML en lote."""
+        imports = self.filtered(lambda r: r.direction == "import")
+        storages = self.env["aeat.import.g4.temporary.storage"].create_from_expedientes(imports)
+        storages.action_generar_xml_g4()
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("G4 en lote"),
+                "message": _("XML G4 generado para %s de %s expedientes seleccionados.") % (len(storages), len(self)),
+                "type": "success" if len(storages) == len(self) else "warning",
+                "next": {"type": "ir.actions.client", "tag": "reload"},
+            },
+        }
+
     def action_abrir_g4_ddt(self):
         """Abre el registro G4 (G4Dec) vinculado al expediente de importación."""
         self.ensure_one()
@@ -827,9 +936,9 @@ class AduanaExpediente(models.Model):
     def _import_checklist_items(self):
         """Lista de comprobaciones del flujo de importación H1 para el operario."""
         self.ensure_one()
-        icp = self.env["ir.config_parameter"].sudo()
-        cert_ok = bool(icp.get_param("aduanas_transport.cert_attachment_id"))
-        endpoint_ok = bool((icp.get_param("aduanas_transport.endpoint.imp_decl") or "").strip())
+        aeat = self._aeat_settings()
+        cert_ok = bool(aeat["cert_attachment_id"])
+        endpoint_ok = bool((aeat["params"].get("aduanas_transport.endpoint.imp_decl") or "").strip())
         ref = self._get_mrn_ddt().upper().replace(" ", "")
         n337_ok = True
         if self.requiere_ddt:
@@ -1097,54 +1206,347 @@ class AduanaExpediente(models.Model):
             else:
                 rec.incoterm_info = False
 
+    def _aeat_settings(self):
+        """Instantánea AEAT de la compañía actual (cacheada en el registro, ver res.company)."""
+        return self.env.company._get_aeat_settings()
+
     def _get_settings(self):
-        icp = self.env["ir.config_parameter"].sudo()
-        def _endpoint_imp_decl():
-            endpoint = icp.get_param("aduanas_transport.endpoint.imp_decl") or "https://prewww1.aeat.es/wlpl/ADIP-JDIT/ws/cci/CC415AV1SOAP"
-            if "ADIM-JDIT/ws/imp/DeclaracionSOAP" in endpoint:
-                return "https://prewww1.aeat.es/wlpl/ADIP-JDIT/ws/cci/CC415AV1SOAP"
-            return endpoint
+        return self._aeat_settings()["endpoints"]
+
+    def _attach_xml(self, filename, xml_text, mimetype="application/xml"):
+        self.env["ir.attachment"].create([{
+            "name": filename,
+            "res_model": rec._name,
+            "res_id": rec.id,
+            "type": "binary",
+            "mimetype": mimetype,
+            "datas": base64.b64encode((xml_text or "").encode("utf-8"))
+        } for rec in self])
+
+    @api.model
+    def _xml_fingerprint_values(self, records):
+        """Valores almacenados (escalares y many2one) de los registros, en orden estable."""
+        names = [
+            name for name, field in sorted(records._fields.items())
+            if field.store and name not in XML_FINGERPRINT_SKIP_FIELDS
+            and field.type not in ("binary", "one2many", "many2many", "html")
+        ]
+        values = []
+        for record in records:
+            row = [record.id]
+            for name in names:
+                value = record[name]
+                row.append(value.id if isinstance(value, models.BaseModel) else value)
+            values.append(tuple(row))
+        return values
+
+    def _xml_fingerprint(self, kind, extra=None, records=None):
+        """
+        Huella SHA-256 de las entradas de un XML generado: cabecera, líneas, valores de
+        interlocutores y compañía que leen los generadores, la parte de la configuración AEAT
+        que usan (XML_FINGERPRINT_SETTINGS) y la versión del generador.
+        No incluye la hora: un XML reutilizado conserva su preparationDateAndTime original.
+        """
+        self.ensure_one()
+        digest = hashlib.sha256()
+
+        def _feed(value):
+            digest.update(repr(value).encode("utf-8"))
+            digest.update(b"\x00")
+
+        _feed((kind, XML_BUILDER_VERSIONS.get(kind, 0), extra))
+        _feed(self._xml_fingerprint_values(self))
+        _feed(self._xml_fingerprint_values(self.line_ids))
+        if records is not None:
+            _feed(self._xml_fingerprint_values(records))
+        company = self.env.company
+        partners = company.partner_id
+        for name, field in self._fields.items():
+            if field.type == "many2one" and field.comodel_name == "res.partner" and field.store:
+                partners |= self[name]
+        _feed((company.id, company.country_id.code or "") + tuple(
+            company[name] or "" for name in XML_FINGERPRINT_COMPANY_FIELDS
+        ))
+        _feed(sorted(
+            (p.id,) + _party_values(p) + tuple(p[name] or "" for name in XML_FINGERPRINT_PARTY_FIELDS)
+            for p in partners
+        ))
+        aeat = self._aeat_settings()
+        for key in XML_FINGERPRINT_SETTINGS:
+            value = aeat[key]
+            _feed((key, sorted(value.items()) if hasattr(value, "items") else value))
+        _feed(sorted(
+            (key, value) for key, value in aeat["params"].items()
+            if key.startswith(XML_FINGERPRINT_PARAM_PREFIXES)
+        ))
+        return digest.hexdigest()
+
+    def _get_xml_artefact(self, kind, filename, build, lookup=None, extra=None, for_send=False):
+        """
+        Devuelve (adjunto, xml) del artefacto generado, reutilizando el adjunto guardado si su
+        huella coincide; si no, ejecuta build() y reescribe el adjunto. lookup es el fragmento
+        de nombre con el que se busca el adjunto (o el propio adjunto). Con for_send=True no se
+        reutiliza un XML ya enviado, para no repetir su messageIdentification.
+        """
+        self.ensure_one()
+        fingerprint = self._xml_fingerprint(kind, extra=extra)
+        if isinstance(lookup, models.BaseModel):
+            att = lookup
+        else:
+            att = self._get_xml_attachment(lookup or filename)
+        if (
+            att and att.raw and att.aduana_xml_fingerprint == fingerprint
+            and not (for_send and att.aduana_xml_sent)
+        ):
+            return att, att.raw.decode("utf-8")
+        xml = build()
+        vals = self._xml_artefact_vals(filename, xml, fingerprint)
+        if att:
+            att.write(vals)
+        else:
+            att = self.env["ir.attachment"].create(vals)
+        return att, xml
+
+    def _prefetch_declaration_data(self):
+        """
+        Precarga lo que leen los generadores XML para todo el lote: cabeceras, líneas,
+        declaraciones parciales, interlocutores con su país y la instantánea AEAT. Cada
+        mapped() sobre el lote se resuelve en una sola consulta (prefetch del ORM), en lugar
+        de una por expediente.
+        """
+        company = self.env.company
+        self.mapped("name")
+        lines = self.mapped("line_ids")
+        lines.mapped("item_number")
+        self.mapped("declaracion_ids").mapped("state")
+        partners = self.mapped("remitente") | self.mapped("consignatario") | company.partner_id
+        partners.mapped("country_id.code")
+        company._get_aeat_settings()
+        return True
+
+    def _get_xml_artefacts_batch(self, kind, filename, build, lookup, errors=None):
+        """
+        _get_xml_artefact para un lote: una búsqueda de adjuntos para todos los expedientes,
+        build(rec) solo si la huella cambió y un único create con los adjuntos nuevos.
+        filename(rec) da el nombre del adjunto y lookup el fragmento con el que se busca.
+        Con errors (dict) los UserError de un expediente se anotan ahí y no cortan el lote.
+        Devuelve {id del expediente: (adjunto, xml)}.
+        """
+        Attachment = self.env["ir.attachment"]
+        existing = {}
+        if self:
+            for att in Attachment.search([
+                ("res_model", "=", self._name),
+                ("res_id", "in", self.ids),
+                ("name", "ilike", lookup),
+            ]):
+                existing.setdefault(att.res_id, att)
+        result = {}
+        to_create = []
+        created_for = []
+        for rec in self:
+            fingerprint = rec._xml_fingerprint(kind)
+            att = existing.get(rec.id)
+            if att and att.aduana_xml_fingerprint == fingerprint and att.raw:
+                result[rec.id] = (att, att.raw.decode("utf-8"))
+                continue
+            try:
+                xml = build(rec)
+            except UserError as e:
+                if errors is None:
+                    raise
+                errors[rec.id] = str(e)
+                continue
+            vals = rec._xml_artefact_vals(filename(rec), xml, fingerprint)
+            if att:
+                att.write(vals)
+                result[rec.id] = (att, xml)
+            else:
+                to_create.append(vals)
+                created_for.append((rec.id, xml))
+        for att, (rec_id, xml) in zip(Attachment.create(to_create), created_for):
+            result[rec_id] = (att, xml)
+        return result
+
+    def _xml_artefact_vals(self, filename, xml, fingerprint):
+        self.ensure_one()
         return {
-            "aeat_endpoint_cc515c": icp.get_param("aduanas_transport.endpoint.cc515c") or "https://prewww1.aeat.es/wlpl/ADEX-JDIT/ws/aes/CC515CV1SOAP",
-            "aeat_endpoint_cc511c": icp.get_param("aduanas_transport.endpoint.cc511c") or "https://prewww1.aeat.es/wlpl/ADEX-JDIT/ws/aes/CC511CV1SOAP",
-            "aeat_endpoint_ccaesc": icp.get_param("aduanas_transport.endpoint.ccaesc") or "https://prewww1.aeat.es/wlpl/ADEX-JDIT/ws/aes/CCAESCV1SOAP",
-            "aeat_endpoint_cc507c": icp.get_param("aduanas_transport.endpoint.cc507c") or "https://prewww1.aeat.es/wlpl/ADEX-JDIT/ws/aes/CC507CV1SOAP",
-            "aeat_endpoint_imp_decl": _endpoint_imp_decl(),
-            "aeat_endpoint_imp_query": icp.get_param("aduanas_transport.endpoint.imp_query") or "https://prewww1.aeat.es/wlpl/ADIP-JDIT/ws/cci/ConsultaImportacionV3SOAP",
-            "aeat_endpoint_bandeja": icp.get_param("aduanas_transport.endpoint.bandeja") or "https://prewww1.aeat.es/wlpl/ADHT-BAND/ws/det/DetalleV5SOAP",
-            "aeat_endpoint_ie615": icp.get_param("aduanas_transport.endpoint.ie615") or "https://prewww1.aeat.es/wlpl/ADRX-JDIT/ws/IE615V5SOAP",
-            "aeat_endpoint_g4_dec": icp.get_param("aduanas_transport.endpoint.g4_dec")
-            or "https://prewww1.aeat.es/wlpl/ADDS-JDIT/ws/G4DecV1SOAP",
+            "name": filename,
+            "res_model": self._name,
+            "res_id": self.id,
+            "type": "binary",
+            "mimetype": "application/xml",
+            "datas": base64.b64encode((xml or "").encode("utf-8")),
+            "aduana_xml_fingerprint": fingerprint,
+            "aduana_xml_sent": False,
         }
 
-    def _attach_xml(self, filename, xml_text, mimetype="application/xml"):
+    def _mark_xml_artefact_sent(self, lookup):
+        """Marca el artefacto como enviado: el siguiente envío lo regenerará."""
         for rec in self:
-            self.env["ir.attachment"].create({
-                "name": filename,
-                "res_model": rec._name,
-                "res_id": rec.id,
-                "type": "binary",
-                "mimetype": mimetype,
-                "datas": base64.b64encode((xml_text or "").encode("utf-8"))
+            att = rec._get_xml_attachment(lookup)
+            if att:
+                att.aduana_xml_sent = True
+
+    # ===== Declaraciones parciales (expedientes por encima del máximo de partidas) =====
+    def _max_goods_items(self, service):
+        """Máximo de partidas por declaración: XSD o aduanas_transport.max_goods_items.<servicio> si es menor."""
+        limit = XML_MAX_GOODS_ITEMS[service]
+        value = self._aeat_settings()["params"].get("aduanas_transport.max_goods_items.%s" % service.lower())
+        try:
+            return max(1, min(int(value), limit)) if value else limit
+        except ValueError:
+            return limit
+
+    def _sorted_goods_lines(self):
+        self.ensure_one()
+        return self.line_ids.sorted(key=lambda l: l.item_number or l.id or 0)
+
+    def _declaration_goods_lines(self, service, part=None):
+        """Partidas de la declaración: las de part o todas, si caben en una sola declaración."""
+        self.ensure_one()
+        if part:
+            return part.line_ids.sorted(key=lambda l: l.item_number or l.id or 0)
+        lines = self._sorted_goods_lines()
+        limit = self._max_goods_items(service)
+        if len(lines) > limit:
+            raise UserError(_(
+                "El expediente %(name)s tiene %(count)s partidas y %(service)s admite %(limit)s por declaración. "
+                "Genere la declaración para dividirlo en declaraciones parciales (pestaña Declaraciones)."
+            ) % {"name": self.name, "count": len(lines), "service": service, "limit": limit})
+        return lines
+
+    def _split_declarations(self, service):
+        """
+        Divide el expediente en declaraciones parciales de service si sus partidas superan el
+        máximo. Reutiliza las existentes si el reparto no ha cambiado; si cambió, sustituye las
+        no presentadas (y falla si alguna ya se presentó). Devuelve las declaraciones parciales,
+        vacío si el expediente cabe en una sola declaración.
+        """
+        self.ensure_one()
+        Declaracion = self.env["aduana.expediente.declaracion"]
+        existing = self.declaracion_ids.filtered(lambda d: d.service == service)
+        lines = self._sorted_goods_lines()
+        limit = self._max_goods_items(service)
+        if len(lines) <= limit:
+            if existing.filtered(lambda d: d.state in DECLARACION_SENT_STATES):
+                return existing
+            existing.unlink()
+            return Declaracion
+        chunks = [lines[i:i + limit] for i in range(0, len(lines), limit)]
+        if [d.line_ids.ids for d in existing.sorted("part")] == [c.ids for c in chunks]:
+            return existing.sorted("part")
+        if existing.filtered(lambda d: d.state in DECLARACION_SENT_STATES):
+            raise UserError(_(
+                "Las partidas del expediente %s han cambiado y ya hay declaraciones parciales %s presentadas."
+            ) % (self.name, service))
+        existing.unlink()
+        base_lrn = (self.lrn or self.name or ("EXP%s" % (self.id or ""))).replace(" ", "")
+        vals_list = []
+        for index, chunk in enumerate(chunks, 1):
+            suffix = "-%d" % index
+            vals_list.append({
+                "expediente_id": self.id,
+                "service": service,
+                "part": index,
+                "part_count": len(chunks),
+                "lrn": base_lrn[:22 - len(suffix)] + suffix,
+                "line_ids": [(6, 0, chunk.ids)],
             })
+        parts = Declaracion.create(vals_list)
+        self.with_context(mail_notrack=True).message_post(
+            body=_("El expediente supera %(limit)s partidas por declaración %(service)s: se divide en %(count)s declaraciones (%(lrns)s).")
+            % {"limit": limit, "service": service, "count": len(parts), "lrns": ", ".join(parts.mapped("lrn"))},
+            subtype_xmlid="mail.mt_note",
+        )
+        return parts
+
+    def _generate_split_declarations(self, service, errors=None):
+        """Divide y genera las declaraciones parciales de service; devuelve los expedientes divididos."""
+        split = self.browse()
+        for rec in self:
+            try:
+                with self.env.cr.savepoint():
+                    parts = rec._split_declarations(service)
+                    if parts:
+                        parts._generate_xml()
+                if parts:
+                    split |= rec
+            except UserError as e:
+                if errors is None:
+                    raise
+                errors[rec.id] = str(e)
+                split |= rec
+        return split
+
+    def _sync_declaration_state(self):
+        """
+        Estado y MRN del expediente a partir de sus declaraciones parciales: aceptado, con levante
+        o con salida cuando lo están todas. Salvo para salir de error, el estado no retrocede.
+        """
+        for rec in self:
+            parts = rec.declaracion_ids.sorted("part")
+            if not parts:
+                continue
+            states = set(parts.mapped("state"))
+            vals = {}
+            if "error" in states:
+                vals["state"] = "error"
+                vals["error_message"] = "\n".join(
+                    "%s: %s" % (p.lrn, p.error_message) for p in parts if p.state == "error"
+                )
+            else:
+                if states == {"exited"}:
+                    state = "exited"
+                elif states <= {"released", "exited"}:
+                    state = "released"
+                elif states <= {"accepted", "released", "exited"}:
+                    state = "accepted"
+                elif states & set(DECLARACION_SENT_STATES):
+                    state = "presented"
+                else:
+                    state = False
+                if state and (
+                    rec.state == "error"
+                    or EXPEDIENTE_STATE_ORDER.index(state) > EXPEDIENTE_STATE_ORDER.index(rec.state or "draft")
+                ):
+                    vals["state"] = state
+                    if state != "presented":
+                        vals["error_message"] = False
+                    if state == "exited" and rec.direction == "export":
+                        vals["iva_exportacion_exento"] = True
+            first_mrn = parts.filtered("mrn")[:1].mrn
+            if first_mrn and not rec.mrn:
+                vals["mrn"] = first_mrn
+            if vals:
+                rec.write(vals)
+
+    def _archive_aeat_xml(self, service, direction, xml_text, filename=None, endpoint=None,
+                          http_status=None, duration_ms=None):
+        """
+        Registra una petición/respuesta AEAT en el archivo comprimido (aduana.aeat.message)
+        en lugar de crear un ir.attachment por envío. Devuelve los mensajes creados.
+        """
+        Message = self.env["aduana.aeat.message"]
+        messages = Message
+        for rec in self:
+            messages |= Message._archive(
+                service, direction, xml_text or "", expediente=rec, filename=filename,
+                endpoint=endpoint, http_status=http_status, duration_ms=duration_ms,
+            )
+        return messages
 
     _CHATTER_XML_PREVIEW_MAX = 32000
 
     def _post_chatter_soap_xml(
-        self, service, endpoint, xml_text, filename=None, title=None, extra_html=None
+        self, service, endpoint, xml_text, filename=None, title=None, extra_html=None,
+        direction="request", archived=None,
     ):
-        """Publica en el chatter un XML SOAP (vista previa + adjunto descargable)."""
+        """Publica en el chatter un XML SOAP (vista previa + enlace de descarga del archivo AEAT)."""
         self.ensure_one()
         xml_text = xml_text or ""
-        filename = filename or "%s_%s_request.xml" % (self.name or "EXP", service)
-        attachment = self.env["ir.attachment"].create({
-            "name": filename,
-            "res_model": self._name,
-            "res_id": self.id,
-            "type": "binary",
-            "mimetype": "application/xml",
-            "datas": base64.b64encode(xml_text.encode("utf-8")),
-        })
+        filename = filename or "%s_%s_%s.xml" % (self.name or "EXP", service, direction)
+        archived = archived or self._archive_aeat_xml(service, direction, xml_text, filename=filename, endpoint=endpoint)
         preview = xml_text
         truncated = False
         if len(preview) > self._CHATTER_XML_PREVIEW_MAX:
@@ -1160,13 +1562,17 @@ class AduanaExpediente(models.Model):
         if truncated:
             truncate_note = (
                 "<p><em>%s</em></p>"
-                % html_escape(_("Vista previa recortada; XML completo en el adjunto."))
+                % html_escape(_("Vista previa recortada; XML completo en el enlace de descarga."))
             )
         extra_block = extra_html or ""
+        download_block = '<p><a href="%s" target="_blank">%s</a></p>' % (
+            html_escape(archived.action_download()["url"]),
+            html_escape(archived.filename or filename),
+        )
         body = (
             "<p><strong>%s</strong> — %s</p>%s%s"
             '<pre style="white-space:pre-wrap;word-break:break-all;'
-            'max-height:480px;overflow:auto;font-size:11px;">%s</pre>%s'
+            'max-height:480px;overflow:auto;font-size:11px;">%s</pre>%s%s'
         ) % (
             html_escape(service),
             html_escape(title or _("Petición enviada a AEAT")),
@@ -1174,13 +1580,13 @@ class AduanaExpediente(models.Model):
             extra_block,
             html_escape(preview),
             truncate_note,
+            download_block,
         )
         self.with_context(mail_notrack=True).message_post(
             body=body,
-            attachment_ids=[attachment.id],
             subtype_xmlid="mail.mt_note",
         )
-        return attachment
+        return archived
 
     def _attach_pdf(self, filename, pdf_data):
         """Adjunta un PDF como documento al expediente"""
@@ -1215,8 +1621,7 @@ class AduanaExpediente(models.Model):
     def _get_aeat_message_sender(self):
         """Identificador del firmante para cabecera MESSAGE (sin prefijo ES en los ejemplos AES)."""
         self.ensure_one()
-        icp = self.env["ir.config_parameter"].sudo()
-        forced = icp.get_param("aduanas_transport.aeat_nif_firmante")
+        forced = self._aeat_settings()["nif_firmante"]
         candidate = forced or (self.env.company.vat or "") or (self.remitente and self.remitente.vat) or ""
         sender = self._nif_core(candidate)
         if not sender:
@@ -1243,31 +1648,15 @@ class AduanaExpediente(models.Model):
         return "ES%s" % raw_office[:6].rjust(6, "0")
 
     def _aeat_is_preproduction(self, endpoint_url=None):
-        icp = self.env["ir.config_parameter"].sudo()
         if endpoint_url:
             return "prewww" in endpoint_url.lower()
-        urls = [
-            icp.get_param("aduanas_transport.endpoint.cc515c") or "https://prewww1.aeat.es/wlpl/ADEX-JDIT/ws/aes/CC515CV1SOAP",
-            icp.get_param("aduanas_transport.endpoint.imp_decl") or "https://prewww1.aeat.es/wlpl/ADIP-JDIT/ws/cci/CC415AV1SOAP",
-            icp.get_param("aduanas_transport.endpoint.imp_query") or "https://prewww1.aeat.es/wlpl/ADIP-JDIT/ws/cci/ConsultaImportacionV3SOAP",
-        ]
-        return any("prewww" in url.lower() for url in urls)
+        return self._aeat_settings()["is_preproduction"]
 
     def _aeat_preprod_test_office(self):
-        return (
-            self.env["ir.config_parameter"].sudo().get_param(
-                "aduanas_transport.aeat_preprod_test_office"
-            )
-            or "ES000101"
-        ).strip().upper()
+        return self._aeat_settings()["preprod_test_office"]
 
     def _aeat_preprod_import_office(self):
-        return (
-            self.env["ir.config_parameter"].sudo().get_param(
-                "aduanas_transport.aeat_preprod_import_office"
-            )
-            or self._aeat_preprod_test_office()
-        ).strip().upper()
+        return self._aeat_settings()["preprod_import_office"]
 
     def _get_cc415a_office_code(self):
         """Oficina H1 para CC415A; en preproducción usa oficina de prueba AEAT."""
@@ -1276,12 +1665,7 @@ class AduanaExpediente(models.Model):
         office = user_office
         office_note = ""
         if self._aeat_is_preproduction():
-            allow_real = (
-                self.env["ir.config_parameter"].sudo().get_param(
-                    "aduanas_transport.preprod_allow_real_import_office"
-                )
-                or ""
-            ).strip().lower() in ("1", "true", "yes", "si", "sí")
+            allow_real = self._aeat_settings()["preprod_allow_real_import_office"]
             if not allow_real:
                 test_office = self._aeat_preprod_import_office()
                 if office != test_office:
@@ -1304,12 +1688,7 @@ class AduanaExpediente(models.Model):
         oficina_exit = user_exit
         office_note = ""
         if self._aeat_is_preproduction():
-            allow_real = (
-                self.env["ir.config_parameter"].sudo().get_param(
-                    "aduanas_transport.preprod_allow_real_office"
-                )
-                == "True"
-            )
+            allow_real = self._aeat_settings()["preprod_allow_real_office"]
             if not allow_real:
                 test_office = self._aeat_preprod_test_office()
                 changes = []
@@ -1359,7 +1738,13 @@ class AduanaExpediente(models.Model):
             value = "%s 00:00:00" % value
         return fields.Datetime.to_datetime(value.replace("T", " "))
 
-    def _apply_aeat_parsed_response(self, parsed, source="AEAT"):
+    def _apply_aeat_parsed_response(self, parsed, source="AEAT", quiet=False):
+        """
+        Aplica una respuesta AEAT parseada al expediente. quiet (consultas del planificador): el
+        estado solo cambia con aceptación, levante o salida explícitos en la respuesta (un MRN
+        informado no basta para darlo por aceptado) y solo se anota en el chatter el levante o
+        la salida cuando cambian el estado.
+        """
         self.ensure_one()
         updates = {"last_response_date": fields.Datetime.now()}
         if parsed.get("mrn"):
@@ -1395,10 +1780,14 @@ class AduanaExpediente(models.Model):
             if self.state not in ("exited", "closed"):
                 updates["state"] = "released"
         elif parsed.get("accepted") or (
-            parsed.get("mrn") and self.state in ("draft", "predeclared", "presented", "error")
+            not quiet and parsed.get("mrn") and self.state in ("draft", "predeclared", "presented", "error")
         ):
-            updates["state"] = "accepted"
+            if not quiet or self.state in ("predeclared", "presented", "error"):
+                updates["state"] = "accepted"
+        state_changed = updates.get("state", self.state) != self.state
         self.write(updates)
+        if quiet and not (state_changed and updates["state"] in ("exited", "released")):
+            return
 
         if updates.get("state") == "exited":
             body = _("Salida efectiva confirmada por AEAT (%s). La exportación queda marcada como IVA exento.") % source
@@ -1435,7 +1824,9 @@ class AduanaExpediente(models.Model):
             report = self.env.ref('aduanas_transport.report_dua_pdf', raise_if_not_found=False)
             if report:
                 # Usar el reporte para generar el PDF
-                pdf_content, _ = report._render_qweb_pdf(self.ids)
+                pdf_content, _report_type = self.env["ir.actions.report"]._render_qweb_pdf(
+                    report.report_name, self.ids
+                )
                 return pdf_content
             else:
                 # Si no existe el reporte, intentar usar el template directamente
@@ -1452,43 +1843,261 @@ class AduanaExpediente(models.Model):
             # Si falla, retornar None para que no se rompa el proceso
             return None
 
+    def _dua_pdf_filename(self):
+        self.ensure_one()
+        return f"DUA_{self.name}_OFICIAL.pdf"
+
+    def _dua_pdf_fingerprint(self):
+        """Huella del PDF del DUA: datos del expediente (como los XML) y versión de la plantilla."""
+        view = self.env.ref("aduanas_transport.template_report_dua_pdf", raise_if_not_found=False)
+        return self._xml_fingerprint("DUA_PDF", extra=str(view.write_date) if view else None)
+
+    def _render_dua_pdfs(self):
+        """
+        PDF del DUA de cada expediente, {id: bytes}. Se renderizan en bloques de
+        DUA_PDF_BATCH_SIZE con una sola llamada a wkhtmltopdf por bloque; Odoo divide el
+        resultado por expediente (un <h1> de primer nivel por DUA). Si no puede dividirlo,
+        ese bloque se renderiza expediente a expediente.
+        """
+        report = self.env.ref("aduanas_transport.report_dua_pdf", raise_if_not_found=False)
+        if not report:
+            return {rec.id: rec._generate_dua_pdf() for rec in self}
+        Report = self.env["ir.actions.report"]
+        result = {}
+        for start in range(0, len(self), DUA_PDF_BATCH_SIZE):
+            chunk = self[start:start + DUA_PDF_BATCH_SIZE]
+            try:
+                streams = Report._render_qweb_pdf_prepare_streams(
+                    report.report_name, {"report_type": "pdf"}, res_ids=chunk.ids
+                )
+            except Exception as e:
+                _logger.error("Error renderizando en lote el PDF del DUA (%s expedientes): %s", len(chunk), e)
+                streams = {False: None}
+            if False in streams or any(res_id not in streams for res_id in chunk.ids):
+                _logger.info("PDF del DUA: no se pudo dividir el lote de %s, se renderiza uno a uno", len(chunk))
+                for rec in chunk:
+                    result[rec.id] = rec._generate_dua_pdf()
+                continue
+            for res_id, entry in streams.items():
+                result[res_id] = entry["stream"].getvalue()
+                entry["stream"].close()
+        return result
+
+    def _generate_dua_pdfs(self):
+        """
+        Adjunta el PDF del DUA a cada expediente reutilizando los que no han cambiado
+        (huella guardada en el adjunto) y renderizando el resto en lote. Los adjuntos nuevos
+        se crean con un solo create. Devuelve {id: adjunto}.
+        """
+        Attachment = self.env["ir.attachment"]
+        existing = {}
+        if self:
+            for att in Attachment.search([
+                ("res_model", "=", self._name),
+                ("res_id", "in", self.ids),
+                ("name", "ilike", "_OFICIAL.pdf"),
+                ("mimetype", "=", "application/pdf"),
+            ]):
+                existing.setdefault(att.res_id, att)
+        fingerprints = {rec.id: rec._dua_pdf_fingerprint() for rec in self}
+        result = {}
+        stale = self.browse()
+        for rec in self:
+            att = existing.get(rec.id)
+            if att and att.aduana_xml_fingerprint == fingerprints[rec.id]:
+                result[rec.id] = att
+            else:
+                stale |= rec
+        start = time.monotonic()
+        pdfs = stale._render_dua_pdfs() if stale else {}
+        to_create = []
+        created_for = []
+        for rec in stale:
+            pdf = pdfs.get(rec.id)
+            if not pdf:
+                _logger.warning("No se pudo generar el PDF del DUA para expediente %s", rec.name)
+                continue
+            vals = {
+                "name": rec._dua_pdf_filename(),
+                "mimetype": "application/pdf",
+                "datas": base64.b64encode(pdf),
+                "aduana_xml_fingerprint": fingerprints[rec.id],
+            }
+            att = existing.get(rec.id)
+            if att:
+                att.write(vals)
+                result[rec.id] = att
+            else:
+                vals.update({"res_model": self._name, "res_id": rec.id, "type": "binary"})
+                to_create.append(vals)
+                created_for.append(rec.id)
+        for att, rec_id in zip(Attachment.create(to_create), created_for):
+            result[rec_id] = att
+        if stale:
+            _logger.info(
+                "PDF del DUA: %s reutilizados, %s renderizados en %.2fs",
+                len(self) - len(stale), len(stale), time.monotonic() - start,
+            )
+        return result
+
+    def action_print_dua_batch(self):
+        """
+        Impresión en lote del DUA: PDFs por expediente (en caché si no han cambiado) y un
+        PDF combinado para descargar, que el cron de purga elimina pasadas DUA_PDF_MERGED_KEEP_HOURS.
+        """
+        exports = self.filtered(lambda r: r.direction == "export")
+        if not exports:
+            raise UserError(_("Seleccione expedientes de exportación para imprimir el DUA."))
+        attachments = exports._generate_dua_pdfs()
+        pdfs = [attachments[rec.id].raw for rec in exports if rec.id in attachments]
+        if not pdfs:
+            raise UserError(_("No se pudo generar el PDF del DUA de los expedientes seleccionados."))
+        merged = self.env["ir.attachment"].create({
+            "name": "DUA_lote_%s.pdf" % fields.Datetime.now().strftime("%Y%m%d%H%M%S"),
+            "res_model": self._name,
+            "res_id": 0,
+            "type": "binary",
+            "mimetype": "application/pdf",
+            "datas": base64.b64encode(pdfs[0] if len(pdfs) == 1 else merge_pdf(pdfs)),
+        })
+        return {
+            "type": "ir.actions.act_url",
+            "url": f"/web/content/{merged.id}?download=1",
+            "target": "self",
+        }
+
+    @api.model
+    def _purge_dua_batch_pdfs(self):
+        """
+        Elimina los PDF combinados de impresión en lote con más de DUA_PDF_MERGED_KEEP_HOURS.
+        En sudo: con res_id=0 el search de ir.attachment los oculta a los usuarios no admin.
+        """
+        expired = self.env["ir.attachment"].sudo().search([
+            ("res_model", "=", self._name),
+            ("res_id", "=", 0),
+            ("name", "=like", "DUA_lote_%.pdf"),
+            ("create_date", "<", fields.Datetime.now() - timedelta(hours=DUA_PDF_MERGED_KEEP_HOURS)),
+        ])
+        expired.unlink()
+        return len(expired)
+
     # ===== Exportación (AES) =====
+    def _render_cusdec_ex1(self):
+        self.ensure_one()
+        return self.env['ir.ui.view']._render_template(
+            "aduanas_transport.tpl_cusdec_ex1",
+            {"exp": self}
+        )
+
+    def _generate_cc515c_artefacts(self, errors=None):
+        """CUSDEC EX1 del lote (un create de adjuntos) y declaraciones parciales CC515C si las hay."""
+        # Generar CUSDEC EX1 (formato oficial del DUA); se reutiliza si nada ha cambiado
+        self._get_xml_artefacts_batch(
+            "CUSDEC_EX1", lambda rec: "DUA_CUSDEC_EX1.xml", lambda rec: rec._render_cusdec_ex1(),
+            "DUA_CUSDEC_EX1.xml", errors=errors,
+        )
+        # Por encima del máximo de partidas, una declaración CC515C por parte
+        self._generate_split_declarations("CC515C", errors=errors)
+
     def action_generate_cc515c(self):
         """Genera el DUA en formato CUSDEC EX1 (formato oficial)"""
         for rec in self:
             if rec.direction != "export":
                 raise UserError(_("DUA solo aplica a exportación"))
-            # Validar datos antes de generar
-            validator = self.env["aduanas.validator"]
+        self._prefetch_declaration_data()
+        # Validar datos antes de generar
+        validator = self.env["aduanas.validator"]
+        for rec in self:
             validator.validate_expediente_export(rec)
-            # Generar CUSDEC EX1 (formato oficial del DUA)
-            xml = self.env['ir.ui.view']._render_template(
-                "aduanas_transport.tpl_cusdec_ex1",
-                {"exp": rec}
-            )
-            rec._attach_xml("DUA_CUSDEC_EX1.xml", xml)
-            
-            # Generar también el PDF del DUA oficial imprimible
-            try:
-                pdf_content = rec._generate_dua_pdf()
-                if pdf_content:
-                    rec._attach_pdf(f"DUA_{rec.name}_OFICIAL.pdf", pdf_content)
-                    _logger.info("PDF del DUA generado correctamente para expediente %s", rec.name)
-                else:
-                    _logger.warning("No se pudo generar el PDF del DUA para expediente %s", rec.name)
-            except Exception as pdf_error:
-                _logger.error("Error generando PDF del DUA para expediente %s: %s", rec.name, pdf_error)
-                # No fallar el proceso si el PDF falla, solo loguear el error
-            
-            rec.state = "predeclared"
-            rec.error_message = False
+        self._generate_cc515c_artefacts()
+        # Generar también el PDF del DUA oficial imprimible (en lote, reutilizando los que no cambian)
+        try:
+            with self.env.cr.savepoint():
+                self._generate_dua_pdfs()
+        except Exception as pdf_error:
+            _logger.error("Error generando PDF del DUA para %s expedientes: %s", len(self), pdf_error)
+            # No fallar el proceso si el PDF falla, solo loguear el error
+        self.write({"state": "predeclared", "error_message": False})
         return True
 
 
 
-    def _build_cc515c_native_body(self):
-        """Genera el contenido del mensaje CC515C en formato nativo AES según GuiaWEBExp (no CUSDEC)."""
+    _CC515C_CONSIGNEE = compile_fragment("""<cc5:Consignee>
+<cc5:name>{name}</cc5:name>
+<cc5:Address>
+<cc5:streetAndNumber>{street}</cc5:streetAndNumber>
+<cc5:postcode>{postcode}</cc5:postcode>
+<cc5:city>{city}</cc5:city>
+<cc5:country>{country}</cc5:country>
+</cc5:Address>
+</cc5:Consignee>""")
+    _CC515C_GOODS_ITEM = compile_fragment("""<cc5:GoodsItem>
+<cc5:declarationGoodsItemNumber>{item_num!raw}</cc5:declarationGoodsItemNumber>
+<cc5:statisticalValue>{statistical_value!raw}</cc5:statisticalValue>
+<cc5:Procedure>
+<cc5:requestedProcedure>10</cc5:requestedProcedure>
+<cc5:previousProcedure>00</cc5:previousProcedure>
+</cc5:Procedure>
+<cc5:Origin>
+<cc5:countryOfOrigin>{origin_country!raw}</cc5:countryOfOrigin>
+<cc5:regionOfDispatch>{region_dispatch!raw}</cc5:regionOfDispatch>
+</cc5:Origin>
+<cc5:Commodity>
+<cc5:descriptionOfGoods>{description}</cc5:descriptionOfGoods>
+<cc5:CommodityCode>
+<cc5:harmonizedSystemSubHeadingCode>{hs!raw}</cc5:harmonizedSystemSubHeadingCode>
+<cc5:combinedNomenclatureCode>{cn!raw}</cc5:combinedNomenclatureCode>
+</cc5:CommodityCode>
+<cc5:GoodsMeasure>
+<cc5:grossMass>{gross!raw}</cc5:grossMass>
+<cc5:netMass>{net!raw}</cc5:netMass>
+</cc5:GoodsMeasure>
+</cc5:Commodity>
+<cc5:Packaging>
+<cc5:sequenceNumber>1</cc5:sequenceNumber>
+<cc5:typeOfPackages>CT</cc5:typeOfPackages>
+<cc5:numberOfPackages>{packages!raw}</cc5:numberOfPackages>
+<cc5:shippingMarks>{shipping_marks}</cc5:shippingMarks>
+</cc5:Packaging>
+<cc5:SupportingDocument>
+<cc5:sequenceNumber>1</cc5:sequenceNumber>
+<cc5:type>N380</cc5:type>
+<cc5:referenceNumber>{invoice_ref!raw}</cc5:referenceNumber>
+<cc5:documentLineItemNumber>{document_line!raw}</cc5:documentLineItemNumber>
+</cc5:SupportingDocument>
+        </cc5:GoodsItem>""")
+
+    def _render_cc515c_consignee(self, partner, pais_dest):
+        consignee_country = ""
+        if partner and getattr(partner, "country_id", False) and partner.country_id:
+            consignee_country = (partner.country_id.code or "").upper()
+        if not consignee_country:
+            consignee_country = (pais_dest or "").upper()
+        consignee_street = " ".join(
+            p for p in [
+                partner and partner.street or "",
+                partner and partner.street2 or "",
+            ] if p
+        ) or "N/A"
+        consignee_city = (
+            partner and partner.city
+            or ("ANDORRA LA VELLA" if consignee_country == "AD" else "N/A")
+        )[:35]
+        return self._CC515C_CONSIGNEE.render(
+            name=((partner and partner.name) or "CONSIGNEE")[:70],
+            street=consignee_street[:70],
+            postcode=(partner and partner.zip or "00000")[:17],
+            city=consignee_city,
+            country=consignee_country,
+        )
+
+    def _build_cc515c_native_body(self, part=None):
+        """
+        Genera el contenido del mensaje CC515C en formato nativo AES según GuiaWEBExp (no CUSDEC).
+        Con part (aduana.expediente.declaracion) solo incluye las partidas de esa declaración parcial.
+        """
         self.ensure_one()
+        lines = self._declaration_goods_lines("CC515C", part)
         # Remitente = exportador (ej. Dorel Hispania). Empresa Odoo = agente (ej. Traldis Porta).
         vat = (self.remitente and self.remitente.vat or "").replace(" ", "").strip() or ""
         if not vat:
@@ -1507,8 +2116,7 @@ class AduanaExpediente(models.Model):
         if es_representacion and not (company_vat_raw or company_core):
             raise UserError(_("Para presentar como representante (agente), la empresa actual debe tener NIF/CIF configurado."))
         # Firmante = quien firma con el certificado (siempre la empresa cuando es representación; remitente en autodespacho). Override por config opcional.
-        icp = self.env["ir.config_parameter"].sudo()
-        nif_firmante_config = (icp.get_param("aduanas_transport.aeat_nif_firmante") or "").replace(" ", "").strip().upper()
+        nif_firmante_config = self._aeat_settings()["nif_firmante"].replace(" ", "").strip().upper()
         if nif_firmante_config:
             nif_firmante = nif_firmante_config
         else:
@@ -1518,48 +2126,20 @@ class AduanaExpediente(models.Model):
         exporter_id = vat  # remitente (Dorel)
         company_id = company_vat_raw or ("ES" + company_core)
         # LRN único por declarante (guía: LRN + Declarant)
-        lrn = (self.lrn or self.name or "").strip() or ("EXP-%s" % (self.id or 0))
+        lrn = part.lrn if part else ((self.lrn or self.name or "").strip() or ("EXP-%s" % (self.id or 0)))
         now = fields.Datetime.now()
         prep_time = now.strftime("%Y-%m-%dT%H:%M:%S") if now else ""
-        msg_id = (self.name or lrn) + "-" + (now.strftime("%Y%m%d%H%M%S") if now else "")
+        msg_id = ((part.lrn if part else self.name) or lrn) + "-" + (now.strftime("%Y%m%d%H%M%S") if now else "")
         oficina_export, oficina_exit, base_off, _office_note = self._get_cc515c_office_codes()
         moneda = self.moneda or "EUR"
-        total_inv = "%.2f" % (self.valor_factura or 0.0)
+        # Declaración parcial: importe facturado de sus partidas
+        total_inv = "%.2f" % (sum(l.valor_linea or 0.0 for l in lines) if part else (self.valor_factura or 0.0))
         incoterm = self.incoterm or "DAP"
         pais_exp = self.pais_origen or "ES"
         pais_dest = self.pais_destino or ""
-        consignee_country = ""
-        if self.consignatario and getattr(self.consignatario, "country_id", False) and self.consignatario.country_id:
-            consignee_country = (self.consignatario.country_id.code or "").upper()
-        if not consignee_country:
-            consignee_country = (pais_dest or "").upper()
-        consignee_name = ((self.consignatario and self.consignatario.name) or "CONSIGNEE")[:70]
-        consignee_street = " ".join(
-            p for p in [
-                self.consignatario and self.consignatario.street or "",
-                self.consignatario and self.consignatario.street2 or "",
-            ] if p
-        ) or "N/A"
-        consignee_postcode = (self.consignatario and self.consignatario.zip or "00000")[:17]
-        consignee_city = (
-            self.consignatario and self.consignatario.city
-            or ("ANDORRA LA VELLA" if consignee_country == "AD" else "N/A")
-        )[:35]
         # AEAT exige Consignee si no va a nivel GoodsItem. Para AD usamos nombre+dirección, no EORI.
-        consignee_block = """<cc5:Consignee>
-<cc5:name>%s</cc5:name>
-<cc5:Address>
-<cc5:streetAndNumber>%s</cc5:streetAndNumber>
-<cc5:postcode>%s</cc5:postcode>
-<cc5:city>%s</cc5:city>
-<cc5:country>%s</cc5:country>
-</cc5:Address>
-</cc5:Consignee>""" % (
-            xml_escape(consignee_name),
-            xml_escape(consignee_street[:70]),
-            xml_escape(consignee_postcode),
-            xml_escape(consignee_city),
-            xml_escape(consignee_country),
+        consignee_block = memoize_partner_fragment(
+            "cc515c_consignee", self.consignatario, self._render_cc515c_consignee, pais_dest,
         )
         # ContactPerson: si se envía, phoneNumber es obligatorio (AEAT); usar "N/A" si está vacío
         contact_remitente_name = (self.remitente and self.remitente.name or "") or "N/A"
@@ -1604,11 +2184,10 @@ class AduanaExpediente(models.Model):
         inland_mode_xml = "" if is_direct_exit else "\n<cc5:inlandModeOfTransport>3</cc5:inlandModeOfTransport>"
         # Resto de elementos: modeOfTransportAtTheBorder, LocationOfGoods, medios de transporte,
         # CountryOfRoutingOfConsignment y TransportDocument.
-        icp = self.env["ir.config_parameter"].sudo()
         loc_auth = (self.location_authorisation_number or "").strip().upper()
         if not loc_auth:
             loc_auth = (
-                icp.get_param("aduanas_transport.aeat_preprod_location_authorisation")
+                self._aeat_settings()["preprod_location_authorisation"]
                 or "010101DA11"
                 if self._aeat_is_preproduction()
                 else "01" + base_off + "01"
@@ -1657,62 +2236,35 @@ class AduanaExpediente(models.Model):
             xml_escape(transport_country),
             xml_escape(transport_doc_ref),
         )
-        region_dispatch = ((self.region_of_dispatch or "46").strip()[:2]).rjust(2, "0")
-        factura_ref = (self.numero_factura or self.name or "FAC").strip()[:35]
-        lines = (self.line_ids or self.env["aduana.expediente.line"]).sorted(key=lambda l: l.item_number or l.id or 0)
+        region_dispatch_xml = xml_escape(((self.region_of_dispatch or "46").strip()[:2]).rjust(2, "0"))
+        factura_ref_xml = xml_escape((self.numero_factura or self.name or "FAC").strip()[:35])
         tot_gross = sum((l.peso_bruto or 0) for l in lines) or 0.0
-        # Construir GoodsItem por línea. El Consignee común va en Consignment, no repetido por partida.
-        goods_items_xml = []
-        for idx, line in enumerate(lines):
-            item_num = line.item_number or (idx + 1)
-            partida = (line.partida or "0000000000").replace(" ", "")[:10].ljust(10, "0")
-            hs = partida[:6]
-            cn = partida[6:8] if len(partida) >= 8 else "00"
-            stat_val = "%.2f" % (line.valor_linea or 0.0)
-            gross = "%.2f" % (line.peso_bruto or 0.0)
-            net = "%.2f" % (line.peso_neto or 0.0)
-            bultos = line.bultos or 1
-            desc = xml_escape((line.descripcion or "")[:350])
-            pais_orig = line.pais_origen or pais_exp
-            shipping_marks = (getattr(line, "shipping_marks", None) or ("%s" % item_num))[:35]
-            goods_items_xml.append("""<cc5:GoodsItem>
-<cc5:declarationGoodsItemNumber>%s</cc5:declarationGoodsItemNumber>
-<cc5:statisticalValue>%s</cc5:statisticalValue>
-<cc5:Procedure>
-<cc5:requestedProcedure>10</cc5:requestedProcedure>
-<cc5:previousProcedure>00</cc5:previousProcedure>
-</cc5:Procedure>
-<cc5:Origin>
-<cc5:countryOfOrigin>%s</cc5:countryOfOrigin>
-<cc5:regionOfDispatch>%s</cc5:regionOfDispatch>
-</cc5:Origin>
-<cc5:Commodity>
-<cc5:descriptionOfGoods>%s</cc5:descriptionOfGoods>
-<cc5:CommodityCode>
-<cc5:harmonizedSystemSubHeadingCode>%s</cc5:harmonizedSystemSubHeadingCode>
-<cc5:combinedNomenclatureCode>%s</cc5:combinedNomenclatureCode>
-</cc5:CommodityCode>
-<cc5:GoodsMeasure>
-<cc5:grossMass>%s</cc5:grossMass>
-<cc5:netMass>%s</cc5:netMass>
-</cc5:GoodsMeasure>
-</cc5:Commodity>
-<cc5:Packaging>
-<cc5:sequenceNumber>1</cc5:sequenceNumber>
-<cc5:typeOfPackages>CT</cc5:typeOfPackages>
-<cc5:numberOfPackages>%s</cc5:numberOfPackages>
-<cc5:shippingMarks>%s</cc5:shippingMarks>
-</cc5:Packaging>
-<cc5:SupportingDocument>
-<cc5:sequenceNumber>1</cc5:sequenceNumber>
-<cc5:type>N380</cc5:type>
-<cc5:referenceNumber>%s</cc5:referenceNumber>
-<cc5:documentLineItemNumber>%s</cc5:documentLineItemNumber>
-</cc5:SupportingDocument>
-        </cc5:GoodsItem>""" % (item_num, stat_val, pais_orig, xml_escape(region_dispatch), desc, hs, cn, gross, net, bultos, xml_escape(shipping_marks), xml_escape(factura_ref), item_num))
-        goods_items_str = "\n".join(goods_items_xml)
-        if not goods_items_str:
+        if not lines:
             raise UserError(_("Añada al menos una línea de mercancía al expediente para presentar el DUA."))
+        # Construir GoodsItem por línea. El Consignee común va en Consignment, no repetido por partida.
+        render_item = self._CC515C_GOODS_ITEM.render
+
+        def _goods_items():
+            for idx, line in enumerate(lines):
+                # En una declaración parcial las partidas se renumeran desde 1; la línea de factura se conserva
+                item_num = (idx + 1) if part else (line.item_number or (idx + 1))
+                partida = (line.partida or "0000000000").replace(" ", "")[:10].ljust(10, "0")
+                yield render_item(
+                    item_num=item_num,
+                    document_line=line.item_number or item_num,
+                    statistical_value="%.2f" % (line.valor_linea or 0.0),
+                    origin_country=line.pais_origen or pais_exp,
+                    region_dispatch=region_dispatch_xml,
+                    description=(line.descripcion or "")[:350],
+                    hs=partida[:6],
+                    cn=partida[6:8] if len(partida) >= 8 else "00",
+                    gross="%.2f" % (line.peso_bruto or 0.0),
+                    net="%.2f" % (line.peso_neto or 0.0),
+                    packages=line.bultos or 1,
+                    shipping_marks=(getattr(line, "shipping_marks", None) or ("%s" % (line.item_number or item_num)))[:35],
+                    invoice_ref=factura_ref_xml,
+                )
+
         # Consignment mínimo (containerIndicator 0 = sin contenedor, grossMass total)
         consignment_gross = "%.2f" % tot_gross if tot_gross else "0.00"
         body = """<cc5:messageSender>%s</cc5:messageSender>
@@ -1777,8 +2329,9 @@ class AduanaExpediente(models.Model):
             consignment_gross,
             consignee_block,
             consignment_extra_after_gross,
-            goods_items_str,
+            ITEMS_MARKER,
         )
+        body, _count = stream_document(body, _goods_items())
         return body
 
     def _build_cc515c_soap_envelope(self, cc515c_body, message_id=None):
@@ -1797,100 +2350,155 @@ class AduanaExpediente(models.Model):
 </soapenv:Body>
 </soapenv:Envelope>""" % (ns_cc515, xml_escape(ent_id), cc515c_body)
 
-    def action_send_cc515c(self):
-        """Envía el DUA a AEAT en formato nativo CC515C (GuiaWEBExp), no CUSDEC."""
-        client = self.env["aduanas.aeat.client"]
-        parser = self.env["aduanas.xml.parser"]
-        validator = self.env["aduanas.validator"]
-        for rec in self:
-            if rec.direction != "export":
-                raise UserError(_("Esta operación es importación Andorra → España. Debe presentarse por CC415A/H1, no por AES."))
-            settings = rec._get_settings()
-            validator.validate_expediente_export(rec)
-            rec._validate_cc515c_offices_before_send(settings)
-            export_office, exit_office, _base, office_note = rec._get_cc515c_office_codes()
-            cc515c_body = rec._build_cc515c_native_body()
-            soap_payload = rec._build_cc515c_soap_envelope(cc515c_body)
-            endpoint = settings.get("aeat_endpoint_cc515c") or ""
-            rec._validate_aeat_endpoint_for_xml(endpoint, soap_payload, "export")
-            offices_html = (
-                "<p>%s: <code>%s</code> — %s: <code>%s</code></p>"
-                % (
-                    html_escape(_("CustomsOfficeOfExport")),
-                    html_escape(export_office),
-                    html_escape(_("CustomsOfficeOfExitDeclared")),
-                    html_escape(exit_office),
-                )
+    def _prepare_cc515c_send(self, part=None):
+        """
+        Valida y construye el envío CC515C. Solo escribe el adjunto del cuerpo CC515C (reutilizado
+        si su huella no ha cambiado y no se ha enviado aún). Con part construye la declaración
+        parcial. Devuelve el dict del envío.
+        """
+        self.ensure_one()
+        if self.direction != "export":
+            raise UserError(_("Esta operación es importación Andorra → España. Debe presentarse por CC415A/H1, no por AES."))
+        settings = self._get_settings()
+        self.env["aduanas.validator"].validate_expediente_export(self)
+        self._validate_cc515c_offices_before_send(settings)
+        export_office, exit_office, _base, office_note = self._get_cc515c_office_codes()
+        if part:
+            _att, cc515c_body = part._get_xml(for_send=True)
+            message_id = "%s-%s" % (part.lrn, fields.Datetime.now().strftime("%Y%m%d%H%M%S"))
+        else:
+            _att, cc515c_body = self._get_xml_artefact(
+                "CC515C", "%s_CC515C.xml" % (self.name or "EXP"), self._build_cc515c_native_body, for_send=True,
             )
-            if office_note:
-                offices_html += "<p><em>%s</em></p>" % html_escape(office_note)
-            rec._post_chatter_soap_xml(
-                "CC515C",
-                endpoint,
-                soap_payload,
-                filename="DUA_CC515C_soap.xml",
-                extra_html=offices_html,
+            message_id = None
+        soap_payload = self._build_cc515c_soap_envelope(cc515c_body, message_id=message_id)
+        endpoint = settings.get("aeat_endpoint_cc515c") or ""
+        self._validate_aeat_endpoint_for_xml(endpoint, soap_payload, "export")
+        offices_html = (
+            "<p>%s: <code>%s</code> — %s: <code>%s</code></p>"
+            % (
+                html_escape(_("CustomsOfficeOfExport")),
+                html_escape(export_office),
+                html_escape(_("CustomsOfficeOfExitDeclared")),
+                html_escape(exit_office),
             )
-            status_code, resp_xml = client.send_xml(endpoint, soap_payload, service="CC515C")
-            rec._attach_xml("DUA_CC515C_response.xml", resp_xml or "")
-            if status_code != 200:
-                rec.last_response_date = fields.Datetime.now()
-                rec.state = "error"
-                if status_code == 403:
-                    rec.error_message = _(
-                        "AEAT ha respondido 403 Forbidden. El servicio de preproducción/producción "
-                        "requiere certificado electrónico de la AEAT. Configure el certificado en "
-                        "Aduanas > Configuración (Certificado P12/PFX) y asegúrese de que el servidor "
-                        "use ese certificado en las peticiones HTTPS."
-                    )
-                else:
-                    rec.error_message = _("AEAT respondió con código HTTP %s. Revisar el adjunto de respuesta.") % status_code
-                rec.with_context(mail_notrack=True).message_post(
-                    body=rec.error_message, subtype_xmlid="mail.mt_note"
-                )
-                return True
-            parsed = parser.parse_aeat_response(resp_xml, "CC515C")
+        )
+        if office_note:
+            offices_html += "<p><em>%s</em></p>" % html_escape(office_note)
+        return {
+            "service": "CC515C",
+            "endpoint": endpoint,
+            "xml": soap_payload,
+            "timeout": 30,
+            "export_office": export_office,
+            "exit_office": exit_office,
+            "offices_html": offices_html,
+            "part": part,
+        }
+
+    def _log_cc515c_request(self, prep):
+        self.ensure_one()
+        if prep.get("part"):
+            return prep["part"]._log_request(prep)
+        self._post_chatter_soap_xml(
+            "CC515C",
+            prep["endpoint"],
+            prep["xml"],
+            filename="DUA_CC515C_soap.xml",
+            extra_html=prep["offices_html"],
+        )
+        self._mark_xml_artefact_sent("%s_CC515C.xml" % (self.name or "EXP"))
+
+    def _apply_cc515c_response(self, prep, status_code, resp_xml):
+        """Procesa la respuesta CC515C. Devuelve False si AEAT respondió con HTTP distinto de 200."""
+        self.ensure_one()
+        if prep.get("part"):
+            return prep["part"]._apply_response(prep, status_code, resp_xml)
+        rec = self
+        parser = self.env["aduanas.xml.parser"]
+        endpoint = prep["endpoint"]
+        archived = rec._archive_aeat_xml(
+            "CC515C", "response", resp_xml, filename="DUA_CC515C_response.xml", endpoint=endpoint,
+            http_status=status_code, duration_ms=(prep.get("elapsed") or 0.0) * 1000.0,
+        )
+        if status_code != 200:
             rec.last_response_date = fields.Datetime.now()
-            if parsed.get("incidencias"):
-                rec._procesar_incidencias(parsed["incidencias"], "cc515c")
-            if parsed.get("success") and parsed.get("mrn"):
-                rec.error_message = False
-                rec._apply_aeat_parsed_response(parsed, source="CC515C")
-                rec.with_context(mail_notrack=True).message_post(
-                    body=_("DUA presentado (CC515C). MRN: %s") % rec.mrn,
-                    subtype_xmlid="mail.mt_note",
+            rec.state = "error"
+            if status_code == 403:
+                rec.error_message = _(
+                    "AEAT ha respondido 403 Forbidden. El servicio de preproducción/producción "
+                    "requiere certificado electrónico de la AEAT. Configure el certificado en "
+                    "Aduanas > Configuración (Certificado P12/PFX) y asegúrese de que el servidor "
+                    "use ese certificado en las peticiones HTTPS."
                 )
             else:
-                rec.state = "error"
-                error_msg = "\n".join(parsed.get("errors") or []) or parsed.get("error") or _("Error desconocido")
-                rec.error_message = error_msg
-                tipo = parsed.get("tipo_respuesta") or ""
-                rec.with_context(mail_notrack=True).message_post(
-                    body=_(
-                        "AEAT rechazó o no admitió el DUA (CC515C) [%s]:\n%s\n\n"
-                        "Oficinas en la petición — exportación: %s, salida: %s"
-                    )
-                    % (tipo, error_msg, export_office, exit_office),
-                    subtype_xmlid="mail.mt_note",
+                rec.error_message = _("AEAT respondió con código HTTP %s. Revisar la respuesta en Mensajes AEAT.") % status_code
+            rec.with_context(mail_notrack=True).message_post(
+                body=rec.error_message, subtype_xmlid="mail.mt_note"
+            )
+            return False
+        parsed = parser.parse_aeat_response(resp_xml, "CC515C")
+        rec.last_response_date = fields.Datetime.now()
+        if parsed.get("incidencias"):
+            rec._procesar_incidencias(parsed["incidencias"], "cc515c")
+        if parsed.get("success") and parsed.get("mrn"):
+            rec.error_message = False
+            rec._apply_aeat_parsed_response(parsed, source="CC515C")
+            rec.with_context(mail_notrack=True).message_post(
+                body=_("DUA presentado (CC515C). MRN: %s") % rec.mrn,
+                subtype_xmlid="mail.mt_note",
+            )
+        else:
+            rec.state = "error"
+            error_msg = "\n".join(parsed.get("errors") or []) or parsed.get("error") or _("Error desconocido")
+            rec.error_message = error_msg
+            tipo = parsed.get("tipo_respuesta") or ""
+            rec.with_context(mail_notrack=True).message_post(
+                body=_(
+                    "AEAT rechazó o no admitió el DUA (CC515C) [%s]:\n%s\n\n"
+                    "Oficinas en la petición — exportación: %s, salida: %s"
+                )
+                % (tipo, error_msg, prep["export_office"], prep["exit_office"]),
+                subtype_xmlid="mail.mt_note",
+            )
+            if resp_xml:
+                rec._post_chatter_soap_xml(
+                    "CC515C",
+                    endpoint,
+                    resp_xml,
+                    filename="DUA_CC515C_response.xml",
+                    title=_("Respuesta de AEAT"),
+                    direction="response",
+                    archived=archived,
                 )
-                if resp_xml:
-                    rec._post_chatter_soap_xml(
-                        "CC515C",
-                        endpoint,
-                        resp_xml,
-                        filename="DUA_CC515C_response.xml",
-                        title=_("Respuesta de AEAT"),
-                    )
         return True
 
-    def _build_ccaesc_soap_envelope(self):
-        """Consulta completa de exportación AES por MRN (CCAESCV1Ent)."""
+    def action_send_cc515c(self):
+        """Envía el DUA a AEAT en formato nativo CC515C (GuiaWEBExp), no CUSDEC."""
+        client = self.env["aduanas.aeat.client"]
+        for rec in self:
+            parts = rec._split_declarations("CC515C")
+            if parts:
+                parts.action_send()
+                continue
+            prep = rec._prepare_cc515c_send()
+            rec._log_cc515c_request(prep)
+            start = time.monotonic()
+            status_code, resp_xml = client.send_xml(prep["endpoint"], prep["xml"], service="CC515C")
+            prep["elapsed"] = time.monotonic() - start
+            if not rec._apply_cc515c_response(prep, status_code, resp_xml):
+                return True
+        return True
+
+    def _build_ccaesc_soap_envelope(self, mrn=None):
+        """Consulta completa de exportación AES por MRN (CCAESCV1Ent); mrn de una declaración parcial o el del expediente."""
         self.ensure_one()
-        if not self.mrn:
+        mrn = mrn or self.mrn
+        if not mrn:
             raise UserError(_("Debe tener un MRN antes de consultar el estado del DUA."))
         now = fields.Datetime.now()
         prep_time = now.strftime("%Y-%m-%dT%H:%M:%S")
-        msg_id = "%s-CCAESC-%s" % ((self.name or self.mrn).replace(" ", "")[:20], now.strftime("%Y%m%d%H%M%S"))
+        msg_id = "%s-CCAESC-%s" % ((self.name or mrn).replace(" ", "")[:20], now.strftime("%Y%m%d%H%M%S"))
         sender = self._get_aeat_message_sender()
         ns = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aduanas/es/aeat/adex/jdit/ws/aes/CCAESCV1Ent.xsd"
         return """<?xml version="1.0" encoding="UTF-8"?>
@@ -1910,36 +2518,79 @@ class AduanaExpediente(models.Model):
 </cc5:CCAESC>
 </cc5:CCAESCV1Ent>
 </soapenv:Body>
-</soapenv:Envelope>""" % (ns, xml_escape(msg_id[:40]), xml_escape(sender), prep_time, xml_escape(msg_id[:35]), xml_escape(self.mrn))
+</soapenv:Envelope>""" % (ns, xml_escape(msg_id[:40]), xml_escape(sender), prep_time, xml_escape(msg_id[:35]), xml_escape(mrn))
+
+    def _prepare_ccaesc_send(self, part=None):
+        """Valida y construye la consulta CCAESC (sin escribir nada); con part, la del MRN de la parte."""
+        self.ensure_one()
+        if self.direction != "export":
+            raise UserError(_("La consulta CCAESC solo aplica a exportación."))
+        settings = self._get_settings()
+        endpoint = settings.get("aeat_endpoint_ccaesc")
+        if not endpoint:
+            raise UserError(_("Configure el endpoint de consulta exportación (CCAESC) en Aduanas > Configuración."))
+        xml = self._build_ccaesc_soap_envelope(mrn=part.mrn if part else None)
+        return {"service": "CCAESC", "endpoint": endpoint, "xml": xml, "timeout": 60, "part": part}
+
+    def _log_ccaesc_request(self, prep):
+        self.ensure_one()
+        name = prep["part"].lrn if prep.get("part") else self.name
+        self._archive_aeat_xml(
+            "CCAESC", "request", prep["xml"], filename="%s_CCAESC_request.xml" % name, endpoint=prep["endpoint"],
+        )
+
+    def _apply_ccaesc_response(self, prep, status_code, resp_xml):
+        self.ensure_one()
+        rec = self
+        parser = self.env["aduanas.xml.parser"]
+        part = prep.get("part")
+        rec._archive_aeat_xml(
+            "CCAESC", "response", resp_xml, filename="%s_CCAESC_response.xml" % (part.lrn if part else rec.name),
+            endpoint=prep["endpoint"],
+            http_status=status_code, duration_ms=(prep.get("elapsed") or 0.0) * 1000.0,
+        )
+        quiet = self.env.context.get("aeat_poll_quiet")
+        if status_code != 200:
+            if quiet:
+                _logger.info("Consulta CCAESC %s: HTTP %s, se reintentará", part.lrn if part else rec.name, status_code)
+                return False
+            rec.state = "error"
+            rec.error_message = _("AEAT respondió HTTP %s al consultar CCAESC. Revisar la respuesta en Mensajes AEAT.") % status_code
+            rec.last_response_date = fields.Datetime.now()
+            return rec._aeat_response_error(rec.error_message)
+        parsed = parser.parse_aeat_response(resp_xml, "CCAESC")
+        if parsed.get("errors") and quiet:
+            _logger.warning("Consulta CCAESC %s con errores: %s", part.lrn if part else rec.name, "; ".join(parsed["errors"]))
+            return False
+        if parsed.get("errors"):
+            rec.error_message = "\n".join(parsed.get("errors") or [])
+            if parsed.get("incidencias"):
+                rec._procesar_incidencias(parsed["incidencias"], "ccaesc")
+            return rec._aeat_response_error(_("La consulta CCAESC devolvió errores:\n%s") % rec.error_message)
+        if part:
+            part._apply_aeat_status(parsed, source="CCAESC")
+            return True
+        rec.error_message = False
+        rec._apply_aeat_parsed_response(parsed, source="CCAESC", quiet=quiet)
+        return True
 
     def action_consultar_estado_dua(self):
-        """Consulta CCAESC: MRN, estado AES, circuito, levantes, errores y salida efectiva."""
+        """
+        Consulta CCAESC: MRN, estado AES, circuito, levantes, errores y salida efectiva; si el
+        expediente se dividió, una consulta por cada declaración parcial con MRN.
+        """
         client = self.env["aduanas.aeat.client"]
-        parser = self.env["aduanas.xml.parser"]
         for rec in self:
-            if rec.direction != "export":
-                raise UserError(_("La consulta CCAESC solo aplica a exportación."))
-            settings = rec._get_settings()
-            endpoint = settings.get("aeat_endpoint_ccaesc")
-            if not endpoint:
-                raise UserError(_("Configure el endpoint de consulta exportación (CCAESC) en Aduanas > Configuración."))
-            soap_payload = rec._build_ccaesc_soap_envelope()
-            rec._attach_xml("%s_CCAESC_request.xml" % rec.name, soap_payload)
-            status_code, resp_xml = client.send_xml(endpoint, soap_payload, service="CCAESC", timeout=60)
-            rec._attach_xml("%s_CCAESC_response.xml" % rec.name, resp_xml or "")
-            if status_code != 200:
-                rec.state = "error"
-                rec.error_message = _("AEAT respondió HTTP %s al consultar CCAESC. Revisar adjunto de respuesta.") % status_code
-                rec.last_response_date = fields.Datetime.now()
-                raise UserError(rec.error_message)
-            parsed = parser.parse_aeat_response(resp_xml, "CCAESC")
-            if parsed.get("errors"):
-                rec.error_message = "\n".join(parsed.get("errors") or [])
-                if parsed.get("incidencias"):
-                    rec._procesar_incidencias(parsed["incidencias"], "ccaesc")
-                raise UserError(_("La consulta CCAESC devolvió errores:\n%s") % rec.error_message)
-            rec.error_message = False
-            rec._apply_aeat_parsed_response(parsed, source="CCAESC")
+            parts = rec._aeat_batch_parts("ccaesc")
+            for part in parts if parts is not None else [None]:
+                prep = rec._prepare_ccaesc_send(part=part)
+                rec._log_ccaesc_request(prep)
+                start = time.monotonic()
+                status_code, resp_xml = client.send_xml(prep["endpoint"], prep["xml"], service="CCAESC", timeout=60)
+                prep["elapsed"] = time.monotonic() - start
+                rec._apply_ccaesc_response(prep, status_code, resp_xml)
+            if parts is not None:
+                rec._sync_declaration_state()
         return True
 
     def _build_cc507c_soap_envelope(self):
@@ -1959,9 +2610,7 @@ class AduanaExpediente(models.Model):
         _export_office, office, _base, _office_note = self._get_cc515c_office_codes()
         location_auth = (
             (self.location_authorisation_number or "").strip().upper()
-            or self.env["ir.config_parameter"].sudo().get_param(
-                "aduanas_transport.aeat_preprod_location_authorisation"
-            )
+            or self._aeat_settings()["preprod_location_authorisation"]
             or ("010101DA11" if self._aeat_is_preproduction() else self._default_location_authorisation())
         )
         ns = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aduanas/es/aeat/adex/jdit/ws/aes/CC507CV1Ent.xsd"
@@ -2031,12 +2680,18 @@ class AduanaExpediente(models.Model):
                     "en ese caso informe 'Oficina aduanas de salida' antes de notificar llegada."
                 ) % exit_declared_office)
             soap_payload = rec._build_cc507c_soap_envelope()
-            rec._attach_xml("%s_CC507C_request.xml" % rec.name, soap_payload)
+            rec._archive_aeat_xml(
+                "CC507C", "request", soap_payload, filename="%s_CC507C_request.xml" % rec.name, endpoint=endpoint,
+            )
+            start = time.monotonic()
             status_code, resp_xml = client.send_xml(endpoint, soap_payload, service="CC507C", timeout=60)
-            rec._attach_xml("%s_CC507C_response.xml" % rec.name, resp_xml or "")
+            rec._archive_aeat_xml(
+                "CC507C", "response", resp_xml, filename="%s_CC507C_response.xml" % rec.name, endpoint=endpoint,
+                http_status=status_code, duration_ms=(time.monotonic() - start) * 1000.0,
+            )
             if status_code != 200:
                 rec.state = "error"
-                rec.error_message = _("AEAT respondió HTTP %s al enviar CC507C. Revisar adjunto de respuesta.") % status_code
+                rec.error_message = _("AEAT respondió HTTP %s al enviar CC507C. Revisar la respuesta en Mensajes AEAT.") % status_code
                 rec.last_response_date = fields.Datetime.now()
                 raise UserError(rec.error_message)
             parsed = parser.parse_aeat_response(resp_xml, "CC507C")
@@ -2060,17 +2715,19 @@ class AduanaExpediente(models.Model):
                 raise UserError(_("CC511C solo aplica a exportación"))
             if not rec.mrn:
                 raise UserError(_("Debe tener un MRN antes de presentar CC511C"))
-            xml = self.env['ir.ui.view']._render_template(
-                "aduanas_transport.tpl_cc511c",
-                {"exp": rec}
-            )
-            rec._attach_xml(f"{rec.name}_CC511C.xml", xml)
+            _att, xml = rec._get_xml_artefact("CC511C", f"{rec.name}_CC511C.xml", rec._render_cc511c, for_send=True)
             settings = rec._get_settings()
-            status_code, resp_xml = client.send_xml(settings.get("aeat_endpoint_cc511c"), xml, service="CC511C")
-            rec._attach_xml(f"{rec.name}_CC511C_response.xml", resp_xml or "")
+            endpoint = settings.get("aeat_endpoint_cc511c")
+            rec._mark_xml_artefact_sent(f"{rec.name}_CC511C.xml")
+            start = time.monotonic()
+            status_code, resp_xml = client.send_xml(endpoint, xml, service="CC511C")
+            rec._archive_aeat_xml(
+                "CC511C", "response", resp_xml, filename=f"{rec.name}_CC511C_response.xml", endpoint=endpoint,
+                http_status=status_code, duration_ms=(time.monotonic() - start) * 1000.0,
+            )
             if status_code != 200:
                 rec.state = "error"
-                rec.error_message = _("AEAT respondió HTTP %s. Revisar adjunto de respuesta.") % status_code
+                rec.error_message = _("AEAT respondió HTTP %s. Revisar la respuesta en Mensajes AEAT.") % status_code
                 raise UserError(rec.error_message)
             
             # Parsear respuesta mejorada
@@ -2099,6 +2756,25 @@ class AduanaExpediente(models.Model):
         return True
 
     # ===== EXS (Declaración Sumaria de Salida - IE615 V5) =====
+    _IE615_GOODS_ITEM = compile_fragment("""<GOOITEGDS>
+<IteNumGDS7>{item_num!raw}</IteNumGDS7>
+<GooDesGDS23>{description}</GooDesGDS23>
+<GroMasGDS46>{gross!raw}</GroMasGDS46>
+<PREDOCGODITM1>
+<DocTypPD11>N337</DocTypPD11>
+<DocRefPD12>{doc_ref!raw}</DocRefPD12>
+<DocGdsIteNumPD13>{doc_item!raw}</DocGdsIteNumPD13>
+</PREDOCGODITM1>
+<COMCODGODITM>
+<ComNomCMD1>{partida!raw}</ComNomCMD1>
+</COMCODGODITM>
+<PACGS2>
+<MarNumOfPacGS21>MARCAS</MarNumOfPacGS21>
+<KinOfPacGS23>BX</KinOfPacGS23>
+<NumOfPacGS24>{packages!raw}</NumOfPacGS24>
+</PACGS2>
+</GOOITEGDS>""")
+
     def _build_ie615_body(self, preprod_maritimo=True, preprod_doc_ref=None, preprod_doc_item="00001"):
         """
         Construye el cuerpo XML del mensaje IE615 (CC615A) para presentación EXS.
@@ -2165,6 +2841,7 @@ class AduanaExpediente(models.Model):
         else:
             sender_name, sender_street, sender_zip, sender_city, sender_country, sender_tin = "Remitente", "Calle", "28000", "Madrid", "ES", "ESA99999998"
         ns = "https://www2.agenciatributaria.gob.es/ADUA/internet/es/aeat/dit/adu/adrx/ws/IE615V5Ent.xsd"
+        render_item = self._IE615_GOODS_ITEM.render
         lines_xml = []
         for idx, line in enumerate(self.line_ids or [None]):
             if line is None:
@@ -2172,29 +2849,22 @@ class AduanaExpediente(models.Model):
                 desc = "Mercancía"
                 gross = "%.6g" % (tot_gross or 1)
                 partida = "840999"
+                packages = tot_packages
             else:
                 item_num = line.item_number or (idx + 1)
                 desc = (line.descripcion or "Mercancía")[:350]
                 gross = "%.6g" % (line.peso_bruto or 0) or "1"
                 partida = (line.partida or "840999").replace(" ", "")[:10]
-            lines_xml.append("""<GOOITEGDS>
-<IteNumGDS7>%s</IteNumGDS7>
-<GooDesGDS23>%s</GooDesGDS23>
-<GroMasGDS46>%s</GroMasGDS46>
-<PREDOCGODITM1>
-<DocTypPD11>N337</DocTypPD11>
-<DocRefPD12>%s</DocRefPD12>
-<DocGdsIteNumPD13>%s</DocGdsIteNumPD13>
-</PREDOCGODITM1>
-<COMCODGODITM>
-<ComNomCMD1>%s</ComNomCMD1>
-</COMCODGODITM>
-<PACGS2>
-<MarNumOfPacGS21>MARCAS</MarNumOfPacGS21>
-<KinOfPacGS23>BX</KinOfPacGS23>
-<NumOfPacGS24>%s</NumOfPacGS24>
-</PACGS2>
-</GOOITEGDS>""" % (item_num, xml_escape(desc), gross, doc_ref, preprod_doc_item, partida, tot_packages if not self.line_ids else (line.bultos or 1)))
+                packages = line.bultos or 1
+            lines_xml.append(render_item(
+                item_num=item_num,
+                description=desc,
+                gross=gross,
+                doc_ref=doc_ref,
+                doc_item=preprod_doc_item,
+                partida=partida,
+                packages=packages,
+            ))
         dest_country = self.pais_destino or ""
         body = """<?xml version="1.0" encoding="UTF-8"?>
 <exs:CC615A xmlns:exs="%s">
@@ -2327,14 +2997,26 @@ class AduanaExpediente(models.Model):
             endpoint = settings.get("aeat_endpoint_ie615")
             if not endpoint:
                 raise UserError(_("Configure el endpoint EXS (IE615) en Aduanas > Configuración"))
-            body = rec._build_ie615_body(preprod_maritimo=preprod_maritimo, preprod_doc_ref=preprod_doc_ref, preprod_doc_item=preprod_doc_item)
-            rec._attach_xml("EXS_IE615_%s.xml" % rec.name, body)
+            _att, body = rec._get_xml_artefact(
+                "IE615",
+                "EXS_IE615_%s.xml" % rec.name,
+                lambda rec=rec: rec._build_ie615_body(
+                    preprod_maritimo=preprod_maritimo, preprod_doc_ref=preprod_doc_ref, preprod_doc_item=preprod_doc_item,
+                ),
+                extra=(preprod_maritimo, preprod_doc_ref, preprod_doc_item),
+                for_send=True,
+            )
             soap = rec._build_ie615_soap_envelope(body)
+            rec._mark_xml_artefact_sent("EXS_IE615_%s.xml" % rec.name)
+            start = time.monotonic()
             status_code, resp_xml = client.send_xml(endpoint, soap, service="IE615_EXS", timeout=60)
-            rec._attach_xml("EXS_IE615_response_%s.xml" % rec.name, resp_xml or "")
+            rec._archive_aeat_xml(
+                "IE615_EXS", "response", resp_xml, filename="EXS_IE615_response_%s.xml" % rec.name, endpoint=endpoint,
+                http_status=status_code, duration_ms=(time.monotonic() - start) * 1000.0,
+            )
             if status_code != 200:
                 rec.state = "error"
-                rec.error_message = _("AEAT respondió HTTP %s. Revisar adjunto de respuesta.") % status_code
+                rec.error_message = _("AEAT respondió HTTP %s. Revisar la respuesta en Mensajes AEAT.") % status_code
                 raise UserError(rec.error_message)
             rec.last_response_date = fields.Datetime.now()
             parsed = parser.parse_ie615_response(resp_xml or "")
@@ -2373,7 +3055,17 @@ class AduanaExpediente(models.Model):
             return vat
         return "%s%s" % (default_country, vat)
 
+    _IMP_ADDRESS = compile_fragment("""<Address>
+<streetAndNumber>{street}</streetAndNumber>
+<postcode>{postcode}</postcode>
+<city>{city}</city>
+<country>{country}</country>
+</Address>""")
+
     def _imp_address_xml(self, partner):
+        return memoize_partner_fragment("imp_address", partner, self._render_imp_address)
+
+    def _render_imp_address(self, partner):
         if not partner:
             return ""
         street = " ".join(p for p in [partner.street or "", partner.street2 or ""] if p)[:70]
@@ -2381,16 +3073,11 @@ class AduanaExpediente(models.Model):
         country = partner.country_id.code if partner.country_id else ""
         if not street or not city or not country:
             return ""
-        return """<Address>
-<streetAndNumber>%s</streetAndNumber>
-<postcode>%s</postcode>
-<city>%s</city>
-<country>%s</country>
-</Address>""" % (
-            xml_escape(street),
-            xml_escape((partner.zip or "00000")[:17]),
-            xml_escape(city),
-            xml_escape(country),
+        return self._IMP_ADDRESS.render(
+            street=street,
+            postcode=(partner.zip or "00000")[:17],
+            city=city,
+            country=country,
         )
 
     def _imp_contact_person_xml(self, partner):
@@ -2421,10 +3108,7 @@ class AduanaExpediente(models.Model):
             return ""
         if ident.startswith("ES"):
             return "<identificationNumber>%s</identificationNumber>" % xml_escape(ident)
-        allow_foreign = (
-            self.env["ir.config_parameter"].sudo().get_param("aduanas_transport.imp_allow_foreign_seller_eori")
-            or ""
-        ).strip().lower() in ("1", "true", "yes", "si", "sí")
+        allow_foreign = self._aeat_settings()["imp_allow_foreign_seller_eori"]
         if allow_foreign:
             return "<identificationNumber>%s</identificationNumber>" % xml_escape(ident)
         return ""
@@ -2460,26 +3144,31 @@ class AduanaExpediente(models.Model):
         method = (self.import_tax_method_of_payment or "E").strip().upper()[:1]
         return method if re.match(r"^[A-Z]$", method) else "E"
 
-    def _imp_duty_tax_block_xml(self, sequence, tax_type, base_amount, tax_rate, tax_amount, method_of_payment):
-        return """<DutiesAndTaxes>
-<sequenceNumber>%s</sequenceNumber>
-<taxType>%s</taxType>
-<payableTaxAmount>%.2f</payableTaxAmount>
-<methodOfPayment>%s</methodOfPayment>
+    _IMP_DUTY_TAX = compile_fragment("""<DutiesAndTaxes>
+<sequenceNumber>{sequence!raw}</sequenceNumber>
+<taxType>{tax_type}</taxType>
+<payableTaxAmount>{tax_amount!raw}</payableTaxAmount>
+<methodOfPayment>{method_of_payment}</methodOfPayment>
 <TaxBase>
 <sequenceNumber>1</sequenceNumber>
-<taxRate>%.3f</taxRate>
-<amount>%.2f</amount>
-<taxAmount>%.2f</taxAmount>
+<taxRate>{tax_rate!raw}</taxRate>
+<amount>{base_amount!raw}</amount>
+<taxAmount>{tax_amount!raw}</taxAmount>
 </TaxBase>
-</DutiesAndTaxes>""" % (
-            sequence,
-            xml_escape(tax_type),
-            tax_amount,
-            xml_escape(method_of_payment),
-            tax_rate,
-            base_amount,
-            tax_amount,
+</DutiesAndTaxes>""")
+    _IMP_CALCULATION_OF_TAXES = compile_fragment("""<CalculationOfTaxes>
+<preference>{preference}</preference>
+{blocks!raw}
+</CalculationOfTaxes>""")
+
+    def _imp_duty_tax_block_xml(self, sequence, tax_type, base_amount, tax_rate, tax_amount, method_of_payment):
+        return self._IMP_DUTY_TAX.render(
+            sequence=sequence,
+            tax_type=tax_type,
+            tax_amount="%.2f" % tax_amount,
+            method_of_payment=method_of_payment,
+            tax_rate="%.3f" % tax_rate,
+            base_amount="%.2f" % base_amount,
         )
 
     def _imp_calculation_of_taxes_xml(self, line, preference):
@@ -2502,13 +3191,24 @@ class AduanaExpediente(models.Model):
         blocks.append(
             self._imp_duty_tax_block_xml(seq, "B00", vat_base, vat_rate, vat_tax, method_b00)
         )
-        return """<CalculationOfTaxes>
-<preference>%s</preference>
-%s
-</CalculationOfTaxes>""" % (xml_escape(preference), "\n".join(blocks))
+        return self._IMP_CALCULATION_OF_TAXES.render(preference=preference, blocks="\n".join(blocks))
 
-    def _imp_previous_document_xml(self, line, type_of_packages="CT"):
-        """PreviousDocument por partida; solo si requiere_ddt (N337 + MRN DDT/G4)."""
+    _IMP_PREVIOUS_DOCUMENT = compile_fragment("""<PreviousDocument>
+<sequenceNumber>1</sequenceNumber>
+<type>N337</type>
+<referenceNumber>{reference}</referenceNumber>{type_of_packages_xml!raw}{packages_xml!raw}
+<measurementUnitAndQualifier>KGMG</measurementUnitAndQualifier>
+<quantity>{quantity}</quantity>{goods_item_xml!raw}
+</PreviousDocument>""")
+
+    def _imp_n337_context(self):
+        """Referencia N337 normalizada, si lleva goodsItemIdentifier y si admite decimales (común a todas las partidas)."""
+        self.ensure_one()
+        reference = self._normalize_n337_reference(self._get_mrn_ddt())
+        return reference, self._n337_reference_uses_goods_item(reference), self._ddt_quantity_allows_decimals()
+
+    def _imp_previous_document_xml(self, line, type_of_packages="CT", n337=None):
+        """PreviousDocument por partida; solo si requiere_ddt (N337 + MRN DDT/G4). n337: ver _imp_n337_context."""
         self.ensure_one()
         if not self.requiere_ddt:
             return ""
@@ -2523,8 +3223,7 @@ class AduanaExpediente(models.Model):
             )
 
         if doc_type == "N337":
-            reference = self._normalize_n337_reference(self._get_mrn_ddt())
-            is_g4 = self._ddt_quantity_allows_decimals()
+            reference, uses_goods_item, is_g4 = n337 or self._imp_n337_context()
             if is_g4:
                 quantity = "%.2f" % gross
             else:
@@ -2540,7 +3239,7 @@ class AduanaExpediente(models.Model):
                 type_of_packages_xml = "\n<typeOfPackages>%s</typeOfPackages>" % xml_escape(packages_type)
                 packages_xml = "\n<numberOfPackages>%s</numberOfPackages>" % packages
             goods_item_xml = ""
-            if self._n337_reference_uses_goods_item(reference):
+            if uses_goods_item:
                 ddt_item = line.import_ddt_goods_item or line.item_number
                 if not ddt_item:
                     raise UserError(
@@ -2548,18 +3247,12 @@ class AduanaExpediente(models.Model):
                         % (line.item_number or line.id)
                     )
                 goods_item_xml = "\n<goodsItemIdentifier>%s</goodsItemIdentifier>" % xml_escape(str(ddt_item))
-            return """<PreviousDocument>
-<sequenceNumber>1</sequenceNumber>
-<type>N337</type>
-<referenceNumber>%s</referenceNumber>%s%s
-<measurementUnitAndQualifier>KGMG</measurementUnitAndQualifier>
-<quantity>%s</quantity>%s
-</PreviousDocument>""" % (
-                xml_escape(reference[:70]),
-                type_of_packages_xml,
-                packages_xml,
-                xml_escape(quantity),
-                goods_item_xml,
+            return self._IMP_PREVIOUS_DOCUMENT.render(
+                reference=reference[:70],
+                type_of_packages_xml=type_of_packages_xml,
+                packages_xml=packages_xml,
+                quantity=quantity,
+                goods_item_xml=goods_item_xml,
             )
 
     def _validate_aeat_endpoint_for_xml(self, endpoint, xml_content, direction):
@@ -2601,9 +3294,55 @@ class AduanaExpediente(models.Model):
         if (self.pais_origen or "").upper() != "AD" or (self.pais_destino or "").upper() != "ES":
             raise UserError(_("Para importación Andorra → España debe declarar countryOfDispatch=AD y countryOfDestination=ES."))
 
-    def _build_cc415a_soap_envelope(self):
-        """Genera una declaración completa H1 CC415A básica según CC415AV1Ent.xsd."""
+    _CC415A_GOODS_ITEM = compile_fragment("""<GoodsShipmentItem>
+<sequenceNumber>{sequence!raw}</sequenceNumber>
+<declarationGoodsItemNumber>{goods_item_number!raw}</declarationGoodsItemNumber>
+<statisticalValue>{statistical_value!raw}</statisticalValue>
+<Procedure>
+<requestedProcedure>40</requestedProcedure>
+<previousProcedure>00</previousProcedure>
+</Procedure>
+<Origin>
+<countryOfOrigin>{origin_country!raw}</countryOfOrigin>
+</Origin>
+<Commodity>
+<descriptionOfGoods>{description}</descriptionOfGoods>
+<CommodityCode>
+<harmonizedSystemSubheadingCode>{hs}</harmonizedSystemSubheadingCode>
+<combinedNomenclatureCode>{cn}</combinedNomenclatureCode>
+{taric_xml!raw}</CommodityCode>
+<GoodsMeasure>
+<grossMass>{gross!raw}</grossMass>
+<netMass>{net!raw}</netMass>
+</GoodsMeasure>
+<InvoiceLine>
+<itemAmountInvoiced>{amount!raw}</itemAmountInvoiced>
+</InvoiceLine>
+{taxes_xml!raw}
+</Commodity>
+<Packaging>
+<sequenceNumber>1</sequenceNumber>
+<typeOfPackages>{packages_type}</typeOfPackages>
+{packages_xml!raw}</Packaging>
+{previous_document_xml!raw}
+<SupportingDocument>
+<sequenceNumber>1</sequenceNumber>
+<type>N380</type>
+<referenceNumber>{invoice_ref!raw}</referenceNumber>
+<documentLineItemNumber>{document_line!raw}</documentLineItemNumber>
+</SupportingDocument>
+<CustomsValuation>
+<valuationMethod>{valuation_method!raw}</valuationMethod>
+</CustomsValuation>
+</GoodsShipmentItem>""")
+
+    def _build_cc415a_soap_envelope(self, part=None):
+        """
+        Genera una declaración completa H1 CC415A básica según CC415AV1Ent.xsd. Con part
+        (aduana.expediente.declaracion) solo incluye las partidas de esa declaración parcial.
+        """
         self.ensure_one()
+        lines = self._declaration_goods_lines("CC415A", part)
         self._validate_import_cc415a_roles()
         if not (self.oficina or "").strip():
             raise UserError(_("Informe la oficina aduanera de importación."))
@@ -2613,7 +3352,7 @@ class AduanaExpediente(models.Model):
             raise UserError(_("El consignatario/importador debe tener NIF/EORI para CC415A."))
         company = self.env.company
         declarant_id = self._imp_eori(company.partner_id, "ES") or importer_id
-        lrn = (self.lrn or self.name or ("EXP%s" % (self.id or ""))).replace(" ", "")[:22]
+        lrn = part.lrn if part else (self.lrn or self.name or ("EXP%s" % (self.id or ""))).replace(" ", "")[:22]
         now = fields.Datetime.now()
         prep_time = now.strftime("%Y-%m-%dT%H:%M:%S")
         msg_id = ("%s-CC415A-%s" % (lrn, now.strftime("%Y%m%d%H%M%S")))[:40]
@@ -2642,89 +3381,57 @@ class AduanaExpediente(models.Model):
             self._normalize_n337_reference(self._get_mrn_ddt())
         location_authorisation = (
             self.location_authorisation_number
-            or self.env["ir.config_parameter"].sudo().get_param("aduanas_transport.aeat_preprod_location_authorisation")
+            or self._aeat_settings()["preprod_location_authorisation"]
             or "010101DA11"
         )
         transport_country = (self.pais_transporte or "ES").strip().upper()[:2]
-        total_gross = sum((line.peso_bruto or 0.0) for line in self.line_ids) or 0.0
-        lines_xml = []
-        for idx, line in enumerate(self.line_ids.sorted(key=lambda l: l.item_number or l.id or 0), 1):
-            partida = (line.taric_completo or line.partida or "").replace(" ", "").replace(".", "")
-            if len(partida) != 10 or not partida.isdigit():
-                raise UserError(_("Línea %s: informe un TARIC completo de 10 dígitos.") % idx)
-            hs = partida[:6]
-            cn = partida[6:8] if len(partida) >= 8 else "00"
-            taric = partida[8:10] if len(partida) >= 10 else ""
-            taric_xml = "<taricCode>%s</taricCode>" % xml_escape(taric) if taric else ""
-            goods_item_number = line.item_number or idx
-            packages_type = (line.type_of_packages or "CT").strip().upper()
-            packages_count = int(line.bultos or 1)
-            lines_xml.append("""<GoodsShipmentItem>
-<sequenceNumber>%s</sequenceNumber>
-<declarationGoodsItemNumber>%s</declarationGoodsItemNumber>
-<statisticalValue>%.2f</statisticalValue>
-<Procedure>
-<requestedProcedure>40</requestedProcedure>
-<previousProcedure>00</previousProcedure>
-</Procedure>
-<Origin>
-<countryOfOrigin>%s</countryOfOrigin>
-</Origin>
-<Commodity>
-<descriptionOfGoods>%s</descriptionOfGoods>
-<CommodityCode>
-<harmonizedSystemSubheadingCode>%s</harmonizedSystemSubheadingCode>
-<combinedNomenclatureCode>%s</combinedNomenclatureCode>
-%s</CommodityCode>
-<GoodsMeasure>
-<grossMass>%.2f</grossMass>
-<netMass>%.2f</netMass>
-</GoodsMeasure>
-<InvoiceLine>
-<itemAmountInvoiced>%.2f</itemAmountInvoiced>
-</InvoiceLine>
-%s
-</Commodity>
-<Packaging>
-<sequenceNumber>1</sequenceNumber>
-<typeOfPackages>%s</typeOfPackages>
-%s</Packaging>
-%s
-<SupportingDocument>
-<sequenceNumber>1</sequenceNumber>
-<type>N380</type>
-<referenceNumber>%s</referenceNumber>
-<documentLineItemNumber>%s</documentLineItemNumber>
-</SupportingDocument>
-<CustomsValuation>
-<valuationMethod>%s</valuationMethod>
-</CustomsValuation>
-</GoodsShipmentItem>""" % (
-                idx,
-                goods_item_number,
-                line.valor_linea or 0.0,
-                xml_escape(origin_country),
-                xml_escape((line.descripcion or "Mercancia")[:512]),
-                xml_escape(hs),
-                xml_escape(cn),
-                taric_xml,
-                line.peso_bruto or 0.0,
-                line.peso_neto or 0.0,
-                line.valor_linea or 0.0,
-                self._imp_calculation_of_taxes_xml(line, preference),
-                xml_escape(packages_type),
-                (
-                    "<numberOfPackages>%s</numberOfPackages>" % packages_count
-                    if packages_type != "FR" and packages_count > 0
-                    else ""
-                ),
-                self._imp_previous_document_xml(line, packages_type),
-                xml_escape((self.numero_factura or self.name or "FACTURA")[:35]),
-                goods_item_number,
-                xml_escape(valuation_method),
-            ))
-        if not lines_xml:
+        total_gross = sum((line.peso_bruto or 0.0) for line in lines) or 0.0
+        # Valores comunes a todas las partidas: se calculan/escapan una vez fuera del bucle
+        origin_country_xml = xml_escape(origin_country)
+        invoice_ref_xml = xml_escape((self.numero_factura or self.name or "FACTURA")[:35])
+        valuation_method_xml = xml_escape(valuation_method)
+        n337 = self._imp_n337_context() if self.requiere_ddt else None
+        render_item = self._CC415A_GOODS_ITEM.render
+        if not lines:
             raise UserError(_("Añada al menos una línea de mercancía para generar CC415A."))
+
+        def _goods_items():
+            for idx, line in enumerate(lines, 1):
+                partida = (line.taric_completo or line.partida or "").replace(" ", "").replace(".", "")
+                if len(partida) != 10 or not partida.isdigit():
+                    raise UserError(
+                        _("Línea %s: informe un TARIC completo de 10 dígitos.") % ((line.item_number or idx) if part else idx)
+                    )
+                taric = partida[8:10] if len(partida) >= 10 else ""
+                # En una declaración parcial las partidas se renumeran desde 1; la línea de factura se conserva
+                goods_item_number = idx if part else (line.item_number or idx)
+                packages_type = (line.type_of_packages or "CT").strip().upper()
+                packages_count = int(line.bultos or 1)
+                yield render_item(
+                    sequence=idx,
+                    goods_item_number=goods_item_number,
+                    document_line=line.item_number or goods_item_number,
+                    statistical_value="%.2f" % (line.valor_linea or 0.0),
+                    origin_country=origin_country_xml,
+                    description=(line.descripcion or "Mercancia")[:512],
+                    hs=partida[:6],
+                    cn=partida[6:8] if len(partida) >= 8 else "00",
+                    taric_xml="<taricCode>%s</taricCode>" % xml_escape(taric) if taric else "",
+                    gross="%.2f" % (line.peso_bruto or 0.0),
+                    net="%.2f" % (line.peso_neto or 0.0),
+                    amount="%.2f" % (line.valor_linea or 0.0),
+                    taxes_xml=self._imp_calculation_of_taxes_xml(line, preference),
+                    packages_type=packages_type,
+                    packages_xml=(
+                        "<numberOfPackages>%s</numberOfPackages>" % packages_count
+                        if packages_type != "FR" and packages_count > 0
+                        else ""
+                    ),
+                    previous_document_xml=self._imp_previous_document_xml(line, packages_type, n337=n337),
+                    invoice_ref=invoice_ref_xml,
+                    valuation_method=valuation_method_xml,
+                )
+
         declarant_partner = company.partner_id
         seller_id = self._imp_eori(self.remitente, self.pais_origen or "AD")
         seller_name = "<name>%s</name>" % xml_escape((self.remitente.name or "")[:70]) if self.remitente and self.remitente.name else ""
@@ -2756,7 +3463,7 @@ class AduanaExpediente(models.Model):
         incoterm = self.incoterm or "DAP"
         delivery_location = self.import_delivery_location or "LA FARGA DE MOLES"
         ns = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aduanas/es/aeat/adip/jdit/ws/cci/CC415AV1Ent.xsd"
-        return """<?xml version="1.0" encoding="UTF-8"?>
+        document = """<?xml version="1.0" encoding="UTF-8"?>
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:imp="%s">
 <soapenv:Header/>
 <soapenv:Body>
@@ -2853,99 +3560,422 @@ class AduanaExpediente(models.Model):
             total_gross,
             xml_escape(location_authorisation),
             xml_escape(transport_country),
-            "\n".join(lines_xml),
+            ITEMS_MARKER,
+        )
+        xml, _count = stream_document(document, _goods_items())
+        return xml
+
+    def _generate_imp_decl_artefacts(self, errors=None):
+        """CC415A del lote: declaraciones parciales donde toque y el resto en una pasada (un create de adjuntos)."""
+        single = self - self._generate_split_declarations("CC415A", errors=errors)
+        single._get_xml_artefacts_batch(
+            "CC415A", lambda rec: rec._cc415a_attachment_name(), lambda rec: rec._build_cc415a_soap_envelope(),
+            "_CC415A.xml", errors=errors,
         )
 
     def action_generate_imp_decl(self):
         for rec in self:
             if rec.direction != "import":
                 raise UserError(_("Operación España → Andorra / país tercero: debe presentarse por AES CC515C, no por CC415A/H1."))
-            # Validar datos antes de generar
-            validator = self.env["aduanas.validator"]
+        self._prefetch_declaration_data()
+        # Validar datos antes de generar
+        validator = self.env["aduanas.validator"]
+        for rec in self:
             validator.validate_expediente_import(rec)
-            xml = rec._build_cc415a_soap_envelope()
-            rec._attach_xml(f"{rec.name}_CC415A.xml", xml)
-            rec.state = "predeclared"
-            rec.error_message = False
+        self._generate_imp_decl_artefacts()
+        self.write({"state": "predeclared", "error_message": False})
         return True
 
+    def action_generate_declarations_batch(self):
+        """
+        Genera los borradores de declaración de los expedientes seleccionados (CC415A en
+        importación, CUSDEC EX1/CC515C en exportación) con precarga de todo el lote. Un
+        expediente con datos no válidos no detiene al resto; se resume en una notificación.
+        """
+        start = time.monotonic()
+        self._prefetch_declaration_data()
+        validator = self.env["aduanas.validator"]
+        errors = {}
+        for rec in self:
+            try:
+                if rec.direction == "import":
+                    validator.validate_expediente_import(rec)
+                else:
+                    validator.validate_expediente_export(rec)
+            except UserError as e:
+                errors[rec.id] = str(e)
+        valid = self.filtered(lambda r: r.id not in errors)
+        imports = valid.filtered(lambda r: r.direction == "import")
+        imports._generate_imp_decl_artefacts(errors=errors)
+        (valid - imports)._generate_cc515c_artefacts(errors=errors)
+        generated = valid.filtered(lambda r: r.id not in errors)
+        generated.write({"state": "predeclared", "error_message": False})
+        try:
+            with self.env.cr.savepoint():
+                generated.filtered(lambda r: r.direction == "export")._generate_dua_pdfs()
+        except Exception as pdf_error:
+            _logger.error("Error generando en lote el PDF del DUA: %s", pdf_error)
+        _logger.info(
+            "Generación en lote: %s expedientes, %s generados, %s con errores en %.2fs",
+            len(self), len(generated), len(errors), time.monotonic() - start,
+        )
+        detail = "\n".join("%s: %s" % (rec.name, errors[rec.id][:200]) for rec in self if rec.id in errors)
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Generación de declaraciones en lote"),
+                "message": _("%s de %s generados.%s") % (len(generated), len(self), ("\n" + detail) if detail else ""),
+                "type": "success" if not errors else "warning",
+                "sticky": bool(errors),
+                "next": {"type": "ir.actions.client", "tag": "reload"},
+            },
+        }
+
+
+    def _prepare_imp_decl_send(self, part=None):
+        """
+        Valida y construye la declaración CC415A/H1 (solo escribe el adjunto *_CC415A.xml si cambia).
+        Con part construye la declaración parcial (adjunto propio de la declaración).
+        """
+        self.ensure_one()
+        if self.direction != "import":
+            raise UserError(_("Operación España → Andorra / país tercero: debe presentarse por AES CC515C, no por CC415A/H1."))
+        settings = self._get_settings()
+        self.env["aduanas.validator"].validate_expediente_import(self)
+        if part:
+            _att, xml_content = part._get_xml(for_send=True)
+        else:
+            _att, xml_content = self._get_xml_artefact(
+                "CC415A", self._cc415a_attachment_name(), self._build_cc415a_soap_envelope, lookup="_CC415A.xml",
+                for_send=True,
+            )
+        endpoint = settings.get("aeat_endpoint_imp_decl")
+        self._validate_aeat_endpoint_for_xml(endpoint, xml_content, "import")
+        return {"service": "IMP_DECL", "endpoint": endpoint, "xml": xml_content, "timeout": 30, "part": part}
+
+    def _log_imp_decl_request(self, prep):
+        self.ensure_one()
+        if prep.get("part"):
+            return prep["part"]._log_request(prep)
+        self._archive_aeat_xml(
+            "IMP_DECL", "request", prep["xml"], filename=f"{self.name}_CC415A_request.xml", endpoint=prep["endpoint"],
+        )
+        self._mark_xml_artefact_sent("_CC415A.xml")
+        self.state = "presented"
+
+    def _apply_imp_decl_response(self, prep, status_code, resp_xml):
+        self.ensure_one()
+        if prep.get("part"):
+            return prep["part"]._apply_response(prep, status_code, resp_xml)
+        rec = self
+        parser = self.env["aduanas.xml.parser"]
+        rec._archive_aeat_xml(
+            "IMP_DECL", "response", resp_xml, filename=f"{rec.name}_CC415A_response.xml", endpoint=prep["endpoint"],
+            http_status=status_code, duration_ms=(prep.get("elapsed") or 0.0) * 1000.0,
+        )
+        if status_code != 200:
+            rec.state = "error"
+            rec.error_message = _("AEAT respondió HTTP %s. Revisar la respuesta en Mensajes AEAT.") % status_code
+            return rec._aeat_response_error(rec.error_message)
+
+        # Parsear respuesta mejorada
+        parsed = parser.parse_aeat_response(resp_xml, "IMP_DECL")
+        rec.last_response_date = fields.Datetime.now()
+
+        if parsed.get("success") and (parsed.get("mrn") or parsed.get("accepted")):
+            if parsed.get("mrn"):
+                rec.mrn = parsed["mrn"]
+            rec.state = "accepted"
+            rec.error_message = False
+            messages = parsed.get("messages") or []
+            body = _("Declaración importación H1 aceptada. MRN: %s") % (rec.mrn or _("pendiente/no informado en respuesta"))
+            if messages:
+                body += _("\nMensajes: %s") % "\n".join(messages)
+            rec.with_context(mail_notrack=True).message_post(
+                body=body,
+                subtype_xmlid='mail.mt_note'
+            )
+            # Procesar incidencias si las hay
+            if parsed.get("incidencias"):
+                rec._procesar_incidencias(parsed["incidencias"], "imp_decl")
+        else:
+            rec.state = "error"
+            error_msg = "\n".join(parsed.get("errors", [])) or parsed.get("error", _("Error desconocido"))
+            if error_msg == _("Error desconocido") and resp_xml:
+                fault = None
+                if resp_xml.strip().startswith("<"):
+                    try:
+                        fault = parser._find_first_text(
+                            ET.fromstring(resp_xml),
+                            "faultstring", "FaultString", "errorDescription", "errorText", "remarks"
+                        )
+                    except Exception:
+                        fault = None
+                if fault:
+                    error_msg = fault
+            if error_msg == _("Error desconocido") and resp_xml:
+                error_msg = _("AEAT devolvió una respuesta sin MRN ni detalle de error parseable. Revise la respuesta en Mensajes AEAT. Extracto:\n%s") % (
+                    (resp_xml or "").strip()[:1200]
+                )
+            rec.error_message = error_msg
+            rec.with_context(mail_notrack=True).message_post(body=_("Error al enviar declaración:\n%s") % error_msg, subtype_xmlid='mail.mt_note')
+            # Procesar incidencias de error
+            if parsed.get("incidencias"):
+                rec._procesar_incidencias(parsed["incidencias"], "imp_decl")
+            return rec._aeat_response_error(_("Error al enviar a AEAT:\n%s") % error_msg)
+        return True
 
     def action_send_imp_decl(self):
         client = self.env["aduanas.aeat.client"]
-        parser = self.env["aduanas.xml.parser"]
         for rec in self:
-            if rec.direction != "import":
-                raise UserError(_("Operación España → Andorra / país tercero: debe presentarse por AES CC515C, no por CC415A/H1."))
-            settings = rec._get_settings()
-            validator = self.env["aduanas.validator"]
-            validator.validate_expediente_import(rec)
-            xml_content = rec._build_cc415a_soap_envelope()
-            endpoint = settings.get("aeat_endpoint_imp_decl")
-            rec._validate_aeat_endpoint_for_xml(endpoint, xml_content, "import")
-            rec._attach_xml(f"{rec.name}_CC415A_request.xml", xml_content)
-            rec.state = "presented"
-            status_code, resp_xml = client.send_xml(endpoint, xml_content, service="IMP_DECL")
-            rec._attach_xml(f"{rec.name}_CC415A_response.xml", resp_xml or "")
-            if status_code != 200:
-                rec.state = "error"
-                rec.error_message = _("AEAT respondió HTTP %s. Revisar adjunto de respuesta.") % status_code
-                raise UserError(rec.error_message)
-            
-            # Parsear respuesta mejorada
-            parsed = parser.parse_aeat_response(resp_xml, "IMP_DECL")
-            rec.last_response_date = fields.Datetime.now()
-            
-            if parsed.get("success") and (parsed.get("mrn") or parsed.get("accepted")):
-                if parsed.get("mrn"):
-                    rec.mrn = parsed["mrn"]
-                rec.state = "accepted"
-                rec.error_message = False
-                messages = parsed.get("messages") or []
-                body = _("Declaración importación H1 aceptada. MRN: %s") % (rec.mrn or _("pendiente/no informado en respuesta"))
-                if messages:
-                    body += _("\nMensajes: %s") % "\n".join(messages)
-                rec.with_context(mail_notrack=True).message_post(
-                    body=body,
-                    subtype_xmlid='mail.mt_note'
-                )
-                # Procesar incidencias si las hay
-                if parsed.get("incidencias"):
-                    rec._procesar_incidencias(parsed["incidencias"], "imp_decl")
-            else:
-                rec.state = "error"
-                error_msg = "\n".join(parsed.get("errors", [])) or parsed.get("error", _("Error desconocido"))
-                if error_msg == _("Error desconocido") and resp_xml:
-                    fault = None
-                    if resp_xml.strip().startswith("<"):
-                        try:
-                            fault = parser._find_first_text(
-                                ET.fromstring(resp_xml),
-                                "faultstring", "FaultString", "errorDescription", "errorText", "remarks"
-                            )
-                        except Exception:
-                            fault = None
-                    if fault:
-                        error_msg = fault
-                if error_msg == _("Error desconocido") and resp_xml:
-                    error_msg = _("AEAT devolvió una respuesta sin MRN ni detalle de error parseable. Revise el adjunto de respuesta. Extracto:\n%s") % (
-                        (resp_xml or "").strip()[:1200]
-                    )
-                rec.error_message = error_msg
-                rec.with_context(mail_notrack=True).message_post(body=_("Error al enviar declaración:\n%s") % error_msg, subtype_xmlid='mail.mt_note')
-                # Procesar incidencias de error
-                if parsed.get("incidencias"):
-                    rec._procesar_incidencias(parsed["incidencias"], "imp_decl")
-                raise UserError(_("Error al enviar a AEAT:\n%s") % error_msg)
+            parts = rec._split_declarations("CC415A")
+            if parts:
+                parts.action_send()
+                continue
+            prep = rec._prepare_imp_decl_send()
+            rec._log_imp_decl_request(prep)
+            start = time.monotonic()
+            status_code, resp_xml = client.send_xml(prep["endpoint"], prep["xml"], service="IMP_DECL")
+            prep["elapsed"] = time.monotonic() - start
+            rec._apply_imp_decl_response(prep, status_code, resp_xml)
         return True
 
-    def _build_imp_query_v3_soap_envelope(self):
-        """Consulta completa de importación CAU/H1 por MRN (ConsultaImportacionV3Ent)."""
+    # ===== Envío en lote a AEAT (concurrencia acotada) =====
+    # modo -> (preparar, registrar petición, aplicar respuesta)
+    _AEAT_BATCH_MODES = {
+        "cc515c": ("_prepare_cc515c_send", "_log_cc515c_request", "_apply_cc515c_response"),
+        "imp_decl": ("_prepare_imp_decl_send", "_log_imp_decl_request", "_apply_imp_decl_response"),
+        "ccaesc": ("_prepare_ccaesc_send", "_log_ccaesc_request", "_apply_ccaesc_response"),
+        "imp_query": ("_prepare_imp_query_send", "_log_imp_query_request", "_apply_imp_query_response"),
+    }
+    _AEAT_BATCH_DEFAULT_LIMITS = {"CC515C": 4, "IMP_DECL": 4, "CCAESC": 8, "IMP_QUERY_V3": 8}
+    # modo de consulta -> declaración parcial cuyo MRN se consulta
+    _AEAT_BATCH_POLL = {"ccaesc": "CC515C", "imp_query": "CC415A"}
+    # modo -> (declaración parcial, dirección) de los modos que dividen expedientes grandes
+    _AEAT_BATCH_SPLIT = {"cc515c": ("CC515C", "export"), "imp_decl": ("CC415A", "import")}
+
+    @api.model
+    def _aeat_batch_limits(self):
+        """(max_workers, {servicio: límite}) desde aduanas_transport.batch.* con valores por defecto."""
+        icp = self.env["ir.config_parameter"].sudo()
+        try:
+            max_workers = int(icp.get_param("aduanas_transport.batch.max_workers") or 8)
+        except ValueError:
+            max_workers = 8
+        limits = {}
+        for service, default in self._AEAT_BATCH_DEFAULT_LIMITS.items():
+            try:
+                limits[service] = int(icp.get_param("aduanas_transport.batch.limit.%s" % service.lower()) or default)
+            except ValueError:
+                limits[service] = default
+        return max(max_workers, 1), limits
+
+    def _aeat_batch_parts(self, mode):
+        """
+        Declaraciones parciales del lote: las pendientes de enviar, dividiendo el expediente como
+        action_send_cc515c / action_send_imp_decl si supera el máximo de partidas, o en la
+        consulta de estado las que tienen MRN y esperan levante o salida. None si el expediente va
+        en una sola declaración.
+        """
         self.ensure_one()
-        if not self.mrn:
+        if mode in self._AEAT_BATCH_POLL:
+            service = self._AEAT_BATCH_POLL[mode]
+            parts = self.declaracion_ids.filtered(lambda d: d.service == service)
+            if not parts:
+                return None
+            return parts.filtered(lambda d: d.mrn and d.state in DECLARACION_POLL_STATES).sorted("part")
+        service, direction = self._AEAT_BATCH_SPLIT.get(mode, (None, None))
+        if not service or self.direction != direction:
+            return None
+        parts = self._split_declarations(service)
+        if not parts:
+            return None
+        return parts.filtered(lambda d: d.state not in DECLARACION_SENT_STATES).sorted("part")
+
+    def _aeat_response_error(self, message):
+        """
+        Respuesta AEAT con error ya registrada en el expediente: en el envío individual lanza
+        UserError; en lote (contexto aeat_batch) devuelve False para que el lote la anote y siga.
+        """
+        if self.env.context.get("aeat_batch"):
+            return False
+        raise UserError(message)
+
+    def _aeat_batch_send(self, mode):
+        """
+        Envío en lote: 1) construye y valida todos los envelopes (una declaración por parte si
+        el expediente se divide), 2) registra y archiva cada petición en su savepoint, 3) los
+        envía en paralelo (hilos solo HTTP, límite por endpoint), 4) aplica cada respuesta en su
+        propio savepoint: un error al aplicarla no deshace la petición ni la respuesta archivadas.
+        Con contexto aeat_batch_commit=True (cron, job y acciones de lote) se hace commit tras
+        registrar las peticiones y tras cada expediente. Con aeat_poll_quiet=True (planificador)
+        un fallo de transporte o una respuesta con errores no cambia el estado ni el chatter.
+        Devuelve una lista de dicts por expediente: name, outcome, message, build_s, send_s, apply_s.
+        """
+        self = self.with_context(aeat_batch=True)
+        prepare_name, log_name, apply_name = self._AEAT_BATCH_MODES[mode]
+        client = self.env["aduanas.aeat.client"]
+        max_workers, limits = self._aeat_batch_limits()
+        commit = self.env.context.get("aeat_batch_commit")
+        report = {}
+        # (id expediente, id parte o 0) -> envío preparado
+        preps = {}
+        for rec in self:
+            start = time.monotonic()
+            line = report[rec.id] = {"name": rec.name, "outcome": "pending", "message": "",
+                                     "build_s": 0.0, "send_s": 0.0, "apply_s": 0.0}
+            rec_preps = {}
+            try:
+                with self.env.cr.savepoint():
+                    parts = rec._aeat_batch_parts(mode)
+                    if parts is None:
+                        rec_preps[(rec.id, 0)] = getattr(rec, prepare_name)()
+                    for part in parts or ():
+                        rec_preps[(rec.id, part.id)] = getattr(rec, prepare_name)(part=part)
+                if parts is not None and not parts:
+                    line.update(outcome="ok", message=_("Sin declaraciones parciales pendientes."))
+            except Exception as e:
+                line.update(outcome="invalid", message=str(e))
+                rec_preps = {}
+            for key, prep in rec_preps.items():
+                try:
+                    with self.env.cr.savepoint():
+                        getattr(rec, log_name)(prep)
+                    preps[key] = prep
+                except Exception as e:
+                    line.update(outcome="invalid", message=str(e))
+            line["build_s"] = time.monotonic() - start
+        if commit:
+            self.env.cr.commit()
+        jobs = [dict(prep, key=key) for key, prep in preps.items()]
+        responses = client.send_xml_batch(jobs, limits=limits, max_workers=max_workers)
+        for rec in self:
+            keys = [key for key in preps if key[0] == rec.id]
+            if not keys:
+                continue
+            line = report[rec.id]
+            start = time.monotonic()
+            errors = []
+            for key in keys:
+                prep = preps[key]
+                target = prep.get("part") or rec
+                response = responses.get(key) or {"status_code": 0, "text": "", "elapsed": 0.0, "error": None}
+                prep["elapsed"] = response.get("elapsed") or 0.0
+                line["send_s"] += prep["elapsed"]
+                try:
+                    with self.env.cr.savepoint():
+                        applied = getattr(rec, apply_name)(prep, response["status_code"], response["text"])
+                    if applied is False:
+                        errors.append(response.get("error") or target.error_message or _("Error desconocido"))
+                except Exception as e:
+                    message = response.get("error") or str(e)
+                    errors.append(message)
+                    if self.env.context.get("aeat_poll_quiet"):
+                        _logger.warning("Consulta AEAT %s de %s fallida: %s", mode, rec.name, message)
+                        continue
+                    with self.env.cr.savepoint():
+                        target.write({"state": "error", "error_message": message,
+                                      "last_response_date": fields.Datetime.now()})
+            if keys[0][1]:
+                rec._sync_declaration_state()
+            if errors or rec.state == "error":
+                line["outcome"] = "error"
+                line["message"] = "\n".join(errors) or rec.error_message or ""
+            elif line["outcome"] == "pending":
+                line["outcome"] = "ok"
+                line["message"] = rec.mrn or ""
+            line["apply_s"] = time.monotonic() - start
+            if commit:
+                self.env.cr.commit()
+        lines = [report[rec.id] for rec in self]
+        _logger.info(
+            "Lote AEAT %s: %s expedientes, %s ok, %s error, %s no válidos",
+            mode, len(lines),
+            len([l for l in lines if l["outcome"] == "ok"]),
+            len([l for l in lines if l["outcome"] == "error"]),
+            len([l for l in lines if l["outcome"] == "invalid"]),
+        )
+        return lines
+
+    def action_validate_xsd_imp_decl_batch(self):
+        """Comprueba contra el XSD CC415A las declaraciones de importación seleccionadas, sin enviarlas."""
+        records = self.filtered(lambda r: r.direction == "import")
+        lines = self.env["aduanas.xsd.validator"].validate_records(
+            records, "IMP_DECL", build=lambda rec: rec._get_xml_artefact(
+                "CC415A", rec._cc415a_attachment_name(), rec._build_cc415a_soap_envelope, lookup="_CC415A.xml",
+            )[1]
+        )
+        skipped = [l for l in lines if l["skipped"]]
+        if skipped:
+            return {
+                "type": "ir.actions.client",
+                "tag": "display_notification",
+                "params": {
+                    "title": _("Validación XSD CC415A"),
+                    "message": _("No se pudo validar: %s") % skipped[0]["skipped"],
+                    "type": "warning",
+                },
+            }
+        ok = len([l for l in lines if l["valid"]])
+        detail = "\n".join(
+            "%s: %s" % (l["name"], _("correcto") if l["valid"] else "; ".join(l["errors"][:3]))
+            for l in lines
+        )
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Validación XSD CC415A"),
+                "message": _("%s de %s cumplen el esquema:\n%s") % (ok, len(lines), detail),
+                "type": "success" if ok == len(lines) else "warning",
+                "sticky": ok != len(lines),
+            },
+        }
+
+    def _aeat_batch_notification(self, title, lines):
+        ok = len([l for l in lines if l["outcome"] == "ok"])
+        detail = "\n".join(
+            "%s: %s (%.1fs + %.1fs + %.1fs)%s" % (
+                l["name"], l["outcome"], l["build_s"], l["send_s"], l["apply_s"],
+                (" — %s" % l["message"][:120]) if l["message"] and l["outcome"] != "ok" else "",
+            )
+            for l in lines
+        )
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": title,
+                "message": _("%s de %s correctos (construcción + envío + aplicación):\n%s") % (ok, len(lines), detail),
+                "type": "success" if ok == len(lines) else "warning",
+                "sticky": ok != len(lines),
+                "next": {"type": "ir.actions.client", "tag": "reload"},
+            },
+        }
+
+    # Las acciones de lote confirman cada expediente: lo ya enviado a la AEAT no se deshace si otro falla
+    def action_send_cc515c_batch(self):
+        lines = self.with_context(aeat_batch_commit=True)._aeat_batch_send("cc515c")
+        return self._aeat_batch_notification(_("Presentación DUA en lote (CC515C)"), lines)
+
+    def action_send_imp_decl_batch(self):
+        lines = self.with_context(aeat_batch_commit=True)._aeat_batch_send("imp_decl")
+        return self._aeat_batch_notification(_("Presentación importación en lote (CC415A)"), lines)
+
+    def action_consultar_estado_dua_batch(self):
+        lines = self.with_context(aeat_batch_commit=True)._aeat_batch_send("ccaesc")
+        return self._aeat_batch_notification(_("Consulta estado DUA en lote (CCAESC)"), lines)
+
+    def _build_imp_query_v3_soap_envelope(self, mrn=None):
+        """Consulta completa de importación CAU/H1 por MRN (ConsultaImportacionV3Ent); mrn de una parte o el del expediente."""
+        self.ensure_one()
+        mrn = mrn or self.mrn
+        if not mrn:
             raise UserError(_("Debe tener un MRN antes de consultar el estado de importación."))
         now = fields.Datetime.now()
         prep_time = now.strftime("%Y-%m-%dT%H:%M:%S")
-        msg_id = "%s-IMPQ3-%s" % ((self.name or self.mrn).replace(" ", "")[:20], now.strftime("%Y%m%d%H%M%S"))
+        msg_id = "%s-IMPQ3-%s" % ((self.name or mrn).replace(" ", "")[:20], now.strftime("%Y%m%d%H%M%S"))
         ns = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aduanas/es/aeat/adip/jdit/ws/cci/ConsultaImportacionV3Ent.xsd"
         return """<?xml version="1.0" encoding="UTF-8"?>
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:imp="%s">
@@ -2961,49 +3991,96 @@ class AduanaExpediente(models.Model):
 </ConsultaCompleta>
 </imp:ConsultaImportacionV3Ent>
 </soapenv:Body>
-</soapenv:Envelope>""" % (ns, xml_escape(msg_id[:40]), prep_time, xml_escape(self.mrn))
+</soapenv:Envelope>""" % (ns, xml_escape(msg_id[:40]), prep_time, xml_escape(mrn))
+
+    def _prepare_imp_query_send(self, part=None):
+        """Valida y construye la ConsultaImportacionV3 (sin escribir nada); con part, la del MRN de la parte."""
+        self.ensure_one()
+        if self.direction != "import":
+            raise UserError(_("La consulta de importación solo aplica a expedientes de importación."))
+        endpoint = self._get_settings().get("aeat_endpoint_imp_query")
+        if not endpoint:
+            raise UserError(_("Configure el endpoint de consulta importación en Aduanas > Configuración."))
+        xml = self._build_imp_query_v3_soap_envelope(mrn=part.mrn if part else None)
+        return {"service": "IMP_QUERY_V3", "endpoint": endpoint, "xml": xml, "timeout": 60, "part": part}
+
+    def _log_imp_query_request(self, prep):
+        self.ensure_one()
+        filename = "%s_IMP_QUERY_V3_request.xml" % (prep["part"].lrn if prep.get("part") else self.name)
+        if self.env.context.get("aeat_poll_quiet"):
+            self._archive_aeat_xml("IMP_QUERY_V3", "request", prep["xml"], filename=filename, endpoint=prep["endpoint"])
+        else:
+            self._post_chatter_soap_xml("ConsultaImportacionV3", prep["endpoint"], prep["xml"], filename=filename)
+
+    def _apply_imp_query_response(self, prep, status_code, resp_xml):
+        self.ensure_one()
+        rec = self
+        part = prep.get("part")
+        name = part.lrn if part else rec.name
+        quiet = self.env.context.get("aeat_poll_quiet")
+        rec._archive_aeat_xml(
+            "IMP_QUERY_V3", "response", resp_xml, filename="%s_IMP_QUERY_V3_response.xml" % name,
+            endpoint=prep["endpoint"], http_status=status_code, duration_ms=(prep.get("elapsed") or 0.0) * 1000.0,
+        )
+        if status_code != 200:
+            if quiet:
+                _logger.info("Consulta importación %s: HTTP %s, se reintentará", name, status_code)
+                return False
+            rec.last_response_date = fields.Datetime.now()
+            rec.state = "error"
+            rec.error_message = _("AEAT respondió HTTP %s al consultar importación. Revisar la respuesta en Mensajes AEAT.") % status_code
+            return rec._aeat_response_error(rec.error_message)
+        parsed = self.env["aduanas.xml.parser"].parse_aeat_response(resp_xml or "", "IMP_QUERY_V3")
+        if parsed.get("errors") and quiet:
+            _logger.warning("Consulta importación %s con errores: %s", name, "; ".join(parsed["errors"]))
+            return False
+        if parsed.get("errors"):
+            rec.last_response_date = fields.Datetime.now()
+            rec.error_message = "\n".join(parsed.get("errors") or [])
+            if parsed.get("incidencias"):
+                rec._procesar_incidencias(parsed["incidencias"], "imp_decl")
+            return rec._aeat_response_error(_("La consulta de importación devolvió errores:\n%s") % rec.error_message)
+        if part:
+            part._apply_aeat_status(parsed, source="ConsultaImportacionV3")
+            if not quiet:
+                rec.with_context(mail_notrack=True).message_post(
+                    body=_("Consulta importación V3 realizada correctamente para MRN %s (declaración parcial %s/%s).")
+                    % (part.mrn, part.part, part.part_count),
+                    subtype_xmlid="mail.mt_note",
+                )
+            return True
+        if quiet:
+            rec._apply_aeat_parsed_response(parsed, source="ConsultaImportacionV3", quiet=True)
+            return True
+        rec.last_response_date = fields.Datetime.now()
+        if parsed.get("mrn"):
+            rec.mrn = parsed["mrn"]
+        rec.error_message = False
+        if rec.state in ("draft", "predeclared", "presented"):
+            rec.state = "accepted"
+        rec.with_context(mail_notrack=True).message_post(
+            body=_("Consulta importación V3 realizada correctamente para MRN %s.") % (rec.mrn or "-"),
+            subtype_xmlid="mail.mt_note",
+        )
+        return True
 
     def action_consultar_estado_importacion(self):
-        """Consulta importación CAU/H1 por MRN mediante ConsultaImportacionV3."""
+        """
+        Consulta importación CAU/H1 por MRN mediante ConsultaImportacionV3; si el expediente se
+        dividió, una consulta por cada declaración parcial con MRN.
+        """
         client = self.env["aduanas.aeat.client"]
-        parser = self.env["aduanas.xml.parser"]
         for rec in self:
-            if rec.direction != "import":
-                raise UserError(_("La consulta de importación solo aplica a expedientes de importación."))
-            settings = rec._get_settings()
-            endpoint = settings.get("aeat_endpoint_imp_query")
-            if not endpoint:
-                raise UserError(_("Configure el endpoint de consulta importación en Aduanas > Configuración."))
-            soap_payload = rec._build_imp_query_v3_soap_envelope()
-            rec._attach_xml("%s_IMP_QUERY_V3_request.xml" % rec.name, soap_payload)
-            rec._post_chatter_soap_xml(
-                "ConsultaImportacionV3",
-                endpoint,
-                soap_payload,
-                filename="%s_IMP_QUERY_V3_request.xml" % rec.name,
-            )
-            status_code, resp_xml = client.send_xml(endpoint, soap_payload, service="IMP_QUERY_V3", timeout=60)
-            rec._attach_xml("%s_IMP_QUERY_V3_response.xml" % rec.name, resp_xml or "")
-            rec.last_response_date = fields.Datetime.now()
-            if status_code != 200:
-                rec.state = "error"
-                rec.error_message = _("AEAT respondió HTTP %s al consultar importación. Revisar adjunto de respuesta.") % status_code
-                raise UserError(rec.error_message)
-            parsed = parser.parse_aeat_response(resp_xml or "", "IMP_QUERY_V3")
-            if parsed.get("errors"):
-                rec.error_message = "\n".join(parsed.get("errors") or [])
-                if parsed.get("incidencias"):
-                    rec._procesar_incidencias(parsed["incidencias"], "imp_decl")
-                raise UserError(_("La consulta de importación devolvió errores:\n%s") % rec.error_message)
-            if parsed.get("mrn"):
-                rec.mrn = parsed["mrn"]
-            rec.error_message = False
-            if rec.state in ("draft", "predeclared", "presented"):
-                rec.state = "accepted"
-            rec.with_context(mail_notrack=True).message_post(
-                body=_("Consulta importación V3 realizada correctamente para MRN %s.") % (rec.mrn or "-"),
-                subtype_xmlid="mail.mt_note",
-            )
+            parts = rec._aeat_batch_parts("imp_query")
+            for part in parts if parts is not None else [None]:
+                prep = rec._prepare_imp_query_send(part=part)
+                rec._log_imp_query_request(prep)
+                start = time.monotonic()
+                status_code, resp_xml = client.send_xml(prep["endpoint"], prep["xml"], service="IMP_QUERY_V3", timeout=60)
+                prep["elapsed"] = time.monotonic() - start
+                rec._apply_imp_query_response(prep, status_code, resp_xml)
+            if parts is not None:
+                rec._sync_declaration_state()
         return True
 
     # ===== Bandeja AEAT (común) =====
@@ -3023,12 +4100,16 @@ class AduanaExpediente(models.Model):
             )
             endpoint = settings.get("aeat_endpoint_bandeja")
             ultimo_inicial = rec.bandeja_last_num
+            start = time.monotonic()
             status_code, resp = client.send_xml(endpoint, xml, service="BANDEJA")
+            response_filename = "%s_BANDEJA_response_%s.xml" % (rec.name, rec.bandeja_last_num + 1)
+            rec._archive_aeat_xml(
+                "BANDEJA", "response", resp, filename=response_filename, endpoint=endpoint,
+                http_status=status_code, duration_ms=(time.monotonic() - start) * 1000.0,
+            )
             if status_code != 200:
                 rec.error_message = _("Bandeja AEAT respondió HTTP %s.") % status_code
                 raise UserError(rec.error_message)
-            response_filename = "%s_BANDEJA_response_%s.xml" % (rec.name, rec.bandeja_last_num + 1)
-            rec._attach_xml(response_filename, resp or "")
             bandeja = parser.parse_bandeja_response(resp or "")
             rec.last_response_date = fields.Datetime.now()
             if bandeja.get("last_message_num"):
@@ -3036,33 +4117,14 @@ class AduanaExpediente(models.Model):
 
             processed_count = 0
             skipped_count = 0
+            part_mrns = set(rec.declaracion_ids.filtered("mrn").mapped("mrn"))
             for msg in bandeja.get("messages") or []:
                 mrn = msg.get("mrn")
-                if mrn and rec.mrn and mrn != rec.mrn:
+                if mrn and rec.mrn and mrn != rec.mrn and mrn not in part_mrns:
                     skipped_count += 1
                     continue
                 processed_count += 1
-                parsed_msg = {
-                    "mrn": mrn or rec.mrn,
-                    "estado_aes": msg.get("estado_aes"),
-                    "circuito": msg.get("circuito"),
-                    "circuito_llegada": msg.get("circuito"),
-                    "csv_levante": msg.get("csv_levante_export"),
-                    "csv_levante_salida": msg.get("csv_levante_salida"),
-                    "fecha_salida_efectiva": msg.get("fecha_salida_efectiva"),
-                    "fecha_levante": msg.get("fecha_levante"),
-                }
-                tipo = (msg.get("message_type") or "").upper()
-                if tipo == "CLEVEX":
-                    parsed_msg["released"] = True
-                if tipo in ("CSALID", "RESUSA", "COMUNICARESULSALIDA") or msg.get("fecha_salida_efectiva"):
-                    parsed_msg["exited"] = True
-                rec._apply_aeat_parsed_response(parsed_msg, source="Bandeja %s" % (tipo or "AEAT"))
-                if tipo:
-                    rec.with_context(mail_notrack=True).message_post(
-                        body=_("Bandeja AEAT: mensaje %s (MRN %s).") % (tipo, mrn or rec.mrn or "-"),
-                        subtype_xmlid="mail.mt_note",
-                    )
+                rec._route_bandeja_message(msg)
 
             if not processed_count and not bandeja.get("errors"):
                 rec.with_context(mail_notrack=True).message_post(
@@ -3091,7 +4153,53 @@ class AduanaExpediente(models.Model):
                     subtype_xmlid="mail.mt_note",
                 )
         return True
-    
+
+    @api.model
+    def _parse_bandeja_message(self, msg):
+        """Mensaje de bandeja ya parseado (dict de parse_bandeja_response) en el formato de parse_aeat_response."""
+        parsed = {
+            "mrn": msg.get("mrn"),
+            "estado_aes": msg.get("estado_aes"),
+            "circuito": msg.get("circuito"),
+            "circuito_llegada": msg.get("circuito"),
+            "csv_levante": msg.get("csv_levante_export"),
+            "csv_levante_salida": msg.get("csv_levante_salida"),
+            "fecha_salida_efectiva": msg.get("fecha_salida_efectiva"),
+            "fecha_levante": msg.get("fecha_levante"),
+        }
+        tipo = (msg.get("message_type") or "").upper()
+        if tipo == "CLEVEX":
+            parsed["released"] = True
+        if tipo in ("CSALID", "RESUSA", "COMUNICARESULSALIDA") or msg.get("fecha_salida_efectiva"):
+            parsed["exited"] = True
+        return parsed
+
+    def _route_bandeja_message(self, msg):
+        """Aplica el mensaje de bandeja a la declaración parcial de su MRN o, si no la hay, al expediente."""
+        self.ensure_one()
+        mrn = msg.get("mrn")
+        part = self.declaracion_ids.filtered(lambda d: mrn and d.mrn == mrn)[:1]
+        if not part:
+            return self._apply_bandeja_message(msg)
+        part._apply_bandeja_message(msg)
+        self._sync_declaration_state()
+        return True
+
+    def _apply_bandeja_message(self, msg):
+        """Aplica al expediente un mensaje de bandeja ya parseado (dict de parse_bandeja_response)."""
+        self.ensure_one()
+        mrn = msg.get("mrn")
+        parsed_msg = self._parse_bandeja_message(msg)
+        parsed_msg["mrn"] = mrn or self.mrn
+        tipo = (msg.get("message_type") or "").upper()
+        self._apply_aeat_parsed_response(parsed_msg, source="Bandeja %s" % (tipo or "AEAT"))
+        if tipo:
+            self.with_context(mail_notrack=True).message_post(
+                body=_("Bandeja AEAT: mensaje %s (MRN %s).") % (tipo, mrn or self.mrn or "-"),
+                subtype_xmlid="mail.mt_note",
+            )
+        return True
+
     def _procesar_incidencias(self, incidencias_data, origen="bandeja"):
         """Procesa y crea incidencias desde datos parseados de AEAT"""
         self.ensure_one()
@@ -3153,16 +4261,91 @@ class AduanaExpediente(models.Model):
         return True
 
 
+    # ===== Planificador adaptativo de consultas AEAT =====
+    def _aeat_poll_interval(self, now=None):
+        """Intervalo hasta la próxima consulta: crece con la antigüedad del estado y según el circuito."""
+        self.ensure_one()
+        now = now or fields.Datetime.now()
+        since = self.aeat_state_change_date or self.write_date or self.create_date or now
+        age_hours = max((now - since).total_seconds(), 0.0) / 3600.0
+        minutes = AEAT_POLL_BACKOFF[-1][1]
+        for max_hours, tier_minutes in AEAT_POLL_BACKOFF:
+            if max_hours is None or age_hours < max_hours:
+                minutes = tier_minutes
+                break
+        circuito = (self.aes_circuito or "").strip().upper()[:1]
+        return timedelta(minutes=minutes * AEAT_POLL_CIRCUIT_FACTOR.get(circuito, 1.0))
+
+    def _schedule_aeat_poll(self):
+        """Recalcula aeat_next_poll_date; lo vacía si el estado ya no requiere seguimiento."""
+        now = fields.Datetime.now()
+        for rec in self:
+            if rec.state in BANDEJA_ACTIVE_STATES:
+                next_date = now + rec._aeat_poll_interval(now)
+            else:
+                next_date = False
+            if rec.aeat_next_poll_date != next_date:
+                rec.write({"aeat_next_poll_date": next_date})
+
+    @api.model
+    def _aeat_poll_due_domain(self, now=None):
+        now = now or fields.Datetime.now()
+        return [
+            ("state", "in", BANDEJA_ACTIVE_STATES),
+            "|", ("aeat_next_poll_date", "=", False), ("aeat_next_poll_date", "<=", now),
+        ]
+
+    @api.model
+    def _aeat_poll_limit(self):
+        value = self.env["ir.config_parameter"].sudo().get_param("aduanas_transport.poll.max_per_run")
+        try:
+            return max(int(value or AEAT_POLL_DEFAULT_LIMIT), 1)
+        except ValueError:
+            return AEAT_POLL_DEFAULT_LIMIT
+
+    @api.model
+    def cron_poll_aeat_status(self, limit=None):
+        """
+        Consulta el estado en AEAT (CCAESC exportación, ConsultaImportacionV3 importación) de los
+        expedientes cuya próxima consulta ha vencido, primero los más atrasados y los de cambio
+        de estado más reciente. Los expedientes divididos se consultan por el MRN de cada
+        declaración parcial. Consulta silenciosa: archiva petición y respuesta y solo aplica
+        cambios de estado reales, sin chatter; si la AEAT no responde o responde con error el
+        estado no cambia. Tras consultar, cada expediente se reprograma con backoff.
+        """
+        now = fields.Datetime.now()
+        due = self.sudo().search(
+            self._aeat_poll_due_domain(now) + ["|", ("mrn", "!=", False), ("declaracion_ids.mrn", "!=", False)],
+            order="aeat_next_poll_date asc nulls first, aeat_state_change_date desc, id",
+            limit=limit or self._aeat_poll_limit(),
+        ).with_context(aeat_batch_commit=True, aeat_poll_quiet=True)
+        if not due:
+            return True
+        exports = due.filtered(lambda r: r.direction == "export")
+        lines = []
+        if exports:
+            lines += exports._aeat_batch_send("ccaesc")
+        if due - exports:
+            lines += (due - exports)._aeat_batch_send("imp_query")
+        due = due.exists()
+        due.write({"aeat_last_poll_date": now})
+        due._schedule_aeat_poll()
+        _logger.info(
+            "Planificador AEAT: %s expedientes consultados (%s exportación), %s sin respuesta válida",
+            len(due), len(exports), len([l for l in lines if l["outcome"] != "ok"]),
+        )
+        return True
+
     @api.model
     def cron_poll_bandeja_all(self):
-        domain = [("state","in",["predeclared","presented","accepted","released"])]
-        for rec in self.search(domain, limit=50):
-            try:
-                rec.action_poll_bandeja(limit=50)
-            except Exception as e:
-                _logger.exception("Error al consultar bandeja para %s: %s", rec.name, e)
-                rec.state = "error"
-                
+        """
+        Lee cada bandeja (EXPORAES/IMPORAES) una sola vez por compañía/certificado mediante
+        aduana.bandeja.cursor (solo si hay expedientes con consulta vencida) y después consulta
+        individualmente los expedientes que sigan vencidos, por orden de urgencia.
+        """
+        self.env["aduana.bandeja.cursor"].cron_poll_all()
+        return self.cron_poll_aeat_status()
+
 
     def _get_xml_attachment(self, name_contains):
         self.ensure_one()
@@ -3246,18 +4429,19 @@ class AduanaExpediente(models.Model):
         
         return att
 
-    def _ensure_cc511c_xml(self):
+    def _render_cc511c(self):
         self.ensure_one()
-        xml = self.env['ir.ui.view']._render_template(
+        return self.env['ir.ui.view']._render_template(
             "aduanas_transport.tpl_cc511c",
             {"exp": self}
         )
-        att = self._get_xml_attachment("CC511C.xml")
-        if att:
-            att.datas = base64.b64encode(xml.encode("utf-8"))
-            return att
-        self._attach_xml(f"{self.name}_CC511C.xml", xml)
-        return self._get_xml_attachment("CC511C.xml")
+
+    def _ensure_cc511c_xml(self):
+        self.ensure_one()
+        att, _xml = self._get_xml_artefact(
+            "CC511C", f"{self.name}_CC511C.xml", self._render_cc511c, lookup="CC511C.xml",
+        )
+        return att
 
     def _cc415a_attachment_name(self):
         return "%s_CC415A.xml" % (self.name or "import")
@@ -3279,17 +4463,10 @@ class AduanaExpediente(models.Model):
         if att and att.datas and self.state in ("predeclared", "presented", "accepted", "released", "exited", "error"):
             return att
         self.env["aduanas.validator"].validate_expediente_import(self)
-        xml = self._build_cc415a_soap_envelope()
-        fname = self._cc415a_attachment_name()
-        if att:
-            att.write({
-                "name": fname,
-                "datas": base64.b64encode(xml.encode("utf-8")),
-                "mimetype": "application/xml",
-            })
-            return att
-        self._attach_xml(fname, xml)
-        return self._get_cc415a_attachment()
+        att, _xml = self._get_xml_artefact(
+            "CC415A", self._cc415a_attachment_name(), self._build_cc415a_soap_envelope, lookup=att,
+        )
+        return att
 
     def _ensure_imp_decl_xml(self):
         """Compat: previsualizar/descargar CC415A (antes usaba tpl_imp_decl obsoleto)."""
@@ -3856,7 +5033,11 @@ class AduanaExpediente(models.Model):
                     advertencias.append(_("No se pudieron extraer líneas de productos. Deberás agregarlas manualmente."))
                 else:
                     datos_extraidos.append(_("Líneas extraídas: %d") % len(invoice_data.get("lineas", [])))
-                
+                # Interpretación por fragmentos: la suma de las líneas no coincide con el total de la factura
+                conciliacion = invoice_data.get("reconciliacion") or {}
+                if conciliacion.get("cuadra") is False:
+                    advertencias.append(_("La suma de las líneas (%.2f) no coincide con el total de la factura (%.2f). Revise si faltan o sobran líneas.") % (conciliacion["suma_lineas"], conciliacion["valor_total"]))
+
                 # Rellenar expediente; si hay factura (modelo factura), las líneas se crean en este expediente con factura_id
                 rec = rec.with_context(**ctx_no_mail)
                 if factura:
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+# Servicio de la declaración parcial -> (servicio del cliente AEAT, origen de incidencias)
+DECLARACION_SERVICES = {
+    "CC415A": ("IMP_DECL", "imp_decl"),
+    "CC515C": ("CC515C", "cc515c"),
+}
+# Estados de una parte ya presentada: no se vuelve a enviar ni se sustituye al dividir
+DECLARACION_SENT_STATES = ("presented", "accepted", "released", "exited")
+# Estados de una parte con MRN que sigue esperando levante o salida (bandeja y consultas AEAT)
+DECLARACION_POLL_STATES = ("accepted", "released")
+
+
+class AduanaExpedienteDeclaracion(models.Model):
+    """
+    Declaración parcial de un expediente: cuando las partidas superan el máximo por
+    declaración (XML_MAX_GOODS_ITEMS) el expediente se divide en varias declaraciones
+    enlazadas, cada una con su LRN (LRN del expediente + "-n"), sus partidas y su MRN.
+    """
+    _name = "aduana.expediente.declaracion"
+    _description = "Declaración parcial del expediente"
+    _order = "expediente_id, service, part"
+    _rec_name = "lrn"
+
+    expediente_id = fields.Many2one("aduana.expediente", string="Expediente", required=True, ondelete="cascade", index=True)
+    service = fields.Selection([
+        ("CC415A", "Importación H1 (CC415A)"),
+        ("CC515C", "Exportación AES (CC515C)"),
+    ], string="Declaración", required=True)
+    part = fields.Integer(string="Parte", required=True)
+    part_count = fields.Integer(string="De")
+    lrn = fields.Char(string="LRN", required=True, copy=False)
+    mrn = fields.Char(string="MRN", index=True, copy=False, readonly=True)
+    line_ids = fields.Many2many(
+        "aduana.expediente.line",
+        "aduana_expediente_declaracion_line_rel",
+        "declaracion_id",
+        "line_id",
+        string="Partidas",
+    )
+    line_count = fields.Integer(string="Nº partidas", compute="_compute_line_info")
+    first_item = fields.Integer(string="Desde línea", compute="_compute_line_info")
+    last_item = fields.Integer(string="Hasta línea", compute="_compute_line_info")
+    attachment_id = fields.Many2one("ir.attachment", string="XML", ondelete="set null", copy=False)
+    state = fields.Selection([
+        ("draft", "Borrador"),
+        ("generated", "XML generado"),
+        ("presented", "Presentada"),
+        ("accepted", "Aceptada (MRN)"),
+        ("released", "Levante"),
+        ("exited", "Salida/Entrada confirmada"),
+        ("error", "Error"),
+    ], string="Estado", default="draft", required=True, copy=False)
+    error_message = fields.Text(string="Error", readonly=True, copy=False)
+    last_response_date = fields.Datetime(string="Última respuesta", readonly=True, copy=False)
+
+    _sql_constraints = [
+        ("part_uniq", "unique(expediente_id, service, part)", "La parte ya existe en el expediente."),
+    ]
+
+    @api.depends("line_ids", "line_ids.item_number")
+    def _compute_line_info(self):
+        for rec in self:
+            items = rec.line_ids.mapped("item_number")
+            rec.line_count = len(rec.line_ids)
+            rec.first_item = min(items) if items else 0
+            rec.last_item = max(items) if items else 0
+
+    def unlink(self):
+        # El XML de la parte se guarda como adjunto del expediente: se elimina con ella
+        self.mapped("attachment_id").unlink()
+        return super().unlink()
+
+    def _xml_filename(self):
+        self.ensure_one()
+        return "%s_%s_p%d.xml" % (self.expediente_id.name or "EXP", self.service, self.part)
+
+    def _build_xml(self):
+        self.ensure_one()
+        if self.service == "CC415A":
+            return self.expediente_id._build_cc415a_soap_envelope(part=self)
+        return self.expediente_id._build_cc515c_native_body(part=self)
+
+    def _get_xml(self, for_send=False):
+        """(adjunto, xml) de la parte, reutilizado mientras su huella (partidas incluidas) no cambie."""
+        self.ensure_one()
+        att, xml = self.expediente_id._get_xml_artefact(
+            self.service,
+            self._xml_filename(),
+            self._build_xml,
+            lookup=self.attachment_id or self._xml_filename(),
+            extra=(self.part, self.part_count, self.lrn, tuple(self.line_ids.ids)),
+            for_send=for_send,
+        )
+        if att != self.attachment_id:
+            self.attachment_id = att
+        return att, xml
+
+    def _generate_xml(self):
+        for rec in self:
+            rec._get_xml()
+            if rec.state in ("draft", "error"):
+                rec.write({"state": "generated", "error_message": False})
+        return True
+
+    def _prepare_send(self):
+        self.ensure_one()
+        if self.service == "CC415A":
+            return self.expediente_id._prepare_imp_decl_send(part=self)
+        return self.expediente_id._prepare_cc515c_send(part=self)
+
+    def _log_request(self, prep):
+        self.ensure_one()
+        self.expediente_id._archive_aeat_xml(
+            prep["service"], "request", prep["xml"], filename="%s_%s_request.xml" % (self.lrn, self.service),
+            endpoint=prep["endpoint"],
+        )
+        if self.attachment_id:
+            self.attachment_id.aduana_xml_sent = True
+        self.state = "presented"
+
+    def _apply_response(self, prep, status_code, resp_xml):
+        """Aplica la respuesta AEAT a la parte (MRN o error); el estado del expediente se agrega aparte."""
+        self.ensure_one()
+        expediente = self.expediente_id
+        service, origen = DECLARACION_SERVICES[self.service]
+        expediente._archive_aeat_xml(
+            service, "response", resp_xml, filename="%s_%s_response.xml" % (self.lrn, self.service),
+            endpoint=prep["endpoint"], http_status=status_code, duration_ms=(prep.get("elapsed") or 0.0) * 1000.0,
+        )
+        self.last_response_date = fields.Datetime.now()
+        if status_code != 200:
+            self.write({
+                "state": "error",
+                "error_message": _("AEAT respondió HTTP %s. Revisar la respuesta en Mensajes AEAT.") % status_code,
+            })
+        else:
+            parsed = self.env["aduanas.xml.parser"].parse_aeat_response(resp_xml, service)
+            if parsed.get("incidencias"):
+                expediente._procesar_incidencias(parsed["incidencias"], origen)
+            if parsed.get("success") and (parsed.get("mrn") or (service == "IMP_DECL" and parsed.get("accepted"))):
+                self.write({"state": "accepted", "mrn": parsed.get("mrn") or False, "error_message": False})
+            else:
+                error_msg = "\n".join(parsed.get("errors") or []) or parsed.get("error") or _("Error desconocido")
+                self.write({"state": "error", "error_message": error_msg})
+        if self.state == "accepted":
+            body = _("Declaración parcial %(part)s/%(count)s (%(lrn)s) aceptada. MRN: %(mrn)s") % {
+                "part": self.part, "count": self.part_count, "lrn": self.lrn,
+                "mrn": self.mrn or _("pendiente/no informado en respuesta"),
+            }
+        else:
+            body = _("Declaración parcial %(part)s/%(count)s (%(lrn)s) con error:\n%(error)s") % {
+                "part": self.part, "count": self.part_count, "lrn": self.lrn, "error": self.error_message,
+            }
+        expediente.with_context(mail_notrack=True).message_post(body=body, subtype_xmlid="mail.mt_note")
+        return self.state == "accepted"
+
+    def _apply_aeat_status(self, parsed, source="AEAT"):
+        """
+        Estado de la parte según una consulta (CCAESC, ConsultaImportacionV3) o un mensaje de
+        bandeja de su MRN: levante, salida o aceptación. No retrocede el estado. Devuelve True
+        si el estado ha cambiado.
+        """
+        self.ensure_one()
+        estado = (parsed.get("estado_aes") or "").upper()
+        vals = {"last_response_date": fields.Datetime.now()}
+        if parsed.get("mrn") and not self.mrn:
+            vals["mrn"] = parsed["mrn"]
+        if parsed.get("exited") or estado == "SA":
+            vals["state"] = "exited"
+        elif parsed.get("released"):
+            if self.state != "exited":
+                vals["state"] = "released"
+        elif parsed.get("accepted") and self.state in ("generated", "presented", "error"):
+            vals.update(state="accepted", error_message=False)
+        changed = vals.get("state", self.state) != self.state
+        self.write(vals)
+        if changed:
+            _logger.info("Declaración parcial %s: %s (%s)", self.lrn, self.state, source)
+        return changed
+
+    def _apply_bandeja_message(self, msg):
+        """Aplica a la parte un mensaje de bandeja de su MRN (dict de parse_bandeja_response)."""
+        self.ensure_one()
+        expediente = self.expediente_id
+        self._apply_aeat_status(expediente._parse_bandeja_message(msg), source="Bandeja")
+        tipo = (msg.get("message_type") or "").upper()
+        if tipo:
+            expediente.with_context(mail_notrack=True).message_post(
+                body=_("Bandeja AEAT: mensaje %(tipo)s (MRN %(mrn)s, declaración parcial %(part)s/%(count)s).") % {
+                    "tipo": tipo, "mrn": self.mrn, "part": self.part, "count": self.part_count,
+                },
+                subtype_xmlid="mail.mt_note",
+            )
+        return True
+
+    def action_generate(self):
+        return self._generate_xml()
+
+    def _set_send_error(self, message):
+        self.ensure_one()
+        with self.env.cr.savepoint():
+            self.write({"state": "error", "error_message": message, "last_response_date": fields.Datetime.now()})
+
+    def action_send(self):
+        """
+        Presenta las partes pendientes una a una, como el envío en lote: cada petición se registra
+        en su savepoint y se confirma antes de enviarla, y la respuesta se aplica en otro savepoint
+        con commit tras cada parte. Un error en una parte la deja en error sin deshacer las ya
+        presentadas (MRN, estado y XML archivados) ni detener las demás.
+        """
+        client = self.env["aduanas.aeat.client"]
+        for rec in self.filtered(lambda d: d.state not in DECLARACION_SENT_STATES).sorted("part"):
+            try:
+                with self.env.cr.savepoint():
+                    prep = rec._prepare_send()
+                    rec._log_request(prep)
+            except Exception as e:
+                rec._set_send_error(str(e))
+                self.env.cr.commit()
+                continue
+            self.env.cr.commit()
+            start = time.monotonic()
+            try:
+                status_code, resp_xml = client.send_xml(prep["endpoint"], prep["xml"], service=prep["service"])
+                prep["elapsed"] = time.monotonic() - start
+                with self.env.cr.savepoint():
+                    rec._apply_response(prep, status_code, resp_xml)
+            except Exception as e:
+                _logger.exception("Declaración parcial %s (%s): error al enviar", rec.lrn, rec.service)
+                rec._set_send_error(str(e))
+            self.env.cr.commit()
+            _logger.info("Declaración parcial %s (%s): %s", rec.lrn, rec.service, rec.state)
+        self.mapped("expediente_id")._sync_declaration_state()
+        return True
+
+    def action_download(self):
+        self.ensure_one()
+        att, _xml = self._get_xml()
+        return {
+            "type": "ir.actions.act_url",
+            "url": f"/web/content/{att.id}?download=1",
+            "target": "self",
+        }
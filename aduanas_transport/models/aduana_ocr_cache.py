@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+import logging
+import zlib
+from datetime import timedelta
+
+import psycopg2
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+# Política de expulsión (ir.config_parameter aduanas_transport.ocr.cache_days / cache_max_entries):
+# se eliminan las entradas sin uso en cache_days días (0 = sin caducidad) y, por encima de
+# cache_max_entries (0 = sin límite), las usadas hace más tiempo.
+OCR_CACHE_DEFAULT_DAYS = 90
+OCR_CACHE_DEFAULT_MAX_ENTRIES = 5000
+OCR_CACHE_COMPRESS_LEVEL = 6
+# Puntos de control de páginas de extracciones que nunca terminaron
+OCR_CHECKPOINT_KEEP_DAYS = 7
+
+
+class AduanaOcrCache(models.Model):
+    """
+    Resultado de extract_invoice_data direccionado por el SHA-256 del PDF y la versión del
+    extractor: el mismo documento (copia del expediente, reenvío desde el asistente de
+    subida, reintento del job) se resuelve sin volver a pagar OCR ni interpretación GPT.
+    El resultado (incluido el texto extraído) se guarda comprimido en base de datos.
+    """
+    _name = "aduana.ocr.cache"
+    _description = "Caché de extracción de facturas"
+    _order = "last_used_date desc, id desc"
+    _rec_name = "sha256"
+
+    sha256 = fields.Char(string="SHA-256 del PDF", required=True, index=True, readonly=True)
+    extractor_version = fields.Char(string="Versión del extractor", required=True, readonly=True)
+    metodo_usado = fields.Char(string="Método", readonly=True)
+    numero_factura = fields.Char(string="Nº factura", readonly=True)
+    line_count = fields.Integer(string="Líneas", readonly=True)
+    pdf_size = fields.Integer(string="Tamaño PDF (bytes)", readonly=True)
+    data = fields.Binary(string="Resultado comprimido", attachment=False, readonly=True)
+    size_compressed = fields.Integer(string="Comprimido (bytes)", readonly=True)
+    hit_count = fields.Integer(string="Aciertos", readonly=True)
+    last_used_date = fields.Datetime(string="Último uso", readonly=True, index=True, default=fields.Datetime.now)
+
+    _sql_constraints = [
+        ("sha256_version_uniq", "unique(sha256, extractor_version)", "El resultado ya está en caché."),
+    ]
+
+    @api.model
+    def _digest(self, pdf_bytes):
+        return hashlib.sha256(pdf_bytes).hexdigest()
+
+    @api.model
+    def _lookup(self, digest, extractor_version):
+        """Resultado guardado (dict) o None; cuenta el acierto y renueva la fecha de uso."""
+        entry = self.sudo().search([("sha256", "=", digest), ("extractor_version", "=", extractor_version)], limit=1)
+        if not entry or not entry.data:
+            return None
+        try:
+            result = json.loads(zlib.decompress(base64.b64decode(entry.data)).decode("utf-8"))
+        except (ValueError, zlib.error) as e:
+            _logger.warning("Entrada de caché OCR %s ilegible, se descarta: %s", digest[:12], e)
+            entry.unlink()
+            return None
+        # UPDATE directo, sin tracking ni write_date. Solo es estadística de uso: si otro job tiene
+        # la fila bloqueada se omite (SKIP LOCKED) y si la modificó después de nuestra instantánea
+        # (REPEATABLE READ: "could not serialize access") se descarta en su savepoint
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute(
+                    "UPDATE aduana_ocr_cache SET hit_count = hit_count + 1, "
+                    "last_used_date = (now() at time zone 'UTC') "
+                    "WHERE id IN (SELECT id FROM aduana_ocr_cache WHERE id = %s FOR UPDATE SKIP LOCKED)",
+                    (entry.id,),
+                )
+        except psycopg2.OperationalError as e:
+            _logger.debug("Uso de la entrada de caché OCR %s no actualizado: %s", digest[:12], e)
+        entry.invalidate_recordset(["hit_count", "last_used_date"])
+        return result
+
+    @api.model
+    def _store(self, digest, extractor_version, result, pdf_size=0):
+        """Guarda el resultado (dict serializable a JSON) para el PDF; devuelve la entrada."""
+        Cache = self.sudo()
+        raw = json.dumps(result, ensure_ascii=False, default=str).encode("utf-8")
+        compressed = zlib.compress(raw, OCR_CACHE_COMPRESS_LEVEL)
+        vals = {
+            "sha256": digest,
+            "extractor_version": extractor_version,
+            "metodo_usado": result.get("metodo_usado") or False,
+            "numero_factura": result.get("numero_factura") or False,
+            "line_count": len(result.get("lineas") or []),
+            "pdf_size": pdf_size,
+            "data": base64.b64encode(compressed),
+            "size_compressed": len(compressed),
+            "last_used_date": fields.Datetime.now(),
+        }
+        entry = Cache.search([("sha256", "=", digest), ("extractor_version", "=", extractor_version)], limit=1)
+        if entry:
+            entry.write(vals)
+            return entry
+        try:
+            with self.env.cr.savepoint():
+                return Cache.create(vals)
+        except Exception:
+            # Otro job guardó el mismo PDF a la vez (unique sha256 + versión)
+            entry = Cache.search([("sha256", "=", digest), ("extractor_version", "=", extractor_version)], limit=1)
+            if entry:
+                return entry
+            raise
+
+    @api.model
+    def _cache_limits(self):
+        icp = self.env["ir.config_parameter"].sudo()
+        limits = []
+        for key, default in (("cache_days", OCR_CACHE_DEFAULT_DAYS), ("cache_max_entries", OCR_CACHE_DEFAULT_MAX_ENTRIES)):
+            value = icp.get_param("aduanas_transport.ocr.%s" % key)
+            try:
+                limits.append(default if value in (None, False, "") else max(int(value), 0))
+            except ValueError:
+                limits.append(default)
+        return tuple(limits)
+
+    @api.model
+    def cron_purge_cache(self):
+        """Expulsa las entradas sin uso en cache_days días y las que exceden cache_max_entries (LRU)."""
+        days, max_entries = self._cache_limits()
+        removed = 0
+        if days:
+            self.env.cr.execute(
+                "DELETE FROM aduana_ocr_cache WHERE last_used_date < %s",
+                (fields.Datetime.now() - timedelta(days=days),),
+            )
+            removed += self.env.cr.rowcount
+        if max_entries:
+            self.env.cr.execute("""
+                DELETE FROM aduana_ocr_cache
+                 WHERE id IN (SELECT id FROM aduana_ocr_cache
+                               ORDER BY last_used_date DESC NULLS LAST, id DESC
+                              OFFSET %s)
+            """, (max_entries,))
+            removed += self.env.cr.rowcount
+        self.invalidate_model()
+        self.env.cr.execute(
+            "DELETE FROM aduana_ocr_page WHERE create_date < %s",
+            (fields.Datetime.now() - timedelta(days=OCR_CHECKPOINT_KEEP_DAYS),),
+        )
+        stale_pages = self.env.cr.rowcount
+        self.env["aduana.ocr.page"].invalidate_model()
+        _logger.info("Caché OCR: %s entradas expulsadas, %s páginas de control abandonadas", removed, stale_pages)
+        return True
+
+    @api.model
+    def action_purge_all(self):
+        """Vacía la caché (p.ej. tras cambiar prompts o parámetros del extractor)."""
+        self.env.cr.execute("DELETE FROM aduana_ocr_cache")
+        removed = self.env.cr.rowcount
+        self.invalidate_model()
+        _logger.info("Caché OCR vaciada manualmente: %s entradas", removed)
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Caché OCR"),
+                "message": _("Se han eliminado %s resultados de la caché de facturas.") % removed,
+                "type": "success",
+                "next": {"type": "ir.actions.client", "tag": "reload"},
+            },
+        }
+
+
+class AduanaOcrPage(models.Model):
+    """
+    Punto de control de la transcripción por páginas (SHA-256 del PDF + versión + página).
+    Cada página transcrita por visión se guarda al terminar en una transacción propia, de
+    modo que un reintento del job (o un worker reiniciado) solo procesa las que faltan. Se
+    borran al completar la extracción y, si nunca se completa, a los OCR_CHECKPOINT_KEEP_DAYS.
+    """
+    _name = "aduana.ocr.page"
+    _description = "Página transcrita (punto de control OCR)"
+    _order = "sha256, page"
+    _rec_name = "sha256"
+
+    sha256 = fields.Char(string="SHA-256 del PDF", required=True, index=True, readonly=True)
+    extractor_version = fields.Char(string="Versión del extractor", required=True, readonly=True)
+    page = fields.Integer(string="Página", required=True, readonly=True)
+    path = fields.Char(string="Ruta", readonly=True)
+    text = fields.Text(string="Texto", readonly=True)
+    api_ms = fields.Integer(string="API (ms)", readonly=True)
+    attempts = fields.Integer(string="Intentos", readonly=True)
+
+    _sql_constraints = [
+        ("page_uniq", "unique(sha256, extractor_version, page)", "La página ya tiene punto de control."),
+    ]
+
+    @api.model
+    def _load(self, digest, extractor_version):
+        """{página: texto} de las páginas ya transcritas del documento."""
+        self.env.cr.execute(
+            "SELECT page, text FROM aduana_ocr_page WHERE sha256 = %s AND extractor_version = %s",
+            (digest, extractor_version),
+        )
+        return {page: text or "" for page, text in self.env.cr.fetchall()}
+
+    @api.model
+    def _save(self, digest, extractor_version, result):
+        """
+        Guarda la página en un cursor aparte con commit inmediato: sobrevive al rollback
+        del job. result: dict de transcribe_page (page, text, path, api_ms, attempts).
+        """
+        with self.env.registry.cursor() as cr:
+            cr.execute("""
+                INSERT INTO aduana_ocr_page
+                       (sha256, extractor_version, page, path, text, api_ms, attempts,
+                        create_uid, write_uid, create_date, write_date)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC')
+                ON CONFLICT (sha256, extractor_version, page) DO UPDATE
+                   SET path = EXCLUDED.path, text = EXCLUDED.text, api_ms = EXCLUDED.api_ms,
+                       attempts = EXCLUDED.attempts, write_date = EXCLUDED.write_date
+            """, (
+                digest, extractor_version, result["page"], result.get("path") or "vision", result["text"],
+                int(result.get("api_ms") or 0), result.get("attempts") or 0, self.env.uid, self.env.uid,
+            ))
+
+    @api.model
+    def _clear(self, digest, extractor_version):
+        self.env.cr.execute(
+            "DELETE FROM aduana_ocr_page WHERE sha256 = %s AND extractor_version = %s", (digest, extractor_version),
+        )
+        self.invalidate_model()
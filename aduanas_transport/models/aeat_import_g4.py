@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 """G4 / depósito temporal — presentación G4DecV1SOAP (distinto de CC415A H1)."""
+import base64
+import time
+
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
 
@@ -47,6 +50,7 @@ class AeatImportG4TemporaryStorage(models.Model):
         help="Servicio G4DecV1SOAP (ADDS-JDIT). No usar CC415AV1SOAP ni endpoints AES.",
     )
     request_xml = fields.Text(string="XML petición G4", readonly=True)
+    request_fingerprint = fields.Char(string="Huella XML petición", readonly=True, copy=False)
     response_xml = fields.Text(string="XML respuesta G4", readonly=True)
     error_message = fields.Text(string="Error", readonly=True)
 
@@ -59,10 +63,8 @@ class AeatImportG4TemporaryStorage(models.Model):
         )
 
     def _ensure_cert_configured(self):
-        icp = self.env["ir.config_parameter"].sudo()
-        attach_id = int(icp.get_param("aduanas_transport.cert_attachment_id") or 0)
-        password = (icp.get_param("aduanas_transport.cert_password") or "").strip()
-        if not attach_id or not password:
+        aeat = self.env.company._get_aeat_settings()
+        if not aeat["cert_attachment_id"] or not aeat["cert_password"]:
             raise UserError(
                 _(
                     "Configure el certificado AEAT (.p12) y su contraseña en "
@@ -70,10 +72,22 @@ class AeatImportG4TemporaryStorage(models.Model):
                 )
             )
 
+    def _request_fingerprint(self, endpoint):
+        self.ensure_one()
+        return self.expediente_id._xml_fingerprint("G4_DEC", extra=endpoint, records=self)
+
     def action_generar_xml_g4(self):
         builder = self.env["aduanas.g4.xml.builder"]
+        self.mapped("expediente_id")._prefetch_declaration_data()
+        attachments = []
         for rec in self:
             endpoint = rec._get_g4_endpoint()
+            fingerprint = rec._request_fingerprint(endpoint)
+            if rec.request_xml and rec.request_fingerprint == fingerprint:
+                # Mismas entradas que el XML ya generado: no se reconstruye
+                if rec.state == "draft":
+                    rec.state = "generated"
+                continue
             xml = builder.build_g4_soap_envelope(rec, endpoint_url=endpoint)
             lrn = builder._lrn(rec, rec.expediente_id)
             rec.write({
@@ -83,10 +97,19 @@ class AeatImportG4TemporaryStorage(models.Model):
                 "state": "generated",
                 "error_message": False,
             })
-            rec.expediente_id._attach_xml(
-                "%s_G4Dec_request.xml" % (rec.expediente_id.name or "G4"),
-                xml,
-            )
+            # Huella tras escribir el lrn generado, para que coincida en la siguiente llamada
+            rec.request_fingerprint = rec._request_fingerprint(endpoint)
+            attachments.append({
+                "name": "%s_G4Dec_request.xml" % (rec.expediente_id.name or "G4"),
+                "res_model": rec.expediente_id._name,
+                "res_id": rec.expediente_id.id,
+                "type": "binary",
+                "mimetype": "application/xml",
+                "datas": base64.b64encode(xml.encode("utf-8")),
+            })
+        # Un solo create para los XML de todo el lote
+        if attachments:
+            self.env["ir.attachment"].create(attachments)
         return True
 
     def action_presentar_g4(self):
@@ -97,28 +120,37 @@ class AeatImportG4TemporaryStorage(models.Model):
             rec._ensure_cert_configured()
             endpoint = rec._get_g4_endpoint()
             xml = rec.request_xml
-            if not (xml or "").strip() or rec.state == "draft":
+            if (
+                not (xml or "").strip() or rec.state == "draft"
+                or rec.request_fingerprint != rec._request_fingerprint(endpoint)
+            ):
                 xml = builder.build_g4_soap_envelope(rec, endpoint_url=endpoint)
                 rec.write({
                     "request_xml": xml,
                     "lrn": builder._lrn(rec, rec.expediente_id),
                 })
+                rec.request_fingerprint = rec._request_fingerprint(endpoint)
             rec.write({
                 "endpoint_url": endpoint,
                 "state": "presented",
                 "error_message": False,
             })
-            rec.expediente_id._attach_xml(
-                "%s_G4Dec_request.xml" % (rec.expediente_id.name or "G4"),
-                xml,
+            rec.expediente_id._archive_aeat_xml(
+                "G4_DEC", "request", xml,
+                filename="%s_G4Dec_request.xml" % (rec.expediente_id.name or "G4"),
+                endpoint=endpoint,
             )
+            start = time.monotonic()
             status_code, resp_xml = client.send_xml(
                 endpoint, xml, service="G4_DEC", timeout=60
             )
             rec.response_xml = resp_xml or ""
-            rec.expediente_id._attach_xml(
-                "%s_G4Dec_response.xml" % (rec.expediente_id.name or "G4"),
-                resp_xml or "",
+            rec.expediente_id._archive_aeat_xml(
+                "G4_DEC", "response", resp_xml,
+                filename="%s_G4Dec_response.xml" % (rec.expediente_id.name or "G4"),
+                endpoint=endpoint,
+                http_status=status_code,
+                duration_ms=(time.monotonic() - start) * 1000.0,
             )
             if status_code != 200:
                 rec.state = "error"
@@ -165,16 +197,21 @@ class AeatImportG4TemporaryStorage(models.Model):
     def create_from_expediente(self, expediente):
         """Crea o reutiliza el registro G4 asociado al expediente de importación."""
         expediente.ensure_one()
-        if expediente.direction != "import":
+        return self.create_from_expedientes(expediente)
+
+    @api.model
+    def create_from_expedientes(self, expedientes):
+        """
+        Versión en lote de create_from_expediente: una búsqueda de los G4 existentes y un
+        único create para los expedientes que no tienen. Devuelve un G4 por expediente, en
+        el orden de expedientes.
+        """
+        if expedientes.filtered(lambda e: e.direction != "import"):
             raise UserError(_("G4/DDT solo aplica a expedientes de importación."))
-        existing = self.search(
-            [("expediente_id", "=", expediente.id)],
-            limit=1,
-            order="id desc",
-        )
-        if existing:
-            return existing
-        return self.create({
-            "expediente_id": expediente.id,
-            "state": "draft",
-        })
+        by_expediente = {}
+        for rec in self.search([("expediente_id", "in", expedientes.ids)], order="id desc"):
+            by_expediente.setdefault(rec.expediente_id.id, rec)
+        missing = expedientes.filtered(lambda e: e.id not in by_expediente)
+        for rec in self.create([{"expediente_id": exp.id, "state": "draft"} for exp in missing]):
+            by_expediente[rec.expediente_id.id] = rec
+        return self.browse([by_expediente[exp.id].id for exp in expedientes])
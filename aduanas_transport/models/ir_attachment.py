@@ -36,6 +36,19 @@ class IrAttachment(models.Model):
         store=False
     )
     
+    aduana_xml_fingerprint = fields.Char(
+        string="Huella XML aduanas",
+        readonly=True,
+        copy=False,
+        help="SHA-256 de las entradas con que se generó el XML (ver aduana.expediente._xml_fingerprint)"
+    )
+    
+    aduana_xml_sent = fields.Boolean(
+        string="XML enviado a AEAT",
+        readonly=True,
+        copy=False
+    )
+    
     tipo_documento = fields.Char(
         string="Tipo",
         compute="_compute_tipo_documento",
@@ -1,4 +1,8 @@
-from odoo import fields, models
+from types import MappingProxyType
+
+from odoo import api, fields, models, tools
+
+_TRUE_VALUES = ("1", "true", "yes", "si", "sí")
 
 
 class ResCompany(models.Model):
@@ -122,28 +126,96 @@ class ResCompany(models.Model):
         help="Opcional. Si está vacío se usa el NIF de la empresa o del remitente según el flujo.",
     )
 
+    def write(self, vals):
+        res = super().write(vals)
+        if set(vals) & (set(self._AEAT_DEFAULTS) | set(self._AEAT_LEGACY_PARAMS)):
+            # La instantánea AEAT se cachea por compañía en el registro
+            self.clear_caches()
+        return res
+
+    def _get_aeat_settings(self):
+        """
+        Instantánea inmutable de la configuración AEAT de la compañía (endpoints, certificado,
+        oficinas y marcas de preproducción). Se construye una vez por compañía y se comparte
+        entre peticiones en la caché del registro; ir.config_parameter limpia esa caché en
+        create/write/unlink y write de res.company también, así que no queda obsoleta.
+        """
+        self.ensure_one()
+        return self._aeat_settings_snapshot(self.id)
+
+    @api.model
+    @tools.ormcache("company_id")
+    def _aeat_settings_snapshot(self, company_id):
+        icp = self.env["ir.config_parameter"].sudo()
+        icp.flush_model(["key", "value"])
+        # Una sola consulta para todos los parámetros del módulo
+        self.env.cr.execute(
+            "SELECT key, value FROM ir_config_parameter WHERE key LIKE %s", ("aduanas_transport.%",)
+        )
+        params = dict(self.env.cr.fetchall())
+        company_prefix = "aduanas_transport.company.%s." % company_id
+
+        def _flag(key):
+            return (params.get(key) or "").strip().lower() in _TRUE_VALUES
+
+        company = {}
+        for field_name in set(self._AEAT_DEFAULTS) | set(self._AEAT_LEGACY_PARAMS):
+            value = params.get(company_prefix + field_name)
+            if value in (None, False, ""):
+                value = params.get(self._AEAT_LEGACY_PARAMS.get(field_name, ""))
+            if value in (None, False, ""):
+                value = self._AEAT_DEFAULTS.get(field_name, "")
+            company[field_name] = value
+        # Endpoints globales (ir.config_parameter) tal como los usan los flujos del expediente
+        endpoints = {}
+        for field_name, default in self._AEAT_DEFAULTS.items():
+            if field_name.startswith("aeat_endpoint_"):
+                endpoints[field_name] = params.get(self._AEAT_LEGACY_PARAMS[field_name]) or default
+        for values in (company, endpoints):
+            if "ADIM-JDIT/ws/imp/DeclaracionSOAP" in (values["aeat_endpoint_imp_decl"] or ""):
+                values["aeat_endpoint_imp_decl"] = self._AEAT_DEFAULTS["aeat_endpoint_imp_decl"]
+        test_office = (params.get("aduanas_transport.aeat_preprod_test_office") or "ES000101").strip().upper()
+        return MappingProxyType({
+            "company_id": company_id,
+            "params": MappingProxyType(params),
+            "company": MappingProxyType(company),
+            "endpoints": MappingProxyType(endpoints),
+            "cert_attachment_id": int(params.get("aduanas_transport.cert_attachment_id") or 0),
+            "cert_password": (params.get("aduanas_transport.cert_password") or "").strip(),
+            "nif_firmante": params.get("aduanas_transport.aeat_nif_firmante") or "",
+            "is_preproduction": any(
+                "prewww" in endpoints[key].lower()
+                for key in ("aeat_endpoint_cc515c", "aeat_endpoint_imp_decl", "aeat_endpoint_imp_query")
+            ),
+            "preprod_test_office": test_office,
+            "preprod_import_office": (
+                params.get("aduanas_transport.aeat_preprod_import_office") or test_office
+            ).strip().upper(),
+            "preprod_allow_real_office": params.get("aduanas_transport.preprod_allow_real_office") == "True",
+            "preprod_allow_real_import_office": _flag("aduanas_transport.preprod_allow_real_import_office"),
+            "preprod_location_authorisation": params.get("aduanas_transport.aeat_preprod_location_authorisation") or "",
+            "imp_allow_foreign_seller_eori": _flag("aduanas_transport.imp_allow_foreign_seller_eori"),
+        })
+
     def _aeat_param_key(self, field_name):
         self.ensure_one()
         return "aduanas_transport.company.%s.%s" % (self.id, field_name)
 
     def _get_aeat_param(self, field_name):
         self.ensure_one()
-        icp = self.env["ir.config_parameter"].sudo()
-        value = icp.get_param(self._aeat_param_key(field_name))
-        if value in (None, False, ""):
-            value = icp.get_param(self._AEAT_LEGACY_PARAMS.get(field_name, ""))
-        if value in (None, False, ""):
-            value = self._AEAT_DEFAULTS.get(field_name, "")
-        if field_name == "aeat_endpoint_imp_decl" and "ADIM-JDIT/ws/imp/DeclaracionSOAP" in (value or ""):
-            value = self._AEAT_DEFAULTS["aeat_endpoint_imp_decl"]
-        return value
+        return self._get_aeat_settings()["company"].get(field_name, "")
 
     def _set_aeat_param(self, field_name, value):
         self.ensure_one()
         value = value or ""
         if field_name == "aeat_endpoint_imp_decl" and "ADIM-JDIT/ws/imp/DeclaracionSOAP" in value:
             value = self._AEAT_DEFAULTS["aeat_endpoint_imp_decl"]
-        self.env["ir.config_parameter"].sudo().set_param(self._aeat_param_key(field_name), value)
+        icp = self.env["ir.config_parameter"].sudo()
+        key = self._aeat_param_key(field_name)
+        if field_name in ("aeat_cert_attachment_id", "aeat_cert_password") and str(icp.get_param(key) or "") != str(value):
+            # Certificado o contraseña cambiados: cerrar sesiones mTLS cacheadas de la compañía
+            self.env["aduanas.aeat.client"].invalidate_session_pool([self.id])
+        icp.set_param(key, value)
 
     def _compute_aeat_config(self):
         for company in self:
@@ -2,6 +2,7 @@
 from odoo import models, _
 import logging
 import re
+import threading
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import ParseError
 
@@ -36,6 +37,337 @@ def _extract_mrn_from_raw_text(text):
                 return val
     return None
 
+
+# ---------------------------------------------------------------------------
+# Bandeja: extracción en streaming
+# ---------------------------------------------------------------------------
+
+# Nombre local del elemento -> (clave del mensaje, longitud máxima o None)
+_BANDEJA_FIELDS = {
+    "MRN": ("mrn", None),
+    "estadoAES": ("estado_aes", None),
+    "circuito": ("circuito", None),
+    "fechaLevante": ("fecha_levante", 10),
+    "fechaSalidaEfectiva": ("fecha_salida_efectiva", 10),
+    "fechaLevanteSalida": ("fecha_levante_salida", 10),
+    "CSVLevanteExportacion": ("csv_levante_export", None),
+    "CSVLevanteSalida": ("csv_levante_salida", None),
+}
+
+_BANDEJA_TOKEN_RE = re.compile(
+    r"<(?:[\w.-]+:)?(messageType|NumUltimoMensaje|NumMensaje|%s)(?:\s[^>]*)?>([^<]*)<" % "|".join(_BANDEJA_FIELDS),
+    re.IGNORECASE,
+)
+
+
+def _iterparse_events(xml_text):
+    """Eventos (start/end) de ElementTree.iterparse liberando cada subárbol al cerrarse."""
+    import io
+    data = xml_text.encode("utf-8") if isinstance(xml_text, str) else xml_text
+    stack = []
+    for event, elem in ET.iterparse(io.BytesIO(data), events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            yield event, elem
+            continue
+        yield event, elem
+        stack.pop()
+        # Memoria acotada: el elemento ya procesado se desengancha de su padre
+        if stack:
+            parent = stack[-1]
+            try:
+                parent.remove(elem)
+            except ValueError:
+                pass
+        elem.clear()
+
+
+def _walk_events(root):
+    """Eventos (start/end) equivalentes a iterparse sobre un árbol ya construido (lxml recover)."""
+    stack = [(root, False)]
+    while stack:
+        elem, closing = stack.pop()
+        if closing:
+            yield "end", elem
+            continue
+        if not isinstance(elem.tag, str):
+            continue  # comentarios / PI de lxml
+        yield "start", elem
+        stack.append((elem, True))
+        for child in reversed(list(elem)):
+            stack.append((child, False))
+
+
+def _stream_bandeja(events):
+    """
+    Máquina de estados de una sola pasada sobre eventos start/end.
+    Un mensaje = el padre de messageType (ComunicaXxx / MESSAGE); si no hay messageType,
+    cada DatosComunicacion cierra un mensaje. NumMensaje (previo al contenedor) queda en
+    "num" del mensaje. Devuelve (mensajes, NumUltimoMensaje).
+    """
+    messages = []
+    last_num = 0
+    depth = 0
+    container_depth = None
+    current = {}
+    for event, elem in events:
+        if event == "start":
+            depth += 1
+            continue
+        tag = elem.tag
+        local = tag.split("}")[-1] if "}" in tag else tag
+        text = (elem.text or "").strip()
+        if local == "messageType" and text:
+            if current.get("message_type"):
+                # Nuevo messageType sin cierre del contenedor anterior: emitir el previo
+                messages.append(current)
+                current = {}
+            current["message_type"] = text.upper()
+            container_depth = depth - 1
+        elif local == "NumUltimoMensaje" and text:
+            try:
+                last_num = int(text)
+            except ValueError:
+                pass
+        elif local == "NumMensaje" and text:
+            try:
+                current["num"] = int(text)
+            except ValueError:
+                pass
+        elif text and local in _BANDEJA_FIELDS:
+            key, size = _BANDEJA_FIELDS[local]
+            current[key] = text[:size] if size else text
+        elif local == "DatosComunicacion" and container_depth is None:
+            if current.get("mrn") or current.get("message_type"):
+                messages.append(current)
+            current = {}
+        if container_depth is not None and depth == container_depth:
+            if current.get("message_type") or current.get("mrn"):
+                messages.append(current)
+            current = {}
+            container_depth = None
+        depth -= 1
+    if current.get("message_type") or current.get("mrn"):
+        messages.append(current)
+    return messages, last_num
+
+
+def _scan_bandeja_regex(xml_text):
+    """Último recurso para XML irrecuperable: un único barrido regex de las etiquetas de interés."""
+    messages = []
+    last_num = 0
+    current = {}
+    if not isinstance(xml_text, str):
+        return messages, last_num
+    for m in _BANDEJA_TOKEN_RE.finditer(xml_text):
+        local, text = m.group(1), m.group(2).strip()
+        if not text:
+            continue
+        lower = local.lower()
+        if lower == "messagetype":
+            if current.get("message_type") or current.get("mrn"):
+                messages.append(current)
+                current = {}
+            current["message_type"] = text.upper()
+            continue
+        if lower == "numultimomensaje":
+            try:
+                last_num = int(text)
+            except ValueError:
+                pass
+            continue
+        if lower == "nummensaje":
+            # NumMensaje abre el mensaje siguiente
+            if current.get("message_type") or current.get("mrn"):
+                messages.append(current)
+                current = {}
+            try:
+                current["num"] = int(text)
+            except ValueError:
+                pass
+            continue
+        for name, (key, size) in _BANDEJA_FIELDS.items():
+            if name.lower() == lower:
+                if key == "mrn" and current.get("mrn"):
+                    # Segundo MRN sin messageType intermedio: mensaje nuevo
+                    messages.append(current)
+                    current = {}
+                current[key] = text[:size] if size else text
+                break
+    if current.get("message_type") or current.get("mrn"):
+        messages.append(current)
+    return messages, last_num
+
+
+# ---------------------------------------------------------------------------
+# Extracción declarativa de campos: un único recorrido del árbol por respuesta
+# ---------------------------------------------------------------------------
+
+# Cada servicio declara los nombres locales que necesita:
+#   first    -> primer texto no vacío de cada nombre
+#   all      -> todos los textos no vacíos de cada nombre (orden de documento)
+#   elements -> los elementos con ese nombre (para bloques de error, HEAHEA, etc.)
+# La recogida ignora mayúsculas; first/all/elements consultan por nombre exacto y
+# find_first/find_all reproducen _find_first_text/_find_all_text (orden de documento).
+# BANDEJA declara sus campos en _BANDEJA_FIELDS y se extrae en streaming (_stream_bandeja).
+_AEAT_FIELD_SPECS = {
+    "AES": {
+        "first": (
+            "tipoRespuesta", "codigoRespuesta", "MRN", "estadoAES", "circuitoLlegada", "circuito",
+            "CSVDeclaracionElectronica", "CSVLevanteExportacion", "CSVLevanteSalida", "CSVCertificadoSalida",
+            "fechaLevante", "fechaLlegada", "fechaLlegadaSalida", "fechaLevanteSalida", "fechaSalidaEfectiva",
+        ),
+        "elements": ("FunctionalError", "XMLError"),
+    },
+    "G4_DEC": {
+        "first": ("ResponseCode", "MRN", "LRN"),
+        "all": ("ErrorCode", "ErrorDescription", "ErrorInfo"),
+    },
+    "IE615": {
+        "elements": ("CC628A", "CC616A", "CD919B", "HEAHEA", "FUNERRER1", "XMLERR805"),
+    },
+    "GENERIC": {
+        "first": (
+            "MRN", "LRN", "estadoAES", "EstadoAES", "codigoRespuesta", "CódigoRespuesta",
+            "circuitoAEAT", "circuito", "Circuito", "circuitoLlegada",
+            "CSVDeclaracionElectronica", "CSVDeclaracion", "CSVLevanteExportacion", "CSVLevante",
+            "CSVLevanteSalida", "CSVCertificadoSalida", "fechaAdmision", "FechaAdmision",
+            "fechaLevante", "FechaLevante", "fechaLlegada", "fechaLevanteSalida",
+            "fechaSalidaEfectiva", "fechaSalida", "messageType", "NumUltimoMensaje",
+        ),
+        "all": ("Mensaje", "Message"),
+        "elements": (
+            "Error", "FunctionalError", "XMLError", "XmlError", "ERROR", "CodigoError",
+            "Incidencia", "Requerimiento", "Solicitud",
+            "ACEPTACION", "Aceptacion", "CC415R", "LEVANTE", "Levante",
+        ),
+    },
+}
+
+_XPATH_CACHE = threading.local()
+
+
+class _AeatFields:
+    """Resultado de extract_fields: accesos O(1) a los valores recogidos en la pasada."""
+
+    __slots__ = ("_first", "_all", "_elements", "_order", "_texts")
+
+    def __init__(self):
+        self._first = {}
+        self._all = {}
+        self._elements = {}
+        self._order = []
+        self._texts = []
+
+    def first(self, *names):
+        """Primer valor del primer nombre que tenga texto (equivale a a() or b() or ...)."""
+        for name in names:
+            value = self._first.get(name)
+            if value:
+                return value
+        return None
+
+    def find_first(self, *names):
+        """Como _find_first_text: sin distinguir mayúsculas, el primero en orden de documento."""
+        wanted = {name.lower() for name in names}
+        for local, text in self._texts:
+            if local in wanted:
+                return text
+        return None
+
+    def find_all(self, *names):
+        """Como _find_all_text: sin distinguir mayúsculas, en orden de documento."""
+        wanted = {name.lower() for name in names}
+        return [text for local, text in self._texts if local in wanted]
+
+    def all(self, name):
+        return self._all.get(name, [])
+
+    def elements(self, name):
+        return self._elements.get(name, [])
+
+    def first_element(self, *names):
+        """Primer elemento (orden de documento) cuyo nombre local esté en names."""
+        for local, el in self._order:
+            if local in names:
+                return el
+        return None
+
+
+def _spec_index(spec_name):
+    """{nombre_local en minúsculas: (en_first, en_all, en_elements)} del spec."""
+    spec = _AEAT_FIELD_SPECS[spec_name]
+    index = {}
+    for role, key in enumerate(("first", "all", "elements")):
+        for name in spec.get(key, ()):
+            roles = list(index.get(name.lower(), (False, False, False)))
+            roles[role] = True
+            index[name.lower()] = tuple(roles)
+    return index
+
+
+_SPEC_INDEXES = {name: _spec_index(name) for name in _AEAT_FIELD_SPECS}
+
+_XPATH_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZÁÉÍÓÚÜÑ"
+_XPATH_LOWER = "abcdefghijklmnopqrstuvwxyzáéíóúüñ"
+
+
+def _compiled_xpath(spec_name):
+    """XPath lxml precompilado (sin namespace ni mayúsculas) por spec; uno por hilo."""
+    cache = getattr(_XPATH_CACHE, "xpaths", None)
+    if cache is None:
+        cache = _XPATH_CACHE.xpaths = {}
+    xpath = cache.get(spec_name)
+    if xpath is None:
+        from lxml import etree
+        names = "|%s|" % "|".join(sorted(_SPEC_INDEXES[spec_name]))
+        xpath = cache[spec_name] = etree.XPath(
+            "descendant-or-self::*[contains('%s', concat('|', translate(local-name(), '%s', '%s'), '|'))]"
+            % (names, _XPATH_UPPER, _XPATH_LOWER)
+        )
+    return xpath
+
+
+def extract_fields(root, spec_name):
+    """
+    Rellena todos los campos del spec en una sola pasada sobre el árbol.
+    Con lxml usa un XPath precompilado (recorrido en C); con ElementTree, un único root.iter().
+    """
+    index = _SPEC_INDEXES[spec_name]
+    out = _AeatFields()
+    if hasattr(root, "xpath"):
+        try:
+            nodes = _compiled_xpath(spec_name)(root)
+        except Exception:
+            nodes = root.iter()
+    else:
+        nodes = root.iter()
+    first, all_, elements, order, texts = out._first, out._all, out._elements, out._order, out._texts
+    for el in nodes:
+        tag = el.tag
+        if not isinstance(tag, str):
+            continue
+        local = tag.rsplit("}", 1)[-1]
+        lower = local.lower()
+        roles = index.get(lower)
+        if roles is None:
+            continue
+        in_first, in_all, in_elements = roles
+        if in_elements:
+            elements.setdefault(local, []).append(el)
+            order.append((local, el))
+        if in_first or in_all:
+            text = (el.text or "").strip()
+            if not text:
+                continue
+            texts.append((lower, text))
+            if in_first and local not in first:
+                first[local] = text
+            if in_all:
+                all_.setdefault(local, []).append(text)
+    return out
+
+
 class AduanaXmlParser(models.AbstractModel):
     _name = "aduanas.xml.parser"
     _description = "Parser de respuestas XML de AEAT"
@@ -145,53 +477,33 @@ class AduanaXmlParser(models.AbstractModel):
                 "raw_xml": xml_text
             }
             
-            # Extraer MRN
-            mrn_elements = root.findall(".//MRN") + root.findall(".//{*}MRN")
-            if mrn_elements:
-                result["mrn"] = mrn_elements[0].text
-            
-            # Extraer LRN
-            lrn_elements = root.findall(".//LRN") + root.findall(".//{*}LRN")
-            if lrn_elements:
-                result["lrn"] = lrn_elements[0].text
-
-            result["estado_aes"] = self._find_first_text(root, "estadoAES", "EstadoAES")
-            result["response_code"] = self._find_first_text(root, "codigoRespuesta", "CódigoRespuesta")
-            result["circuito"] = self._find_first_text(root, "circuitoAEAT", "circuito", "Circuito")
-            result["circuito_llegada"] = self._find_first_text(root, "circuitoLlegada")
-            result["csv_declaracion"] = self._find_first_text(root, "CSVDeclaracionElectronica", "CSVDeclaracion")
-            result["csv_levante"] = self._find_first_text(root, "CSVLevanteExportacion", "CSVLevante")
-            result["csv_levante_salida"] = self._find_first_text(root, "CSVLevanteSalida")
-            result["csv_certificado_salida"] = self._find_first_text(root, "CSVCertificadoSalida")
-            result["fecha_admision"] = self._find_first_text(root, "fechaAdmision", "FechaAdmision")
-            result["fecha_levante"] = self._find_first_text(root, "fechaLevante", "FechaLevante")
-            result["fecha_llegada"] = self._find_first_text(root, "fechaLlegada")
-            result["fecha_levante_salida"] = self._find_first_text(root, "fechaLevanteSalida")
-            result["fecha_salida_efectiva"] = self._find_first_text(root, "fechaSalidaEfectiva", "fechaSalida")
+            # Una sola pasada sobre el árbol para todos los campos
+            f = extract_fields(root, "GENERIC")
+            result["mrn"] = f.first("MRN")
+            result["lrn"] = f.first("LRN")
+            result["estado_aes"] = f.find_first("estadoAES", "EstadoAES")
+            result["response_code"] = f.find_first("codigoRespuesta", "CódigoRespuesta")
+            result["circuito"] = f.find_first("circuitoAEAT", "circuito", "Circuito")
+            result["circuito_llegada"] = f.find_first("circuitoLlegada")
+            result["csv_declaracion"] = f.find_first("CSVDeclaracionElectronica", "CSVDeclaracion")
+            result["csv_levante"] = f.find_first("CSVLevanteExportacion", "CSVLevante")
+            result["csv_levante_salida"] = f.find_first("CSVLevanteSalida")
+            result["csv_certificado_salida"] = f.find_first("CSVCertificadoSalida")
+            result["fecha_admision"] = f.find_first("fechaAdmision", "FechaAdmision")
+            result["fecha_levante"] = f.find_first("fechaLevante", "FechaLevante")
+            result["fecha_llegada"] = f.find_first("fechaLlegada")
+            result["fecha_levante_salida"] = f.find_first("fechaLevanteSalida")
+            result["fecha_salida_efectiva"] = f.find_first("fechaSalidaEfectiva", "fechaSalida")
             if result["circuito_llegada"] and not result["circuito"]:
                 result["circuito"] = result["circuito_llegada"]
             
             # Buscar errores e incidencias
-            error_elements = (
-                root.findall(".//Error") + 
-                root.findall(".//{*}Error") +
-                root.findall(".//FunctionalError") +
-                root.findall(".//{*}FunctionalError") +
-                root.findall(".//XMLError") +
-                root.findall(".//{*}XMLError") +
-                root.findall(".//XmlError") +
-                root.findall(".//{*}XmlError") +
-                root.findall(".//ERROR") +
-                root.findall(".//{*}ERROR") +
-                root.findall(".//CodigoError") +
-                root.findall(".//{*}CodigoError") +
-                root.findall(".//Incidencia") +
-                root.findall(".//{*}Incidencia") +
-                root.findall(".//Requerimiento") +
-                root.findall(".//{*}Requerimiento") +
-                root.findall(".//Solicitud") +
-                root.findall(".//{*}Solicitud")
-            )
+            error_elements = []
+            for name in (
+                "Error", "FunctionalError", "XMLError", "XmlError", "ERROR",
+                "CodigoError", "Incidencia", "Requerimiento", "Solicitud",
+            ):
+                error_elements.extend(f.elements(name))
             
             # Estructura para incidencias
             result["incidencias"] = []
@@ -271,41 +583,17 @@ class AduanaXmlParser(models.AbstractModel):
                     result["errors"].append(formatted_error)
             
             # Buscar mensajes
-            message_elements = (
-                root.findall(".//Mensaje") + 
-                root.findall(".//{*}Mensaje") +
-                root.findall(".//Message") +
-                root.findall(".//{*}Message")
-            )
-            for msg in message_elements:
-                if msg.text:
-                    result["messages"].append(msg.text)
+            result["messages"].extend(f.all("Mensaje") + f.all("Message"))
             
             # Buscar estado de aceptación
-            aceptacion_elements = (
-                root.findall(".//ACEPTACION") +
-                root.findall(".//{*}ACEPTACION") +
-                root.findall(".//Aceptacion") +
-                root.findall(".//{*}Aceptacion")
-            )
-            if aceptacion_elements:
+            if f.first_element("ACEPTACION", "Aceptacion", "CC415R") is not None:
                 result["accepted"] = True
-            for elem in root.iter():
-                if self._local_name(elem.tag) == "CC415R":
-                    result["accepted"] = True
-                    break
             
             # Buscar levante
-            levante_elements = (
-                root.findall(".//LEVANTE") +
-                root.findall(".//{*}LEVANTE") +
-                root.findall(".//Levante") +
-                root.findall(".//{*}Levante")
-            )
-            if levante_elements:
+            if f.first_element("LEVANTE", "Levante") is not None:
                 result["released"] = True
 
-            message_type = (self._find_first_text(root, "messageType") or "").upper()
+            message_type = (f.find_first("messageType") or "").upper()
             estado = (result.get("estado_aes") or "").upper()
             response_code = (result.get("response_code") or "").upper()
             if response_code in ("A", "B", "L", "OK") or estado:
@@ -316,13 +604,9 @@ class AduanaXmlParser(models.AbstractModel):
                 result["exited"] = True
             
             # Buscar NumUltimoMensaje en bandeja
-            num_msg_elements = (
-                root.findall(".//NumUltimoMensaje") +
-                root.findall(".//{*}NumUltimoMensaje")
-            )
-            if num_msg_elements:
+            if f.first("NumUltimoMensaje"):
                 try:
-                    result["last_message_num"] = int(num_msg_elements[0].text or 0)
+                    result["last_message_num"] = int(f.first("NumUltimoMensaje"))
                 except (ValueError, TypeError):
                     pass
             
@@ -400,19 +684,19 @@ class AduanaXmlParser(models.AbstractModel):
             root, _used_lxml = _parse_with_lxml_recover(xml_text)
             if root is None:
                 root = ET.fromstring(xml_text)
-            response_code = self._find_first_text(root, "ResponseCode")
-            mrn = self._find_first_text(root, "MRN")
-            lrn = self._find_first_text(root, "LRN")
+            f = extract_fields(root, "G4_DEC")
+            response_code = f.find_first("ResponseCode")
+            mrn = f.find_first("MRN")
+            lrn = f.find_first("LRN")
             if not mrn:
                 mrn = _extract_mrn_from_raw_text(xml_text)
             errors = []
-            for code in self._find_all_text(root, "ErrorCode"):
-                desc = ""
+            for code in f.find_all("ErrorCode"):
                 errors.append(code)
-            for desc in self._find_all_text(root, "ErrorDescription"):
+            for desc in f.find_all("ErrorDescription"):
                 if desc:
                     errors.append(desc)
-            for info in self._find_all_text(root, "ErrorInfo"):
+            for info in f.find_all("ErrorInfo"):
                 if info and info not in errors:
                     errors.append(info)
             if not errors and response_code == "RE":
@@ -453,39 +737,16 @@ class AduanaXmlParser(models.AbstractModel):
             return {"success": False, "errors": [_("Respuesta vacía")], "response_type": None}
         try:
             root = ET.fromstring(xml_text)
-            # Quitar namespace para búsquedas
-            def strip_ns(tag):
-                return tag.split("}")[-1] if "}" in tag else tag
-            # Buscar Body y dentro el mensaje (CC628A, CC616A o CD919B)
-            body = root.find(".//{http://schemas.xmlsoap.org/soap/envelope/}Body")
-            if body is None:
-                body = root.find(".//Body") or root
-            msg = None
-            for child in body:
-                if child.tag and strip_ns(child.tag) in ("CC628A", "CC616A", "CD919B"):
-                    msg = child
-                    break
-            if msg is None:
-                # Quizá la respuesta es directa (sin SOAP)
-                for elem in [root] + list(root):
-                    if elem.tag and strip_ns(elem.tag) in ("CC628A", "CC616A", "CD919B"):
-                        msg = elem
-                        break
+            f = extract_fields(root, "IE615")
+            # Mensaje de respuesta (CC628A, CC616A o CD919B), con o sin envelope SOAP
+            msg = f.first_element("CC628A", "CC616A", "CD919B")
             if msg is None:
                 return {"success": False, "errors": [_("No se encontró mensaje IE628/IE616/IE919 en la respuesta")], "raw_xml": xml_text, "response_type": None}
-            msg_tag = strip_ns(msg.tag)
+            msg_tag = self._local_name(msg.tag)
             result = {"success": False, "mrn": None, "exs_circuito": None, "exs_dec_csv": None, "exs_rel_csv": None, "exs_tipo_declaracion": None, "exs_predeclaracion": None, "errors": [], "response_type": msg_tag}
-            def find_text(parent, local_name):
-                for e in parent.iter():
-                    if strip_ns(e.tag) == local_name and (e.text or "").strip():
-                        return (e.text or "").strip()
-                return None
+            find_text = self._find_first_text
             # HEAHEA común
-            hea = None
-            for e in msg.iter():
-                if strip_ns(e.tag) == "HEAHEA":
-                    hea = e
-                    break
+            hea = f.first_element("HEAHEA")
             if hea is not None:
                 result["mrn"] = find_text(hea, "DocNumHEA5")
                 result["exs_tipo_declaracion"] = find_text(hea, "DecTypeHEA")
@@ -497,20 +758,18 @@ class AduanaXmlParser(models.AbstractModel):
                 result["success"] = True
                 return result
             if msg_tag == "CC616A":
-                for err in msg.iter():
-                    if strip_ns(err.tag) == "FUNERRER1":
-                        err_typ = find_text(err, "ErrTypER11")
-                        err_poi = find_text(err, "ErrPoiER12")
-                        err_val = find_text(err, "OriAttValER14")
-                        result["errors"].append("%s: %s (valor: %s)" % (err_typ or "", err_poi or "", err_val or ""))
+                for err in f.elements("FUNERRER1"):
+                    err_typ = find_text(err, "ErrTypER11")
+                    err_poi = find_text(err, "ErrPoiER12")
+                    err_val = find_text(err, "OriAttValER14")
+                    result["errors"].append("%s: %s (valor: %s)" % (err_typ or "", err_poi or "", err_val or ""))
                 if not result["errors"]:
                     result["errors"].append(_("Rechazo funcional IE616 sin detalle"))
                 return result
             if msg_tag == "CD919B":
-                for err in msg.iter():
-                    if strip_ns(err.tag) == "XMLERR805":
-                        err_reason = find_text(err, "ErrReaXMLER802") or find_text(err, "OriAttValXMLER804")
-                        result["errors"].append(err_reason or _("Error de formato XML"))
+                for err in f.elements("XMLERR805"):
+                    err_reason = find_text(err, "ErrReaXMLER802") or find_text(err, "OriAttValXMLER804")
+                    result["errors"].append(err_reason or _("Error de formato XML"))
                 if not result["errors"]:
                     result["errors"].append(_("Rechazo XML IE919 sin detalle"))
                 return result
@@ -612,38 +871,36 @@ class AduanaXmlParser(models.AbstractModel):
             root, ok = _parse_with_lxml_recover(xml_text)
             if not ok or root is None:
                 root = ET.fromstring(xml_text)
-            result["tipo_respuesta"] = self._xml_text(root, "tipoRespuesta")
-            result["codigo_respuesta"] = self._xml_text(root, "codigoRespuesta")
-            result["mrn"] = self._xml_text(root, "MRN") or _extract_mrn_from_raw_text(xml_text)
-            result["estado_aes"] = self._xml_text(root, "estadoAES")
-            result["circuito"] = (
-                self._xml_text(root, "circuitoLlegada")
-                or self._xml_text(root, "circuito")
-            )
-            result["csv_declaracion"] = self._xml_text(root, "CSVDeclaracionElectronica")
-            result["csv_levante_export"] = self._xml_text(root, "CSVLevanteExportacion")
-            result["csv_levante_salida"] = self._xml_text(root, "CSVLevanteSalida")
-            result["csv_certificado_salida"] = self._xml_text(root, "CSVCertificadoSalida")
-            fecha_levante = self._xml_text(root, "fechaLevante")
+            f = extract_fields(root, "AES")
+            result["tipo_respuesta"] = f.first("tipoRespuesta")
+            result["codigo_respuesta"] = f.first("codigoRespuesta")
+            result["mrn"] = f.first("MRN") or _extract_mrn_from_raw_text(xml_text)
+            result["estado_aes"] = f.first("estadoAES")
+            result["circuito"] = f.first("circuitoLlegada", "circuito")
+            result["csv_declaracion"] = f.first("CSVDeclaracionElectronica")
+            result["csv_levante_export"] = f.first("CSVLevanteExportacion")
+            result["csv_levante_salida"] = f.first("CSVLevanteSalida")
+            result["csv_certificado_salida"] = f.first("CSVCertificadoSalida")
+            fecha_levante = f.first("fechaLevante")
             if fecha_levante and len(fecha_levante) >= 10:
                 result["fecha_levante"] = fecha_levante[:10]
-            fecha_lleg = self._xml_text(root, "fechaLlegada") or self._xml_text(root, "fechaLlegadaSalida")
+            fecha_lleg = f.first("fechaLlegada", "fechaLlegadaSalida")
             if fecha_lleg and len(fecha_lleg) >= 10:
                 result["fecha_llegada"] = fecha_lleg[:10]
-            fecha_levante_salida = self._xml_text(root, "fechaLevanteSalida")
+            fecha_levante_salida = f.first("fechaLevanteSalida")
             if fecha_levante_salida and len(fecha_levante_salida) >= 10:
                 result["fecha_levante_salida"] = fecha_levante_salida[:10]
-            fecha_se = self._xml_text(root, "fechaSalidaEfectiva")
+            fecha_se = f.first("fechaSalidaEfectiva")
             if fecha_se and len(fecha_se) >= 10:
                 result["fecha_salida_efectiva"] = fecha_se[:10]
-            for fe in self._xml_all(root, "FunctionalError"):
+            for fe in f.elements("FunctionalError"):
                 result["functional_errors"].append({
                     "error_pointer": self._xml_text(fe, "errorPointer"),
                     "error_code": self._xml_text(fe, "errorCode"),
                     "error_reason": self._xml_text(fe, "errorReason"),
                     "error_description": self._xml_text(fe, "errorDescription"),
                 })
-            for xe in self._xml_all(root, "XMLError"):
+            for xe in f.elements("XMLError"):
                 result["xml_errors"].append({
                     "error_text": self._xml_text(xe, "errorText"),
                     "error_code": self._xml_text(xe, "errorCode"),
@@ -678,109 +935,35 @@ class AduanaXmlParser(models.AbstractModel):
     def parse_bandeja_response(self, xml_text):
         """
         Extrae mensajes de bandeja EXPORAES embebidos (ComunicaLevanteExpor, ComunicaResulSalida, etc.).
+        Lectura en streaming (iterparse, una sola pasada, memoria acotada): un dict por bloque
+        DatosComunicacion. Si el XML está mal formado se recorre el árbol recuperado por lxml y,
+        como último recurso, un único barrido regex del texto.
         """
         result = {"messages": [], "last_message_num": 0, "incidencias": [], "errors": []}
         if not xml_text:
             return result
         try:
+            messages, last_num = _stream_bandeja(_iterparse_events(xml_text))
+        except ParseError as e:
             root, ok = _parse_with_lxml_recover(xml_text)
-            if not ok or root is None:
-                root = ET.fromstring(xml_text)
-            num = self._xml_text(root, "NumUltimoMensaje")
-            if num:
-                try:
-                    result["last_message_num"] = int(num)
-                except ValueError:
-                    pass
-            # Cada bloque con messageType + DatosComunicacion
-            for el in root.iter():
-                local = el.tag.split("}")[-1] if "}" in el.tag else el.tag
-                if local != "messageType" or not el.text:
-                    continue
-                msg_type = (el.text or "").strip().upper()
-                if not hasattr(el, "getparent"):
-                    continue
-                block = el
-                for _ in range(15):
-                    parent = block.getparent()
-                    if parent is None:
-                        break
-                    block = parent
-                msg = {"message_type": msg_type}
-                for sub in block.iter() if hasattr(block, "iter") else []:
-                    loc = sub.tag.split("}")[-1] if "}" in sub.tag else sub.tag
-                    if loc == "MRN" and sub.text:
-                        msg["mrn"] = sub.text.strip()
-                    elif loc == "estadoAES" and sub.text:
-                        msg["estado_aes"] = sub.text.strip()
-                    elif loc == "fechaLevante" and sub.text:
-                        msg["fecha_levante"] = sub.text.strip()[:10]
-                    elif loc == "fechaSalidaEfectiva" and sub.text:
-                        msg["fecha_salida_efectiva"] = sub.text.strip()[:10]
-                    elif loc == "fechaLevanteSalida" and sub.text:
-                        msg["fecha_levante_salida"] = sub.text.strip()[:10]
-                    elif loc == "CSVLevanteExportacion" and sub.text:
-                        msg["csv_levante_export"] = sub.text.strip()
-                    elif loc == "CSVLevanteSalida" and sub.text:
-                        msg["csv_levante_salida"] = sub.text.strip()
-                if msg_type or msg.get("mrn"):
-                    result["messages"].append(msg)
-            # Fallback: regex sobre XML completo si no hay getparent (ElementTree estándar)
-            if not result["messages"]:
-                import re
-                for m in re.finditer(
-                    r"<messageType>([^<]+)</messageType>.*?<MRN>([^<]+)</MRN>",
-                    xml_text,
-                    re.DOTALL | re.IGNORECASE,
-                ):
-                    result["messages"].append({
-                        "message_type": m.group(1).strip().upper(),
-                        "mrn": m.group(2).strip(),
-                    })
-                for m in re.finditer(
-                    r"<messageType>(CSALID|CLEVEX|CLEVSA|CDISSA)[^<]*</messageType>",
-                    xml_text,
-                    re.IGNORECASE,
-                ):
-                    msg = {"message_type": m.group(1).upper()}
-                    mrn_m = re.search(
-                        r"<MRN>([^<]+)</MRN>",
-                        xml_text[m.end() : m.end() + 800],
-                        re.IGNORECASE,
-                    )
-                    if mrn_m:
-                        msg["mrn"] = mrn_m.group(1).strip()
-                    fe_m = re.search(
-                        r"<fechaSalidaEfectiva>([^<]+)</fechaSalidaEfectiva>",
-                        xml_text[m.end() : m.end() + 800],
-                        re.IGNORECASE,
-                    )
-                    if fe_m:
-                        msg["fecha_salida_efectiva"] = fe_m.group(1).strip()[:10]
-                    fls_m = re.search(
-                        r"<fechaLevanteSalida>([^<]+)</fechaLevanteSalida>",
-                        xml_text[m.end() : m.end() + 800],
-                        re.IGNORECASE,
-                    )
-                    if fls_m:
-                        msg["fecha_levante_salida"] = fls_m.group(1).strip()[:10]
-                    estado_m = re.search(
-                        r"<estadoAES>([^<]+)</estadoAES>",
-                        xml_text[m.end() : m.end() + 800],
-                        re.IGNORECASE,
-                    )
-                    if estado_m:
-                        msg["estado_aes"] = estado_m.group(1).strip()
-                    csv_m = re.search(
-                        r"<CSVLevanteSalida>([^<]+)</CSVLevanteSalida>",
-                        xml_text[m.end() : m.end() + 800],
-                        re.IGNORECASE,
-                    )
-                    if csv_m:
-                        msg["csv_levante_salida"] = csv_m.group(1).strip()
-                    result["messages"].append(msg)
+            if ok and root is not None:
+                messages, last_num = _stream_bandeja(_walk_events(root))
+            else:
+                _logger.warning("parse_bandeja_response: %s", e)
+                result["errors"].append(str(e))
+                messages, last_num = [], 0
         except Exception as e:
             _logger.warning("parse_bandeja_response: %s", e)
             result["errors"].append(str(e))
+            messages, last_num = [], 0
+        if not messages:
+            regex_messages, regex_last = _scan_bandeja_regex(xml_text)
+            messages = regex_messages
+            last_num = last_num or regex_last
+        if not last_num:
+            # Sin NumUltimoMensaje: el mayor NumMensaje de la página
+            last_num = max((m.get("num") or 0 for m in messages), default=0)
+        result["messages"] = messages
+        result["last_message_num"] = last_num
         return result
 
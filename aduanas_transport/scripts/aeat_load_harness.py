@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga del camino envío/parseo AEAT contra el stub local (aeat_stub_server.py).
+
+Arranca el stub en un hilo, apunta los endpoints (globales y de la compañía actual) al stub,
+y mide throughput y latencias (p50/p95) de:
+  1) aduanas.aeat.client.send_xml en serie, por servicio,
+  2) aduanas.aeat.client.send_xml_batch (pool de hilos con límite por endpoint),
+  3) acciones de expediente: consulta CCAESC individual y en lote, y lectura de bandeja por cursor.
+Por defecto hace rollback al terminar (no deja expedientes ni parámetros cambiados).
+
+Uso:
+    odoo-bin shell -d tu_base_de_datos
+    >>> exec(open('addons/aduanas_transport/scripts/aeat_load_harness.py').read())
+    >>> run_harness(env, requests_per_service=100, latency_ms=120, jitter_ms=40, reject_rate=0.05)
+"""
+
+import importlib.util
+import logging
+import os
+import time
+
+from odoo.exceptions import UserError
+from odoo.modules.module import get_module_path
+
+_logger = logging.getLogger(__name__)
+
+# Servicio del cliente -> (clave de endpoint, ruta del stub)
+HARNESS_SERVICES = {
+    "CC515C": ("cc515c", "CC515CV1SOAP"),
+    "CC511C": ("cc511c", "CC511CV1SOAP"),
+    "CCAESC": ("ccaesc", "CCAESCV1SOAP"),
+    "CC507C": ("cc507c", "CC507CV1SOAP"),
+    "IMP_DECL": ("imp_decl", "CC415AV1SOAP"),
+    "IMP_QUERY_V3": ("imp_query", "ConsultaImportacionV3SOAP"),
+    "BANDEJA": ("bandeja", "DetalleV5SOAP"),
+    "IE615_EXS": ("ie615", "IE615V5SOAP"),
+    "G4_DEC": ("g4_dec", "G4DecV1SOAP"),
+}
+
+_SAMPLE_BODIES = {
+    "BANDEJA": "<DetalleV5Ent><CodigoBandeja>EXPORAES</CodigoBandeja><NumUltimoMensajeLeido>0</NumUltimoMensajeLeido>"
+               "<MaxMensajes>50</MaxMensajes></DetalleV5Ent>",
+}
+
+
+def _load_stub_module():
+    path = os.path.join(get_module_path("aduanas_transport"), "scripts", "aeat_stub_server.py")
+    spec = importlib.util.spec_from_file_location("aduanas_transport_aeat_stub_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _summary(label, latencies, statuses, wall):
+    ok = len([s for s in statuses if s == 200])
+    return {
+        "label": label,
+        "requests": len(latencies),
+        "http_200": ok,
+        "http_other": len(statuses) - ok,
+        "throughput_rps": (len(latencies) / wall) if wall else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000.0,
+        "p95_ms": _percentile(latencies, 95) * 1000.0,
+        "wall_s": wall,
+    }
+
+
+def _point_endpoints_to_stub(env, base_url):
+    icp = env["ir.config_parameter"].sudo()
+    company = env.company
+    for _service, (key, path) in HARNESS_SERVICES.items():
+        url = "%s/%s" % (base_url, path)
+        icp.set_param("aduanas_transport.endpoint.%s" % key, url)
+        company._set_aeat_param("aeat_endpoint_%s" % key, url)
+
+
+def _run_client_phase(env, base_url, requests_per_service, concurrency):
+    client = env["aduanas.aeat.client"]
+    rows = []
+    jobs = []
+    for service, (_key, path) in HARNESS_SERVICES.items():
+        endpoint = "%s/%s" % (base_url, path)
+        body = _SAMPLE_BODIES.get(service, "<Ent><MRN>26ESE0000000000001</MRN></Ent>")
+        latencies, statuses = [], []
+        start = time.monotonic()
+        for i in range(requests_per_service):
+            t0 = time.monotonic()
+            status, _text = client.send_xml(endpoint, body, service=service)
+            latencies.append(time.monotonic() - t0)
+            statuses.append(status)
+            jobs.append({"key": (service, i), "endpoint": endpoint, "xml": body, "service": service, "timeout": 30})
+        rows.append(_summary("send_xml %s (serie)" % service, latencies, statuses, time.monotonic() - start))
+    limits = {service: concurrency for service in HARNESS_SERVICES}
+    start = time.monotonic()
+    results = client.send_xml_batch(jobs, limits=limits, max_workers=concurrency)
+    wall = time.monotonic() - start
+    rows.append(_summary(
+        "send_xml_batch todos (x%s)" % concurrency,
+        [r["elapsed"] for r in results.values()],
+        [r["status_code"] for r in results.values()],
+        wall,
+    ))
+    return rows
+
+
+def _run_expediente_phase(env, stub_state, expedientes):
+    Expediente = env["aduana.expediente"]
+    recs = Expediente.create([
+        {"direction": "export", "state": "presented", "mrn": stub_state.new_mrn("E")}
+        for _i in range(expedientes)
+    ])
+    rows = []
+    latencies, statuses = [], []
+    start = time.monotonic()
+    for rec in recs:
+        t0 = time.monotonic()
+        try:
+            with env.cr.savepoint():
+                rec.action_consultar_estado_dua()
+            statuses.append(200)
+        except UserError:
+            statuses.append(0)
+        latencies.append(time.monotonic() - t0)
+    rows.append(_summary("action_consultar_estado_dua (serie)", latencies, statuses, time.monotonic() - start))
+
+    start = time.monotonic()
+    report = recs._aeat_batch_send("ccaesc")
+    rows.append(_summary(
+        "_aeat_batch_send ccaesc (lote)",
+        [line["build_s"] + line["send_s"] + line["apply_s"] for line in report],
+        [200 if line["outcome"] == "ok" else 0 for line in report],
+        time.monotonic() - start,
+    ))
+
+    for rec in recs:
+        stub_state.post_mailbox("EXPORAES", "CLEVEX", rec.mrn, "<estadoAES>DE</estadoAES>")
+    cursor = env["aduana.bandeja.cursor"]._get_cursor(env.company, "EXPORAES")
+    start = time.monotonic()
+    cursor.action_poll()
+    wall = time.monotonic() - start
+    rows.append(_summary("bandeja cursor (%s mensajes)" % cursor.last_message_count, [wall], [200], wall))
+    return rows
+
+
+def run_harness(env, requests_per_service=100, concurrency=8, expedientes=20, latency_ms=120.0, jitter_ms=40.0,
+                reject_rate=0.05, forbidden_rate=0.0, bad_gateway_rate=0.0, fault_rate=0.0, seed=42, rollback=True):
+    """Ejecuta las tres fases y devuelve/imprime la tabla de resultados."""
+    stub = _load_stub_module()
+    server, base_url, state = stub.start_stub_server(
+        latency_ms=latency_ms, jitter_ms=jitter_ms, reject_rate=reject_rate, forbidden_rate=forbidden_rate,
+        bad_gateway_rate=bad_gateway_rate, fault_rate=fault_rate, seed=seed,
+    )
+    rows = []
+    try:
+        _point_endpoints_to_stub(env, base_url)
+        rows += _run_client_phase(env, base_url, requests_per_service, concurrency)
+        rows += _run_expediente_phase(env, state, expedientes)
+    finally:
+        server.shutdown()
+        if rollback:
+            env.cr.rollback()
+            env["aduanas.aeat.client"].invalidate_session_pool()
+    print("%-42s %6s %6s %6s %9s %9s %9s %8s" % ("fase", "req", "200", "otros", "req/s", "p50 ms", "p95 ms", "wall s"))
+    for r in rows:
+        print("%-42s %6d %6d %6d %9.1f %9.1f %9.1f %8.2f" % (
+            r["label"][:42], r["requests"], r["http_200"], r["http_other"],
+            r["throughput_rps"], r["p50_ms"], r["p95_ms"], r["wall_s"]))
+    print("Peticiones atendidas por el stub: %s" % state.requests)
+    return rows
+
+
+# Si se ejecuta directamente desde la consola
+if __name__ == "__main__":
+    if "env" in globals():
+        run_harness(env)  # noqa: F821
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Servidor SOAP local que simula los servicios AEAT usados por el módulo, para pruebas de
+carga sin tocar prewww1.aeat.es. Solo librería estándar (no necesita Odoo).
+
+Servicios (se reconocen por el final de la ruta, como en los endpoints reales):
+    CC515CV1SOAP, CC511CV1SOAP, CCAESCV1SOAP, CC507CV1SOAP      (AES exportación)
+    CC415AV1SOAP, ConsultaImportacionV3SOAP                     (importación H1)
+    DetalleV5SOAP                                               (bandeja EXPORAES/IMPORAES)
+    IE615V5SOAP                                                 (EXS)
+    G4DecV1SOAP                                                 (depósito temporal G4)
+
+Respuestas: asignación de MRN, rechazos funcionales (--reject-rate), páginas de bandeja con
+levante/salida de los MRN emitidos, y fallos inyectados: 403 (--forbidden-rate),
+502 (--bad-gateway-rate), SOAP Fault 500 (--fault-rate) y latencia (--latency-ms/--jitter-ms).
+
+Uso:
+    python3 aeat_stub_server.py --port 8769 --latency-ms 150 --jitter-ms 50 --reject-rate 0.05
+    # y en Aduanas > Configuración apuntar los endpoints a http://127.0.0.1:8769/<Servicio>
+"""
+
+import argparse
+import itertools
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SOAP_ENV = "http://schemas.xmlsoap.org/soap/envelope/"
+
+SERVICES = (
+    "CC515CV1SOAP", "CC511CV1SOAP", "CCAESCV1SOAP", "CC507CV1SOAP",
+    "CC415AV1SOAP", "ConsultaImportacionV3SOAP", "DetalleV5SOAP", "IE615V5SOAP", "G4DecV1SOAP",
+)
+
+_MRN_RE = re.compile(r"<(?:[\w.-]+:)?MRN>([^<]+)</", re.IGNORECASE)
+_BANDEJA_CODE_RE = re.compile(r"<(?:[\w.-]+:)?CodigoBandeja>([^<]+)</")
+_BANDEJA_LAST_RE = re.compile(r"<(?:[\w.-]+:)?NumUltimoMensajeLeido>(\d+)</")
+_BANDEJA_MAX_RE = re.compile(r"<(?:[\w.-]+:)?MaxMensajes>(\d+)</")
+
+
+class StubConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, reject_rate=0.0, forbidden_rate=0.0,
+                 bad_gateway_rate=0.0, fault_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.reject_rate = reject_rate
+        self.forbidden_rate = forbidden_rate
+        self.bad_gateway_rate = bad_gateway_rate
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+
+
+class StubState:
+    """Estado compartido: MRN emitidos y bandejas (lista de mensajes por código)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.mailboxes = {"EXPORAES": [], "IMPORAES": []}
+        self.requests = 0
+
+    def new_mrn(self, kind="E"):
+        with self.lock:
+            n = next(self._counter)
+        return "26ES%s%013d" % (kind, n)
+
+    def post_mailbox(self, code, message_type, mrn, extra=""):
+        with self.lock:
+            box = self.mailboxes.setdefault(code, [])
+            box.append((len(box) + 1, message_type, mrn, extra))
+
+    def read_mailbox(self, code, last, maximum):
+        with self.lock:
+            box = list(self.mailboxes.get(code, []))
+        page = [m for m in box if m[0] > last][:maximum]
+        return page, (page[-1][0] if page else last)
+
+
+def _envelope(body):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<soapenv:Envelope xmlns:soapenv="%s"><soapenv:Body>%s</soapenv:Body></soapenv:Envelope>'
+            % (SOAP_ENV, body))
+
+
+def _soap_fault(text):
+    return _envelope("<soapenv:Fault><faultcode>soapenv:Server</faultcode><faultstring>%s</faultstring></soapenv:Fault>" % text)
+
+
+def _aes_ok(service, mrn, extra=""):
+    return _envelope(
+        "<%sV1Sal><ControlRespuesta><tipoRespuesta>OK</tipoRespuesta><codigoRespuesta>A</codigoRespuesta></ControlRespuesta>"
+        "<DatosRespuestaCorrecta><MRN>%s</MRN>%s</DatosRespuestaCorrecta></%sV1Sal>" % (service, mrn, extra, service)
+    )
+
+
+def _aes_reject(service):
+    return _envelope(
+        "<%sV1Sal><ControlRespuesta><tipoRespuesta>EF</tipoRespuesta></ControlRespuesta>"
+        "<FunctionalError><errorPointer>/%s/GoodsShipment/GoodsItem[1]/Commodity/CommodityCode</errorPointer>"
+        "<errorCode>12</errorCode><errorReason>R0123</errorReason>"
+        "<errorDescription>Código de mercancía no válido (stub)</errorDescription></FunctionalError></%sV1Sal>"
+        % (service, service, service)
+    )
+
+
+def handle_service(service, body, config, state):
+    """Devuelve (status, texto) de la respuesta simulada para un servicio."""
+    rnd = config.random
+    reject = rnd.random() < config.reject_rate
+    mrn_in = (_MRN_RE.search(body) or [None, None])[1]
+    today = time.strftime("%Y-%m-%d")
+    if service == "CC515CV1SOAP":
+        if reject:
+            return 200, _aes_reject("CC515C")
+        mrn = state.new_mrn("E")
+        state.post_mailbox("EXPORAES", "CLEVEX", mrn, "<estadoAES>DE</estadoAES><fechaLevante>%sT10:00:00</fechaLevante>"
+                                                       "<CSVLevanteExportacion>CSV%s</CSVLevanteExportacion>" % (today, mrn[-8:]))
+        return 200, _aes_ok("CC515C", mrn, "<estadoAES>AD</estadoAES><CSVDeclaracionElectronica>CSVDEC%s</CSVDeclaracionElectronica>" % mrn[-8:])
+    if service == "CC511CV1SOAP":
+        return 200, (_aes_reject("CC511C") if reject else _aes_ok("CC511C", mrn_in or state.new_mrn("E")))
+    if service == "CCAESCV1SOAP":
+        if reject or not mrn_in:
+            return 200, _aes_reject("CCAESC")
+        estado = rnd.choice(("AD", "DE", "SA"))
+        extra = "<estadoAES>%s</estadoAES><circuito>V</circuito>" % estado
+        if estado in ("DE", "SA"):
+            extra += "<fechaLevante>%sT10:00:00</fechaLevante>" % today
+        if estado == "SA":
+            extra += "<fechaSalidaEfectiva>%sT12:00:00</fechaSalidaEfectiva>" % today
+        return 200, _aes_ok("CCAESC", mrn_in, extra)
+    if service == "CC507CV1SOAP":
+        if reject or not mrn_in:
+            return 200, _aes_reject("CC507C")
+        state.post_mailbox("EXPORAES", "CSALID", mrn_in, "<estadoAES>SA</estadoAES><fechaSalidaEfectiva>%sT12:00:00</fechaSalidaEfectiva>"
+                                                          "<CSVLevanteSalida>CSVSAL%s</CSVLevanteSalida>" % (today, mrn_in[-8:]))
+        return 200, _aes_ok("CC507C", mrn_in, "<circuitoLlegada>V</circuitoLlegada><fechaLlegada>%sT11:00:00</fechaLlegada>" % today)
+    if service == "CC415AV1SOAP":
+        if reject:
+            return 200, _envelope(
+                "<CC415AV1Sal><FunctionalError><errorPointer>/CC415A/GoodsShipment</errorPointer>"
+                "<errorCode>12</errorCode><errorReason>R0456</errorReason>"
+                "<errorDescription>Declaración rechazada (stub)</errorDescription></FunctionalError></CC415AV1Sal>")
+        mrn = state.new_mrn("I")
+        state.post_mailbox("IMPORAES", "CLEVIM", mrn, "<estadoAES>DE</estadoAES><fechaLevante>%sT10:00:00</fechaLevante>" % today)
+        return 200, _envelope("<CC415AV1Sal><CC428A><MRN>%s</MRN><codigoRespuesta>A</codigoRespuesta>"
+                              "<fechaAdmision>%s</fechaAdmision></CC428A></CC415AV1Sal>" % (mrn, today))
+    if service == "ConsultaImportacionV3SOAP":
+        if not mrn_in:
+            return 200, _soap_fault("MRN obligatorio")
+        return 200, _envelope("<ConsultaImportacionV3Sal><MRN>%s</MRN><estadoAES>DE</estadoAES>"
+                              "<fechaLevante>%sT10:00:00</fechaLevante></ConsultaImportacionV3Sal>" % (mrn_in, today))
+    if service == "DetalleV5SOAP":
+        code = (_BANDEJA_CODE_RE.search(body) or [None, "EXPORAES"])[1]
+        last = int((_BANDEJA_LAST_RE.search(body) or [None, "0"])[1])
+        maximum = int((_BANDEJA_MAX_RE.search(body) or [None, "50"])[1])
+        page, last_num = state.read_mailbox(code, last, maximum)
+        parts = ["<DetalleV5Sal><NumUltimoMensaje>%d</NumUltimoMensaje><Mensajes>" % last_num]
+        for num, msg_type, mrn, extra in page:
+            parts.append("<Mensaje><NumMensaje>%d</NumMensaje><Comunicacion><MESSAGE><messageSender>AEAT</messageSender>"
+                         "<messageType>%s</messageType><DatosComunicacion><MRN>%s</MRN>%s</DatosComunicacion>"
+                         "</MESSAGE></Comunicacion></Mensaje>" % (num, msg_type, mrn, extra))
+        parts.append("</Mensajes></DetalleV5Sal>")
+        return 200, _envelope("".join(parts))
+    if service == "IE615V5SOAP":
+        if reject:
+            return 200, _envelope("<CC616A><HEAHEA><DocNumHEA5></DocNumHEA5></HEAHEA><FUNERRER1><ErrTypER11>12</ErrTypER11>"
+                                  "<ErrPoiER12>HEAHEA.TotNumOfIteHEA305</ErrPoiER12><OriAttValER14>0</OriAttValER14></FUNERRER1></CC616A>")
+        mrn = state.new_mrn("X")
+        return 200, _envelope("<CC628A><HEAHEA><DocNumHEA5>%s</DocNumHEA5><DecTypeHEA>EXS</DecTypeHEA><CusChanHEA>V</CusChanHEA>"
+                              "<DecCsvHEA>CSVEXS%s</DecCsvHEA></HEAHEA></CC628A>" % (mrn, mrn[-8:]))
+    if service == "G4DecV1SOAP":
+        if reject:
+            return 200, _envelope("<G4DecV1Sal><ResponseCode>RE</ResponseCode><Error><ErrorCode>G4-001</ErrorCode>"
+                                  "<ErrorDescription>Depósito no autorizado (stub)</ErrorDescription></Error></G4DecV1Sal>")
+        return 200, _envelope("<G4DecV1Sal><ResponseCode>AC</ResponseCode><MRN>%s</MRN></G4DecV1Sal>" % state.new_mrn("G"))
+    return 404, _soap_fault("Servicio no simulado")
+
+
+def make_handler(config, state):
+    class AeatStubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):  # silencioso: el harness mide, no el log
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode("utf-8", "replace")
+            with state.lock:
+                state.requests += 1
+            delay = max(0.0, config.latency_ms + config.random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000.0
+            if delay:
+                time.sleep(delay)
+            service = next((s for s in SERVICES if self.path.rstrip("/").endswith(s)), None)
+            roll = config.random.random()
+            if roll < config.forbidden_rate:
+                status, text = 403, "<html><body>403 Forbidden (stub)</body></html>"
+            elif roll < config.forbidden_rate + config.bad_gateway_rate:
+                status, text = 502, "<html><body>502 Bad Gateway (stub)</body></html>"
+            elif roll < config.forbidden_rate + config.bad_gateway_rate + config.fault_rate:
+                status, text = 500, _soap_fault("Error interno simulado")
+            elif service is None:
+                status, text = 404, _soap_fault("Ruta no reconocida: %s" % self.path)
+            else:
+                status, text = handle_service(service, body, config, state)
+            data = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return AeatStubHandler
+
+
+def start_stub_server(host="127.0.0.1", port=0, **config_kwargs):
+    """Arranca el stub en un hilo. Devuelve (server, base_url, state); parar con server.shutdown()."""
+    config = StubConfig(**config_kwargs)
+    state = StubState()
+    server = ThreadingHTTPServer((host, port), make_handler(config, state))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="aeat_stub", daemon=True)
+    thread.start()
+    return server, "http://%s:%s" % server.server_address[:2], state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub local de servicios SOAP AEAT")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8769)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--forbidden-rate", type=float, default=0.0)
+    parser.add_argument("--bad-gateway-rate", type=float, default=0.0)
+    parser.add_argument("--fault-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server, base_url, _state = start_stub_server(
+        args.host, args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        reject_rate=args.reject_rate, forbidden_rate=args.forbidden_rate,
+        bad_gateway_rate=args.bad_gateway_rate, fault_rate=args.fault_rate, seed=args.seed,
+    )
+    print("Stub AEAT escuchando en %s (Ctrl+C para parar)" % base_url)
+    for service in SERVICES:
+        print("  %s/%s" % (base_url, service))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
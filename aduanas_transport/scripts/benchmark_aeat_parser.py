@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark y corpus de regresión de aduanas.xml.parser.
+
+Genera respuestas AEAT sintéticas (estructura de los esquemas reales) para cada servicio
+soportado — AES (CC515C, CCAESC, CC507C), CC511C, CC415A/IMP_DECL, ConsultaImportacionV3,
+G4Dec, IE615 (IE628/IE616) y bandeja DetalleV5 — en tamaños small / typical / huge y en
+variante bien formada o mal formada (camino lxml recover=True / extracción por texto).
+Para cada caso mide tiempo (mejor de N repeticiones), memoria pico (tracemalloc) y compara
+los campos con la salida esperada (golden). No hace llamadas a la AEAT.
+
+Uso (un solo comando, sin red):
+    echo "exec(open('addons/aduanas_transport/scripts/benchmark_aeat_parser.py').read()); run_benchmark(env)" \\
+        | odoo-bin shell -d tu_base_de_datos --no-http
+
+    >>> run_benchmark(env, sizes=("small", "typical"), services=("CCAESC", "BANDEJA"))
+    >>> write_golden(env, "/tmp/aeat_parser_golden.json")     # instantánea completa antes de un cambio
+    >>> run_benchmark(env, golden_path="/tmp/aeat_parser_golden.json")   # y comparación después
+"""
+
+import json
+import logging
+import time
+import tracemalloc
+
+_logger = logging.getLogger(__name__)
+
+# Tamaño -> número de partidas / errores / mensajes del caso
+CORPUS_SIZES = {"small": 1, "typical": 20, "huge": 5000}
+BENCHMARK_REPEAT = 5
+
+_SOAP_OPEN = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Body>'
+)
+_SOAP_CLOSE = "</soapenv:Body></soapenv:Envelope>"
+_AES_NS = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aduanas/es/aeat/adex/jdit/ws/aes/%s.xsd"
+# Ampersand sin escapar: ElementTree falla (ParseError) y lxml lo recupera
+_MALFORMED_FRAGMENT = "<Observaciones>Carga & descarga en muelle</Observaciones>"
+
+
+def _mrn(i):
+    return "25ESE%013d" % i
+
+
+def _aes_partidas(n):
+    return "".join(
+        "<Partida><numeroPartida>%d</numeroPartida><codigoMercancia>84713000%02d</codigoMercancia>"
+        "<estadoPartida>DE</estadoPartida><masaNeta>%d.500</masaNeta></Partida>" % (i + 1, i % 100, i + 10)
+        for i in range(n)
+    )
+
+
+def _case_ccaesc_ok(n):
+    xml = (
+        _SOAP_OPEN + '<CCAESCV1Sal xmlns="%s">' % (_AES_NS % "CCAESCV1Sal")
+        + "<ControlRespuesta><tipoRespuesta>OK</tipoRespuesta><codigoRespuesta>L</codigoRespuesta></ControlRespuesta>"
+        "<DatosRespuestaCorrecta><MRN>%s</MRN><estadoAES>DE</estadoAES><circuito>V</circuito>"
+        "<CSVDeclaracionElectronica>CSVDEC0001</CSVDeclaracionElectronica>"
+        "<CSVLevanteExportacion>CSVLEV0001</CSVLevanteExportacion>"
+        "<fechaLevante>2025-11-03T10:15:00</fechaLevante><Partidas>%s</Partidas></DatosRespuestaCorrecta>"
+        "</CCAESCV1Sal>" % (_mrn(1), _aes_partidas(n)) + _SOAP_CLOSE
+    )
+    expected = {
+        "success": True, "mrn": _mrn(1), "estado_aes": "DE", "circuito": "V", "csv_levante": "CSVLEV0001",
+        "fecha_levante": "2025-11-03", "released": True, "exited": False, "n_errors": 0,
+    }
+    return xml, expected, {"success": True, "mrn": _mrn(1)}
+
+
+def _case_cc515c_rejected(n):
+    errors = "".join(
+        "<FunctionalError><errorPointer>/CC515C/GoodsShipment/GoodsItem[%d]/CommodityCode</errorPointer>"
+        "<errorCode>12</errorCode><errorReason>R%03d</errorReason>"
+        "<errorDescription>Código de mercancía no válido en la partida %d</errorDescription></FunctionalError>"
+        % (i + 1, i, i + 1)
+        for i in range(n)
+    )
+    xml = (
+        _SOAP_OPEN + '<CC515CV1Sal xmlns="%s">' % (_AES_NS % "CC515CV1Sal")
+        + "<ControlRespuesta><tipoRespuesta>EF</tipoRespuesta></ControlRespuesta>%s</CC515CV1Sal>" % errors
+        + _SOAP_CLOSE
+    )
+    # _aes_to_legacy_parse añade cada FunctionalError dos veces a errors (comportamiento actual)
+    expected = {"success": False, "mrn": None, "tipo_respuesta": "EF", "n_errors": 2 * n, "n_incidencias": n}
+    return xml, expected, {"success": False}
+
+
+def _case_cc507c_exit(n):
+    xml = (
+        _SOAP_OPEN + '<CC507CV1Sal xmlns="%s">' % (_AES_NS % "CC507CV1Sal")
+        + "<ControlRespuesta><tipoRespuesta>OK</tipoRespuesta></ControlRespuesta>"
+        "<DatosRespuestaCorrecta><MRN>%s</MRN><estadoAES>SA</estadoAES><circuitoLlegada>V</circuitoLlegada>"
+        "<fechaLlegada>2025-11-04T08:00:00</fechaLlegada><fechaSalidaEfectiva>2025-11-04T09:30:00</fechaSalidaEfectiva>"
+        "<CSVLevanteSalida>CSVSAL0001</CSVLevanteSalida><Partidas>%s</Partidas></DatosRespuestaCorrecta>"
+        "</CC507CV1Sal>" % (_mrn(2), _aes_partidas(n)) + _SOAP_CLOSE
+    )
+    expected = {
+        "success": True, "mrn": _mrn(2), "estado_aes": "SA", "circuito": "V", "fecha_llegada": "2025-11-04",
+        "fecha_salida_efectiva": "2025-11-04", "csv_levante_salida": "CSVSAL0001", "exited": True,
+    }
+    return xml, expected, {"success": True, "mrn": _mrn(2)}
+
+
+def _case_cc511c_rejected(n):
+    errors = "".join('<Error codigo="E%03d">Descripción del error %d</Error>' % (i, i) for i in range(n))
+    xml = (
+        _SOAP_OPEN + '<CC511CV1Sal xmlns="urn:aeat:adex:jdit:ws:aes"><Respuesta>%s</Respuesta></CC511CV1Sal>' % errors
+        + _SOAP_CLOSE
+    )
+    expected = {"success": False, "mrn": None, "n_errors": n, "n_incidencias": n}
+    return xml, expected, {"success": False}
+
+
+def _case_imp_decl_ok(n):
+    mensajes = "".join("<Mensaje>Partida %d admitida</Mensaje>" % (i + 1) for i in range(n))
+    xml = (
+        _SOAP_OPEN + '<DeclaracionImportacionSal xmlns="urn:aeat:adu:importacion">'
+        "<Respuesta><codigoRespuesta>A</codigoRespuesta><MRN>%s</MRN><LRN>LRN-IMP-0001</LRN>"
+        "<fechaAdmision>2025-11-05T11:00:00</fechaAdmision></Respuesta><Aceptacion/>%s"
+        "</DeclaracionImportacionSal>" % (_mrn(3), mensajes) + _SOAP_CLOSE
+    )
+    expected = {
+        "success": True, "mrn": _mrn(3), "lrn": "LRN-IMP-0001", "accepted": True, "released": False,
+        "response_code": "A", "n_messages": n, "n_errors": 0,
+    }
+    return xml, expected, {"success": True, "mrn": _mrn(3)}
+
+
+def _case_imp_query_released(n):
+    partidas = "".join(
+        "<Partida><NumPartida>%d</NumPartida><CodigoNC>61091000%02d</CodigoNC><Estado>LEVANTE</Estado></Partida>"
+        % (i + 1, i % 100)
+        for i in range(n)
+    )
+    xml = (
+        _SOAP_OPEN + '<ConsultaImportacionV3Sal xmlns="urn:aeat:adu:importacion:consulta">'
+        "<ConsultaCompleta><MRN>%s</MRN><Circuito>V</Circuito>"
+        "<Levante><fechaLevante>2025-11-06T12:00:00</fechaLevante></Levante><Partidas>%s</Partidas>"
+        "</ConsultaCompleta></ConsultaImportacionV3Sal>" % (_mrn(4), partidas) + _SOAP_CLOSE
+    )
+    expected = {
+        "success": True, "mrn": _mrn(4), "circuito": "V", "released": True,
+        "fecha_levante": "2025-11-06T12:00:00", "n_errors": 0,
+    }
+    return xml, expected, {"success": True, "mrn": _mrn(4)}
+
+
+def _case_imp_query_mixed_case(n):
+    # Nombres en distinta capitalización y circuito antes que circuitoAEAT: gana el primero del documento
+    partidas = "".join(
+        "<Partida><NumPartida>%d</NumPartida><circuito>R</circuito></Partida>" % (i + 1) for i in range(n)
+    )
+    xml = (
+        _SOAP_OPEN + '<ConsultaImportacionV3Sal xmlns="urn:aeat:adu:importacion:consulta">'
+        "<ConsultaCompleta><MRN>%s</MRN><ESTADOAES>DE</ESTADOAES><Partidas>%s</Partidas>"
+        "<circuitoAEAT>V</circuitoAEAT><CsvLevante>CSVLEV0004</CsvLevante>"
+        "</ConsultaCompleta></ConsultaImportacionV3Sal>" % (_mrn(4), partidas) + _SOAP_CLOSE
+    )
+    expected = {
+        "success": True, "mrn": _mrn(4), "estado_aes": "DE", "circuito": "R", "csv_levante": "CSVLEV0004",
+        "n_errors": 0,
+    }
+    return xml, expected, {"success": True, "mrn": _mrn(4)}
+
+
+def _case_g4_accepted(n):
+    items = "".join(
+        "<GoodsItem><SequenceNumber>%d</SequenceNumber><Description>Bultos %d</Description></GoodsItem>" % (i + 1, i)
+        for i in range(n)
+    )
+    xml = (
+        _SOAP_OPEN + '<G4DecV1Sal xmlns="urn:aeat:adds:jdit:ws:g4dec"><ResponseCode>AC</ResponseCode>'
+        "<MRN>%s</MRN><LRN>LRN-G4-0001</LRN><GoodsItems>%s</GoodsItems></G4DecV1Sal>" % (_mrn(5), items)
+        + _SOAP_CLOSE
+    )
+    expected = {"success": True, "mrn": _mrn(5), "lrn": "LRN-G4-0001", "response_code": "AC", "n_errors": 0}
+    return xml, expected, {"success": True, "mrn": _mrn(5)}
+
+
+def _case_g4_rejected(n):
+    errors = "".join(
+        "<Error><ErrorCode>G4E%03d</ErrorCode><ErrorDescription>Dato obligatorio ausente %d</ErrorDescription></Error>"
+        % (i, i)
+        for i in range(n)
+    )
+    xml = (
+        _SOAP_OPEN + '<G4DecV1Sal xmlns="urn:aeat:adds:jdit:ws:g4dec"><ResponseCode>RE</ResponseCode>'
+        "<LRN>LRN-G4-0002</LRN>%s</G4DecV1Sal>" % errors + _SOAP_CLOSE
+    )
+    # Cada Error aporta su código y su descripción
+    expected = {"success": False, "mrn": None, "response_code": "RE", "n_errors": 2 * n}
+    return xml, expected, {"success": False}
+
+
+def _ie615_heahea(mrn):
+    return (
+        "<HEAHEA><DocNumHEA5>%s</DocNumHEA5><DecTypeHEA>EXS</DecTypeHEA>"
+        "<PreDecCodeHEA>0</PreDecCodeHEA><CusChanHEA>V</CusChanHEA><DecCsvHEA>EXSCSV01</DecCsvHEA>"
+        "<RelCsvHEA>EXSREL01</RelCsvHEA></HEAHEA>" % mrn
+    )
+
+
+def _case_ie628_accepted(n):
+    items = "".join(
+        "<GOOITEGDS><IteNumGDS7>%d</IteNumGDS7><GooDesGDS23>Mercancía %d</GooDesGDS23></GOOITEGDS>" % (i + 1, i)
+        for i in range(n)
+    )
+    xml = _SOAP_OPEN + "<CC628A>%s%s</CC628A>" % (_ie615_heahea(_mrn(6)), items) + _SOAP_CLOSE
+    expected = {
+        "success": True, "mrn": _mrn(6), "response_type": "CC628A", "exs_circuito": "V",
+        "exs_dec_csv": "EXSCSV01", "exs_rel_csv": "EXSREL01", "n_errors": 0,
+    }
+    # IE615 no tiene camino de recuperación: XML mal formado = error de parseo
+    return xml, expected, {"success": False, "response_type": None, "n_errors": 1}
+
+
+def _case_ie616_rejected(n):
+    errors = "".join(
+        "<FUNERRER1><ErrTypER11>12</ErrTypER11><ErrPoiER12>GOOITEGDS(%d).ComCodTarCodGDS</ErrPoiER12>"
+        "<OriAttValER14>99%06d</OriAttValER14></FUNERRER1>" % (i + 1, i)
+        for i in range(n)
+    )
+    xml = _SOAP_OPEN + "<CC616A>%s%s</CC616A>" % (_ie615_heahea(_mrn(7)), errors) + _SOAP_CLOSE
+    expected = {"success": False, "response_type": "CC616A", "n_errors": n}
+    return xml, expected, {"success": False, "response_type": None, "n_errors": 1}
+
+
+def _case_bandeja(n):
+    parts = [
+        _SOAP_OPEN + '<DetalleV5Sal xmlns="urn:aeat:adht:band:det"><NumUltimoMensaje>%d</NumUltimoMensaje><Mensajes>' % n
+    ]
+    for i in range(n):
+        if i % 2:
+            wrapper, msg_type, body = "ComunicaResulSalida", "CSALID", (
+                "<estadoAES>SA</estadoAES><fechaSalidaEfectiva>2025-11-%02dT12:00:00</fechaSalidaEfectiva>"
+                "<CSVLevanteSalida>CSVSAL%06d</CSVLevanteSalida>" % ((i % 28) + 1, i)
+            )
+        else:
+            wrapper, msg_type, body = "ComunicaLevanteExpor", "CLEVEX", (
+                "<estadoAES>DE</estadoAES><fechaLevante>2025-11-%02dT10:00:00</fechaLevante>"
+                "<CSVLevanteExportacion>CSVLEV%06d</CSVLevanteExportacion>" % ((i % 28) + 1, i)
+            )
+        parts.append(
+            "<Mensaje><NumMensaje>%d</NumMensaje><%s><MESSAGE><messageSender>AEAT</messageSender>"
+            "<messageType>%s</messageType><DatosComunicacion><MRN>%s</MRN>%s</DatosComunicacion>"
+            "</MESSAGE></%s></Mensaje>" % (i + 1, wrapper, msg_type, _mrn(100 + i), body, wrapper)
+        )
+    parts.append("</Mensajes></DetalleV5Sal>" + _SOAP_CLOSE)
+    expected = {"last_message_num": n, "n_messages": n, "first_mrn": _mrn(100), "last_mrn": _mrn(99 + n), "n_errors": 0}
+    return "".join(parts), expected, {"n_messages": n, "first_mrn": _mrn(100), "last_mrn": _mrn(99 + n)}
+
+
+# (servicio, caso, método del parser, constructor)
+CORPUS = (
+    ("CCAESC", "ok_levante", "aeat", _case_ccaesc_ok),
+    ("CC515C", "rechazo_ef", "aeat", _case_cc515c_rejected),
+    ("CC507C", "salida", "aeat", _case_cc507c_exit),
+    ("CC511C", "rechazo", "aeat", _case_cc511c_rejected),
+    ("IMP_DECL", "aceptada", "aeat", _case_imp_decl_ok),
+    ("IMP_QUERY_V3", "levante", "aeat", _case_imp_query_released),
+    ("IMP_QUERY_V3", "mayusculas", "aeat", _case_imp_query_mixed_case),
+    ("G4_DEC", "aceptada", "aeat", _case_g4_accepted),
+    ("G4_DEC", "rechazo", "aeat", _case_g4_rejected),
+    ("IE615_EXS", "ie628", "ie615", _case_ie628_accepted),
+    ("IE615_EXS", "ie616", "ie615", _case_ie616_rejected),
+    ("BANDEJA", "mensajes", "bandeja", _case_bandeja),
+)
+
+
+def malform(xml_text):
+    """Inserta un fragmento con '&' sin escapar al inicio del Body (XML no bien formado)."""
+    marker = "<soapenv:Body>"
+    return xml_text.replace(marker, marker + _MALFORMED_FRAGMENT, 1)
+
+
+def build_corpus(sizes=tuple(CORPUS_SIZES), services=None, malformed=True):
+    """Devuelve la lista de casos: dicts con name, service, method, size, xml y expected."""
+    cases = []
+    for service, label, method, builder in CORPUS:
+        if services and service not in services:
+            continue
+        for size in sizes:
+            xml_text, expected, expected_malformed = builder(CORPUS_SIZES[size])
+            base = {"service": service, "method": method, "size": size}
+            cases.append(dict(base, name="%s/%s/%s" % (service, label, size), xml=xml_text, expected=expected))
+            if malformed:
+                cases.append(dict(
+                    base, name="%s/%s/%s/malformado" % (service, label, size),
+                    xml=malform(xml_text), expected=expected_malformed,
+                ))
+    return cases
+
+
+def _parse(parser, case):
+    if case["method"] == "ie615":
+        return parser.parse_ie615_response(case["xml"])
+    if case["method"] == "bandeja":
+        return parser.parse_bandeja_response(case["xml"])
+    return parser.parse_aeat_response(case["xml"], case["service"])
+
+
+def _project(result, keys):
+    """Valores comparables de la salida: n_<clave> = longitud de la lista, first/last_mrn de la bandeja."""
+    out = {}
+    for key in keys:
+        if key.startswith("n_"):
+            out[key] = len(result.get(key[2:]) or [])
+        elif key in ("first_mrn", "last_mrn"):
+            messages = result.get("messages") or []
+            index = 0 if key == "first_mrn" else -1
+            out[key] = messages[index].get("mrn") if messages else None
+        else:
+            out[key] = result.get(key)
+    return out
+
+
+def _snapshot(result):
+    """Salida completa serializable (sin raw_xml) para el modo instantánea."""
+    return json.loads(json.dumps(
+        {k: v for k, v in result.items() if k != "raw_xml"}, default=str, sort_keys=True,
+    ))
+
+
+def _diff(expected, actual):
+    return sorted(k for k in set(expected) | set(actual) if expected.get(k) != actual.get(k))
+
+
+def _measure(parser, case, repeat):
+    best = None
+    for _i in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = _parse(parser, case)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    _parse(parser, case)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def write_golden(env, path, sizes=tuple(CORPUS_SIZES), services=None):
+    """Guarda la salida completa actual de cada caso como instantánea golden (JSON)."""
+    parser = env["aduanas.xml.parser"]
+    golden = {case["name"]: _snapshot(_parse(parser, case)) for case in build_corpus(sizes, services)}
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(golden, fh, indent=1, sort_keys=True, ensure_ascii=False)
+    print("Golden de %s casos guardado en %s" % (len(golden), path))
+    return golden
+
+
+def run_benchmark(env, sizes=tuple(CORPUS_SIZES), services=None, malformed=True, repeat=BENCHMARK_REPEAT,
+                  golden_path=None):
+    """
+    Ejecuta el corpus y devuelve una lista de dicts por caso (tiempo, memoria pico, golden).
+    Con golden_path compara además la salida completa con la instantánea de write_golden.
+    """
+    parser = env["aduanas.xml.parser"]
+    snapshot = None
+    if golden_path:
+        with open(golden_path, encoding="utf-8") as fh:
+            snapshot = json.load(fh)
+    rows = []
+    for case in build_corpus(sizes, services, malformed):
+        # Los casos huge se repiten menos: el tiempo ya es estable
+        result, elapsed, peak = _measure(parser, case, 1 if case["size"] == "huge" else repeat)
+        mismatched = _diff(case["expected"], _project(result, case["expected"]))
+        if snapshot is not None:
+            if case["name"] not in snapshot:
+                mismatched.append("<sin golden>")
+            else:
+                mismatched += ["snapshot:%s" % k for k in _diff(snapshot[case["name"]], _snapshot(result))]
+        rows.append({
+            "case": case["name"],
+            "bytes": len(case["xml"]),
+            "parse_ms": elapsed * 1000.0,
+            "peak_kb": peak / 1024.0,
+            "golden_ok": not mismatched,
+            "mismatched": mismatched,
+        })
+    print("%-46s %10s %10s %10s  %s" % ("caso", "bytes", "ms", "pico KB", "golden"))
+    for r in rows:
+        print("%-46s %10d %10.2f %10.1f  %s" % (
+            r["case"][:46], r["bytes"], r["parse_ms"], r["peak_kb"],
+            "OK" if r["golden_ok"] else "FALLO: %s" % ", ".join(r["mismatched"])))
+    failed = [r for r in rows if not r["golden_ok"]]
+    print("%s casos, %s con diferencias respecto al golden" % (len(rows), len(failed)))
+    return rows
+
+
+# Si se ejecuta directamente desde la consola
+if __name__ == "__main__":
+    if "env" in globals():
+        run_benchmark(env)  # noqa: F821
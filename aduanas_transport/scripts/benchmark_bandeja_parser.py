@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del parser de bandeja AEAT: parse_bandeja_response (streaming iterparse)
+frente a la implementación anterior (árbol completo + getparent x15 + regex por ventana).
+
+Genera respuestas DetalleV5 sintéticas de 50, 500 y 5.000 mensajes y mide tiempo,
+memoria pico (tracemalloc) y número de mensajes extraídos. No hace llamadas a la AEAT.
+
+Uso:
+    odoo-bin shell -d tu_base_de_datos
+    >>> exec(open('addons/aduanas_transport/scripts/benchmark_bandeja_parser.py').read())
+    >>> run_benchmark(env)
+"""
+
+import logging
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from odoo.addons.aduanas_transport.models.xml_parser import _parse_with_lxml_recover
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = (50, 500, 5000)
+
+_MESSAGE_TEMPLATES = (
+    ("CLEVEX", "ComunicaLevanteExpor", "<estadoAES>DE</estadoAES><fechaLevante>2025-11-%02dT10:00:00</fechaLevante>"
+               "<CSVLevanteExportacion>CSVLEV%06d</CSVLevanteExportacion>"),
+    ("CSALID", "ComunicaResulSalida", "<estadoAES>SA</estadoAES><fechaSalidaEfectiva>2025-11-%02dT12:00:00</fechaSalidaEfectiva>"
+               "<CSVLevanteSalida>CSVSAL%06d</CSVLevanteSalida>"),
+)
+
+
+def build_bandeja_xml(count):
+    """Respuesta de bandeja con `count` mensajes alternando levante / salida, MRN distinto por mensaje."""
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Body>'
+        '<DetalleV5Sal xmlns="urn:aeat:adht:band:det"><NumUltimoMensaje>%d</NumUltimoMensaje><Mensajes>' % count
+    ]
+    for i in range(count):
+        msg_type, wrapper, body = _MESSAGE_TEMPLATES[i % 2]
+        parts.append(
+            "<Mensaje><NumMensaje>%d</NumMensaje><%s><MESSAGE><messageSender>AEAT</messageSender>"
+            "<messageType>%s</messageType><DatosComunicacion><MRN>25ES00000000%06d</MRN>%s</DatosComunicacion>"
+            "</MESSAGE></%s></Mensaje>"
+            % (i + 1, wrapper, msg_type, i, body % ((i % 28) + 1, i), wrapper)
+        )
+    parts.append("</Mensajes></DetalleV5Sal></soapenv:Body></soapenv:Envelope>")
+    return "".join(parts)
+
+
+def _legacy_xml_text(root, tag):
+    for el in root.iter():
+        local = el.tag.split("}")[-1] if "}" in el.tag else el.tag
+        if local == tag and el.text:
+            return (el.text or "").strip()
+    return None
+
+
+def legacy_parse_bandeja_response(xml_text):
+    """
+    Implementación anterior de parse_bandeja_response (getparent x15 + barridos regex
+    por ventana), copiada como referencia para la comparación.
+    """
+    result = {"messages": [], "last_message_num": 0, "incidencias": [], "errors": []}
+    if not xml_text:
+        return result
+    try:
+        root, ok = _parse_with_lxml_recover(xml_text)
+        if not ok or root is None:
+            root = ET.fromstring(xml_text)
+        num = _legacy_xml_text(root, "NumUltimoMensaje")
+        if num:
+            try:
+                result["last_message_num"] = int(num)
+            except ValueError:
+                pass
+        # Cada bloque con messageType + DatosComunicacion
+        for el in root.iter():
+            local = el.tag.split("}")[-1] if "}" in el.tag else el.tag
+            if local != "messageType" or not el.text:
+                continue
+            msg_type = (el.text or "").strip().upper()
+            if not hasattr(el, "getparent"):
+                continue
+            block = el
+            for _ in range(15):
+                parent = block.getparent()
+                if parent is None:
+                    break
+                block = parent
+            msg = {"message_type": msg_type}
+            for sub in block.iter() if hasattr(block, "iter") else []:
+                loc = sub.tag.split("}")[-1] if "}" in sub.tag else sub.tag
+                if loc == "MRN" and sub.text:
+                    msg["mrn"] = sub.text.strip()
+                elif loc == "estadoAES" and sub.text:
+                    msg["estado_aes"] = sub.text.strip()
+                elif loc == "fechaLevante" and sub.text:
+                    msg["fecha_levante"] = sub.text.strip()[:10]
+                elif loc == "fechaSalidaEfectiva" and sub.text:
+                    msg["fecha_salida_efectiva"] = sub.text.strip()[:10]
+                elif loc == "fechaLevanteSalida" and sub.text:
+                    msg["fecha_levante_salida"] = sub.text.strip()[:10]
+                elif loc == "CSVLevanteExportacion" and sub.text:
+                    msg["csv_levante_export"] = sub.text.strip()
+                elif loc == "CSVLevanteSalida" and sub.text:
+                    msg["csv_levante_salida"] = sub.text.strip()
+            if msg_type or msg.get("mrn"):
+                result["messages"].append(msg)
+        # Fallback: regex sobre XML completo si no hay getparent (ElementTree estándar)
+        if not result["messages"]:
+            import re
+            for m in re.finditer(
+                r"<messageType>([^<]+)</messageType>.*?<MRN>([^<]+)</MRN>",
+                xml_text,
+                re.DOTALL | re.IGNORECASE,
+            ):
+                result["messages"].append({
+                    "message_type": m.group(1).strip().upper(),
+                    "mrn": m.group(2).strip(),
+                })
+            for m in re.finditer(
+                r"<messageType>(CSALID|CLEVEX|CLEVSA|CDISSA)[^<]*</messageType>",
+                xml_text,
+                re.IGNORECASE,
+            ):
+                msg = {"message_type": m.group(1).upper()}
+                mrn_m = re.search(
+                    r"<MRN>([^<]+)</MRN>",
+                    xml_text[m.end() : m.end() + 800],
+                    re.IGNORECASE,
+                )
+                if mrn_m:
+                    msg["mrn"] = mrn_m.group(1).strip()
+                fe_m = re.search(
+                    r"<fechaSalidaEfectiva>([^<]+)</fechaSalidaEfectiva>",
+                    xml_text[m.end() : m.end() + 800],
+                    re.IGNORECASE,
+                )
+                if fe_m:
+                    msg["fecha_salida_efectiva"] = fe_m.group(1).strip()[:10]
+                fls_m = re.search(
+                    r"<fechaLevanteSalida>([^<]+)</fechaLevanteSalida>",
+                    xml_text[m.end() : m.end() + 800],
+                    re.IGNORECASE,
+                )
+                if fls_m:
+                    msg["fecha_levante_salida"] = fls_m.group(1).strip()[:10]
+                estado_m = re.search(
+                    r"<estadoAES>([^<]+)</estadoAES>",
+                    xml_text[m.end() : m.end() + 800],
+                    re.IGNORECASE,
+                )
+                if estado_m:
+                    msg["estado_aes"] = estado_m.group(1).strip()
+                csv_m = re.search(
+                    r"<CSVLevanteSalida>([^<]+)</CSVLevanteSalida>",
+                    xml_text[m.end() : m.end() + 800],
+                    re.IGNORECASE,
+                )
+                if csv_m:
+                    msg["csv_levante_salida"] = csv_m.group(1).strip()
+                result["messages"].append(msg)
+    except Exception as e:
+        _logger.warning("parse_bandeja_response: %s", e)
+        result["errors"].append(str(e))
+    return result
+
+
+def _measure(func, xml_text):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(xml_text)
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_benchmark(env, sizes=BENCHMARK_SIZES):
+    """Compara ambos parsers y devuelve una lista de dicts con los resultados."""
+    parser = env["aduanas.xml.parser"]
+    rows = []
+    for size in sizes:
+        xml_text = build_bandeja_xml(size)
+        new, new_time, new_peak = _measure(parser.parse_bandeja_response, xml_text)
+        old, old_time, old_peak = _measure(legacy_parse_bandeja_response, xml_text)
+        new_mrns = [m.get("mrn") for m in new["messages"]]
+        expected = ["25ES00000000%06d" % i for i in range(size)]
+        rows.append({
+            "messages": size,
+            "bytes": len(xml_text),
+            "stream_s": new_time,
+            "stream_peak_kb": new_peak / 1024.0,
+            "stream_found": len(new["messages"]),
+            "stream_mrn_ok": new_mrns == expected,
+            "legacy_s": old_time,
+            "legacy_peak_kb": old_peak / 1024.0,
+            "legacy_found": len(old["messages"]),
+        })
+    header = "%8s %10s %10s %12s %8s %6s %10s %12s %8s" % (
+        "msgs", "bytes", "stream_s", "stream_KB", "found", "mrn_ok", "legacy_s", "legacy_KB", "found")
+    print(header)
+    for r in rows:
+        print("%8d %10d %10.4f %12.1f %8d %6s %10.4f %12.1f %8d" % (
+            r["messages"], r["bytes"], r["stream_s"], r["stream_peak_kb"], r["stream_found"],
+            r["stream_mrn_ok"], r["legacy_s"], r["legacy_peak_kb"], r["legacy_found"]))
+    return rows
+
+
+# Si se ejecuta directamente desde la consola
+if __name__ == "__main__":
+    if "env" in globals():
+        run_benchmark(env)  # noqa: F821
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la extracción local de líneas de factura (ruta sin OpenAI): velocidad y
+recall (líneas esperadas encontradas con la misma cantidad e importe).
+
+- Transcripciones con etiquetas (**Artículo**: ... **H.S.**: ...): extract_labelled_lines
+  (un recorrido) frente a la implementación anterior (finditer + 6 regex por ventana de
+  2.000 caracteres tras cada artículo).
+- Facturas multipágina sintéticas con tabla (palabras con coordenadas como las de
+  pdfplumber, descripciones en dos filas, H.S. en fila aparte, "Suma y sigue", pie de
+  página y fila de totales): TableLineExtractor frente a las regex sobre el texto plano.
+- Opcionalmente, un directorio con PDFs reales: para cada factura.pdf con un factura.json
+  al lado ({"lineas": [{"cantidad": ..., "total": ...}, ...]}) se mide el extractor por
+  tablas con pdfplumber.
+
+Uso:
+    odoo-bin shell -d tu_base_de_datos
+    >>> exec(open('addons/aduanas_transport/scripts/benchmark_invoice_lines.py').read())
+    >>> run_benchmark(env)
+    >>> run_benchmark(env, corpus_dir='/ruta/facturas')
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+from odoo.addons.aduanas_transport.services.ocr_tables import (
+    TableLineExtractor,
+    extract_labelled_lines,
+    page_rules,
+)
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = (100, 1000, 5000)
+ROWS_PER_PAGE = 40
+FONT_SIZE = 8.0
+_COLUMNS = (("Ref.", 40), ("Descripción", 90), ("Cantidad", 330), ("Precio unitario", 390), ("Importe", 480), ("H.S.", 540))
+
+
+def _es_amount(value):
+    integer, decimals = ("%.2f" % value).split(".")
+    groups = []
+    while len(integer) > 3:
+        groups.insert(0, integer[-3:])
+        integer = integer[:-3]
+    groups.insert(0, integer)
+    return "%s,%s" % (".".join(groups), decimals)
+
+
+def _expected_line(i):
+    cantidad = (i % 37) + 1
+    precio = round(1.5 + (i % 113) * 0.73, 2)
+    return {
+        "articulo": "%06d" % (100000 + i),
+        "descripcion": "Producto de prueba %d modelo %s" % (i, "ABCDEFG"[i % 7]),
+        "cantidad": float(cantidad),
+        "precio_unitario": precio,
+        "total": round(cantidad * precio, 2),
+        "partida": "%08d" % (84713000 + i % 97),
+    }
+
+
+def build_labelled_transcript(count):
+    """Transcripción tipo GPT Vision con etiquetas por artículo y ruido entre bloques."""
+    parts = ["**FACTURA** Nº F-2025-0001\nFecha: 01.10.2025\n"]
+    for i in range(count):
+        line = _expected_line(i)
+        parts.append(
+            "**Artículo**: %s\n**Descripción**: %s\n**Cantidad Expedición**: %d UN\n"
+            "**Precio**: %s\n**Importe (EUR)**: %s\n**H.S.**: %s\nObservaciones: embalaje estándar, "
+            "palet europeo, mercancía no peligrosa.\n\n"
+            % (line["articulo"], line["descripcion"], line["cantidad"], _es_amount(line["precio_unitario"]),
+               _es_amount(line["total"]), line["partida"])
+        )
+    return "".join(parts)
+
+
+def legacy_extract_labelled_lines(text):
+    """Implementación anterior (finditer + regex por ventana), copiada como referencia."""
+    lineas = []
+    articulo_pattern = r'(?:\*\*)?Artículo(?:\*\*)?\s*:?\s*(\d+)'
+    descripcion_pattern = r'(?:\*\*)?Descripción(?:\*\*)?\s*:?\s*([^\n]+?)(?=\n(?:\*\*)?[A-Z]|\n\n|$)'
+    cantidad_pattern = r'(?:\*\*)?Cantidad\s+Expedición(?:\*\*)?\s*:?\s*(\d+[.,]?\d*)\s*([A-Z/]+)?'
+    importe_pattern = r'(?:\*\*)?Importe\s+\(EUR\)(?:\*\*)?\s*:?\s*([\d.,]+)'
+    importe_neto_pattern = r'(?:\*\*)?Importe\s+Neto\s+2(?:\*\*)?\s*:?\s*([\d.,]+)'
+    hs_pattern = r'(?:\*\*)?H\.S\.(?:\*\*)?\s*:?\s*(\d+)'
+    for articulo_match in list(re.finditer(articulo_pattern, text, re.IGNORECASE)):
+        window = text[articulo_match.start():articulo_match.start() + 2000]
+        linea = {"articulo": articulo_match.group(1).strip(), "descripcion": None, "cantidad": None,
+                 "total": None, "partida": None}
+        desc_match = re.search(descripcion_pattern, window, re.IGNORECASE)
+        if desc_match:
+            linea["descripcion"] = desc_match.group(1).strip()
+        cant_match = re.search(cantidad_pattern, window, re.IGNORECASE)
+        if cant_match:
+            linea["cantidad"] = float(cant_match.group(1).replace(',', '.'))
+        importe_match = re.search(importe_pattern, window, re.IGNORECASE) or \
+            re.search(importe_neto_pattern, window, re.IGNORECASE)
+        if importe_match:
+            linea["total"] = float(importe_match.group(1).replace('.', '').replace(',', '.'))
+        hs_match = re.search(hs_pattern, window, re.IGNORECASE)
+        if hs_match:
+            linea["partida"] = hs_match.group(1).strip()
+        if linea.get("descripcion") and linea.get("cantidad"):
+            lineas.append(linea)
+    return lineas
+
+
+def _word(text, x0, top):
+    return {"text": text, "x0": float(x0), "x1": x0 + len(text) * FONT_SIZE * 0.5, "top": float(top),
+            "bottom": top + FONT_SIZE}
+
+
+def _row_words(cells, top):
+    words = []
+    for text, x0 in cells:
+        x = x0
+        for token in text.split():
+            words.append(_word(token, x, top))
+            x = words[-1]["x1"] + FONT_SIZE * 0.3
+    return words
+
+
+def build_table_pages(count, rows_per_page=ROWS_PER_PAGE):
+    """
+    Páginas de palabras con coordenadas (como extract_words de pdfplumber) y texto plano
+    equivalente. Cada 3ª línea tiene la descripción en dos filas y cada 5ª el H.S. en una
+    fila aparte; cada página acaba en "Suma y sigue" y pie, la última en la fila de totales.
+    """
+    pages, texts = [], []
+    i = 0
+    page_count = max((count + rows_per_page - 1) // rows_per_page, 1)
+    for page_number in range(1, page_count + 1):
+        rows = [[("FACTURA F-2025-0001", 40), ("Página %d de %d" % (page_number, page_count), 480)],
+                list(_COLUMNS)]
+        for _n in range(rows_per_page):
+            if i >= count:
+                break
+            line = _expected_line(i)
+            descripcion = line["descripcion"]
+            wrapped = i % 3 == 0
+            rows.append([
+                (line["articulo"], 40),
+                (descripcion.rsplit(" modelo", 1)[0] if wrapped else descripcion, 90),
+                ("%d" % line["cantidad"], 340),
+                (_es_amount(line["precio_unitario"]), 400),
+                (_es_amount(line["total"]), 480),
+            ] + ([] if i % 5 == 0 else [(line["partida"], 540)]))
+            if wrapped:
+                rows.append([("modelo " + descripcion.rsplit(" modelo ", 1)[1], 90)])
+            if i % 5 == 0:
+                rows.append([("H.S. " + line["partida"], 90)])
+            i += 1
+        if page_number < page_count:
+            rows.append([("Suma y sigue", 90), (_es_amount(12345.67), 480)])
+        else:
+            rows.append([("TOTAL FACTURA", 90), (_es_amount(99999.99), 480)])
+        rows.append([("Pág. %d" % page_number, 280)])
+        words = []
+        for index, cells in enumerate(rows):
+            words.extend(_row_words(cells, 40 + index * (FONT_SIZE + 4)))
+        pages.append(words)
+        texts.append("\n".join("  ".join(text for text, _x in cells) for cells in rows))
+    return pages, "\n".join(texts)
+
+
+def _recall(found, count):
+    expected = {(_expected_line(i)["cantidad"], _expected_line(i)["total"]) for i in range(count)}
+    got = {(line.get("cantidad"), round(line["total"], 2) if line.get("total") is not None else None)
+           for line in found}
+    return len(expected & got) / float(len(expected) or 1)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _run_tables(pages):
+    extractor = TableLineExtractor()
+    lines = []
+    for words in pages:
+        lines.extend(extractor.feed_page(words))
+    lines.extend(extractor.finish())
+    return lines
+
+
+def run_corpus(env, corpus_dir):
+    """Extractor por tablas sobre PDFs reales con su .json de líneas esperadas."""
+    import pdfplumber
+
+    rows = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if not name.lower().endswith(".pdf"):
+            continue
+        path = os.path.join(corpus_dir, name)
+        expected_path = os.path.splitext(path)[0] + ".json"
+        expected = []
+        if os.path.exists(expected_path):
+            with open(expected_path, encoding="utf-8") as f:
+                expected = json.load(f).get("lineas") or []
+        start = time.perf_counter()
+        extractor = TableLineExtractor()
+        lines = []
+        with pdfplumber.open(path) as pdf:
+            pages = len(pdf.pages)
+            for page in pdf.pages:
+                lines.extend(extractor.feed_page(page.extract_words(), page_rules(page)))
+        lines.extend(extractor.finish())
+        elapsed = time.perf_counter() - start
+        wanted = {(float(l.get("cantidad") or 0), round(float(l.get("total") or 0), 2)) for l in expected}
+        got = {(l.get("cantidad"), round(l["total"], 2) if l.get("total") is not None else None) for l in lines}
+        rows.append({"pdf": name, "pages": pages, "expected": len(expected), "found": len(lines), "s": elapsed,
+                     "recall": len(wanted & got) / float(len(wanted)) if wanted else None})
+    print("%-40s %6s %8s %8s %10s %7s" % ("pdf", "pages", "expected", "found", "s", "recall"))
+    for r in rows:
+        print("%-40s %6d %8d %8d %10.4f %7s" % (
+            r["pdf"][:40], r["pages"], r["expected"], r["found"], r["s"],
+            "%.3f" % r["recall"] if r["recall"] is not None else "-"))
+    return rows
+
+
+def run_benchmark(env, sizes=BENCHMARK_SIZES, corpus_dir=None):
+    """Compara ambos extractores sobre el corpus sintético y devuelve una lista de dicts."""
+    ocr_service = env["aduanas.invoice.ocr.service"]
+    rows = []
+    for size in sizes:
+        transcript = build_labelled_transcript(size)
+        new, new_time = _timed(extract_labelled_lines, transcript)
+        old, old_time = _timed(legacy_extract_labelled_lines, transcript)
+        pages, plain_text = build_table_pages(size)
+        table, table_time = _timed(_run_tables, pages)
+        text, text_time = _timed(ocr_service._extract_invoice_lines, plain_text)
+        rows.append({
+            "lines": size,
+            "pages": len(pages),
+            "labelled_s": new_time, "labelled_recall": _recall(new, size),
+            "legacy_s": old_time, "legacy_recall": _recall(old, size),
+            "table_s": table_time, "table_recall": _recall(table, size), "table_found": len(table),
+            "text_s": text_time, "text_recall": _recall(text, size), "text_found": len(text),
+        })
+    print("%6s %5s | %10s %6s %10s %6s | %10s %6s %6s %10s %6s %6s" % (
+        "lines", "pages", "label_s", "recall", "legacy_s", "recall",
+        "table_s", "recall", "found", "text_s", "recall", "found"))
+    for r in rows:
+        print("%6d %5d | %10.4f %6.3f %10.4f %6.3f | %10.4f %6.3f %6d %10.4f %6.3f %6d" % (
+            r["lines"], r["pages"], r["labelled_s"], r["labelled_recall"], r["legacy_s"], r["legacy_recall"],
+            r["table_s"], r["table_recall"], r["table_found"], r["text_s"], r["text_recall"], r["text_found"]))
+    if corpus_dir:
+        run_corpus(env, corpus_dir)
+    return rows
+
+
+# Si se ejecuta directamente desde la consola
+if __name__ == "__main__":
+    if "env" in globals():
+        run_benchmark(env)  # noqa: F821
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de los generadores XML escritos a mano (fragmentos precompilados).
+
+Crea expedientes temporales de importación y exportación con 1, 100 y 999 partidas y mide
+el tiempo de construcción (mejor de N repeticiones) de:
+  - CC415A (sobre SOAP completo, importación H1),
+  - CC515C (cuerpo nativo, exportación),
+  - IE615 (cuerpo EXS, exportación),
+  - G4Dec (cuerpo MES_Message + DEC_Declaration, depósito temporal de importación).
+La primera repetición se mide aparte ("frío"): en ella se rellenan los bloques de
+interlocutor memorizados; el resto reutiliza la caché por partner y valores.
+Comprueba que cada XML está bien formado y que contiene una partida por línea.
+No llama a la AEAT y hace rollback al terminar.
+
+Uso:
+    odoo-bin shell -d tu_base_de_datos
+    >>> exec(open('addons/aduanas_transport/scripts/benchmark_xml_builders.py').read())
+    >>> run_benchmark(env)
+    >>> run_benchmark(env, sizes=(1, 100), repeat=10)
+"""
+
+import logging
+import re
+import time
+import xml.etree.ElementTree as ET
+
+from odoo.addons.aduanas_transport.services.xml_fragments import clear_partner_fragments
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = (1, 100, 999)
+BENCHMARK_REPEAT = 5
+
+# Generador -> etiqueta de cada partida en el XML resultante
+_ITEM_TAGS = {
+    "CC415A": "GoodsShipmentItem",
+    "CC515C": "cc5:GoodsItem",
+    "IE615": "GOOITEGDS",
+    "G4": "MI_MasterConsignment_Item",
+}
+
+
+def _make_partners(env):
+    Partner = env["res.partner"]
+    country = env["res.country"].search
+    remitente = Partner.create({
+        "name": "Proveedor Benchmark SL", "street": "Avinguda Meritxell 1", "city": "Andorra la Vella",
+        "zip": "AD500", "vat": "L123456Z", "email": "proveedor@example.com",
+        "country_id": country([("code", "=", "AD")], limit=1).id,
+    })
+    consignatario = Partner.create({
+        "name": "Cliente Benchmark SA", "street": "Calle Mayor 10", "city": "Madrid", "zip": "28001",
+        "vat": "ESB12345678", "email": "cliente@example.com",
+        "country_id": country([("code", "=", "ES")], limit=1).id,
+    })
+    return remitente, consignatario
+
+
+def _line_vals(n):
+    return [(0, 0, {
+        "item_number": i + 1,
+        "partida": "8471300000",
+        "taric_completo": "8471300000",
+        "descripcion": "Ordenador portátil modelo %04d" % i,
+        "unidades": 2.0,
+        "bultos": 1,
+        "peso_bruto": 3.5,
+        "peso_neto": 3.0,
+        "valor_linea": 1200.0 + i,
+        "pais_origen": "CN",
+    }) for i in range(n)]
+
+
+def _make_expedientes(env, n, remitente, consignatario):
+    Expediente = env["aduana.expediente"]
+    common = {
+        "remitente": remitente.id,
+        "consignatario": consignatario.id,
+        "matricula": "1234ABC",
+        "transportista": "Transportes Benchmark",
+        "numero_factura": "FB-%04d" % n,
+        "valor_factura": sum(1200.0 + i for i in range(n)),
+        "line_ids": _line_vals(n),
+    }
+    export = Expediente.create(dict(common, direction="export", pais_origen="ES", pais_destino="AD"))
+    imp = Expediente.create(dict(
+        common, direction="import", pais_origen="AD", pais_destino="ES",
+        requiere_ddt=True, mrn_ddt="26ES00000000000001", ddt_type="g4",
+    ))
+    g4 = env["aeat.import.g4.temporary.storage"].create({"expediente_id": imp.id})
+    return export, imp, g4
+
+
+def _builders(env, export, imp, g4):
+    g4_builder = env["aduanas.g4.xml.builder"]
+    return {
+        "CC415A": imp._build_cc415a_soap_envelope,
+        "CC515C": export._build_cc515c_native_body,
+        "IE615": export._build_ie615_body,
+        "G4": lambda: g4_builder.build_g4_body(g4),
+    }
+
+
+def _count_items(xml_text, tag):
+    return len(re.findall(r"<%s>" % re.escape(tag), xml_text))
+
+
+def _check(xml_text):
+    try:
+        ET.fromstring(xml_text.encode("utf-8"))
+        return True
+    except ET.ParseError:
+        # Los cuerpos sin sobre (CC515C, IE615, G4) tienen varios elementos raíz
+        try:
+            ET.fromstring(("<root>%s</root>" % re.sub(r"^<\?xml[^>]*\?>", "", xml_text.strip())).encode("utf-8"))
+            return True
+        except ET.ParseError:
+            return False
+
+
+def _time_builder(build, repeat):
+    clear_partner_fragments()
+    t0 = time.perf_counter()
+    xml_text = build()
+    cold = time.perf_counter() - t0
+    best = cold
+    for _i in range(max(repeat - 1, 0)):
+        t0 = time.perf_counter()
+        build()
+        best = min(best, time.perf_counter() - t0)
+    return xml_text, cold, best
+
+
+def run_benchmark(env, sizes=BENCHMARK_SIZES, repeat=BENCHMARK_REPEAT, rollback=True):
+    """Mide cada generador para cada tamaño y devuelve/imprime la tabla de resultados."""
+    rows = []
+    try:
+        company = env.company
+        if not (company.email or env.user.email):
+            company.email = "aduanas@example.com"  # CC415A exige Declarant.ContactPerson
+        remitente, consignatario = _make_partners(env)
+        for n in sizes:
+            export, imp, g4 = _make_expedientes(env, n, remitente, consignatario)
+            for kind, build in _builders(env, export, imp, g4).items():
+                row = {"builder": kind, "items": n, "cold_ms": 0.0, "best_ms": 0.0, "per_item_us": 0.0,
+                       "size_kb": 0.0, "ok": False, "error": ""}
+                try:
+                    xml_text, cold, best = _time_builder(build, repeat)
+                except Exception as e:  # un generador que falla no interrumpe el resto
+                    row["error"] = str(e).splitlines()[0][:80] if str(e) else type(e).__name__
+                    rows.append(row)
+                    continue
+                found = _count_items(xml_text, _ITEM_TAGS[kind])
+                row.update(
+                    cold_ms=cold * 1000.0,
+                    best_ms=best * 1000.0,
+                    per_item_us=best * 1e6 / n,
+                    size_kb=len(xml_text.encode("utf-8")) / 1024.0,
+                    ok=_check(xml_text) and found == n,
+                    error="" if found == n else "partidas %s != %s" % (found, n),
+                )
+                rows.append(row)
+    finally:
+        if rollback:
+            env.cr.rollback()
+            clear_partner_fragments()
+    print("%-8s %6s %10s %10s %12s %9s %4s  %s" % (
+        "xml", "items", "frío ms", "mejor ms", "µs/partida", "KB", "ok", "error"))
+    for r in rows:
+        print("%-8s %6d %10.2f %10.2f %12.1f %9.1f %4s  %s" % (
+            r["builder"], r["items"], r["cold_ms"], r["best_ms"], r["per_item_us"], r["size_kb"],
+            "sí" if r["ok"] else "NO", r["error"]))
+    return rows
+
+
+# Si se ejecuta directamente desde la consola
+if __name__ == "__main__":
+    if "env" in globals():
+        run_benchmark(env)  # noqa: F821
@@ -1 +1 @@
-from . import aeat_client, g4_xml_builder, invoice_ocr_service, taric_service
+from . import aeat_client, g4_xml_builder, invoice_ocr_service, taric_service, xsd_validator
@@ -1,11 +1,55 @@
 import base64
+import hashlib
 import logging
 import os
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from odoo import models
 _logger = logging.getLogger(__name__)
 
+# Pool de sesiones mTLS por proceso: {(dbname, company_id, huella_cert): _AeatSessionEntry}.
+# La huella incluye el checksum del adjunto P12 y un hash de la contraseña, de modo que
+# cualquier cambio de certificado genera otra clave (también en otros workers).
+_SESSION_POOL = {}
+_SESSION_POOL_LOCK = threading.RLock()
+_SESSION_POOL_SIZE = 16
+
+
+class _AeatMtlsAdapter(HTTPAdapter):
+    """HTTPAdapter con SSLContext que ya tiene cargado el certificado cliente en memoria."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+class _AeatSessionEntry:
+    """Sesión requests reutilizable (keep-alive por host AEAT) + material PEM descifrado."""
+
+    def __init__(self, session, pid, cert_pem=None, key_pem=None):
+        self.session = session
+        self.pid = pid
+        self.cert_pem = cert_pem
+        self.key_pem = key_pem
+
+    def close(self):
+        try:
+            self.session.close()
+        except Exception:
+            pass
+
 
 class AduanasAeatClient(models.AbstractModel):
     _name = "aduanas.aeat.client"
@@ -22,6 +66,80 @@ class AduanasAeatClient(models.AbstractModel):
         Convierte P12/PFX a archivos temporales PEM (cert + key) usando cryptography
         (compatible con Odoo 16 / cryptography 3.4.x). Retorna (cert_pem_path, key_pem_path) o (None, None).
         """
+        cert_pem, key_pem = self._p12_to_pem_bytes(p12_data, password)
+        if not cert_pem or not key_pem:
+            return None, None
+        cert_fd, cert_path = tempfile.mkstemp(suffix=".pem")
+        key_fd, key_path = tempfile.mkstemp(suffix=".pem")
+        try:
+            os.write(cert_fd, cert_pem)
+            os.close(cert_fd)
+            cert_fd = None
+            os.write(key_fd, key_pem)
+            os.close(key_fd)
+            key_fd = None
+            return cert_path, key_path
+        except Exception as e:
+            _logger.warning("Error escribiendo PEM temporales: %s", e)
+            for fd, path in ((cert_fd, cert_path), (key_fd, key_path)):
+                if fd is not None:
+                    try:
+                        os.close(fd)
+                    except Exception:
+                        pass
+                if path and os.path.exists(path):
+                    try:
+                        os.unlink(path)
+                    except Exception:
+                        pass
+            return None, None
+
+    def _get_cert_tuple_for_requests(self):
+        """
+        Obtiene (cert_pem_path, key_pem_path) para requests usando el P12 configurado.
+        Convierte P12 a PEM con cryptography. Retorna (None, None) si no hay cert o falla.
+        """
+        aeat = self.env.company._get_aeat_settings()
+        attach_id = aeat["cert_attachment_id"]
+        password = aeat["cert_password"]
+        if not attach_id or not password:
+            return None, None
+        attachment = self.env["ir.attachment"].sudo().browse(attach_id)
+        if not attachment.exists() or not attachment.datas:
+            return None, None
+        try:
+            p12_data = base64.b64decode(attachment.datas)
+        except Exception as e:
+            _logger.warning("No se pudo decodificar el certificado P12: %s", e)
+            return None, None
+        return self._p12_to_pem_files(p12_data, password)
+
+    def _get_cert_source(self):
+        """
+        Devuelve (attachment, password) del certificado de la compañía actual
+        (parámetros por compañía con fallback a los globales). (None, "") si no hay.
+        """
+        company = self.env.company
+        attach_id = int(company._get_aeat_param("aeat_cert_attachment_id") or 0)
+        password = (company._get_aeat_param("aeat_cert_password") or "").strip()
+        if not attach_id or not password:
+            return None, ""
+        attachment = self.env["ir.attachment"].sudo().browse(attach_id)
+        if not attachment.exists():
+            return None, ""
+        return attachment, password
+
+    def _session_pool_key(self, attachment, password):
+        """Clave del pool: (bd, compañía, huella del certificado y contraseña)."""
+        if not attachment:
+            return (self.env.cr.dbname, self.env.company.id, "nocert")
+        digest = hashlib.sha256()
+        digest.update(("%s:%s:" % (attachment.id, attachment.checksum or "")).encode("utf-8"))
+        digest.update(password.encode("utf-8"))
+        return (self.env.cr.dbname, self.env.company.id, digest.hexdigest())
+
+    def _p12_to_pem_bytes(self, p12_data, password):
+        """Convierte P12/PFX a (cert_pem, key_pem) en memoria con cryptography. (None, None) si falla."""
         try:
             from cryptography.hazmat.primitives.serialization import (
                 Encoding,
@@ -61,92 +179,206 @@ class AduanasAeatClient(models.AbstractModel):
         except Exception as e:
             _logger.warning("Error serializando P12 a PEM: %s", e)
             return None, None
+        return cert_pem, key_pem
+
+    def _build_mtls_ssl_context(self, cert_pem, key_pem):
+        """
+        Crea un SSLContext con el certificado cliente cargado. OpenSSL solo acepta rutas,
+        así que el PEM se escribe un instante en temporales 0600 y se borra tras cargarlo:
+        a partir de ahí la clave vive solo en memoria del proceso.
+        """
+        from urllib3.util.ssl_ import create_urllib3_context
+
+        context = create_urllib3_context()
+        context.load_default_certs()
         cert_fd, cert_path = tempfile.mkstemp(suffix=".pem")
         key_fd, key_path = tempfile.mkstemp(suffix=".pem")
         try:
             os.write(cert_fd, cert_pem)
+            os.write(key_fd, key_pem)
             os.close(cert_fd)
             cert_fd = None
-            os.write(key_fd, key_pem)
             os.close(key_fd)
             key_fd = None
-            return cert_path, key_path
-        except Exception as e:
-            _logger.warning("Error escribiendo PEM temporales: %s", e)
-            for fd, path in ((cert_fd, cert_path), (key_fd, key_path)):
+            context.load_cert_chain(cert_path, key_path)
+        finally:
+            for fd in (cert_fd, key_fd):
                 if fd is not None:
                     try:
                         os.close(fd)
                     except Exception:
                         pass
-                if path and os.path.exists(path):
-                    try:
-                        os.unlink(path)
-                    except Exception:
-                        pass
-            return None, None
+            for path in (cert_path, key_path):
+                try:
+                    os.unlink(path)
+                except Exception:
+                    pass
+        return context
 
-    def _get_cert_tuple_for_requests(self):
-        """
-        Obtiene (cert_pem_path, key_pem_path) para requests usando el P12 configurado.
-        Convierte P12 a PEM con cryptography. Retorna (None, None) si no hay cert o falla.
-        """
-        icp = self.env["ir.config_parameter"].sudo()
-        attach_id = int(icp.get_param("aduanas_transport.cert_attachment_id") or 0)
-        password = (icp.get_param("aduanas_transport.cert_password") or "").strip()
-        if not attach_id or not password:
-            return None, None
-        attachment = self.env["ir.attachment"].sudo().browse(attach_id)
-        if not attachment.exists() or not attachment.datas:
-            return None, None
+    def _new_pooled_session(self, attachment, password):
+        """Crea la entrada del pool: descifra el P12 (una vez) y monta el adapter mTLS."""
+        session = requests.Session()
+        session.headers.update({"Content-Type": "text/xml; charset=utf-8", "SOAPAction": ""})
+        if not attachment:
+            session.mount("https://", HTTPAdapter(pool_connections=_SESSION_POOL_SIZE, pool_maxsize=_SESSION_POOL_SIZE))
+            return _AeatSessionEntry(session, os.getpid())
         try:
-            p12_data = base64.b64decode(attachment.datas)
+            p12_data = base64.b64decode(attachment.datas or b"")
         except Exception as e:
             _logger.warning("No se pudo decodificar el certificado P12: %s", e)
-            return None, None
-        return self._p12_to_pem_files(p12_data, password)
+            p12_data = b""
+        cert_pem, key_pem = self._p12_to_pem_bytes(p12_data, password) if p12_data else (None, None)
+        if not cert_pem or not key_pem:
+            session.close()
+            return None
+        try:
+            context = self._build_mtls_ssl_context(cert_pem, key_pem)
+        except Exception as e:
+            _logger.warning("Error cargando certificado cliente en SSLContext: %s", e)
+            session.close()
+            return None
+        session.mount(
+            "https://",
+            _AeatMtlsAdapter(context, pool_connections=_SESSION_POOL_SIZE, pool_maxsize=_SESSION_POOL_SIZE),
+        )
+        return _AeatSessionEntry(session, os.getpid(), cert_pem=cert_pem, key_pem=key_pem)
+
+    def _get_pooled_session(self):
+        """
+        Devuelve (entry, con_certificado) del pool del proceso, creándolo si hace falta.
+        Si el certificado configurado no se puede cargar, devuelve (None, False).
+        """
+        attachment, password = self._get_cert_source()
+        key = self._session_pool_key(attachment, password)
+        pid = os.getpid()
+        with _SESSION_POOL_LOCK:
+            entry = _SESSION_POOL.get(key)
+            if entry and entry.pid != pid:
+                # Worker hijo tras fork: no compartir sockets con el proceso padre
+                _SESSION_POOL.pop(key, None)
+                entry = None
+        if entry is not None:
+            return entry, bool(attachment)
+        # Descifrar el P12 y montar el SSLContext fuera del lock: no bloquea a otras compañías
+        entry = self._new_pooled_session(attachment, password)
+        if entry is None:
+            return None, bool(attachment)
+        with _SESSION_POOL_LOCK:
+            current = _SESSION_POOL.get(key)
+            if current is not None and current.pid == pid:
+                # Otro hilo la creó mientras tanto: se conserva la suya
+                entry.close()
+                return current, bool(attachment)
+            # Sustituir entradas antiguas de la misma compañía (cert/contraseña cambiados)
+            for old_key in [k for k in _SESSION_POOL if k[:2] == key[:2] and k != key]:
+                _SESSION_POOL.pop(old_key).close()
+            _SESSION_POOL[key] = entry
+        return entry, bool(attachment)
+
+    def invalidate_session_pool(self, company_ids=None):
+        """
+        Cierra y elimina las sesiones del pool de esta BD (todas, o solo las de company_ids).
+        Se llama al cambiar certificado o contraseña en res.company.
+        """
+        dbname = self.env.cr.dbname
+        company_ids = set(company_ids or [])
+        with _SESSION_POOL_LOCK:
+            for key in list(_SESSION_POOL):
+                if key[0] != dbname:
+                    continue
+                if company_ids and key[1] not in company_ids:
+                    continue
+                _SESSION_POOL.pop(key).close()
 
     def send_xml(self, endpoint: str, xml_text: str, service: str, timeout=30):
         """
         Envía XML al endpoint AEAT. Retorna (status_code, response_text).
-        Si hay certificado P12 configurado, se convierte a PEM con cryptography y se usa con requests (sin requests-pkcs12).
+        Usa una sesión del pool del proceso (por compañía y huella del certificado): el P12 se
+        descifra una sola vez y las conexiones HTTPS keep-alive se reutilizan por host AEAT.
         """
         if not endpoint:
             raise ValueError("Endpoint no configurado para %s" % service)
         xml_signed = self.sign_xml(xml_text, service)
-        headers = {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": ""}
         data = xml_signed.encode("utf-8")
-        cert_path, key_path = self._get_cert_tuple_for_requests()
-        temp_paths = []
-        if cert_path:
-            temp_paths.append(cert_path)
-        if key_path:
-            temp_paths.append(key_path)
+        entry, with_cert = self._get_pooled_session()
+        transient = entry is None
+        if transient:
+            # Certificado configurado pero ilegible: se envía sin certificado (comportamiento previo)
+            entry = self._new_pooled_session(None, "")
+            with_cert = False
         try:
-            if cert_path and key_path:
-                resp = requests.post(
-                    endpoint,
-                    data=data,
-                    headers=headers,
-                    timeout=timeout,
-                    cert=(cert_path, key_path),
-                    verify=True,
-                )
+            resp = entry.session.post(endpoint, data=data, timeout=timeout, verify=True)
+            if with_cert:
                 _logger.info("AEAT %s → %s (%s) [con certificado PEM]", service, endpoint, resp.status_code)
-                return (resp.status_code, resp.text)
-            resp = requests.post(endpoint, data=data, headers=headers, timeout=timeout)
-            _logger.info("AEAT %s → %s (%s)", service, endpoint, resp.status_code)
+            else:
+                _logger.info("AEAT %s → %s (%s)", service, endpoint, resp.status_code)
             return (resp.status_code, resp.text)
+        except requests.exceptions.SSLError as e:
+            # Posible certificado revocado/cambiado fuera de Odoo: descartar la sesión del pool
+            _logger.exception("Error TLS enviando a AEAT %s: %s", service, e)
+            self.invalidate_session_pool([self.env.company.id])
+            return (0, "")
         except requests.exceptions.RequestException as e:
             _logger.exception("Error enviando a AEAT %s: %s", service, e)
             return (0, "")
         finally:
-            for path in temp_paths:
-                if path and os.path.exists(path):
-                    try:
-                        os.unlink(path)
-                    except Exception:
-                        pass
+            if transient:
+                entry.close()
+
+    def send_xml_batch(self, jobs, limits=None, default_limit=4, max_workers=8):
+        """
+        Envía varios XML en paralelo con concurrencia acotada por endpoint.
+        jobs: lista de dicts {"key", "endpoint", "xml", "service", "timeout"}.
+        limits: {service: máximo de peticiones simultáneas contra ese endpoint}.
+        Retorna {key: {"status_code", "text", "elapsed", "error"}}.
+        Los hilos solo hacen HTTP (sesión del pool); no tocan el ORM ni el cursor.
+        """
+        limits = limits or {}
+        results = {}
+        if not jobs:
+            return results
+        entry, with_cert = self._get_pooled_session()
+        transient = entry is None
+        if transient:
+            entry = self._new_pooled_session(None, "")
+            with_cert = False
+        semaphores = {}
+        prepared = []
+        for job in jobs:
+            if not job.get("endpoint"):
+                results[job["key"]] = {"status_code": 0, "text": "", "elapsed": 0.0,
+                                       "error": "Endpoint no configurado para %s" % job.get("service")}
+                continue
+            limit = max(int(limits.get(job.get("service"), default_limit) or default_limit), 1)
+            if job["endpoint"] not in semaphores:
+                semaphores[job["endpoint"]] = threading.BoundedSemaphore(limit)
+            data = self.sign_xml(job["xml"], job.get("service")).encode("utf-8")
+            prepared.append((job, data))
+
+        def _post(job, data):
+            with semaphores[job["endpoint"]]:
+                start = time.monotonic()
+                try:
+                    resp = entry.session.post(job["endpoint"], data=data, timeout=job.get("timeout") or 30, verify=True)
+                    return job["key"], {"status_code": resp.status_code, "text": resp.text,
+                                        "elapsed": time.monotonic() - start, "error": None}
+                except requests.exceptions.RequestException as e:
+                    return job["key"], {"status_code": 0, "text": "", "elapsed": time.monotonic() - start, "error": str(e)}
+
+        workers = max(1, min(max_workers, len(prepared), _SESSION_POOL_SIZE))
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aeat_batch") as executor:
+                for key, outcome in executor.map(lambda item: _post(*item), prepared):
+                    results[key] = outcome
+        finally:
+            if transient:
+                entry.close()
+        for job, _data in prepared:
+            outcome = results.get(job["key"]) or {}
+            _logger.info("AEAT %s → %s (%s) %.2fs [lote%s]", job.get("service"), job["endpoint"],
+                         outcome.get("status_code"), outcome.get("elapsed") or 0.0,
+                         ", con certificado PEM" if with_cert else "")
+        return results
 
     def send_xml_legacy(self, endpoint: str, xml_text: str, service: str, timeout=30) -> str:
         """Compatibilidad: devuelve solo el texto. Si status != 200 devuelve vacío."""
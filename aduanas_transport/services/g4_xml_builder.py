@@ -6,6 +6,13 @@ from odoo import _, fields, models
 from odoo.exceptions import UserError
 from xml.sax.saxutils import escape as xml_escape
 
+from odoo.addons.aduanas_transport.services.xml_fragments import (
+    ITEMS_MARKER,
+    compile_fragment,
+    memoize_partner_fragment,
+    stream_document,
+)
+
 NS_G4_ENT = (
     "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aduanas/"
     "es/aeat/adds/jdit/g4/ws/G4DecV1Ent.xsd"
@@ -17,11 +24,11 @@ class AduanasG4XmlBuilder(models.AbstractModel):
     _name = "aduanas.g4.xml.builder"
     _description = "Constructor XML G4 depósito temporal (G4DecV1)"
 
-    def _icp(self):
-        return self.env["ir.config_parameter"].sudo()
+    def _aeat_settings(self):
+        return self.env.company._get_aeat_settings()
 
     def _g4_param(self, key, default=""):
-        return (self._icp().get_param(key) or default).strip()
+        return (self._aeat_settings()["params"].get(key) or default).strip()
 
     def _is_preproduction(self, endpoint_url=None):
         if endpoint_url:
@@ -34,8 +41,7 @@ class AduanasG4XmlBuilder(models.AbstractModel):
         return "PRE.AEAT" if self._is_preproduction(endpoint_url) else "ES.AEAT"
 
     def _sender_id(self, expediente):
-        icp = self._icp()
-        forced = (icp.get_param("aduanas_transport.aeat_nif_firmante") or "").strip()
+        forced = self._aeat_settings()["nif_firmante"].strip()
         if forced:
             return forced.replace(" ", "").replace("-", "").upper()[:17]
         company = expediente.env.company
@@ -75,7 +81,43 @@ class AduanasG4XmlBuilder(models.AbstractModel):
             raw = "G4-%s" % base
         return raw[:22]
 
+    _G4_FULL_ADDRESS = compile_fragment("""<FullAddress>
+<Street>{street}</Street>
+<Number>S/N</Number>
+<Country>{country}</Country>
+<PostCode>{postcode}</PostCode>
+<City>{city}</City>
+</FullAddress>""")
+    _G4_COMMUNICATION = compile_fragment("""<Communication>
+<CommType>EM</CommType>
+<CommId>{email}</CommId>
+</Communication>""")
+    _G4_ACTOR = compile_fragment("""<{tag!raw}>
+{id_xml!raw}
+<TypeOfPerson>{type_of_person!raw}</TypeOfPerson>
+<Name>{name}</Name>
+{addr!raw}{comm_block!raw}
+</{tag!raw}>""")
+    _G4_MASTER_ITEM = compile_fragment("""<MI_MasterConsignment_Item>
+<GoodsItemNumber>{gin!raw}</GoodsItemNumber>
+<Commodity>
+<CommodityCode>
+<HarmonizedSystem>{hs}</HarmonizedSystem>
+{cn_xml!raw}
+</CommodityCode>
+<DescriptionOfGoods>{description}</DescriptionOfGoods>
+</Commodity>
+<GrossMass>{gross!raw}</GrossMass>
+<Packaging>
+<PackagingType>{pkg_type}</PackagingType>
+<NumberOfPackages>{pkg_count!raw}</NumberOfPackages>
+</Packaging>
+</MI_MasterConsignment_Item>""")
+
     def _g4_full_address_xml(self, partner, default_country="ES"):
+        return memoize_partner_fragment("g4_full_address", partner, self._render_g4_full_address, default_country)
+
+    def _render_g4_full_address(self, partner, default_country):
         if not partner:
             return ""
         street = " ".join(p for p in [partner.street or "", partner.street2 or ""] if p)[:70]
@@ -85,28 +127,18 @@ class AduanasG4XmlBuilder(models.AbstractModel):
         ) or default_country
         if not street:
             street = city or "S/N"
-        return """<FullAddress>
-<Street>%s</Street>
-<Number>%s</Number>
-<Country>%s</Country>
-<PostCode>%s</PostCode>
-<City>%s</City>
-</FullAddress>""" % (
-            xml_escape(street),
-            xml_escape("S/N"),
-            xml_escape(country[:2]),
-            xml_escape((partner.zip or "00000")[:17]),
-            xml_escape(city),
+        return self._G4_FULL_ADDRESS.render(
+            street=street,
+            country=country[:2],
+            postcode=(partner.zip or "00000")[:17],
+            city=city,
         )
 
     def _g4_communication_xml(self, partner):
         email = (partner.email or "").strip()[:512]
         if not email:
             return ""
-        return """<Communication>
-<CommType>EM</CommType>
-<CommId>%s</CommId>
-</Communication>""" % xml_escape(email)
+        return self._G4_COMMUNICATION.render(email=email)
 
     def _g4_declarant_xml(self, expediente):
         company = expediente.env.company
@@ -127,34 +159,30 @@ class AduanasG4XmlBuilder(models.AbstractModel):
     def _g4_actor_block(self, tag, partner, expediente, default_country, type_of_person="2"):
         if not partner:
             return ""
-        ident = expediente._imp_eori(partner, default_country)
+        allow_foreign_id = self._g4_param(
+            "aduanas_transport.g4_allow_foreign_actor_id", ""
+        ).lower() in ("1", "true", "yes", "si", "sí")
+        return memoize_partner_fragment(
+            "g4_actor", partner, self._render_g4_actor_block, expediente._imp_eori(partner, default_country),
+            tag, default_country, type_of_person, allow_foreign_id,
+        )
+
+    def _render_g4_actor_block(self, partner, ident, tag, default_country, type_of_person, allow_foreign_id):
         id_xml = ""
         if ident and len(ident) >= 9:
-            if ident.startswith("ES") or self._g4_param(
-                "aduanas_transport.g4_allow_foreign_actor_id", ""
-            ).lower() in ("1", "true", "yes", "si", "sí"):
+            if ident.startswith("ES") or allow_foreign_id:
                 id_xml = "<Id>%s</Id>" % xml_escape(ident[:17])
-        name = (partner.name or tag)[:70]
-        addr = self._g4_full_address_xml(partner, default_country)
         comm = self._g4_communication_xml(partner)
-        comm_block = ("\n%s" % comm) if comm else ""
-        return """<%s>
-%s
-<TypeOfPerson>%s</TypeOfPerson>
-<Name>%s</Name>
-%s%s
-</%s>""" % (
-            tag,
-            id_xml,
-            type_of_person,
-            xml_escape(name),
-            addr,
-            comm_block,
-            tag,
+        return self._G4_ACTOR.render(
+            tag=tag,
+            id_xml=id_xml,
+            type_of_person=type_of_person,
+            name=(partner.name or tag)[:70],
+            addr=self._g4_full_address_xml(partner, default_country),
+            comm_block=("\n%s" % comm) if comm else "",
         )
 
     def _location_of_goods_xml(self, expediente, office):
-        icp = self._icp()
         loc_type = self._g4_param("aduanas_transport.g4_loc_type", "B")
         loc_qual = self._g4_param("aduanas_transport.g4_loc_qualifier", "Y")
         loc_ref = self._g4_param("aduanas_transport.g4_loc_customs_ref") or (
@@ -168,7 +196,7 @@ class AduanasG4XmlBuilder(models.AbstractModel):
         wh_id = (
             self._g4_param("aduanas_transport.g4_warehouse_id")
             or expediente.location_authorisation_number
-            or icp.get_param("aduanas_transport.aeat_preprod_location_authorisation")
+            or self._aeat_settings()["preprod_location_authorisation"]
             or "010101DA11"
         )
         return """<LocationOfGoods>
@@ -225,11 +253,16 @@ class AduanasG4XmlBuilder(models.AbstractModel):
             xml_escape(means_id[:35]),
         )
 
-    def _master_items_xml(self, expediente):
-        blocks = []
-        for idx, line in enumerate(
-            expediente.line_ids.sorted(key=lambda l: l.item_number or l.id or 0), 1
-        ):
+    def _iter_master_items(self, expediente):
+        """Genera las partidas MI_MasterConsignment_Item una a una (se escriben en stream_document)."""
+        lines = expediente._sorted_goods_lines()
+        limit = expediente._max_goods_items("G4_DEC")
+        if len(lines) > limit:
+            raise UserError(
+                _("El expediente tiene %s partidas y G4 admite %s por declaración.") % (len(lines), limit)
+            )
+        render_item = self._G4_MASTER_ITEM.render
+        for idx, line in enumerate(lines, 1):
             partida = (line.taric_completo or line.partida or "").replace(" ", "").replace(".", "")
             if len(partida) < 6 or not partida[:6].isdigit():
                 raise UserError(
@@ -247,36 +280,15 @@ class AduanasG4XmlBuilder(models.AbstractModel):
             gross = line.peso_bruto or 0.0
             if gross <= 0:
                 raise UserError(_("Línea %s: indique peso bruto para G4.") % idx)
-            pkg_type = (line.type_of_packages or "CT").strip().upper()[:2]
-            pkg_count = int(line.bultos or 1)
-            gin = line.item_number or idx
-            blocks.append(
-                """<MI_MasterConsignment_Item>
-<GoodsItemNumber>%s</GoodsItemNumber>
-<Commodity>
-<CommodityCode>
-<HarmonizedSystem>%s</HarmonizedSystem>
-%s
-</CommodityCode>
-<DescriptionOfGoods>%s</DescriptionOfGoods>
-</Commodity>
-<GrossMass>%.6f</GrossMass>
-<Packaging>
-<PackagingType>%s</PackagingType>
-<NumberOfPackages>%s</NumberOfPackages>
-</Packaging>
-</MI_MasterConsignment_Item>"""
-                % (
-                    gin,
-                    xml_escape(hs),
-                    cn_xml,
-                    xml_escape(desc),
-                    gross,
-                    xml_escape(pkg_type),
-                    pkg_count,
-                )
+            yield render_item(
+                gin=line.item_number or idx,
+                hs=hs,
+                cn_xml=cn_xml,
+                description=desc,
+                gross="%.6f" % gross,
+                pkg_type=(line.type_of_packages or "CT").strip().upper()[:2],
+                pkg_count=int(line.bultos or 1),
             )
-        return "\n".join(blocks)
 
     def validate_g4_expediente(self, g4_rec):
         expediente = g4_rec.expediente_id
@@ -326,7 +338,6 @@ class AduanasG4XmlBuilder(models.AbstractModel):
 %s
 %s
 %s
-%s
 <TotalGrossMass>%.6f</TotalGrossMass>
 %s
 %s
@@ -340,10 +351,10 @@ class AduanasG4XmlBuilder(models.AbstractModel):
             consignor,
             consignee,
             xml_escape(dest_country),
-            self._master_items_xml(expediente),
+            ITEMS_MARKER,
         )
 
-        return """<MES_Message>
+        document = """<MES_Message>
 <Sender>%s</Sender>
 <Recipient>%s</Recipient>
 <MessageId>%s</MessageId>
@@ -368,6 +379,8 @@ class AduanasG4XmlBuilder(models.AbstractModel):
             self._g4_declarant_xml(expediente),
             mc_block,
         )
+        body, _count = stream_document(document, self._iter_master_items(expediente))
+        return body
 
     def build_g4_soap_envelope(self, g4_rec, endpoint_url=None):
         body = self.build_g4_body(g4_rec, endpoint_url=endpoint_url)
@@ -3,11 +3,64 @@ import base64
 import json
 import re
 import io
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from odoo import models, fields, _
 from odoo.exceptions import UserError
 
+from odoo.addons.aduanas_transport.services.ocr_chunks import (
+    CHUNK_SYSTEM_PROMPT,
+    HEADER_PROMPT,
+    LINES_PROMPT,
+    merge_chunk_lines,
+    reconcile_lines,
+    split_transcript,
+)
+from odoo.addons.aduanas_transport.services.ocr_header import extract_header
+from odoo.addons.aduanas_transport.services.ocr_pages import (
+    classify_page,
+    complete_json,
+    get_rate_limiter,
+    render_page_for_vision,
+    transcribe_page,
+)
+from odoo.addons.aduanas_transport.services.ocr_tables import (
+    TableLineExtractor,
+    extract_labelled_lines,
+    page_rules,
+)
+from odoo.addons.aduanas_transport.services.ocr_tesseract import ocr_pages, tesseract_available
+
 _logger = logging.getLogger(__name__)
 
+# Versión de la extracción para la caché aduana.ocr.cache: incrementar al cambiar prompts,
+# parámetros o parsing para que no se sirvan resultados del extractor anterior
+OCR_EXTRACTOR_VERSION = "6"
+
+# Parámetros aduanas_transport.ocr.<clave>: (clave, valor por defecto, tipo)
+OCR_SETTINGS = (
+    ("max_workers", 4, int),           # páginas enviadas a la vez a GPT-4o Vision
+    ("requests_per_minute", 0, int),   # 0 = sin límite propio (solo los 429 de la API)
+    ("max_retries", 4, int),           # reintentos por página ante 429/5xx/timeout
+    ("page_timeout", 60.0, float),     # segundos por llamada
+    ("text_fast_path", 1, int),        # 0 = enviar todas las páginas a visión
+    ("text_min_chars", 80, int),       # caracteres visibles mínimos para usar el texto embebido
+    ("text_min_glyph_ratio", 0.97, float),  # glifos con carácter Unicode real / total
+    ("text_max_image_ratio", 0.5, float),   # superficie de imagen máxima (escaneos con capa de texto)
+    ("raster_profile", "adaptive", str),    # adaptive | fixed (200 DPI, PNG color, página completa)
+    ("raster_dpi_min", 120, int),      # páginas poco densas
+    ("raster_dpi_max", 200, int),      # páginas muy densas (letra pequeña, tablas apretadas)
+    ("raster_jpeg_quality", 75, int),  # escaneos
+    ("raster_crop_margins", 1, int),   # recortar márgenes vacíos
+    ("interpret_chunk_chars", 24000, int),  # por encima, interpretación por fragmentos (0 = nunca)
+    ("interpret_timeout", 120.0, float),    # segundos por llamada de interpretación
+    ("tesseract", 1, int),             # 0 = sin OCR local de páginas escaneadas en la ruta sin OpenAI
+    ("tesseract_lang", "spa+eng", str),
+    ("tesseract_dpi", 300, int),
+    ("tesseract_page_timeout", 60.0, float),  # segundos de Tesseract por página
+    ("tesseract_workers", 0, int),     # procesos del pool (0 = núcleos disponibles)
+)
+
 class InvoiceOCRService(models.AbstractModel):
     _name = "aduanas.invoice.ocr.service"
     _description = "Servicio OCR/IA para procesar facturas PDF"
@@ -19,6 +72,9 @@ class InvoiceOCRService(models.AbstractModel):
         :param pdf_data: Datos binarios del PDF (base64 o bytes)
         :param api_key: API key de OpenAI (opcional, se obtiene de configuración si no se proporciona)
         :return: Diccionario con datos extraídos (incluye campo 'error' si hay problemas)
+        
+        El resultado se guarda en aduana.ocr.cache por SHA-256 del PDF y versión del extractor;
+        con contexto ocr_no_cache=True se ignora la caché.
         """
         if not pdf_data:
             return {
@@ -81,6 +137,26 @@ class InvoiceOCRService(models.AbstractModel):
             else:
                 _logger.warning("No se encontró API key de OpenAI en la configuración del módulo Aduanas. Verifica en Aduanas > Configuración")
         
+        # Caché por contenido: el mismo PDF (copias, reenvíos, reintentos del job) no se vuelve a procesar
+        cache = self.env["aduana.ocr.cache"]
+        use_cache = not self.env.context.get("ocr_no_cache")
+        cache_key = cache._digest(pdf_bytes)
+        # Sin OpenAI, el resultado depende de si hay OCR local para las páginas escaneadas
+        if api_key:
+            backend = "vision"
+        elif self._ocr_settings()["tesseract"] and tesseract_available()[0]:
+            backend = "local-tesseract"
+        else:
+            backend = "local"
+        cache_version = "%s-%s" % (OCR_EXTRACTOR_VERSION, backend)
+        if use_cache:
+            cached = cache._lookup(cache_key, cache_version)
+            if cached is not None:
+                _logger.info("Factura %s… resuelta desde la caché OCR (%s)", cache_key[:12], cached.get("metodo_usado"))
+                cached["metodo_usado"] = _("%s (caché)") % (cached.get("metodo_usado") or "")
+                cached["cache_hit"] = True
+                return cached
+        
         resultado = None
         metodo_usado = None
         
@@ -89,8 +165,10 @@ class InvoiceOCRService(models.AbstractModel):
             _logger.info("API key disponible. Iniciando procesamiento con GPT-4o Vision...")
             try:
                 _logger.info("Enviando PDF a OpenAI GPT-4o Vision con splitting por páginas...")
-                resultado = self._extract_with_openai_vision(api_key, pdf_bytes)
-                metodo_usado = "OpenAI GPT-4o Vision"
+                resultado = self._extract_with_openai_vision(
+                    api_key, pdf_bytes, checkpoint=(cache_key, cache_version),
+                )
+                metodo_usado = self._ocr_method_label(resultado.get("ocr_paginas") or [])
                 _logger.info("OpenAI GPT-4o Vision procesó el PDF exitosamente")
             except Exception as e:
                 error_gpt = str(e)
@@ -163,25 +241,41 @@ class InvoiceOCRService(models.AbstractModel):
         
         # Agregar información del método usado
         if resultado:
+            if resultado.get("ocr_tesseract"):
+                metodo_usado = "%s + Tesseract (%d pág.)" % (metodo_usado, resultado["ocr_tesseract"]["paginas"])
             resultado["metodo_usado"] = metodo_usado
             
             # Validar que se extrajo texto
             if not resultado.get("texto_extraido") or len(resultado.get("texto_extraido", "").strip()) < 10:
                 if not resultado.get("error"):
-                    resultado["error"] = _("No se pudo extraer texto del PDF. Posibles causas:\n- El PDF es una imagen escaneada (necesitas OpenAI API Key)\n- El PDF está protegido o encriptado\n- El PDF está corrupto\n- La calidad del escaneado es muy baja")
+                    resultado["error"] = _("No se pudo extraer texto del PDF. Posibles causas:\n- El PDF es una imagen escaneada (necesitas OpenAI API Key o Tesseract instalado en el servidor)\n- El PDF está protegido o encriptado\n- El PDF está corrupto\n- La calidad del escaneado es muy baja")
+            
+            # Solo se guardan extracciones completas por la vía prevista (no los fallback tras un fallo de la API);
+            # completada la extracción, los puntos de control de sus páginas ya no hacen falta
+            if not resultado.get("error") and (not api_key or "fallback" not in (metodo_usado or "")):
+                try:
+                    with self.env.cr.savepoint():
+                        if use_cache:
+                            cache._store(cache_key, cache_version, resultado, pdf_size=len(pdf_bytes))
+                        if api_key:
+                            self.env["aduana.ocr.page"]._clear(cache_key, cache_version)
+                except Exception as e:
+                    _logger.warning("No se pudo guardar la factura en la caché OCR: %s", e)
         
         return resultado
 
-    def _extract_with_openai_vision(self, api_key, pdf_bytes):
+    def _extract_with_openai_vision(self, api_key, pdf_bytes, checkpoint=None):
         """
         Extrae datos usando OpenAI GPT-4o Vision convirtiendo PDF a imágenes.
         Requiere: pip install openai PyMuPDF
         
-        OpenAI solo acepta imágenes (no PDFs directamente), por lo que necesitamos
-        convertir cada página del PDF a imagen antes de enviarla.
+        OpenAI solo acepta imágenes (no PDFs directamente), por lo que las páginas escaneadas
+        se convierten a imagen antes de enviarlas; las que tienen texto embebido fiable se
+        leen directamente del PDF (ver _transcribe_pages).
         
         :param api_key: API key de OpenAI
         :param pdf_bytes: Datos binarios del PDF (bytes)
+        :param checkpoint: (sha256, versión) para guardar/reanudar las páginas en aduana.ocr.page
         :return: Diccionario con datos extraídos
         """
         try:
@@ -191,11 +285,12 @@ class InvoiceOCRService(models.AbstractModel):
             if not api_key:
                 raise ValueError("API key de OpenAI no proporcionada")
             
-            # Inicializar cliente de OpenAI (sin timeout explícito para permitir trabajos largos en cola)
-            client = OpenAI(api_key=api_key)
+            # Inicializar cliente de OpenAI (sin timeout explícito para permitir trabajos largos en cola).
+            # Los reintentos (429 con Retry-After, 5xx) los gestiona el limitador compartido.
+            client = OpenAI(api_key=api_key, max_retries=0)
             
-            # Abrir PDF y convertir a imágenes
-            _logger.info("Convirtiendo PDF a imágenes por páginas...")
+            # Abrir PDF y analizar sus páginas
+            _logger.info("Analizando el PDF por páginas...")
             try:
                 pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
                 num_pages = len(pdf_document)
@@ -208,92 +303,14 @@ class InvoiceOCRService(models.AbstractModel):
                 _logger.error("Error al abrir PDF: %s", pdf_error)
                 raise Exception(_("Error al abrir el PDF. Verifica que el archivo sea un PDF válido."))
             
-            # Procesar cada página con GPT-4o Vision
-            all_texts = []
-            errores_paginas = []
-            for page_num in range(num_pages):
-                _logger.info("Procesando página %d/%d con GPT-4o Vision...", page_num + 1, num_pages)
-                
-                try:
-                    # Obtener página y convertir a imagen PNG
-                    page = pdf_document[page_num]
-                    mat = fitz.Matrix(200/72, 200/72)  # 200 DPI para buena calidad
-                    pix = page.get_pixmap(matrix=mat)
-                    
-                    # Convertir a base64
-                    img_bytes = pix.tobytes("png")
-                    img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-                    
-                    # Llamar a OpenAI Vision API con prompt específico para contexto legal/administrativo
-                    _logger.debug("Enviando página %d a OpenAI (tamaño imagen: %d bytes base64)", page_num + 1, len(img_base64))
-                    try:
-                        response = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "text",
-                                            "text": "Eres un asistente de procesamiento documental para una empresa de logística y aduanas.\n\n"
-                                                    "El documento proporcionado es una PÁGINA de una factura comercial utilizada exclusivamente para generar un documento aduanero (DUA).\n\n"
-                                                    "La extracción que vas a hacer es para un proceso legal obligatorio.\n\n"
-                                                    "IMPORTANTE: Esta es una de varias páginas de la factura. Debes transcribir TODO el texto visible de esta página, incluyendo:\n"
-                                                    "- Números de factura, fechas, direcciones\n"
-                                                    "- TODAS las líneas de productos/artículos (descripción, cantidad, precio, total)\n"
-                                                    "- Totales, subtotales, descuentos\n"
-                                                    "- Información de transporte, matrículas, referencias\n"
-                                                    "- Cualquier otro texto visible en la página\n\n"
-                                                    "No omitas ninguna línea de producto ni información relevante.\n"
-                                                    "No devuelvas la imagen completa ni reproduzcas el documento.\n"
-                                                    "Simplemente transcribe TODO el texto visible de esta página.\n\n"
-                                                    "La extracción es estrictamente con fines administrativos y está permitida.\n"
-                                                    "Devuelve únicamente el texto transcrito, sin notas adicionales ni explicaciones."
-                                        },
-                                        {
-                                            "type": "image_url",
-                                            "image_url": {
-                                                "url": f"data:image/png;base64,{img_base64}"
-                                            }
-                                        }
-                                    ]
-                                }
-                            ],
-                            max_tokens=8000,  # Aumentado para páginas con muchas líneas
-                            timeout=60.0  # Timeout de 60 segundos por página
-                        )
-                        _logger.debug("Respuesta recibida de OpenAI para página %d", page_num + 1)
-                    except Exception as api_call_error:
-                        _logger.error("Error en la llamada a OpenAI API para página %d: %s (tipo: %s)", 
-                                    page_num + 1, api_call_error, type(api_call_error).__name__)
-                        raise  # Re-lanzar para que se capture en el except exterior
-                    
-                    # Verificar que la respuesta tenga contenido
-                    if not response or not response.choices or len(response.choices) == 0:
-                        _logger.error("Página %d: OpenAI no devolvió ninguna respuesta", page_num + 1)
-                        errores_paginas.append(f"Página {page_num + 1}: OpenAI no devolvió respuesta")
-                        continue
-                    
-                    page_text = response.choices[0].message.content
-                    if page_text and page_text.strip():
-                        all_texts.append(page_text)
-                        _logger.info("Texto extraído de página %d: %d caracteres", page_num + 1, len(page_text))
-                    else:
-                        _logger.warning("Página %d: GPT Vision respondió pero el contenido está vacío o es None. Respuesta: %s", page_num + 1, response.choices[0].message if response.choices else "Sin respuesta")
-                        errores_paginas.append(f"Página {page_num + 1}: Respuesta vacía de GPT Vision")
-                    
-                    # Limpiar memoria
-                    pix = None
-                    
-                except Exception as api_error:
-                    error_msg = str(api_error)
-                    _logger.error("Error al procesar página %d con OpenAI: %s", page_num + 1, api_error)
-                    errores_paginas.append(f"Página {page_num + 1}: {error_msg}")
-                    # Continuar con las siguientes páginas
-                    continue
-            
-            # Cerrar documento
-            pdf_document.close()
+            # Texto embebido donde es fiable; el resto de páginas con GPT-4o Vision en paralelo (orden conservado)
+            settings = self._ocr_settings()
+            try:
+                paginas = self._transcribe_pages(client, api_key, pdf_document, settings, checkpoint=checkpoint)
+            finally:
+                pdf_document.close()
+            all_texts = [p["text"] for p in paginas if p["text"]]
+            errores_paginas = ["Página %d: %s" % (p["page"], p["error"]) for p in paginas if p["error"]]
             
             if not all_texts:
                 # Construir mensaje de error más informativo
@@ -309,19 +326,27 @@ class InvoiceOCRService(models.AbstractModel):
             full_text = "\n\n".join(all_texts)
             _logger.info("Texto total extraído: %d caracteres de %d página(s)", len(full_text), num_pages)
             
+            # Informe por página sin el texto (ya va en texto_extraido)
+            informe_paginas = [{k: v for k, v in p.items() if k != "text"} for p in paginas]
+            
             # Intentar interpretar el texto con GPT-4o para estructurarlo
             try:
-                structured_data = self._interpret_text_with_gpt(api_key, full_text)
+                structured_data = self._interpret_text_with_gpt(
+                    api_key, full_text, pages=[(p["page"], p["text"]) for p in paginas if p["text"]],
+                )
                 if structured_data:
                     # Agregar el texto extraído al resultado
                     structured_data["texto_extraido"] = full_text
+                    structured_data["ocr_paginas"] = informe_paginas
                     _logger.info("Datos estructurados extraídos con GPT-4o")
                     return structured_data
             except Exception as gpt_error:
                 _logger.warning("Error al interpretar texto con GPT-4o: %s. Usando parsing con regex...", gpt_error)
             
             # Fallback: Parsear datos de la factura con regex
-            return self._parse_invoice_text(full_text)
+            data = self._parse_invoice_text(full_text)
+            data["ocr_paginas"] = informe_paginas
+            return data
             
         except ImportError as import_err:
             _logger.error("Error de importación: %s", import_err)
@@ -334,6 +359,135 @@ class InvoiceOCRService(models.AbstractModel):
             _logger.exception("Error con OpenAI GPT-4o Vision: %s", e)
             raise
 
+    def _ocr_settings(self):
+        """Parámetros aduanas_transport.ocr.* leídos una vez por factura (los hilos no tocan el ORM)."""
+        icp = self.env["ir.config_parameter"].sudo()
+        settings = {}
+        for key, default, cast in OCR_SETTINGS:
+            try:
+                settings[key] = cast(icp.get_param("aduanas_transport.ocr.%s" % key) or default)
+            except ValueError:
+                settings[key] = default
+        settings["max_workers"] = max(settings["max_workers"], 1)
+        return settings
+
+    def _transcribe_pages(self, client, api_key, pdf_document, settings, checkpoint=None):
+        """
+        Transcribe las páginas del PDF. Cada página se clasifica antes (classify_page): las de
+        texto embebido fiable se usan directamente y solo las escaneadas o de imagen se
+        rasterizan (render_page_for_vision: resolución, color y formato según la densidad de la
+        página) y se envían a GPT-4o Vision, en un pool de max_workers hilos. PyMuPDF no es
+        seguro entre hilos: clasificación y rasterizado se hacen en este hilo y solo la llamada
+        a la API va al pool, con como mucho 2 × max_workers imágenes pendientes en memoria.
+        Con checkpoint=(sha256, versión) cada página transcrita por visión se guarda en
+        aduana.ocr.page al terminar (transacción propia) y las ya guardadas por un intento
+        anterior del job no se vuelven a rasterizar ni a enviar (resumed=True).
+        Devuelve un dict por página en el orden del PDF: page, path ("text"/"vision"), text,
+        error, attempts, render_ms, wait_ms, api_ms, latency_ms, bytes (enviados en base64),
+        resumed, raster (dpi, mode, codec, crop...), chars, glyph_ratio, image_ratio.
+        """
+        num_pages = len(pdf_document)
+        limiter = get_rate_limiter(api_key, settings["requests_per_minute"])
+        workers = min(settings["max_workers"], num_pages)
+        Checkpoint = self.env["aduana.ocr.page"]
+        saved = Checkpoint._load(*checkpoint) if checkpoint else {}
+        results = {}
+        meta = {}
+        start = time.monotonic()
+
+        def _collect(future):
+            result = future.result()
+            results[result["page"]] = result
+            if checkpoint and result["text"] and not result["error"]:
+                try:
+                    Checkpoint._save(checkpoint[0], checkpoint[1], dict(result, path="vision"))
+                except Exception as e:
+                    _logger.warning("No se pudo guardar el punto de control de la página %d: %s", result["page"], e)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr_vision") as executor:
+            pending = set()
+            for page_num in range(num_pages):
+                page_number = page_num + 1
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _collect(future)
+                if page_number in saved:
+                    results[page_number] = {"page": page_number, "text": saved[page_number], "error": None,
+                                            "attempts": 0, "wait_ms": 0.0, "api_ms": 0.0, "bytes": 0,
+                                            "latency_ms": 0.0}
+                    meta[page_number] = {"path": "vision", "render_ms": 0.0, "resumed": True, "raster": None}
+                    continue
+                t0 = time.monotonic()
+                page = pdf_document[page_num]
+                path, text, metrics = "vision", "", {}
+                if settings["text_fast_path"]:
+                    try:
+                        path, text, metrics = classify_page(
+                            page, settings["text_min_chars"], settings["text_min_glyph_ratio"],
+                            settings["text_max_image_ratio"],
+                        )
+                    except Exception as e:
+                        _logger.warning("No se pudo clasificar la página %d, se enviará a visión: %s", page_number, e)
+                meta[page_number] = dict(metrics, path=path, resumed=False, raster=None)
+                if path == "text":
+                    render_ms = (time.monotonic() - t0) * 1000.0
+                    results[page_number] = {"page": page_number, "text": text, "error": None, "attempts": 0,
+                                            "wait_ms": 0.0, "api_ms": 0.0, "bytes": 0, "latency_ms": render_ms}
+                    meta[page_number]["render_ms"] = render_ms
+                    continue
+                try:
+                    img_base64, mime, meta[page_number]["raster"] = render_page_for_vision(
+                        page, settings, image_ratio=metrics.get("image_ratio"),
+                    )
+                except Exception as e:
+                    _logger.error("Error al rasterizar la página %d: %s", page_number, e)
+                    results[page_number] = {"page": page_number, "text": "", "error": str(e), "attempts": 0,
+                                            "wait_ms": 0.0, "api_ms": 0.0, "bytes": 0, "latency_ms": 0.0}
+                    continue
+                finally:
+                    meta[page_number]["render_ms"] = (time.monotonic() - t0) * 1000.0
+                pending.add(executor.submit(
+                    transcribe_page, client, limiter, page_number, img_base64, mime=mime,
+                    timeout=settings["page_timeout"], max_retries=settings["max_retries"], started=t0,
+                ))
+            for future in pending:
+                _collect(future)
+        paginas = []
+        for page_number in range(1, num_pages + 1):
+            result = dict(results[page_number], **meta[page_number])
+            paginas.append(result)
+            raster = result["raster"]
+            _logger.info(
+                "Página %d/%d [%s%s]: %d caracteres, %s, %.0f KB, render %.0f ms, espera %.0f ms, "
+                "API %.0f ms, total %.0f ms, %d intento(s)%s",
+                page_number, num_pages, result["path"], ", reanudada" if result["resumed"] else "",
+                len(result["text"]),
+                "%s DPI %s %s" % (raster["dpi"], raster["mode"], raster["codec"]) if raster else "sin imagen",
+                result["bytes"] / 1024.0, result["render_ms"], result["wait_ms"], result["api_ms"],
+                result["latency_ms"], result["attempts"],
+                " — error: %s" % result["error"] if result["error"] else "",
+            )
+        _logger.info(
+            "Páginas transcritas en %.1f s: %d con texto embebido, %d con GPT-4o Vision (%d reanudadas), "
+            "%.0f KB enviados con perfil %s (%d hilo(s))",
+            time.monotonic() - start, len([p for p in paginas if p["path"] == "text"]),
+            len([p for p in paginas if p["path"] == "vision"]), len(saved),
+            sum(p["bytes"] for p in paginas) / 1024.0, settings["raster_profile"], workers,
+        )
+        return paginas
+
+    @staticmethod
+    def _ocr_method_label(paginas):
+        """Texto de metodo_usado según la ruta que ha seguido cada página."""
+        text_pages = len([p for p in paginas if p.get("path") == "text"])
+        vision_pages = len(paginas) - text_pages
+        if not text_pages:
+            return "OpenAI GPT-4o Vision"
+        if not vision_pages:
+            return "Texto embebido (%d pág.) + GPT-4o" % text_pages
+        return "Texto embebido (%d pág.) + OpenAI GPT-4o Vision (%d pág.)" % (text_pages, vision_pages)
+
     def _extract_with_google_vision(self, api_key_or_path, pdf_data):
         """
         Extrae datos usando Google Cloud Vision API.
@@ -565,10 +719,56 @@ class InvoiceOCRService(models.AbstractModel):
             # Re-lanzar para que el método padre maneje el fallback
             raise
 
+    def _ocr_scanned_pages(self, pdf_bytes, page_texts):
+        """
+        Pasa por Tesseract (ocr_tesseract.ocr_pages, un proceso tesseract por núcleo) las páginas
+        sin capa de texto útil: menos de text_min_chars caracteres visibles. Devuelve (page_texts
+        con esas páginas sustituidas cuando el OCR da más texto, índices de las páginas
+        sustituidas, informe o None si no se ha usado Tesseract).
+        """
+        settings = self._ocr_settings()
+        scanned = [
+            index for index, text in enumerate(page_texts)
+            if len("".join((text or "").split())) < settings["text_min_chars"]
+        ]
+        if not scanned or not settings["tesseract"]:
+            return page_texts, [], None
+        ok, reason = tesseract_available()
+        if not ok:
+            _logger.warning("%d página(s) sin texto embebido y sin OCR local: %s", len(scanned), reason)
+            return page_texts, [], None
+        try:
+            texts, stats = ocr_pages(
+                pdf_bytes, scanned,
+                dpi=settings["tesseract_dpi"],
+                lang=settings["tesseract_lang"],
+                timeout=settings["tesseract_page_timeout"],
+                workers=settings["tesseract_workers"],
+            )
+        except Exception as e:
+            _logger.warning("OCR local con Tesseract no disponible: %s", e)
+            return page_texts, [], None
+        page_texts = list(page_texts)
+        replaced = []
+        for index in scanned:
+            text = (texts.get(index) or "").strip()
+            if len(text) > len((page_texts[index] or "").strip()):
+                page_texts[index] = text
+                replaced.append(index)
+        _logger.info(
+            "Tesseract: %d de %d página(s) en %.1f s con %d proceso(s), %d error(es)",
+            len(replaced), len(scanned), stats["seconds"], stats["workers"], len(stats["errors"]),
+        )
+        report = {"paginas": len(replaced), "procesos": stats["workers"], "segundos": round(stats["seconds"], 1),
+                  "errores": {index + 1: error for index, error in stats["errors"].items()}}
+        return page_texts, replaced, report
+
     def _extract_with_fallback_ocr(self, pdf_data):
         """
         Método alternativo usando PyPDF2 o pdfplumber para extraer texto.
-        Requiere: pip install pdfplumber o PyPDF2
+        Las páginas escaneadas (sin capa de texto) se leen con Tesseract si está instalado
+        (_ocr_scanned_pages).
+        Requiere: pip install pdfplumber o PyPDF2 (y pytesseract PyMuPDF para el OCR local)
         
         :param pdf_data: Bytes del PDF (ya decodificado)
         """
@@ -582,16 +782,40 @@ class InvoiceOCRService(models.AbstractModel):
             if not pdf_bytes or len(pdf_bytes) < 10:
                 raise ValueError(_("El archivo PDF está vacío o es demasiado pequeño"))
             
-            # Extraer texto del PDF
-            full_text = ""
+            # Extraer texto del PDF y, en la misma pasada, las líneas de las tablas por coordenadas
+            page_texts = []
+            extractor = TableLineExtractor()
+            table_lines = []
+            start = time.monotonic()
             with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
                 for page in pdf.pages:
-                    text = page.extract_text()
-                    if text:
-                        full_text += text + "\n"
+                    page_texts.append(page.extract_text() or "")
+                    if extractor is not None:
+                        try:
+                            table_lines.extend(extractor.feed_page(page.extract_words(), page_rules(page)))
+                        except Exception as e:
+                            _logger.warning("Extracción de tablas por coordenadas desactivada: %s", e)
+                            extractor = None
+                    if hasattr(page, "flush_cache"):
+                        page.flush_cache()
+            if extractor is not None:
+                table_lines.extend(extractor.finish())
+                _logger.info(
+                    "Tablas por coordenadas: %d tabla(s), %d filas, %d líneas en %.0f ms",
+                    extractor.tables, extractor.rows, len(table_lines), (time.monotonic() - start) * 1000.0,
+                )
             
-            # Parsear datos
-            return self._parse_invoice_text(full_text)
+            # Páginas escaneadas: OCR local; sus líneas salen del texto y se suman a las de las tablas
+            page_texts, replaced, ocr_report = self._ocr_scanned_pages(pdf_bytes, page_texts)
+            if table_lines and replaced:
+                table_lines.extend(self._extract_invoice_lines("\n".join(page_texts[i] for i in replaced)))
+            full_text = "".join(text + "\n" for text in page_texts if text)
+
+            # Parsear datos (las líneas del texto plano solo si no se reconoció ninguna tabla)
+            data = self._parse_invoice_text(full_text, lineas=table_lines or None)
+            if ocr_report:
+                data["ocr_tesseract"] = ocr_report
+            return data
             
         except ImportError:
             try:
@@ -604,12 +828,15 @@ class InvoiceOCRService(models.AbstractModel):
                 if not pdf_bytes or len(pdf_bytes) < 10:
                     raise ValueError(_("El archivo PDF está vacío o es demasiado pequeño"))
                 
-                full_text = ""
                 pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-                for page in pdf_reader.pages:
-                    full_text += page.extract_text() + "\n"
+                page_texts = [page.extract_text() or "" for page in pdf_reader.pages]
+                page_texts, _replaced, ocr_report = self._ocr_scanned_pages(pdf_bytes, page_texts)
+                full_text = "".join(text + "\n" for text in page_texts)
                 
-                return self._parse_invoice_text(full_text)
+                data = self._parse_invoice_text(full_text)
+                if ocr_report:
+                    data["ocr_tesseract"] = ocr_report
+                return data
                 
             except ImportError:
                 raise UserError(_("Se requiere instalar pdfplumber o PyPDF2 para procesar PDFs. Ejecute: pip install pdfplumber"))
@@ -764,17 +991,27 @@ Recuerda: Si estado = "sugerido" o "corregido", partida_validada DEBE ser un có
             _logger.warning("Validación IA de factura falló: %s", e)
             return {"error": str(e)}
 
-    def _interpret_text_with_gpt(self, api_key, text):
+    def _interpret_text_with_gpt(self, api_key, text, pages=None):
         """
         Usa GPT-4o para interpretar el texto extraído y estructurarlo en formato JSON.
         
         :param api_key: API key de OpenAI
         :param text: Texto extraído de la factura
+        :param pages: [(número de página, texto)]; si el texto supera interpret_chunk_chars se
+            interpreta por fragmentos (_interpret_chunked) en lugar de en una sola llamada
         :return: Diccionario con datos estructurados o None si falla
         """
         try:
             from openai import OpenAI
             
+            settings = self._ocr_settings()
+            chunk_chars = settings["interpret_chunk_chars"]
+            if pages and len(pages) > 1 and chunk_chars > 0 and len(text) > chunk_chars:
+                try:
+                    return self._interpret_chunked(OpenAI(api_key=api_key, max_retries=0), api_key, pages, settings)
+                except Exception as e:
+                    _logger.warning("Interpretación por fragmentos fallida (%s); se usa una sola llamada", e)
+            
             client = OpenAI(api_key=api_key)
             
             # Prompt detallado para extraer información estructurada
@@ -925,162 +1162,7 @@ TEXTO COMPLETO DE LA FACTURA (todas las páginas):
                 if not isinstance(data, dict):
                     raise ValueError("La respuesta no es un diccionario")
                 
-                # Asegurar que lineas es una lista
-                if "lineas" in data and not isinstance(data["lineas"], list):
-                    data["lineas"] = []
-                
-                # Validar y normalizar direction (sentido)
-                if data.get("direction"):
-                    direction = str(data["direction"]).lower() if data["direction"] else None
-                    if direction and direction not in ["export", "import"]:
-                        # Intentar determinar basándose en países
-                        pais_origen = (data.get("pais_origen") or "").upper() if data.get("pais_origen") else ""
-                        pais_destino = (data.get("pais_destino") or "").upper() if data.get("pais_destino") else ""
-                        if pais_origen == "ES" and pais_destino and pais_destino != "ES":
-                            data["direction"] = "export"
-                        elif pais_origen and pais_origen != "ES" and pais_destino == "ES":
-                            data["direction"] = "import"
-                        else:
-                            data["direction"] = None
-                    elif direction:
-                        data["direction"] = direction
-                    else:
-                        data["direction"] = None
-                else:
-                    # Si no hay direction pero hay países, intentar determinarlo
-                    pais_origen = (data.get("pais_origen") or "").upper() if data.get("pais_origen") else ""
-                    pais_destino = (data.get("pais_destino") or "").upper() if data.get("pais_destino") else ""
-                    if pais_origen == "ES" and pais_destino and pais_destino != "ES":
-                        data["direction"] = "export"
-                    elif pais_origen and pais_origen != "ES" and pais_destino == "ES":
-                        data["direction"] = "import"
-                
-                # Validar incoterm - SIEMPRE mapear CIF, FOB, CFR antes de guardar
-                if data.get("incoterm"):
-                    try:
-                        incoterm = str(data["incoterm"]).upper().strip() if data["incoterm"] else None
-                        if incoterm:
-                            incoterm_map = {
-                                "FOB": "FCA",
-                                "CIF": "CIP",
-                                "CFR": "CPT",
-                            }
-                            valid_incoterms = ["EXW", "FCA", "CPT", "CIP", "DAP", "DPU", "DDP"]
-                            
-                            # PRIMERO aplicar mapeo si es necesario
-                            if incoterm in incoterm_map:
-                                data["incoterm"] = incoterm_map[incoterm]
-                            # LUEGO validar
-                            elif incoterm not in valid_incoterms:
-                                # Si no es válido y no se puede mapear, poner None para que no se escriba
-                                _logger.warning("Incoterm '%s' no es válido y no se puede mapear. No se asignará.", incoterm)
-                                data["incoterm"] = None
-                            else:
-                                data["incoterm"] = incoterm
-                        else:
-                            data["incoterm"] = None
-                    except (AttributeError, TypeError) as e:
-                        _logger.warning("Error procesando incoterm '%s': %s", data.get("incoterm"), e)
-                        data["incoterm"] = None
-                
-                # Normalizar valores numéricos
-                if data.get("valor_total"):
-                    try:
-                        if isinstance(data["valor_total"], str):
-                            # Convertir formato español a decimal
-                            data["valor_total"] = float(data["valor_total"].replace('.', '').replace(',', '.'))
-                        else:
-                            data["valor_total"] = float(data["valor_total"])
-                    except:
-                        data["valor_total"] = None
-                
-                # Normalizar líneas y filtrar productos de pedidos pendientes
-                lineas_validas = []
-                for linea in data.get("lineas", []):
-                    # Filtrar productos que puedan ser de pedidos pendientes
-                    descripcion = linea.get("descripcion", "").lower()
-                    # Si la descripción contiene indicadores de pedido pendiente, saltar
-                    if any(palabra in descripcion for palabra in ["pedido pendiente", "pendiente", "pending order"]):
-                        _logger.info("Ignorando línea con descripción de pedido pendiente: %s", linea.get("descripcion"))
-                        continue
-                    # Normalizar cantidad y unidades
-                    if linea.get("cantidad"):
-                        try:
-                            if isinstance(linea["cantidad"], str):
-                                linea["cantidad"] = float(linea["cantidad"].replace(',', '.'))
-                            else:
-                                linea["cantidad"] = float(linea["cantidad"])
-                            if not linea.get("unidades"):
-                                linea["unidades"] = linea["cantidad"]
-                        except:
-                            pass
-                    
-                    # Normalizar precios
-                    for campo_precio in ["precio_unitario", "total", "subtotal"]:
-                        if linea.get(campo_precio):
-                            try:
-                                if isinstance(linea[campo_precio], str):
-                                    linea[campo_precio] = float(linea[campo_precio].replace('.', '').replace(',', '.'))
-                                else:
-                                    linea[campo_precio] = float(linea[campo_precio])
-                            except:
-                                linea[campo_precio] = None
-                    
-                    # Normalizar descuento
-                    if linea.get("descuento"):
-                        try:
-                            if isinstance(linea["descuento"], str):
-                                # Puede venir como "64,00%" o "64.00" o "64"
-                                descuento_str = linea["descuento"].replace('%', '').replace(',', '.')
-                                linea["descuento"] = float(descuento_str)
-                            else:
-                                linea["descuento"] = float(linea["descuento"])
-                        except:
-                            linea["descuento"] = None
-                    
-                    # Normalizar pesos
-                    for campo_peso in ["peso_bruto", "peso_neto"]:
-                        if linea.get(campo_peso):
-                            try:
-                                if isinstance(linea[campo_peso], str):
-                                    linea[campo_peso] = float(linea[campo_peso].replace(',', '.'))
-                                else:
-                                    linea[campo_peso] = float(linea[campo_peso])
-                            except:
-                                linea[campo_peso] = None
-                    
-                    # Normalizar bultos
-                    if linea.get("bultos"):
-                        try:
-                            if isinstance(linea["bultos"], str):
-                                linea["bultos"] = int(float(linea["bultos"].replace(',', '.')))
-                            else:
-                                linea["bultos"] = int(linea["bultos"])
-                        except:
-                            linea["bultos"] = None
-                    
-                    # Normalizar partida arancelaria (asegurar formato correcto)
-                    if linea.get("partida"):
-                        partida = str(linea["partida"]).strip()
-                        # Limpiar espacios y caracteres no numéricos
-                        partida = ''.join(filter(str.isdigit, partida))
-                        if partida:
-                            # Asegurar que tenga al menos 8 dígitos
-                            if len(partida) < 8:
-                                partida = partida.zfill(8)
-                            # Truncar si tiene más de 10
-                            if len(partida) > 10:
-                                partida = partida[:10]
-                            linea["partida"] = partida
-                        else:
-                            linea["partida"] = None
-                    else:
-                        _logger.warning("Línea sin partida arancelaria: %s", linea.get("descripcion"))
-                    
-                    lineas_validas.append(linea)
-                
-                # Reemplazar lineas con las válidas
-                data["lineas"] = lineas_validas
+                data = self._normalize_interpreted_data(data)
                 
                 _logger.info("Datos estructurados validados: %d líneas extraídas", len(data.get("lineas", [])))
                 return data
@@ -1099,10 +1181,240 @@ TEXTO COMPLETO DE LA FACTURA (todas las páginas):
             _logger.exception("Error al interpretar texto con GPT-4o: %s", e)
             return None
 
-    def _parse_invoice_text(self, text):
+    def _interpret_chunked(self, client, api_key, pages, settings):
+        """
+        Interpretación map-reduce de facturas largas: la cabecera y los totales se piden con la
+        primera y la última página, y las líneas de cada fragmento (split_transcript, cortes por
+        página o tabla) en paralelo con el limitador compartido con la transcripción. La fusión
+        (merge_chunk_lines) quita filas de arrastre y reconcile_lines compara la suma con
+        valor_total, quitando las filas repetidas en los cortes solo si así cuadra; el
+        resultado va en "reconciliacion".
+        Lanza excepción si falla la cabecera o algún fragmento (el llamante reintenta en una llamada).
+        """
+        chunks = split_transcript(pages, settings["interpret_chunk_chars"])
+        limiter = get_rate_limiter(api_key, settings["requests_per_minute"])
+        num_pages = pages[-1][0]
+        timeout, max_retries = settings["interpret_timeout"], settings["max_retries"]
+        header_prompt = HEADER_PROMPT.format(
+            num_pages=num_pages,
+            first_page=pages[0][1][:settings["interpret_chunk_chars"]],
+            last_page=pages[-1][1][-settings["interpret_chunk_chars"]:],
+        )
+        start = time.monotonic()
+        workers = min(settings["max_workers"], len(chunks) + 1)
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr_interpret")
+        try:
+            header_future = executor.submit(
+                complete_json, client, limiter, CHUNK_SYSTEM_PROMPT, header_prompt, "cabecera",
+                max_tokens=2000, timeout=timeout, max_retries=max_retries,
+            )
+            chunk_futures = [
+                executor.submit(
+                    complete_json, client, limiter, CHUNK_SYSTEM_PROMPT,
+                    LINES_PROMPT.format(first_page=chunk["first_page"], last_page=chunk["last_page"],
+                                        num_pages=num_pages, text=chunk["text"]),
+                    "fragmento %d (págs. %d-%d)" % (index + 1, chunk["first_page"], chunk["last_page"]),
+                    timeout=timeout, max_retries=max_retries,
+                )
+                for index, chunk in enumerate(chunks)
+            ]
+            header = header_future.result()
+            chunk_lines = []
+            for future in chunk_futures:
+                lineas = future.result().get("lineas")
+                chunk_lines.append(lineas if isinstance(lineas, list) else [])
+        except BaseException:
+            # Cancelar los fragmentos aún en cola y no esperar a los que están en curso:
+            # el llamante reintenta en una sola llamada sin aguantar toda la fase map
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        header.pop("lineas", None)
+        lineas, carry_over, boundary = merge_chunk_lines(chunk_lines)
+        data = self._normalize_interpreted_data(dict(header, lineas=lineas))
+        data["lineas"], data["reconciliacion"] = reconcile_lines(
+            data["lineas"], data.get("valor_total"), boundary=boundary,
+        )
+        data["reconciliacion"].update(fragmentos=len(chunks), filas_arrastre=carry_over, filas_corte=len(boundary))
+        _logger.info(
+            "Interpretación por fragmentos en %.1f s: %d fragmento(s), %d líneas (%d de arrastre descartadas, "
+            "%d de %d repetidas en cortes quitadas), suma %.2f frente a total %s%s",
+            time.monotonic() - start, len(chunks), len(data["lineas"]), carry_over,
+            data["reconciliacion"]["corte_quitadas"], len(boundary),
+            data["reconciliacion"]["suma_lineas"], data["reconciliacion"]["valor_total"],
+            "" if data["reconciliacion"]["cuadra"] is not False else " — NO CUADRA",
+        )
+        return data
+
+    def _normalize_interpreted_data(self, data):
+        """
+        Normaliza el JSON devuelto por GPT-4o: direction, incoterm (CIF/FOB/CFR mapeados),
+        importes y pesos en formato español, partidas arancelarias y líneas de pedidos
+        pendientes descartadas. Modifica y devuelve data.
+        """
+        # Asegurar que lineas es una lista
+        if "lineas" in data and not isinstance(data["lineas"], list):
+            data["lineas"] = []
+
+        # Validar y normalizar direction (sentido)
+        if data.get("direction"):
+            direction = str(data["direction"]).lower() if data["direction"] else None
+            if direction and direction not in ["export", "import"]:
+                # Intentar determinar basándose en países
+                pais_origen = (data.get("pais_origen") or "").upper() if data.get("pais_origen") else ""
+                pais_destino = (data.get("pais_destino") or "").upper() if data.get("pais_destino") else ""
+                if pais_origen == "ES" and pais_destino and pais_destino != "ES":
+                    data["direction"] = "export"
+                elif pais_origen and pais_origen != "ES" and pais_destino == "ES":
+                    data["direction"] = "import"
+                else:
+                    data["direction"] = None
+            elif direction:
+                data["direction"] = direction
+            else:
+                data["direction"] = None
+        else:
+            # Si no hay direction pero hay países, intentar determinarlo
+            pais_origen = (data.get("pais_origen") or "").upper() if data.get("pais_origen") else ""
+            pais_destino = (data.get("pais_destino") or "").upper() if data.get("pais_destino") else ""
+            if pais_origen == "ES" and pais_destino and pais_destino != "ES":
+                data["direction"] = "export"
+            elif pais_origen and pais_origen != "ES" and pais_destino == "ES":
+                data["direction"] = "import"
+
+        # Validar incoterm - SIEMPRE mapear CIF, FOB, CFR antes de guardar
+        if data.get("incoterm"):
+            try:
+                incoterm = str(data["incoterm"]).upper().strip() if data["incoterm"] else None
+                if incoterm:
+                    incoterm_map = {
+                        "FOB": "FCA",
+                        "CIF": "CIP",
+                        "CFR": "CPT",
+                    }
+                    valid_incoterms = ["EXW", "FCA", "CPT", "CIP", "DAP", "DPU", "DDP"]
+
+                    # PRIMERO aplicar mapeo si es necesario
+                    if incoterm in incoterm_map:
+                        data["incoterm"] = incoterm_map[incoterm]
+                    # LUEGO validar
+                    elif incoterm not in valid_incoterms:
+                        # Si no es válido y no se puede mapear, poner None para que no se escriba
+                        _logger.warning("Incoterm '%s' no es válido y no se puede mapear. No se asignará.", incoterm)
+                        data["incoterm"] = None
+                    else:
+                        data["incoterm"] = incoterm
+                else:
+                    data["incoterm"] = None
+            except (AttributeError, TypeError) as e:
+                _logger.warning("Error procesando incoterm '%s': %s", data.get("incoterm"), e)
+                data["incoterm"] = None
+
+        # Normalizar valores numéricos
+        if data.get("valor_total"):
+            try:
+                if isinstance(data["valor_total"], str):
+                    # Convertir formato español a decimal
+                    data["valor_total"] = float(data["valor_total"].replace('.', '').replace(',', '.'))
+                else:
+                    data["valor_total"] = float(data["valor_total"])
+            except:
+                data["valor_total"] = None
+
+        # Normalizar líneas y filtrar productos de pedidos pendientes
+        lineas_validas = []
+        for linea in data.get("lineas", []):
+            # Filtrar productos que puedan ser de pedidos pendientes
+            descripcion = linea.get("descripcion", "").lower()
+            # Si la descripción contiene indicadores de pedido pendiente, saltar
+            if any(palabra in descripcion for palabra in ["pedido pendiente", "pendiente", "pending order"]):
+                _logger.info("Ignorando línea con descripción de pedido pendiente: %s", linea.get("descripcion"))
+                continue
+            # Normalizar cantidad y unidades
+            if linea.get("cantidad"):
+                try:
+                    if isinstance(linea["cantidad"], str):
+                        linea["cantidad"] = float(linea["cantidad"].replace(',', '.'))
+                    else:
+                        linea["cantidad"] = float(linea["cantidad"])
+                    if not linea.get("unidades"):
+                        linea["unidades"] = linea["cantidad"]
+                except:
+                    pass
+
+            # Normalizar precios
+            for campo_precio in ["precio_unitario", "total", "subtotal"]:
+                if linea.get(campo_precio):
+                    try:
+                        if isinstance(linea[campo_precio], str):
+                            linea[campo_precio] = float(linea[campo_precio].replace('.', '').replace(',', '.'))
+                        else:
+                            linea[campo_precio] = float(linea[campo_precio])
+                    except:
+                        linea[campo_precio] = None
+
+            # Normalizar descuento
+            if linea.get("descuento"):
+                try:
+                    if isinstance(linea["descuento"], str):
+                        # Puede venir como "64,00%" o "64.00" o "64"
+                        descuento_str = linea["descuento"].replace('%', '').replace(',', '.')
+                        linea["descuento"] = float(descuento_str)
+                    else:
+                        linea["descuento"] = float(linea["descuento"])
+                except:
+                    linea["descuento"] = None
+
+            # Normalizar pesos
+            for campo_peso in ["peso_bruto", "peso_neto"]:
+                if linea.get(campo_peso):
+                    try:
+                        if isinstance(linea[campo_peso], str):
+                            linea[campo_peso] = float(linea[campo_peso].replace(',', '.'))
+                        else:
+                            linea[campo_peso] = float(linea[campo_peso])
+                    except:
+                        linea[campo_peso] = None
+
+            # Normalizar bultos
+            if linea.get("bultos"):
+                try:
+                    if isinstance(linea["bultos"], str):
+                        linea["bultos"] = int(float(linea["bultos"].replace(',', '.')))
+                    else:
+                        linea["bultos"] = int(linea["bultos"])
+                except:
+                    linea["bultos"] = None
+
+            # Normalizar partida arancelaria (asegurar formato correcto)
+            if linea.get("partida"):
+                partida = str(linea["partida"]).strip()
+                # Limpiar espacios y caracteres no numéricos
+                partida = ''.join(filter(str.isdigit, partida))
+                if partida:
+                    # Asegurar que tenga al menos 8 dígitos
+                    if len(partida) < 8:
+                        partida = partida.zfill(8)
+                    # Truncar si tiene más de 10
+                    if len(partida) > 10:
+                        partida = partida[:10]
+                    linea["partida"] = partida
+                else:
+                    linea["partida"] = None
+            else:
+                _logger.warning("Línea sin partida arancelaria: %s", linea.get("descripcion"))
+
+            lineas_validas.append(linea)
+
+        # Reemplazar lineas con las válidas
+        data["lineas"] = lineas_validas
+        return data
+
+    def _parse_invoice_text(self, text, lineas=None):
         """
         Parsea el texto extraído de la factura y extrae información estructurada.
         Usa expresiones regulares y patrones comunes de facturas.
+        Si se pasan lineas (tablas del PDF leídas por coordenadas) no se buscan en el texto.
         """
         if not text:
             return {
@@ -1129,189 +1441,12 @@ TEXTO COMPLETO DE LA FACTURA (todas las páginas):
             "direction": None,
         }
         
-        # Buscar número de factura
-        factura_patterns = [
-            r'(?:FACTURA|Invoice|Factura)\s*(?:n[º°]?|N[º°]?|Número|No\.?|#)\s*:?\s*(\d+)',
-            r'N[º°]?\s*FACTURA\s*:?\s*(\d+)',
-            r'Factura\s+n[º°]?\s*:?\s*(\d+)',
-            r'Factura\s+([A-Z0-9\-/]+)',
-        ]
-        for pattern in factura_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                data["numero_factura"] = match.group(1).strip()
-                break
-        
-        # Buscar fecha (priorizar fechas después de "Factura" o "de")
-        fecha_patterns = [
-            r'(?:Factura\s+n[º°]?:\s*\d+\s+de\s+|Fecha|Date)\s*:?\s*(\d{1,2}[\./]\d{1,2}[\./]\d{2,4})',
-            r'(\d{1,2}[\./]\d{1,2}[\./]\d{2,4})',
-        ]
-        for pattern in fecha_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                data["fecha_factura"] = match.group(1).strip()
-                break
-        
-        # Buscar NIF/CIF (formato español y andorrano)
-        # Patrón mejorado para NIF español (A12345678) y andorrano (L123456H)
-        nif_patterns = [
-            r'\b([A-Z]\d{8}[A-Z]?)\b',  # NIF español: A12345678 o A12345678Z
-            r'\b(L\d{6,7}[A-Z]?)\b',    # NIF andorrano: L714949H
-            r'\bNIF[:\s]+([A-Z]?\d{6,8}[A-Z]?)\b',  # NIF: A12345678
-            r'\bC\.I\.F\.?[:\s]+([A-Z]?\d{6,8}[A-Z]?)\b',  # C.I.F.: A12345678
-            r'\bNRT[:\s]+([A-Z]?\d{6,8}[A-Z]?)\b',  # NRT: L714949H
-        ]
-        nifs = []
-        for pattern in nif_patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
-            for match in matches:
-                nif = match.group(1).strip().upper()
-                if nif not in nifs:
-                    nifs.append(nif)
-        
-        if nifs:
-            # Buscar contexto para identificar remitente y consignatario
-            # Remitente suele aparecer primero, cerca de "Motul" o "Propietario"
-            # Consignatario suele aparecer después, cerca de "Destinatario" o "Cliente"
-            text_lower = text.lower()
-            for nif in nifs:
-                # Buscar contexto alrededor del NIF
-                nif_pos = text.upper().find(nif.upper())
-                if nif_pos > 0:
-                    context = text[max(0, nif_pos-100):nif_pos+100].lower()
-                    if any(word in context for word in ['propietario', 'motul', 'remitente', 'emisor']):
-                        if not data["remitente_nif"]:
-                            data["remitente_nif"] = nif
-                    elif any(word in context for word in ['destinatario', 'consignatario', 'cliente', 'multi retail']):
-                        if not data["consignatario_nif"]:
-                            data["consignatario_nif"] = nif
-            
-            # Si no se identificaron por contexto, usar orden de aparición
-            if not data["remitente_nif"] and len(nifs) >= 1:
-                data["remitente_nif"] = nifs[0]
-            if not data["consignatario_nif"] and len(nifs) >= 2:
-                data["consignatario_nif"] = nifs[1]
-            elif not data["consignatario_nif"] and len(nifs) >= 1:
-                # Si solo hay un NIF y no se identificó remitente, puede ser consignatario
-                if not data["remitente_nif"]:
-                    data["remitente_nif"] = nifs[0]
-        
-        # Buscar importe total (priorizar "Total Factura" o "Importe Neto")
-        total_patterns = [
-            r'(?:TOTAL\s+FACTURA|Total\s+Factura|Importe\s+Neto\s+2)\s*:?\s*([\d.,]+)',
-            r'(?:TOTAL|Total|Importe Total|Amount)\s*:?\s*([\d.,]+)\s*([A-Z]{3})?',
-            r'([\d.,]+)\s*(?:EUR|€|USD|\$)',
-        ]
-        for pattern in total_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                valor_str = match.group(1).replace('.', '').replace(',', '.')  # Formato español: 2.195,42
-                try:
-                    data["valor_total"] = float(valor_str)
-                except:
-                    pass
-                if match.lastindex >= 2 and match.group(2):
-                    data["moneda"] = match.group(2).upper()
-                break
-        
-        # Buscar nombres de empresas (patrones mejorados)
-        # Remitente: buscar después de "Propietario:", "Motul", o al inicio del documento
-        remitente_patterns = [
-            r'Propietario:\s*([A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]+?)(?:\n|C/|CIF|Tel\.)',
-            r'(Motul\s+Ibérica\s+SA?[A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]*?)(?:\n|C/|CIF|Tel\.)',
-        ]
-        for pattern in remitente_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                nombre = match.group(1).strip()
-                # Limpiar nombre (quitar espacios múltiples, saltos de línea)
-                nombre = re.sub(r'\s+', ' ', nombre).strip()
-                data["remitente_nombre"] = nombre[:100]
-                break
-        
-        # Consignatario: buscar después de "Destinatario:", "DIRECCION ENTREGA", "Cliente N°"
-        consignatario_patterns = [
-            r'Destinatario:\s*([A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]+?)(?:\n|NIF|NRT|Tel\.)',
-            r'DIRECCION\s+ENTREGA\s+[0-9]+:\s*([A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]+?)(?:\n|NRT|NIF)',
-            r'(?:Cliente\s+N[º°]?|Cliente:)\s*[0-9]+\s*([A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]+?)(?:\n|NRT|NIF)',
-            r'(MULTI\s+RETAIL\s+TRADE[,\s]+S\.L\.U\.[A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]*?)(?:\n|NRT|NIF)',
-        ]
-        for pattern in consignatario_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                nombre = match.group(1).strip()
-                # Limpiar nombre
-                nombre = re.sub(r'\s+', ' ', nombre).strip()
-                data["consignatario_nombre"] = nombre[:100]
-                break
-        
-        # Buscar Incoterm
-        incoterm_pattern = r'\b(EXW|FCA|CPT|CIP|DAP|DPU|DDP|FOB|CFR|CIF)\b'
-        match = re.search(incoterm_pattern, text, re.IGNORECASE)
-        if match:
-            data["incoterm"] = match.group(1).upper()
-        
-        # Buscar países (códigos ISO comunes y nombres de países)
-        # Buscar por contexto: España como lado UE y cualquier país tercero frecuente.
-        pais_origen_patterns = [
-            r'(?:Origen|Origin|From|España|Spain|Español)\s*:?\s*([A-Z]{2})',
-            r'\b(ES|ESPAÑA|SPAIN)\b',
-        ]
-        for pattern in pais_origen_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                pais = match.group(1).upper()[:2]
-                if pais == 'ES' or 'ESPAÑA' in pais or 'SPAIN' in pais:
-                    data["pais_origen"] = "ES"
-                    break
-        
-        pais_destino_patterns = [
-            r'(?:Destino|Destination|To)\s*:?\s*([A-Z]{2})',
-            r'\b(AD|ANDORRA|CH|SWITZERLAND|SUIZA|GB|UNITED KINGDOM|UK|MA|MOROCCO|MARRUECOS)\b',
-        ]
-        for pattern in pais_destino_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                pais = match.group(1).upper()
-                if pais in ("ANDORRA", "AD"):
-                    data["pais_destino"] = "AD"
-                    break
-                if pais in ("SWITZERLAND", "SUIZA", "CH"):
-                    data["pais_destino"] = "CH"
-                    break
-                if pais in ("UNITED KINGDOM", "UK", "GB"):
-                    data["pais_destino"] = "GB"
-                    break
-                if pais in ("MOROCCO", "MARRUECOS", "MA"):
-                    data["pais_destino"] = "MA"
-                    break
-        
-        # Si no se encontraron por contexto, buscar códigos ISO en el texto
-        if not data["pais_origen"] or not data["pais_destino"]:
-            pais_pattern = r'\b(ES|AD|FR|PT|DE|IT|GB|US|CH|MA)\b'
-            paises = re.findall(pais_pattern, text)
-            if paises:
-                # Filtrar paises que aparecen en direcciones (códigos postales)
-                paises_validos = []
-                for pais in paises:
-                    # Evitar falsos positivos (códigos que aparecen en otros contextos)
-                    if pais in ['ES', 'AD', 'FR', 'PT', 'DE', 'IT', 'GB', 'US', 'CH', 'MA']:
-                        paises_validos.append(pais)
-                
-                if paises_validos:
-                    # Si hay "ANDORRA" en el texto, el destino es AD
-                    if 'ANDORRA' in text.upper() or 'AD500' in text.upper():
-                        data["pais_destino"] = "AD"
-                    # Si hay "Barcelona" o "España" en el texto, el origen es ES
-                    if 'BARCELONA' in text.upper() or 'ESPAÑA' in text.upper() or 'SPAIN' in text.upper():
-                        data["pais_origen"] = "ES"
-                    
-                    # Valores por defecto si no se encontraron, sin asumir Andorra.
-                    if not data["pais_origen"]:
-                        data["pais_origen"] = paises_validos[0] if len(paises_validos) > 0 else "ES"
-                    if not data["pais_destino"]:
-                        data["pais_destino"] = paises_validos[1] if len(paises_validos) > 1 else None
+        # Cabecera: número, fecha, NIF/CIF/NRT, total, nombres, incoterm y países en un único recorrido
+        header = extract_header(text)
+        moneda = header.pop("moneda")
+        data.update(header)
+        if moneda:
+            data["moneda"] = moneda
         
         # Determinar direction (sentido) basándose en países
         pais_origen = (data.get("pais_origen") or "").upper() if data.get("pais_origen") else ""
@@ -1324,8 +1459,8 @@ TEXTO COMPLETO DE LA FACTURA (todas las páginas):
             data["direction"] = None
         
         # Intentar extraer líneas de productos
-        # Buscar patrones comunes de tablas de factura
-        lineas = self._extract_invoice_lines(text)
+        # Buscar patrones comunes de tablas de factura (salvo que ya vengan de las tablas del PDF)
+        lineas = lineas or self._extract_invoice_lines(text)
         if lineas:
             data["lineas"] = lineas
         
@@ -1339,83 +1474,8 @@ TEXTO COMPLETO DE LA FACTURA (todas las páginas):
         lineas = []
         
         # Método 1: Buscar formato estructurado con etiquetas **Artículo:**, **Descripción:**, etc.
-        # Este formato es común en facturas procesadas por OCR/IA
-        # Patrones flexibles que aceptan asteriscos o sin ellos
-        articulo_pattern = r'(?:\*\*)?Artículo(?:\*\*)?\s*:?\s*(\d+)'
-        descripcion_pattern = r'(?:\*\*)?Descripción(?:\*\*)?\s*:?\s*([^\n]+?)(?=\n(?:\*\*)?[A-Z]|\n\n|$)'
-        cantidad_pattern = r'(?:\*\*)?Cantidad\s+Expedición(?:\*\*)?\s*:?\s*(\d+[.,]?\d*)\s*([A-Z/]+)?'
-        importe_pattern = r'(?:\*\*)?Importe\s+\(EUR\)(?:\*\*)?\s*:?\s*([\d.,]+)'
-        importe_neto_pattern = r'(?:\*\*)?Importe\s+Neto\s+2(?:\*\*)?\s*:?\s*([\d.,]+)'
-        hs_pattern = r'(?:\*\*)?H\.S\.(?:\*\*)?\s*:?\s*(\d+)'
-        
-        # Buscar todas las ocurrencias de artículos
-        articulos = list(re.finditer(articulo_pattern, text, re.IGNORECASE))
-        
-        for articulo_match in articulos:
-            articulo_pos = articulo_match.start()
-            # Buscar descripción, cantidad e importe después de este artículo
-            texto_desde_articulo = text[articulo_pos:articulo_pos+2000]  # Buscar en los siguientes 2000 caracteres
-            
-            linea = {
-                "articulo": articulo_match.group(1).strip(),
-                "descripcion": None,
-                "cantidad": None,
-                "unidades": None,
-                "precio_unitario": None,
-                "total": None,
-                "partida": None,
-            }
-            
-            # Buscar descripción
-            desc_match = re.search(descripcion_pattern, texto_desde_articulo, re.IGNORECASE)
-            if desc_match:
-                linea["descripcion"] = desc_match.group(1).strip()
-            
-            # Buscar cantidad
-            cant_match = re.search(cantidad_pattern, texto_desde_articulo, re.IGNORECASE)
-            if cant_match:
-                try:
-                    cantidad_str = cant_match.group(1).replace(',', '.')
-                    cantidad = float(cantidad_str)
-                    linea["cantidad"] = cantidad
-                    linea["unidades"] = cantidad
-                except:
-                    pass
-            
-            # Buscar importe total
-            importe_match = re.search(importe_pattern, texto_desde_articulo, re.IGNORECASE)
-            if importe_match:
-                try:
-                    importe_str = importe_match.group(1).replace('.', '').replace(',', '.')
-                    importe = float(importe_str)
-                    linea["total"] = importe
-                    # Calcular precio unitario si hay cantidad
-                    if linea.get("cantidad") and linea["cantidad"] > 0:
-                        linea["precio_unitario"] = importe / linea["cantidad"]
-                except:
-                    pass
-            
-            # Si no hay importe total, buscar importe neto
-            if not linea.get("total"):
-                importe_neto_match = re.search(importe_neto_pattern, texto_desde_articulo, re.IGNORECASE)
-                if importe_neto_match:
-                    try:
-                        importe_str = importe_neto_match.group(1).replace('.', '').replace(',', '.')
-                        importe = float(importe_str)
-                        linea["total"] = importe
-                        if linea.get("cantidad") and linea["cantidad"] > 0:
-                            linea["precio_unitario"] = importe / linea["cantidad"]
-                    except:
-                        pass
-            
-            # Buscar partida arancelaria (H.S.)
-            hs_match = re.search(hs_pattern, texto_desde_articulo, re.IGNORECASE)
-            if hs_match:
-                linea["partida"] = hs_match.group(1).strip()
-            
-            # Solo agregar si tiene al menos descripción y cantidad
-            if linea.get("descripcion") and linea.get("cantidad"):
-                lineas.append(linea)
+        # Este formato es común en facturas procesadas por OCR/IA (un único recorrido del texto)
+        lineas.extend(extract_labelled_lines(text))
         
         # Método 2: Buscar formato tabla (ARTICULO DESCRIPCION BULTOS PESO)
         # Buscar todas las ocurrencias en todo el texto, no solo la primera
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Interpretación por fragmentos (map-reduce) de facturas largas. La transcripción se divide
+por páginas (y, dentro de una página demasiado grande, por bloques separados por líneas en
+blanco, que suelen coincidir con tablas); cada fragmento se envía a GPT-4o solo para extraer
+líneas y la cabecera/totales se piden aparte con la primera y la última página. La fusión es
+determinista: quita las filas de arrastre ("suma y sigue"), comprueba la suma de las líneas
+contra valor_total y solo quita las filas repetidas en el corte entre fragmentos si así cuadra.
+Sin ORM: se usa desde los hilos del pool.
+"""
+import re
+import unicodedata
+
+# Filas de arrastre entre páginas: no son artículos
+CARRY_OVER_RE = re.compile(
+    r"\b(suma\s+y\s+sigue|suma\s+anterior|sumas?\s+y\s+siguen?|a\s+trasladar|de\s+la\s+p[aá]gina\s+anterior|"
+    r"carried\s+forward|brought\s+forward|report\s+[aà]\s+nouveau|[aà]\s+reporter|[uü]bertrag)\b",
+    re.IGNORECASE,
+)
+
+# Tolerancia de la conciliación: max(1 % de valor_total, 1 unidad)
+RECONCILE_REL_TOLERANCE = 0.01
+RECONCILE_ABS_TOLERANCE = 1.0
+
+CHUNK_SYSTEM_PROMPT = (
+    "Eres un experto en extracción de datos de facturas comerciales. Siempre devuelves JSON "
+    "válido y estructurado. Responde ÚNICAMENTE con JSON, sin explicaciones ni texto adicional."
+)
+
+HEADER_PROMPT = """Eres un experto en procesamiento de facturas comerciales para documentos aduaneros.
+Recibes la PRIMERA y la ÚLTIMA página de una factura de {num_pages} páginas. Extrae SOLO los datos de
+cabecera y totales (las líneas de producto se extraen aparte).
+
+FORMATO DE RESPUESTA REQUERIDO (JSON válido, sin markdown):
+{{
+  "numero_factura": "número o null",
+  "fecha_factura": "DD.MM.YYYY o DD/MM/YYYY o null",
+  "remitente_nombre": "nombre completo de la empresa emisora o null",
+  "remitente_nif": "NIF/CIF español (formato A12345678) o NIF andorrano (L123456H) o null",
+  "remitente_direccion": "dirección completa o null",
+  "consignatario_nombre": "nombre completo del destinatario o null",
+  "consignatario_nif": "NIF/CIF o null",
+  "consignatario_direccion": "dirección completa o null",
+  "valor_total": número decimal o null (total de la factura, normalmente en la última página),
+  "moneda": "EUR" o "USD" o null,
+  "incoterm": "EXW", "FCA", "CPT", "CIP", "DAP", "DPU", "DDP" o null (CIF → CIP, FOB → FCA, CFR → CPT),
+  "pais_origen": "código ISO de 2 letras o null",
+  "pais_destino": "código ISO de 2 letras o null",
+  "direction": "export" (España → país tercero), "import" (país tercero → España) o null,
+  "transportista": "nombre del transportista o null",
+  "matricula": "matrícula del vehículo o null",
+  "referencia_transporte": "referencia o número de transporte o null",
+  "remolque": "matrícula del remolque o null",
+  "codigo_transporte": "código del transporte o null"
+}}
+
+Valores monetarios en formato español (2.195,42 → 2195.42). Si un campo no aparece, usa null.
+
+PRIMERA PÁGINA:
+{first_page}
+
+ÚLTIMA PÁGINA:
+{last_page}
+"""
+
+LINES_PROMPT = """Eres un experto en procesamiento de facturas comerciales para documentos aduaneros.
+Recibes un FRAGMENTO (páginas {first_page} a {last_page} de {num_pages}) de una factura. Extrae TODAS las
+líneas de producto que aparecen en este fragmento, en el orden del documento.
+
+- NO incluyas filas de arrastre ("Suma y sigue", "Suma anterior", "A trasladar", "Carried forward"),
+  subtotales de página, totales, impuestos ni portes.
+- NO incluyas productos de secciones "Pedido pendiente" / "Pedidos pendientes".
+- Si una línea empieza en el fragmento y continúa fuera de él, inclúyela con los datos visibles.
+- Para el código H.S. (partida arancelaria) busca "H.S.", "HS", "Partida arancelaria" (8-10 dígitos).
+- Valores monetarios en formato español (2.195,42 → 2195.42).
+
+FORMATO DE RESPUESTA REQUERIDO (JSON válido, sin markdown):
+{{
+  "lineas": [
+    {{
+      "articulo": "código del artículo o null",
+      "descripcion": "descripción completa del producto",
+      "cantidad": número decimal,
+      "unidades": número decimal (igual que cantidad),
+      "precio_unitario": número decimal o null,
+      "total": número decimal o null,
+      "subtotal": número decimal o null (subtotal de la línea con descuento aplicado),
+      "descuento": número decimal (porcentaje de descuento) o null,
+      "partida": "código H.S. (8-10 dígitos) o null",
+      "bultos": número entero o null,
+      "peso_bruto": número decimal en KG o null,
+      "peso_neto": número decimal en KG o null
+    }}
+  ]
+}}
+Si el fragmento no contiene líneas de producto devuelve {{"lineas": []}}.
+
+FRAGMENTO:
+{text}
+"""
+
+
+def _split_block(text, max_chars):
+    """Corta un texto mayor que max_chars por líneas en blanco (tablas) y, si no basta, por filas."""
+    pieces = []
+    for separator in ("\n\n", "\n"):
+        parts = text.split(separator)
+        if len(parts) > 1:
+            break
+    else:
+        return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+    current = ""
+    for part in parts:
+        if len(part) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.extend(_split_block(part, max_chars))
+            continue
+        if current and len(current) + len(separator) + len(part) > max_chars:
+            pieces.append(current)
+            current = part
+        else:
+            current = current + separator + part if current else part
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_transcript(pages, max_chars):
+    """
+    Agrupa las páginas [(número, texto)] en fragmentos de como mucho max_chars sin partir
+    páginas; una página mayor que max_chars se divide en bloques (_split_block).
+    Devuelve [{"first_page", "last_page", "text"}] en el orden del documento.
+    """
+    chunks = []
+    current = None
+    for number, text in pages:
+        text = (text or "").strip()
+        if not text:
+            continue
+        if len(text) > max_chars:
+            if current:
+                chunks.append(current)
+                current = None
+            chunks.extend({"first_page": number, "last_page": number, "text": block}
+                          for block in _split_block(text, max_chars))
+            continue
+        if current and len(current["text"]) + 2 + len(text) <= max_chars:
+            current["text"] += "\n\n" + text
+            current["last_page"] = number
+        else:
+            if current:
+                chunks.append(current)
+            current = {"first_page": number, "last_page": number, "text": text}
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _norm_text(value):
+    value = unicodedata.normalize("NFKD", "%s" % (value or ""))
+    return " ".join("".join(c for c in value if not unicodedata.combining(c)).lower().split())
+
+
+def _number(value):
+    try:
+        return round(float(value), 4) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def line_key(line):
+    """Identidad de una línea para detectar repeticiones: artículo, descripción, cantidad e importe."""
+    return (
+        _norm_text(line.get("articulo")),
+        _norm_text(line.get("descripcion")),
+        _number(line.get("cantidad")),
+        _number(line.get("total") if line.get("total") not in (None, "") else line.get("subtotal")),
+    )
+
+
+def is_carry_over(line):
+    """Fila de arrastre (suma y sigue...) devuelta por error como artículo."""
+    text = "%s %s" % (line.get("articulo") or "", line.get("descripcion") or "")
+    return bool(CARRY_OVER_RE.search(text))
+
+
+def merge_chunk_lines(chunk_lines, max_overlap=3):
+    """
+    Une las líneas de los fragmentos (lista de listas en orden) y descarta las filas de
+    arrastre. Las primeras filas de un fragmento que coinciden en orden con las últimas del
+    anterior (la última fila de una página repetida al principio de la siguiente) se
+    conservan y se devuelven aparte como candidatas: pueden ser líneas reales iguales a ambos
+    lados del corte, y solo reconcile_lines decide quitarlas si así cuadra la suma.
+    Devuelve (lineas, filas de arrastre descartadas, candidatas repetidas en los cortes).
+    """
+    merged = []
+    boundary = []
+    carry_over = 0
+    for lines in chunk_lines:
+        kept = []
+        for line in lines or []:
+            if not isinstance(line, dict):
+                continue
+            if is_carry_over(line):
+                carry_over += 1
+                continue
+            kept.append(line)
+        for overlap in range(min(max_overlap, len(merged), len(kept)), 0, -1):
+            if [line_key(line) for line in merged[-overlap:]] == [line_key(line) for line in kept[:overlap]]:
+                boundary.extend(kept[:overlap])
+                break
+        merged.extend(kept)
+    return merged, carry_over, boundary
+
+
+def line_amount(line):
+    """Importe de la línea: total, subtotal o cantidad × precio unitario (0.0 si no hay datos)."""
+    for field in ("total", "subtotal"):
+        value = _number(line.get(field))
+        if value is not None:
+            return value
+    cantidad = _number(line.get("cantidad"))
+    precio = _number(line.get("precio_unitario"))
+    if cantidad is not None and precio is not None:
+        return cantidad * precio
+    return 0.0
+
+
+def _within(lines, total, tolerance):
+    amount = round(sum(line_amount(line) for line in lines), 2)
+    return amount, abs(amount - total) <= tolerance
+
+
+def reconcile_lines(lines, valor_total, boundary=()):
+    """
+    Compara la suma de las líneas con valor_total (tolerancia max(1 %, 1 unidad)). Si no cuadra
+    se prueba, por este orden, a quitar las candidatas repetidas en los cortes entre
+    fragmentos (boundary, de merge_chunk_lines) y a quitar todas las líneas repetidas (misma
+    line_key); se quitan solo si así cuadra. Devuelve (lineas, informe) con informe =
+    {suma_lineas, valor_total, diferencia, cuadra, corte_quitadas, duplicadas_quitadas};
+    cuadra es None si no hay valor_total con el que comparar.
+    """
+    total = _number(valor_total)
+    amount = round(sum(line_amount(line) for line in lines), 2)
+    report = {"suma_lineas": amount, "valor_total": total, "diferencia": None, "cuadra": None,
+              "corte_quitadas": 0, "duplicadas_quitadas": 0}
+    if not total:
+        return lines, report
+    tolerance = max(abs(total) * RECONCILE_REL_TOLERANCE, RECONCILE_ABS_TOLERANCE)
+    if abs(amount - total) > tolerance and boundary:
+        repeated = {id(line) for line in boundary}
+        trimmed = [line for line in lines if id(line) not in repeated]
+        trimmed_amount, fits = _within(trimmed, total, tolerance)
+        if len(trimmed) < len(lines) and fits:
+            report["corte_quitadas"] = len(lines) - len(trimmed)
+            lines, amount = trimmed, trimmed_amount
+    if abs(amount - total) > tolerance:
+        seen = set()
+        unique = []
+        for line in lines:
+            key = line_key(line)
+            if key in seen:
+                continue
+            seen.add(key)
+            unique.append(line)
+        unique_amount, fits = _within(unique, total, tolerance)
+        if len(unique) < len(lines) and fits:
+            report["duplicadas_quitadas"] = len(lines) - len(unique)
+            lines, amount = unique, unique_amount
+    report["suma_lineas"] = amount
+    report["diferencia"] = round(amount - total, 2)
+    report["cuadra"] = abs(amount - total) <= tolerance
+    return lines, report
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Extracción de la cabecera de factura (ruta sin OpenAI) en un único recorrido del texto.
+
+Todos los patrones se compilan al importar. _TOKEN_RE recorre el texto (en minúsculas) una
+vez y se detiene en las posiciones que pueden iniciar un dato (palabras clave, NIF, números,
+códigos de dos o tres letras); en cada una solo se prueban, anclados en esa posición, los
+patrones de los campos que empiezan así. Cada candidato se guarda con su prioridad (el orden
+de los patrones de antes) y su posición, y gana el de menor (prioridad, posición), que es lo
+que daba buscar los patrones uno tras otro. El papel de cada NIF (remitente o consignatario)
+se decide por las palabras clave a menos de NIF_CONTEXT caracteres de donde apareció, con las
+posiciones ya recogidas y sin volver a recorrer el texto.
+Sin ORM: se usa desde _parse_invoice_text.
+"""
+import bisect
+import re
+
+NIF_CONTEXT = 100
+
+_I = re.IGNORECASE
+_DATE = r"\d{1,2}[./]\d{1,2}[./]\d{2,4}"
+_NAME = r"[A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]"
+
+# Palabra clave (en minúsculas) -> tipo
+_KEYWORD_KINDS = {
+    "factura": "factura", "invoice": "factura",
+    "fecha": "fecha", "date": "fecha",
+    "nif": "nif", "nrt": "nif", "c.i.f": "nif",
+    "total": "total", "importe": "total", "amount": "total",
+    "propietario": "propietario", "motul": "motul", "remitente": "remitente", "emisor": "remitente",
+    "destinatario": "destinatario", "consignatario": "consignatario", "cliente": "cliente",
+    "multi": "multi", "direccion": "direccion_entrega",
+    "españa": "espana", "spain": "espana",
+    "origen": "origen", "origin": "origen", "from": "origen", "español": "origen",
+    "destino": "destino", "destination": "destino", "to": "destino",
+    "andorra": "pais", "switzerland": "pais", "suiza": "pais", "united": "pais", "morocco": "pais",
+    "marruecos": "pais",
+    "barcelona": "barcelona", "ad500": "ad500",
+}
+# Códigos de país e incoterms: solo como palabra completa
+_WORDS = frozenset((
+    "es", "ad", "ch", "gb", "uk", "ma", "de", "fr", "pt", "it", "us",
+    "exw", "fca", "cpt", "cip", "dap", "dpu", "ddp", "fob", "cfr", "cif",
+))
+
+
+def _token_pattern():
+    """
+    Alternancia agrupada por primera letra (a(?:d500|mount|...)|b(?:arcelona)|...): sin grupos
+    con nombre ni IGNORECASE, para que el motor descarte cada posición comparando un solo
+    carácter. Dentro de cada letra las palabras más largas van primero (total antes que to).
+    """
+    groups = {}
+    for literal in sorted(set(_KEYWORD_KINDS) | _WORDS, key=lambda w: (w[0], -len(w), w)):
+        branch = re.escape(literal[1:])
+        if literal in _WORDS:
+            branch += r"\b(?<!\w%s)" % re.escape(literal)
+        groups.setdefault(literal[0], []).append(branch)
+    trie = "|".join("%s(?:%s)" % (re.escape(c), "|".join(branches)) for c, branches in groups.items())
+    return re.compile(r"[a-z]\d{6,8}[a-z]?\b|" + trie + r"|\d(?<![\d.,]\d)[\d.,]*")
+
+
+# Se recorre el texto en minúsculas (misma longitud, mismas posiciones)
+_TOKEN_RE = _token_pattern()
+_LOWER_TABLE = {ord(c): ord(c.lower()) for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZÁÉÍÓÚÑÜ"}
+
+# Patrones anclados por tipo de palabra clave: (campo, prioridad, patrón)
+_ANCHORED = {
+    "n_factura": (
+        ("numero_factura", 1, re.compile(r"N[º°]?\s*FACTURA\s*:?\s*(\d+)", _I)),
+    ),
+    "factura": (
+        ("numero_factura", 0, re.compile(r"(?:FACTURA|Invoice)\s*(?:n[º°]?|Número|No\.?|#)\s*:?\s*(\d+)", _I)),
+        ("numero_factura", 2, re.compile(r"Factura\s+n[º°]?\s*:?\s*(\d+)", _I)),
+        ("numero_factura", 3, re.compile(r"Factura\s+([A-Z0-9\-/]+)", _I)),
+        ("fecha_factura", 0, re.compile(r"Factura\s+n[º°]?:\s*\d+\s+de\s+\s*:?\s*(%s)" % _DATE, _I)),
+    ),
+    "fecha": (
+        ("fecha_factura", 0, re.compile(r"(?:Fecha|Date)\s*:?\s*(%s)" % _DATE, _I)),
+    ),
+    "nif": (
+        ("nif", 2, re.compile(r"NIF[:\s]+([A-Z]?\d{6,8}[A-Z]?)\b", _I)),
+        ("nif", 3, re.compile(r"C\.I\.F\.?[:\s]+([A-Z]?\d{6,8}[A-Z]?)\b", _I)),
+        ("nif", 4, re.compile(r"NRT[:\s]+([A-Z]?\d{6,8}[A-Z]?)\b", _I)),
+    ),
+    "total": (
+        ("valor_total", 0, re.compile(r"(?:TOTAL\s+FACTURA|Importe\s+Neto\s+2)\s*:?\s*([\d.,]+)", _I)),
+        ("valor_total", 1, re.compile(r"(?:TOTAL|Importe Total|Amount)\s*:?\s*([\d.,]+)\s*([A-Z]{3})?", _I)),
+    ),
+    "propietario": (
+        ("remitente_nombre", 0, re.compile(r"Propietario:\s*(%s+?)(?:\n|C/|CIF|Tel\.)" % _NAME, _I)),
+    ),
+    "motul": (
+        ("remitente_nombre", 1, re.compile(r"(Motul\s+Ibérica\s+SA?[A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]*?)(?:\n|C/|CIF|Tel\.)", _I)),
+    ),
+    "destinatario": (
+        ("consignatario_nombre", 0, re.compile(r"Destinatario:\s*(%s+?)(?:\n|NIF|NRT|Tel\.)" % _NAME, _I)),
+    ),
+    "direccion_entrega": (
+        ("consignatario_nombre", 1, re.compile(r"DIRECCION\s+ENTREGA\s+[0-9]+:\s*(%s+?)(?:\n|NRT|NIF)" % _NAME, _I)),
+    ),
+    "cliente": (
+        ("consignatario_nombre", 2, re.compile(r"(?:Cliente\s+N[º°]?|Cliente:)\s*[0-9]+\s*(%s+?)(?:\n|NRT|NIF)" % _NAME, _I)),
+    ),
+    "multi": (
+        ("consignatario_nombre", 3, re.compile(r"(MULTI\s+RETAIL\s+TRADE[,\s]+S\.L\.U\.[A-ZÁÉÍÓÚÑa-záéíóúñ\s,\.]*?)(?:\n|NRT|NIF)", _I)),
+    ),
+    "origen": (
+        ("origen_kw", 0, re.compile(r"(?:Origen|Origin|From|España|Spain|Español)\s*:?\s*([A-Z]{2})", _I)),
+    ),
+    "destino": (
+        ("destino_kw", 0, re.compile(r"(?:Destino|Destination|To)\s*:?\s*([A-Z]{2})", _I)),
+    ),
+}
+_ANCHORED["espana"] = _ANCHORED["origen"]
+_DATE_RE = re.compile(_DATE)
+_AMOUNT_RE = re.compile(r"([\d.,]+)\s*(?:EUR|€|USD|\$)", _I)
+_NIF_ES_RE = re.compile(r"[A-Z]\d{8}[A-Z]?", _I)
+_NIF_AD_RE = re.compile(r"L\d{6,7}[A-Z]?", _I)
+_N_BEFORE_RE = re.compile(r"n[º°]?\s*\Z")
+_SPACES_RE = re.compile(r"\s+")
+_WORD_CHAR_RE = re.compile(r"\w")
+
+# Papel que sugiere cada palabra clave cerca de un NIF
+_SENDER_KEYWORDS = frozenset(("propietario", "motul", "remitente"))
+_CONSIGNEE_KEYWORDS = frozenset(("destinatario", "consignatario", "cliente"))
+INCOTERMS = frozenset(("EXW", "FCA", "CPT", "CIP", "DAP", "DPU", "DDP", "FOB", "CFR", "CIF"))
+ISO_COUNTRIES = ("ES", "AD", "FR", "PT", "DE", "IT", "GB", "US", "CH", "MA")
+_DESTINATION_COUNTRIES = {
+    "AD": "AD", "ANDORRA": "AD",
+    "CH": "CH", "SWITZERLAND": "CH", "SUIZA": "CH",
+    "GB": "GB", "UK": "GB", "UNITED KINGDOM": "GB",
+    "MA": "MA", "MOROCCO": "MA", "MARRUECOS": "MA",
+}
+
+
+def _whole_word(text, start, end):
+    return not (start > 0 and _WORD_CHAR_RE.match(text, start - 1)) and not _WORD_CHAR_RE.match(text, end)
+
+
+def _best(candidates):
+    """Valor del candidato con menor (prioridad, posición) o None."""
+    return min(candidates)[2] if candidates else None
+
+
+def scan_header(text):
+    """
+    Recorre el texto una vez y devuelve los candidatos por campo: {campo: [(prioridad,
+    posición, valor)]}, la posición de las palabras clave de remitente y consignatario,
+    los códigos ISO en mayúsculas en orden y las marcas de Andorra/España/Barcelona.
+    """
+    fields = {}
+    roles = {"remitente": [], "consignatario": []}
+    isos = []
+    flags = set()
+
+    def _add(field, priority, pos, value):
+        fields.setdefault(field, []).append((priority, pos, value))
+
+    folded = text.lower()
+    if len(folded) != len(text):
+        folded = text.translate(_LOWER_TABLE)
+    for token in _TOKEN_RE.finditer(folded):
+        pos, end = token.span()
+        value = token.group()
+        if value[0].isdigit():
+            _match_number(text, pos, _add)
+            continue
+        if value[1].isdigit():
+            # Las cifras del NIF también pueden ser un importe ("A12345678 EUR"), como antes
+            _match_number(text, pos + 1, _add)
+            # NIF/CIF suelto: palabra completa, español (A12345678) o andorrano (L123456H)
+            if pos and _WORD_CHAR_RE.match(folded, pos - 1):
+                continue
+            if _NIF_ES_RE.fullmatch(value):
+                _add("nif", 0, pos, value.upper())
+            elif _NIF_AD_RE.fullmatch(value):
+                _add("nif", 1, pos, value.upper())
+            continue
+        if value in _WORDS:
+            upper = value.upper()
+            if upper in INCOTERMS:
+                _add("incoterm", 0, pos, upper)
+            if upper == "ES":
+                _add("origen_word", 0, pos, upper)
+            elif upper in _DESTINATION_COUNTRIES:
+                _add("pais_destino", 0, pos, _DESTINATION_COUNTRIES[upper])
+            if text[pos:end] in ISO_COUNTRIES:
+                isos.append(text[pos:end])
+            continue
+        kind = _KEYWORD_KINDS[value]
+        if kind == "multi" and folded.startswith("multi retail", pos):
+            roles["consignatario"].append((pos, pos + len("multi retail")))
+        elif kind in _SENDER_KEYWORDS:
+            roles["remitente"].append((pos, end))
+        elif kind in _CONSIGNEE_KEYWORDS:
+            roles["consignatario"].append((pos, end))
+        if kind == "factura":
+            # "Nº FACTURA": el patrón empieza antes de la palabra clave
+            match = _N_BEFORE_RE.search(folded, max(0, pos - 16), pos)
+            if match:
+                _match_anchored(text, "n_factura", match.start(), _add)
+        elif value == "total":
+            # "TOTAL" también empieza por el "To" del patrón de destino
+            _match_anchored(text, "destino", pos, _add)
+        elif kind == "espana":
+            flags.add("espana")
+            if _whole_word(folded, pos, end):
+                _add("origen_word", 0, pos, value.upper()[:2])
+        elif kind == "pais":
+            if value == "united":
+                if not folded.startswith("united kingdom", pos):
+                    continue
+                value = "united kingdom"
+            end = pos + len(value)
+            if value == "andorra":
+                flags.add("andorra")
+            if _whole_word(folded, pos, end):
+                _add("pais_destino", 0, pos, _DESTINATION_COUNTRIES[value.upper()])
+            continue
+        elif kind in ("barcelona", "ad500"):
+            flags.add("barcelona" if kind == "barcelona" else "andorra")
+            continue
+        elif kind == "nif" and pos and _WORD_CHAR_RE.match(folded, pos - 1):
+            continue
+        _match_anchored(text, kind, pos, _add)
+    return fields, roles, isos, flags
+
+
+def _match_number(text, pos, add):
+    """Fecha suelta o importe con moneda que empiezan en pos."""
+    match = _DATE_RE.match(text, pos)
+    if match:
+        add("fecha_factura", 1, pos, match.group(0))
+    match = _AMOUNT_RE.match(text, pos)
+    if match:
+        add("valor_total", 2, pos, (match.group(1), None))
+
+
+def _match_anchored(text, kind, pos, add):
+    """Prueba en pos los patrones anclados del tipo de palabra clave y añade sus candidatos."""
+    for field, priority, pattern in _ANCHORED.get(kind, ()):
+        match = pattern.match(text, pos)
+        if not match:
+            continue
+        if field == "valor_total":
+            add(field, priority, pos, (match.group(1), match.group(2) if pattern.groups > 1 else None))
+        elif field == "nif":
+            add(field, priority, match.start(1), match.group(1).strip().upper())
+        else:
+            add(field, priority, pos, match.group(1))
+
+
+def _near(offsets, pos):
+    """¿Alguna palabra clave (inicio, fin) cabe entera en [pos - NIF_CONTEXT, pos + NIF_CONTEXT]?"""
+    low, high = max(0, pos - NIF_CONTEXT), pos + NIF_CONTEXT
+    index = bisect.bisect_left(offsets, (low, low))
+    return index < len(offsets) and offsets[index][0] < high and any(
+        end <= high for start, end in offsets[index:index + 8] if start < high
+    )
+
+
+def extract_header(text):
+    """
+    Datos de cabecera de la factura: numero_factura, fecha_factura, remitente_nif,
+    consignatario_nif, valor_total, moneda (None si no se indica), remitente_nombre,
+    consignatario_nombre, incoterm, pais_origen y pais_destino (None si no se encuentran).
+    """
+    fields, roles, isos, flags = scan_header(text)
+    data = {
+        "numero_factura": (_best(fields.get("numero_factura")) or "").strip() or None,
+        "fecha_factura": (_best(fields.get("fecha_factura")) or "").strip() or None,
+        "remitente_nif": None,
+        "consignatario_nif": None,
+        "valor_total": None,
+        "moneda": None,
+        "remitente_nombre": None,
+        "consignatario_nombre": None,
+        "incoterm": _best(fields.get("incoterm")),
+        "pais_origen": None,
+        "pais_destino": None,
+    }
+
+    # NIF/CIF/NRT: únicos en el orden de los patrones; papel por las palabras clave cercanas
+    nifs, first_pos = [], {}
+    for _priority, pos, nif in sorted(fields.get("nif", ())):
+        if nif not in first_pos:
+            nifs.append(nif)
+        first_pos[nif] = min(pos, first_pos.get(nif, pos))
+    for nif in nifs:
+        pos = first_pos[nif]
+        if pos <= 0:
+            continue
+        if _near(roles["remitente"], pos):
+            data["remitente_nif"] = data["remitente_nif"] or nif
+        elif _near(roles["consignatario"], pos):
+            data["consignatario_nif"] = data["consignatario_nif"] or nif
+    if nifs and not data["remitente_nif"]:
+        data["remitente_nif"] = nifs[0]
+    if len(nifs) >= 2 and not data["consignatario_nif"]:
+        data["consignatario_nif"] = nifs[1]
+
+    # Importe total (formato español: 2.195,42) y moneda si acompaña al total
+    total = _best(fields.get("valor_total"))
+    if total:
+        try:
+            data["valor_total"] = float(total[0].replace(".", "").replace(",", "."))
+        except ValueError:
+            pass
+        if total[1]:
+            data["moneda"] = total[1].upper()
+
+    for field in ("remitente_nombre", "consignatario_nombre"):
+        nombre = _best(fields.get(field))
+        if nombre:
+            data[field] = _SPACES_RE.sub(" ", nombre).strip()[:100]
+
+    # Países: España como origen, país tercero frecuente como destino
+    # (como antes, solo las dos primeras letras cuentan: "Spain" suelto no fija el origen)
+    origen_kw = _best(fields.get("origen_kw"))
+    if (origen_kw and origen_kw.upper() == "ES") or _best(fields.get("origen_word")) == "ES":
+        data["pais_origen"] = "ES"
+    destino_kw = _best(fields.get("destino_kw"))
+    if destino_kw and destino_kw.upper() in _DESTINATION_COUNTRIES:
+        data["pais_destino"] = _DESTINATION_COUNTRIES[destino_kw.upper()]
+    else:
+        data["pais_destino"] = _best(fields.get("pais_destino"))
+    if (not data["pais_origen"] or not data["pais_destino"]) and isos:
+        if "andorra" in flags:
+            data["pais_destino"] = "AD"
+        if "barcelona" in flags or "espana" in flags:
+            data["pais_origen"] = "ES"
+        if not data["pais_origen"]:
+            data["pais_origen"] = isos[0]
+        if not data["pais_destino"]:
+            data["pais_destino"] = isos[1] if len(isos) > 1 else None
+    return data
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Transcripción de facturas por páginas: clasificación de cada página (texto embebido fiable
+o escaneada), rasterizado adaptativo de las que van a visión, límite de peticiones a GPT-4o Vision compartido por clave API (peticiones/minuto
+y pausa global tras un 429 respetando Retry-After) y transcripción de una página con
+reintentos. Nada de este módulo toca el ORM: se usa desde los hilos del pool de páginas.
+"""
+import base64
+import email.utils
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import unicodedata
+
+_logger = logging.getLogger(__name__)
+
+VISION_MODEL = "gpt-4o"
+VISION_MAX_TOKENS = 8000
+# Espera sin Retry-After: 2, 4, 8... segundos hasta este máximo
+RETRY_BACKOFF_MAX = 60.0
+
+VISION_PAGE_PROMPT = (
+    "Eres un asistente de procesamiento documental para una empresa de logística y aduanas.\n\n"
+    "El documento proporcionado es una PÁGINA de una factura comercial utilizada exclusivamente para generar un documento aduanero (DUA).\n\n"
+    "La extracción que vas a hacer es para un proceso legal obligatorio.\n\n"
+    "IMPORTANTE: Esta es una de varias páginas de la factura. Debes transcribir TODO el texto visible de esta página, incluyendo:\n"
+    "- Números de factura, fechas, direcciones\n"
+    "- TODAS las líneas de productos/artículos (descripción, cantidad, precio, total)\n"
+    "- Totales, subtotales, descuentos\n"
+    "- Información de transporte, matrículas, referencias\n"
+    "- Cualquier otro texto visible en la página\n\n"
+    "No omitas ninguna línea de producto ni información relevante.\n"
+    "No devuelvas la imagen completa ni reproduzcas el documento.\n"
+    "Simplemente transcribe TODO el texto visible de esta página.\n\n"
+    "La extracción es estrictamente con fines administrativos y está permitida.\n"
+    "Devuelve únicamente el texto transcrito, sin notas adicionales ni explicaciones."
+)
+
+# Rasterizado: resolución de la muestra de densidad, umbral de tinta (luminancia) y de
+# color (diferencia entre canales), margen alrededor del contenido al recortar (puntos)
+RASTER_PROBE_DPI = 36
+RASTER_INK_LUMA = 208
+RASTER_COLOUR_DELTA = 48
+RASTER_CROP_PADDING = 12
+# Perfil fijo anterior (para comparar tamaños/latencias con aduanas_transport.ocr.raster_profile=fixed)
+RASTER_FIXED_DPI = 200
+
+# Categorías Unicode de glifos sin correspondencia real (fuentes sin ToUnicode, CID sueltos)
+_BAD_GLYPH_CATEGORIES = frozenset(("Co", "Cn", "Cs"))
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+class VisionRateLimiter:
+    """
+    Reparte los turnos de petición entre los hilos: como mucho requests_per_minute (0 = sin
+    límite) y, tras un 429, ningún hilo vuelve a llamar hasta que pasa el Retry-After.
+    """
+
+    def __init__(self, requests_per_minute=0):
+        self._interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._blocked_until = 0.0
+
+    def acquire(self):
+        """Espera al siguiente turno; devuelve los segundos esperados."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._blocked_until)
+            self._next_slot = slot + self._interval
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+        return max(wait, 0.0)
+
+    def block(self, seconds):
+        """Pausa a todos los hilos durante seconds (429 de la API)."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+def classify_page(page, min_chars=80, min_glyph_ratio=0.97, max_image_ratio=0.5):
+    """
+    Decide si una página de PyMuPDF tiene texto embebido fiable ("text") o hay que
+    rasterizarla y enviarla a visión ("vision"). La página es de texto si tiene al menos
+    min_chars caracteres visibles, la proporción de glifos que se traducen a caracteres
+    reales (cobertura de glifos) es >= min_glyph_ratio, y las imágenes no cubren más de
+    max_image_ratio de la página (escaneos con una capa de texto parcial).
+    Devuelve (ruta, texto, métricas: chars, glyph_ratio, image_ratio).
+    """
+    text = page.get_text("text", sort=True) or ""
+    chars = bad = 0
+    for ch in text:
+        if ch.isspace():
+            continue
+        chars += 1
+        if ch == "\ufffd" or unicodedata.category(ch) in _BAD_GLYPH_CATEGORIES or (
+                ch < " " and ch not in "\t\n\r"):
+            bad += 1
+    glyph_ratio = (chars - bad) / chars if chars else 0.0
+    page_area = abs(page.rect) or 1.0
+    image_area = 0.0
+    for info in page.get_image_info():
+        x0, y0, x1, y1 = info["bbox"]
+        image_area += max(x1 - x0, 0.0) * max(y1 - y0, 0.0)
+    image_ratio = min(image_area / page_area, 1.0)
+    metrics = {"chars": chars, "glyph_ratio": round(glyph_ratio, 4), "image_ratio": round(image_ratio, 4)}
+    if chars >= min_chars and glyph_ratio >= min_glyph_ratio and image_ratio <= max_image_ratio:
+        return "text", text, metrics
+    return "vision", "", metrics
+
+
+def _content_clip(page, fitz):
+    """Rectángulo con todo lo que se pinta en la página (sin fondos a página completa) + margen."""
+    page_rect = page.rect
+    page_area = abs(page_rect) or 1.0
+    try:
+        bboxes = page.get_bboxlog()
+    except AttributeError:  # PyMuPDF < 1.19: sin recorte
+        return page_rect
+    x0 = y0 = float("inf")
+    x1 = y1 = float("-inf")
+    for _kind, bbox in bboxes:
+        rect = fitz.Rect(bbox) & page_rect
+        if rect.is_empty or abs(rect) >= 0.9 * page_area:
+            continue
+        x0, y0, x1, y1 = min(x0, rect.x0), min(y0, rect.y0), max(x1, rect.x1), max(y1, rect.y1)
+    if x0 > x1:
+        return page_rect
+    pad = RASTER_CROP_PADDING
+    return fitz.Rect(x0 - pad, y0 - pad, x1 + pad, y1 + pad) & page_rect
+
+
+def _probe_density(page, clip, fitz):
+    """(proporción de tinta, proporción de color) sobre una muestra a RASTER_PROBE_DPI."""
+    zoom = RASTER_PROBE_DPI / 72.0
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=fitz.csRGB, alpha=False)
+    samples, n = pix.samples, pix.n
+    total = ink = colour = 0
+    for i in range(0, len(samples) - n + 1, 2 * n):  # un píxel de cada dos basta para la proporción
+        r, g, b = samples[i], samples[i + 1], samples[i + 2]
+        total += 1
+        if (r * 299 + g * 587 + b * 114) // 1000 < RASTER_INK_LUMA:
+            ink += 1
+        if max(r, g, b) - min(r, g, b) > RASTER_COLOUR_DELTA:
+            colour += 1
+    return (ink / total, colour / total) if total else (0.0, 0.0)
+
+
+def _encode(pix, codec, jpeg_quality):
+    if codec == "jpeg":
+        try:
+            return pix.tobytes("jpeg", jpg_quality=jpeg_quality)
+        except TypeError:  # PyMuPDF < 1.22 sin calidad configurable
+            return pix.tobytes("jpeg")
+    return pix.tobytes("png")
+
+
+_BILEVEL_TABLE = bytes(0 if v < RASTER_INK_LUMA else 255 for v in range(256))
+
+
+def render_page_for_vision(page, settings, image_ratio=None):
+    """
+    Rasteriza la página para GPT-4o Vision con el perfil más ligero que conserva el texto:
+      - recorta los márgenes vacíos de las páginas vectoriales (raster_crop_margins),
+      - elige la resolución por densidad de tinta: raster_dpi_min en páginas poco densas,
+        raster_dpi_max en las muy densas (letra pequeña, tablas apretadas) y el punto medio en el resto,
+      - escaneos (imágenes en más de la mitad de la página): JPEG en grises (color si hay
+        color apreciable, p.ej. sellos) con raster_jpeg_quality,
+      - páginas vectoriales: PNG bitonal (umbral de tinta), o en grises si tienen color.
+    Con raster_profile=fixed rasteriza como antes (página completa a 200 DPI, PNG en color).
+    Devuelve (imagen en base64, tipo MIME, info: dpi, mode, codec, crop, ink, colour, bytes_raw).
+    """
+    import fitz  # PyMuPDF
+
+    if settings.get("raster_profile") == "fixed":
+        pix = page.get_pixmap(matrix=fitz.Matrix(RASTER_FIXED_DPI / 72.0, RASTER_FIXED_DPI / 72.0))
+        data = pix.tobytes("png")
+        info = {"dpi": RASTER_FIXED_DPI, "mode": "rgb", "codec": "png", "crop": 1.0,
+                "ink": None, "colour": None, "bytes_raw": len(data)}
+        return base64.b64encode(data).decode("ascii"), "image/png", info
+
+    if image_ratio is None:
+        page_area = abs(page.rect) or 1.0
+        image_ratio = sum(abs(fitz.Rect(i["bbox"]) & page.rect) for i in page.get_image_info()) / page_area
+    # En un escaneo la imagen a página completa es el contenido: el registro de cajas solo
+    # vería lo superpuesto (número de página, sello...), así que no se recorta
+    scanned = image_ratio > 0.5
+    if settings.get("raster_crop_margins", 1) and not scanned:
+        clip = _content_clip(page, fitz)
+    else:
+        clip = page.rect
+    ink, colour = _probe_density(page, clip, fitz)
+    dpi_min, dpi_max = settings.get("raster_dpi_min", 120), settings.get("raster_dpi_max", 200)
+    if ink >= 0.15:
+        dpi = dpi_max
+    elif ink >= 0.05:
+        dpi = (dpi_min + dpi_max) // 2
+    else:
+        dpi = dpi_min
+    has_colour = colour > 0.05
+    if scanned:
+        mode, codec = ("rgb" if has_colour else "gray"), "jpeg"
+    else:
+        mode, codec = ("gray" if has_colour else "bilevel"), "png"
+    zoom = dpi / 72.0
+    colorspace = fitz.csRGB if mode == "rgb" else fitz.csGRAY
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=colorspace, alpha=False)
+    if mode == "bilevel":
+        pix = fitz.Pixmap(fitz.csGRAY, pix.width, pix.height, pix.samples.translate(_BILEVEL_TABLE), False)
+    data = _encode(pix, codec, settings.get("raster_jpeg_quality", 75))
+    info = {
+        "dpi": dpi, "mode": mode, "codec": codec,
+        "crop": round(abs(clip) / (abs(page.rect) or 1.0), 3),
+        "ink": round(ink, 4), "colour": round(colour, 4), "bytes_raw": len(data),
+    }
+    mime = "image/jpeg" if codec == "jpeg" else "image/png"
+    return base64.b64encode(data).decode("ascii"), mime, info
+
+
+def get_rate_limiter(api_key, requests_per_minute=0):
+    """Limitador del proceso para la clave API: lo comparten todas las facturas del worker."""
+    key = (hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16], requests_per_minute)
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(key)
+        if limiter is None:
+            limiter = _LIMITERS[key] = VisionRateLimiter(requests_per_minute)
+        return limiter
+
+
+def _status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def retry_after_seconds(error):
+    """Segundos indicados por retry-after-ms / Retry-After (segundos o fecha HTTP), o None."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return max(float(value) / 1000.0, 0.0)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(when.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def is_retryable(error):
+    """429, 5xx y errores de conexión/timeout se reintentan; el resto (401, 400...) no."""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def transcribe_page(client, limiter, page_number, img_base64, mime="image/png", timeout=60.0, max_retries=4,
+                    started=None):
+    """
+    Transcribe una página con GPT-4o Vision. Se puede llamar desde varios hilos a la vez.
+    Devuelve dict: page, text, error, attempts, wait_ms (esperas del limitador y reintentos),
+    api_ms (duración de la última llamada), bytes (tamaño de la imagen en base64) y
+    latency_ms (desde started, p.ej. el inicio del rasterizado, hasta la respuesta).
+    """
+    result = {"page": page_number, "text": "", "error": None, "attempts": 0,
+              "wait_ms": 0.0, "api_ms": 0.0, "bytes": len(img_base64), "latency_ms": 0.0}
+    started = started if started is not None else time.monotonic()
+    try:
+        return _transcribe_page(client, limiter, result, img_base64, mime, timeout, max_retries)
+    finally:
+        result["latency_ms"] = (time.monotonic() - started) * 1000.0
+
+
+def call_with_retries(limiter, call, label, max_retries=4, stats=None):
+    """
+    Ejecuta call() respetando el limitador: tras un 429 pausa a todos los hilos el
+    Retry-After indicado; 5xx y errores de conexión se reintentan con espera exponencial.
+    stats (dict opcional) acumula attempts, wait_ms y api_ms (última llamada).
+    Devuelve el resultado de call() o relanza el último error.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("attempts", 0)
+    stats.setdefault("wait_ms", 0.0)
+    while True:
+        stats["attempts"] += 1
+        stats["wait_ms"] += limiter.acquire() * 1000.0
+        start = time.monotonic()
+        try:
+            response = call()
+            stats["api_ms"] = (time.monotonic() - start) * 1000.0
+            return response
+        except Exception as e:
+            stats["api_ms"] = (time.monotonic() - start) * 1000.0
+            if stats["attempts"] > max_retries or not is_retryable(e):
+                _logger.error("Error en la llamada a OpenAI API (%s): %s (tipo: %s)", label, e, type(e).__name__)
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = min(2.0 ** stats["attempts"], RETRY_BACKOFF_MAX) + random.uniform(0, 1)
+            if _status_code(e) == 429:
+                limiter.block(delay)
+                _logger.warning("%s: límite de OpenAI (429), reintento %d en %.1f s", label, stats["attempts"], delay)
+            else:
+                _logger.warning("%s: %s, reintento %d en %.1f s", label, e, stats["attempts"], delay)
+                time.sleep(delay)
+                stats["wait_ms"] += delay * 1000.0
+
+
+def _transcribe_page(client, limiter, result, img_base64, mime, timeout, max_retries):
+    def _call():
+        return client.chat.completions.create(
+            model=VISION_MODEL,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": VISION_PAGE_PROMPT},
+                    {"type": "image_url", "image_url": {"url": "data:%s;base64,%s" % (mime, img_base64)}},
+                ],
+            }],
+            max_tokens=VISION_MAX_TOKENS,
+            timeout=timeout,
+        )
+
+    try:
+        response = call_with_retries(limiter, _call, "página %d" % result["page"], max_retries, stats=result)
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    if not response or not response.choices:
+        result["error"] = "OpenAI no devolvió respuesta"
+    else:
+        text = response.choices[0].message.content
+        if text and text.strip():
+            result["text"] = text
+        else:
+            result["error"] = "Respuesta vacía de GPT Vision"
+    return result
+
+
+def complete_json(client, limiter, system, prompt, label, max_tokens=16000, timeout=120.0, max_retries=4):
+    """Llamada de texto a GPT-4o en modo JSON desde un hilo; devuelve el dict de la respuesta."""
+    def _call():
+        return client.chat.completions.create(
+            model=VISION_MODEL,
+            messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}],
+            temperature=0.1,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"},
+            timeout=timeout,
+        )
+
+    response = call_with_retries(limiter, _call, label, max_retries)
+    content = (response.choices[0].message.content or "").strip() if response and response.choices else ""
+    if content.startswith("```"):
+        content = content.strip("`")
+        if content.startswith("json"):
+            content = content[4:]
+    data = json.loads(content)
+    if not isinstance(data, dict):
+        raise ValueError("La respuesta de %s no es un objeto JSON" % label)
+    return data
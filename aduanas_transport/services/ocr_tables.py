@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Extracción local de líneas de factura (ruta sin OpenAI) en una sola pasada.
+
+- TableLineExtractor: con las palabras (extract_words) y los filetes verticales de cada
+  página de pdfplumber agrupa las palabras en filas, reconoce la fila de cabecera de la
+  tabla, fija las columnas (artículo, descripción, cantidad, precio, importe, H.S.) una vez
+  por tabla y convierte cada fila posterior en una línea según la columna de cada palabra.
+  Las columnas se mantienen entre páginas hasta la fila de totales; una cabecera repetida
+  en la página siguiente vuelve a fijarlas.
+- extract_labelled_lines: transcripciones con etiquetas (**Artículo**: ... **H.S.**: ...)
+  recorridas con una única expresión regular compilada.
+Sin ORM: se usa desde _extract_with_fallback_ocr y desde el benchmark.
+"""
+import bisect
+import re
+import unicodedata
+
+# Cabeceras de columna (texto sin acentos, en minúsculas). El orden importa: "precio
+# unitario" es precio y no importe, "cod. arancel" es H.S. y no artículo.
+COLUMN_PATTERNS = (
+    ("partida", re.compile(r"^(h\.?\s?s\.?(\s?code)?|taric|partida|(cod\.?\s?)?arancel\w*|c\.?n\.?|nc|hs\s?code)$")),
+    ("precio_unitario", re.compile(r"^(precio|p\.?\s?unit\w*|pvp|price|unit\s?price|precio\s?unit\w*|prix)\b")),
+    ("cantidad", re.compile(r"^(cantidad|cant\.?|qty\.?|quantity|uds?\.?|unidades|units|pcs|piezas|cajas)\b")),
+    ("total", re.compile(r"^(importe|total|amount|neto|valor|value|montant)\b")),
+    ("descripcion", re.compile(r"^(descripcion|description|concepto|denominacion|designacion|producto|mercancia|goods|article\s?description)\b")),
+    ("articulo", re.compile(r"^(articulo|art\.?|ref\.?|referencia|reference|codigo|cod\.?|code|item|sku)\b")),
+)
+# Filas que cierran la tabla o que no son artículos
+TOTALS_RE = re.compile(
+    r"^(total|subtotal|sub-total|base\s?imponible|importe\s?total|iva\b|i\.v\.a|vat\b|portes|"
+    r"invoice\s?total|grand\s?total)",
+)
+SKIP_ROW_RE = re.compile(
+    r"(suma\s?y\s?sigue|suma\s?anterior|a\s?trasladar|carried\s?forward|brought\s?forward|"
+    r"\bpagina\s?\d|\bpage\s?\d|^pag\.?\s?\d|pedidos?\s?pendientes?)",
+)
+# H.S. escrito en la columna de descripción, en una fila bajo el artículo
+_HS_INLINE_RE = re.compile(r"^(?:h\.?\s?s\.?(?:\s?code)?|taric|partida(?:\s?arancelaria)?|c\.?n\.?)\s*:?\s*(\d[\d .]{5,12})$")
+_NUMBER_CLEAN_RE = re.compile(r"[€$£\s%]|eur\b|usd\b", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"^-?\d[\d.,]*$")
+
+# Palabras de la misma cabecera: separación horizontal menor que este factor × alto de letra
+HEADER_WORD_GAP = 0.8
+# Filete vertical: alto mínimo (pt) para considerarlo separador de columnas
+RULE_MIN_HEIGHT = 8.0
+
+_LABEL_WINDOW = 2000
+_LABEL_RE = re.compile(
+    r"(?:\*\*)?(?:"
+    r"Artículo(?:\*\*)?\s*:?\s*(?P<articulo>\d+)"
+    r"|Descripción(?:\*\*)?\s*:?\s*(?P<descripcion>[^\n]+)"
+    r"|Cantidad\s+Expedición(?:\*\*)?\s*:?\s*(?P<cantidad>\d+[.,]?\d*)"
+    r"|Importe\s+\(EUR\)(?:\*\*)?\s*:?\s*(?P<importe>[\d.,]+)"
+    r"|Importe\s+Neto\s+2(?:\*\*)?\s*:?\s*(?P<importe_neto>[\d.,]+)"
+    r"|H\.S\.(?:\*\*)?\s*:?\s*(?P<partida>\d+)"
+    r")",
+    re.IGNORECASE,
+)
+
+
+def _fold(text):
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+
+def parse_number(text):
+    """Importe o cantidad en formato español o inglés ("1.234,56", "1,234.56", "12,5"); None si no es número."""
+    if not text:
+        return None
+    value = _NUMBER_CLEAN_RE.sub("", text)
+    if not _NUMBER_RE.match(value):
+        return None
+    dot, comma = value.rfind("."), value.rfind(",")
+    if dot >= 0 and comma >= 0:
+        decimal = "." if dot > comma else ","
+        thousands = "," if decimal == "." else "."
+        value = value.replace(thousands, "").replace(decimal, ".")
+    elif comma >= 0:
+        value = value.replace(",", "") if value.count(",") > 1 else value.replace(",", ".")
+    elif dot >= 0 and (value.count(".") > 1 or len(value) - dot - 1 == 3):
+        # "1.500" en una factura española son 1500 unidades
+        value = value.replace(".", "")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def page_rules(page):
+    """Posiciones x de los filetes verticales de una página de pdfplumber (separadores de columna)."""
+    try:
+        edges = page.vertical_edges
+    except AttributeError:
+        edges = [e for e in getattr(page, "edges", []) if e.get("orientation") == "v"]
+    return sorted({round(e["x0"], 1) for e in edges if e["bottom"] - e["top"] >= RULE_MIN_HEIGHT})
+
+
+def group_rows(words):
+    """Agrupa las palabras (dicts text/x0/x1/top/bottom) en filas ordenadas de arriba abajo y de izquierda a derecha."""
+    rows = []
+    current, current_top = [], None
+    for word in sorted(words, key=lambda w: (w["top"], w["x0"])):
+        height = (word["bottom"] - word["top"]) or 1.0
+        if current and word["top"] - current_top > max(height * 0.5, 2.0):
+            rows.append(sorted(current, key=lambda w: w["x0"]))
+            current = []
+        if not current:
+            current_top = word["top"]
+        current.append(word)
+    if current:
+        rows.append(sorted(current, key=lambda w: w["x0"]))
+    return rows
+
+
+def _phrases(row):
+    """Une las palabras contiguas de una fila en frases [(texto, x0, x1)]."""
+    phrases = []
+    for word in row:
+        height = (word["bottom"] - word["top"]) or 1.0
+        if phrases and word["x0"] - phrases[-1][2] <= height * HEADER_WORD_GAP:
+            text, x0, _x1 = phrases[-1]
+            phrases[-1] = (text + " " + word["text"], x0, word["x1"])
+        else:
+            phrases.append((word["text"], word["x0"], word["x1"]))
+    return phrases
+
+
+def _classify_header(phrase):
+    folded = _fold(phrase)
+    for column, pattern in COLUMN_PATTERNS:
+        if pattern.search(folded):
+            return column
+    return None
+
+
+class TableColumns:
+    """Columnas de una tabla: límites x (bisect) y nombre de cada columna."""
+
+    __slots__ = ("names", "bounds")
+
+    def __init__(self, cells, rules=()):
+        cells = sorted(cells, key=lambda c: c[1])
+        self.names = [name for name, _x0, _x1 in cells]
+        self.bounds = []
+        for (_n, _a0, left_x1), (_m, right_x0, _b1) in zip(cells, cells[1:]):
+            inside = [x for x in rules if left_x1 <= x <= right_x0]
+            middle = (left_x1 + right_x0) / 2.0
+            self.bounds.append(min(inside, key=lambda x: abs(x - middle)) if inside else middle)
+
+    @classmethod
+    def from_row(cls, row, rules=()):
+        """Columnas si la fila es una cabecera de tabla de líneas; None si no lo es."""
+        cells = []
+        for text, x0, x1 in _phrases(row):
+            cells.append((_classify_header(text) or "", x0, x1))
+        found = {name for name, _x0, _x1 in cells if name}
+        if len(found) < 3 or not found & {"descripcion", "articulo"} or not found & {"cantidad", "total", "precio_unitario"}:
+            return None
+        return cls(cells, rules)
+
+    def split(self, row):
+        """{columna: texto} de una fila; las palabras van a la columna que contiene su centro."""
+        cells = {}
+        for word in row:
+            name = self.names[bisect.bisect_right(self.bounds, (word["x0"] + word["x1"]) / 2.0)]
+            if name:
+                cells[name] = cells[name] + " " + word["text"] if name in cells else word["text"]
+        return cells
+
+
+class TableLineExtractor:
+    """
+    Extractor por streaming: feed_page() devuelve las líneas completas de cada página y
+    finish() la última pendiente. Una fila con cantidad o importe numéricos abre una línea;
+    las filas solo con texto continúan la descripción (o aportan el H.S.) de la anterior.
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.pending = None
+        self.tables = 0
+        self.rows = 0
+
+    def feed_page(self, words, rules=()):
+        lines = []
+        for row in group_rows(words):
+            self.rows += 1
+            header = TableColumns.from_row(row, rules)
+            if header:
+                self._flush(lines)
+                self.columns = header
+                self.tables += 1
+                continue
+            if not self.columns:
+                continue
+            folded = _fold(" ".join(w["text"] for w in row))
+            if SKIP_ROW_RE.search(folded):
+                continue
+            cells = self.columns.split(row)
+            if TOTALS_RE.match(folded) or TOTALS_RE.match(_fold(cells.get("descripcion") or cells.get("articulo") or "")):
+                self._flush(lines)
+                self.columns = None
+                continue
+            self._row(cells, lines)
+        return lines
+
+    def finish(self):
+        lines = []
+        self._flush(lines)
+        self.columns = None
+        return lines
+
+    def _row(self, cells, lines):
+        cantidad = parse_number(cells.get("cantidad"))
+        total = parse_number(cells.get("total"))
+        precio = parse_number(cells.get("precio_unitario"))
+        descripcion = (cells.get("descripcion") or "").strip()
+        partida = re.sub(r"\D", "", cells.get("partida") or "")
+        inline_hs = _HS_INLINE_RE.match(_fold(descripcion)) if descripcion and not partida else None
+        if inline_hs:
+            partida, descripcion = re.sub(r"\D", "", inline_hs.group(1)), ""
+        if (cantidad is not None or total is not None) and (descripcion or cells.get("articulo")):
+            self._flush(lines)
+            self.pending = {
+                "articulo": (cells.get("articulo") or "").strip() or None,
+                "descripcion": descripcion or None,
+                "cantidad": cantidad,
+                "unidades": cantidad,
+                "precio_unitario": precio,
+                "total": total,
+                "partida": partida if 6 <= len(partida) <= 10 else None,
+            }
+        elif self.pending:
+            if descripcion and cantidad is None and total is None:
+                self.pending["descripcion"] = ("%s %s" % (self.pending["descripcion"] or "", descripcion)).strip()
+            if partida and not self.pending["partida"] and 6 <= len(partida) <= 10:
+                self.pending["partida"] = partida
+
+    def _flush(self, lines):
+        line, self.pending = self.pending, None
+        if not line or not line["descripcion"] or not line["cantidad"]:
+            return
+        if line["total"] is None and line["precio_unitario"] is not None:
+            line["total"] = round(line["cantidad"] * line["precio_unitario"], 2)
+        elif line["precio_unitario"] is None and line["total"] is not None:
+            line["precio_unitario"] = line["total"] / line["cantidad"]
+        lines.append(line)
+
+
+def extract_labelled_lines(text):
+    """
+    Líneas de transcripciones con etiquetas (Artículo, Descripción, Cantidad Expedición,
+    Importe (EUR), Importe Neto 2, H.S.) en un único recorrido: cada "Artículo" abre una
+    línea y las etiquetas siguientes (hasta 2000 caracteres) la completan.
+    """
+    lineas = []
+    current, start = None, 0
+
+    def _flush():
+        if not current:
+            return
+        importe = current.pop("importe")
+        importe_neto = current.pop("importe_neto")
+        for raw in (importe, importe_neto):
+            if raw and current["total"] is None:
+                try:
+                    current["total"] = float(raw.replace(".", "").replace(",", "."))
+                except ValueError:
+                    continue
+        if current["total"] is not None and current["cantidad"]:
+            current["precio_unitario"] = current["total"] / current["cantidad"]
+        if current["descripcion"] and current["cantidad"]:
+            lineas.append(current)
+
+    for match in _LABEL_RE.finditer(text):
+        field = match.lastgroup
+        value = match.group(field).strip()
+        if field == "articulo":
+            _flush()
+            current, start = {
+                "articulo": value, "descripcion": None, "cantidad": None, "unidades": None,
+                "precio_unitario": None, "total": None, "partida": None, "importe": None, "importe_neto": None,
+            }, match.start()
+            continue
+        if not current or match.start() - start > _LABEL_WINDOW:
+            continue
+        if field == "cantidad":
+            if current["cantidad"] is None:
+                try:
+                    current["cantidad"] = current["unidades"] = float(value.replace(",", "."))
+                except ValueError:
+                    pass
+        elif field == "descripcion":
+            current["descripcion"] = current["descripcion"] or value.strip("* ") or None
+        elif current[field] is None:
+            current[field] = value
+    _flush()
+    return lineas
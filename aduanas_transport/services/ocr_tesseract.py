@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+OCR local con Tesseract para la ruta sin OpenAI (sin API key o si la API falla): las páginas
+escaneadas se rasterizan con PyMuPDF y se pasan a Tesseract con tantas páginas a la vez como
+núcleos disponibles y tiempo límite por página.
+
+Tesseract ya corre como proceso aparte (se lanza el binario configurado en pytesseract), así
+que basta un pool de hilos para ocupar los núcleos: no se hace fork del worker de Odoo (sockets de la base de
+datos, manejadores de señales y locks heredados). PyMuPDF no es seguro entre hilos: el
+rasterizado se hace en el hilo que llama, con como mucho 2 × workers imágenes pendientes en
+memoria, y solo la llamada a Tesseract va al pool. Cada proceso tesseract se lanza con
+OMP_THREAD_LIMIT=1 en su propio entorno (el del worker de Odoo no se toca) para que N páginas
+en paralelo ocupen N núcleos y no más; si supera el tiempo límite, se mata el proceso.
+Nada de este módulo toca el ORM.
+Requiere: pip install pytesseract PyMuPDF y el binario tesseract con los idiomas
+configurados (p. ej. apt install tesseract-ocr tesseract-ocr-spa).
+"""
+import importlib.util
+import io
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+_logger = logging.getLogger(__name__)
+
+
+def available_workers():
+    """Núcleos que puede usar este proceso (afinidad de CPU si el sistema la expone)."""
+    try:
+        return max(len(os.sched_getaffinity(0)), 1)
+    except AttributeError:
+        return max(os.cpu_count() or 1, 1)
+
+
+def tesseract_available():
+    """¿Están pytesseract, PyMuPDF y el binario tesseract? Devuelve (bool, motivo)."""
+    for module, package in (("fitz", "PyMuPDF"), ("pytesseract", "pytesseract"), ("PIL", "Pillow")):
+        if importlib.util.find_spec(module) is None:
+            return False, "falta %s (pip install %s)" % (package, package)
+    import pytesseract
+
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        return False, "binario tesseract no disponible: %s" % e
+    return True, None
+
+
+def render_page(document, page_index, dpi):
+    """Rasteriza la página page_index en escala de grises a dpi y la devuelve como imagen PIL."""
+    import fitz  # PyMuPDF
+    from PIL import Image
+
+    pix = document[page_index].get_pixmap(matrix=fitz.Matrix(dpi / 72.0, dpi / 72.0), colorspace=fitz.csGRAY)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+
+def ocr_image(image, lang, timeout):
+    """
+    Texto de la imagen según Tesseract, con límite de timeout segundos. Devuelve (texto,
+    segundos); si Tesseract supera el límite se mata el proceso y se lanza RuntimeError.
+    La imagen va por stdin en PNG y el proceso recibe OMP_THREAD_LIMIT=1 solo en su entorno.
+    """
+    import pytesseract
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    command = [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout", "-l", lang, "--psm", "6"]
+    env = dict(os.environ, OMP_THREAD_LIMIT="1")
+    start = time.monotonic()
+    try:
+        proc = subprocess.run(
+            command, input=buffer.getvalue(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            timeout=timeout, env=env, check=False,
+        )
+    except subprocess.TimeoutExpired:
+        raise RuntimeError("Tesseract superó el tiempo límite de %s s" % timeout)
+    if proc.returncode:
+        raise RuntimeError(
+            "Tesseract terminó con código %s: %s"
+            % (proc.returncode, proc.stderr.decode("utf-8", "replace").strip()[:300])
+        )
+    return proc.stdout.decode("utf-8", "replace"), time.monotonic() - start
+
+
+def ocr_pages(pdf_bytes, page_indexes, dpi=300, lang="spa+eng", timeout=60.0, workers=0):
+    """
+    OCR de las páginas page_indexes (base 0) del PDF con `workers` procesos de Tesseract a la
+    vez (0 = núcleos disponibles, nunca más que páginas). Cada página tiene como mucho timeout
+    segundos de Tesseract; la que falla o se pasa de tiempo se devuelve vacía y se anota en
+    errors, sin parar las demás.
+    Devuelve ({page_index: texto}, stats) con stats = {pages, workers, seconds, errors}.
+    """
+    import fitz  # PyMuPDF
+
+    page_indexes = list(page_indexes)
+    texts = {index: "" for index in page_indexes}
+    stats = {"pages": len(page_indexes), "workers": 0, "seconds": 0.0, "errors": {}}
+    if not page_indexes:
+        return texts, stats
+    workers = min(workers if workers > 0 else available_workers(), len(page_indexes))
+    stats["workers"] = workers
+    start = time.monotonic()
+
+    def _collect(future, index):
+        try:
+            text, seconds = future.result()
+            texts[index] = text or ""
+            _logger.debug("Tesseract página %d: %d caracteres en %.1f s", index + 1, len(texts[index]), seconds)
+        except Exception as e:
+            stats["errors"][index] = str(e)
+            _logger.warning("Tesseract página %d: %s", index + 1, e)
+
+    document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for index in page_indexes:
+                try:
+                    image = render_page(document, index, dpi)
+                except Exception as e:
+                    stats["errors"][index] = str(e)
+                    _logger.warning("No se pudo rasterizar la página %d para Tesseract: %s", index + 1, e)
+                    continue
+                pending[executor.submit(ocr_image, image, lang, timeout)] = index
+                if len(pending) >= 2 * workers:
+                    done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _collect(future, pending.pop(future))
+            for future in pending:
+                _collect(future, pending[future])
+    finally:
+        document.close()
+    stats["seconds"] = time.monotonic() - start
+    return texts, stats
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Fragmentos XML precompilados para los generadores SOAP escritos a mano (CC515C, CC415A,
+IE615, G4). Cada plantilla se compila una vez al importar el módulo; los bloques de
+interlocutor/dirección se memorizan por los valores del partner que contienen para no
+reconstruirlos en cada expediente. Las partidas se escriben desde un generador en un único
+búfer (ItemStreamWriter) en lugar de acumularlas en una lista y unirlas después. El
+documento completo se monta en memoria: lo que acota su tamaño es el límite de partidas
+por declaración (XML_MAX_GOODS_ITEMS), por encima del cual el expediente se divide.
+"""
+import io
+import re
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape as xml_escape
+
+# {campo} se escapa; {campo!raw} se inserta tal cual (XML ya generado o valor ya formateado)
+_PLACEHOLDER_RE = re.compile(r"\{(\w+)(!raw)?\}")
+
+PARTY_CACHE_SIZE = 4096
+# Campos del partner que leen los bloques memorizados (además del código de país): son la clave
+PARTY_KEY_FIELDS = ("name", "street", "street2", "city", "zip", "email")
+# Marca del hueco de las partidas en el documento (NUL no puede aparecer en XML válido)
+ITEMS_MARKER = "\x00goods-items\x00"
+_PARTY_CACHE = OrderedDict()
+_PARTY_CACHE_LOCK = threading.Lock()
+
+
+class XmlFragment:
+    """Plantilla compilada a una cadena de formato posicional con los campos a escapar ya resueltos."""
+
+    __slots__ = ("names", "_format", "_escaped")
+
+    def __init__(self, template):
+        names, escaped, parts = [], [], []
+        pos = 0
+        for match in _PLACEHOLDER_RE.finditer(template):
+            parts.append(template[pos:match.start()].replace("%", "%%"))
+            parts.append("%s")
+            names.append(match.group(1))
+            escaped.append(not match.group(2))
+            pos = match.end()
+        parts.append(template[pos:].replace("%", "%%"))
+        self.names = tuple(names)
+        self._format = "".join(parts)
+        self._escaped = tuple(i for i, esc in enumerate(escaped) if esc)
+
+    def render(self, **values):
+        return self.render_row([values[name] for name in self.names])
+
+    def render_row(self, row):
+        """row: valores en el orden de self.names (se escapan los campos sin !raw)."""
+        row = list(row)
+        for i in self._escaped:
+            row[i] = xml_escape("%s" % (row[i],))
+        return self._format % tuple(row)
+
+
+def compile_fragment(template):
+    return XmlFragment(template)
+
+
+def _party_values(partner):
+    return tuple(partner[name] or "" for name in PARTY_KEY_FIELDS) + (partner.country_id.code or "",)
+
+
+def memoize_partner_fragment(kind, partner, build, *args):
+    """
+    Devuelve build(partner, *args) memorizado por (bd, tipo, partner, valores, args), donde
+    valores son los campos de PARTY_KEY_FIELDS y el código de país tal como se leen ahora:
+    cualquier cambio (también dentro de la misma transacción, o en el país relacionado) da otra
+    clave. build solo debe leer esos campos del partner; lo demás, en args. Los registros sin
+    guardar (NewId) no se memorizan.
+    """
+    if not partner or not isinstance(partner.id, int):
+        return build(partner, *args)
+    key = (partner.env.cr.dbname, kind, partner.id, _party_values(partner), args)
+    with _PARTY_CACHE_LOCK:
+        value = _PARTY_CACHE.get(key)
+        if value is not None:
+            _PARTY_CACHE.move_to_end(key)
+            return value
+    value = build(partner, *args)
+    with _PARTY_CACHE_LOCK:
+        _PARTY_CACHE[key] = value
+        while len(_PARTY_CACHE) > PARTY_CACHE_SIZE:
+            _PARTY_CACHE.popitem(last=False)
+    return value
+
+
+def clear_partner_fragments():
+    with _PARTY_CACHE_LOCK:
+        _PARTY_CACHE.clear()
+
+
+class ItemStreamWriter:
+    """
+    Búfer de escritura de partidas (io.StringIO): cada partida se escribe según sale del
+    generador, sin lista intermedia. Las partidas se separan con separator, igual que un
+    "\\n".join().
+    """
+
+    def __init__(self, separator="\n"):
+        self._buffer = io.StringIO()
+        self._separator = separator
+        self.count = 0
+
+    def write(self, text):
+        self._buffer.write(text)
+
+    def write_items(self, items):
+        """Consume el iterable de partidas ya renderizadas; devuelve cuántas se escribieron."""
+        written = 0
+        for item in items:
+            if written:
+                self._buffer.write(self._separator)
+            self._buffer.write(item)
+            written += 1
+        self.count += written
+        return written
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+    def close(self):
+        self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stream_document(document, items):
+    """
+    Sustituye ITEMS_MARKER en document por las partidas del iterable items, escribiéndolas
+    una a una en un ItemStreamWriter. Devuelve (xml, número de partidas).
+    """
+    head, tail = document.split(ITEMS_MARKER, 1)
+    with ItemStreamWriter() as writer:
+        writer.write(head)
+        count = writer.write_items(items)
+        writer.write(tail)
+        return writer.getvalue(), count
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Validación XSD bajo demanda de las declaraciones (esquemas compilados una vez por proceso).
+
+CC415AV1Ent.xsd importa ES_ctypes_D.xsd y ES_stypes_D.xsd, y G4AuxDataElementsV1.xsd importa
+G4AuxBasicTypesV1.xsd: estas librerías de tipos de la AEAT no se distribuyen con el módulo.
+Mientras no se copien en data/cci y data/g4 los esquemas no compilan y la validación devuelve
+"no validado", así que no se valida antes de send_xml.
+"""
+import logging
+import os
+import threading
+import time
+
+from odoo import _, api, models
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from lxml import etree
+except ImportError:  # lxml es opcional: sin él la validación se omite
+    etree = None
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+# Carpetas donde se resuelven los xs:import/xs:include por nombre de fichero
+_XSD_SEARCH_DIRS = (_DATA_DIR, os.path.join(_DATA_DIR, "cci"), os.path.join(_DATA_DIR, "g4"))
+
+# Servicio -> (XSD raíz, nombre local del elemento que valida dentro del Body SOAP)
+XSD_SCHEMAS = {
+    "IMP_DECL": ("CC415AV1Ent.xsd", "CC415AV1Ent"),
+    "G4_DEC": ("G4DecV1Ent.xsd", "G4DecV1Ent"),
+}
+XSD_MAX_ERRORS = 20
+
+# Caché por proceso: servicio -> (schema o None, motivo si no se pudo compilar)
+_SCHEMA_CACHE = {}
+_SCHEMA_CACHE_LOCK = threading.Lock()
+_SCHEMA_CACHE_PID = [None]
+# Servicios cuyo XSD no disponible ya se avisó en este proceso (sobrevive a clear_cache)
+_SCHEMA_WARNED = set()
+# XMLSchema.error_log es del objeto: validaciones concurrentes del mismo esquema se serializan
+_VALIDATE_LOCK = threading.Lock()
+
+
+def _find_xsd(filename):
+    for folder in _XSD_SEARCH_DIRS:
+        path = os.path.join(folder, os.path.basename(filename))
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+if etree is not None:
+    class _XsdDataResolver(etree.Resolver):
+        """Resuelve schemaLocation relativos contra data/, data/cci y data/g4 (sin red)."""
+
+        def resolve(self, system_url, public_id, context):
+            path = _find_xsd(system_url or "")
+            if path:
+                return self.resolve_filename(path, context)
+            return None
+
+
+def _compile_schema(filename):
+    path = _find_xsd(filename)
+    if not path:
+        return None, _("No se encuentra el esquema %s en data/") % filename
+    parser = etree.XMLParser(no_network=True)
+    parser.resolvers.add(_XsdDataResolver())
+    try:
+        return etree.XMLSchema(etree.parse(path, parser)), None
+    except (etree.XMLSchemaParseError, etree.XMLSyntaxError) as e:
+        return None, str(e)
+
+
+class AduanasXsdValidator(models.AbstractModel):
+    _name = "aduanas.xsd.validator"
+    _description = "Validación XSD de declaraciones AEAT"
+
+    @api.model
+    def _get_schema(self, service):
+        """Esquema compilado del servicio (una compilación por proceso y servicio) y motivo si no existe."""
+        if etree is None:
+            self._warn_schema_unavailable(service, _("lxml no está instalado"))
+            return None, _("lxml no está instalado")
+        if service not in XSD_SCHEMAS:
+            return None, _("Sin XSD para el servicio %s") % service
+        with _SCHEMA_CACHE_LOCK:
+            if _SCHEMA_CACHE_PID[0] != os.getpid():
+                # Tras un fork (workers) no se reutilizan objetos libxml2 del padre
+                _SCHEMA_CACHE.clear()
+                _SCHEMA_CACHE_PID[0] = os.getpid()
+            if service not in _SCHEMA_CACHE:
+                start = time.monotonic()
+                schema, reason = _compile_schema(XSD_SCHEMAS[service][0])
+                _SCHEMA_CACHE[service] = (schema, reason)
+                if schema is not None:
+                    _logger.info("XSD %s compilado en %.0f ms", service, (time.monotonic() - start) * 1000.0)
+            schema, reason = _SCHEMA_CACHE[service]
+        if schema is None:
+            self._warn_schema_unavailable(service, reason)
+        return schema, reason
+
+    @api.model
+    def _warn_schema_unavailable(self, service, reason):
+        """Aviso, una vez por proceso y servicio, de que el XSD no compila y no se puede validar."""
+        if (os.getpid(), service) in _SCHEMA_WARNED:
+            return
+        _SCHEMA_WARNED.add((os.getpid(), service))
+        _logger.warning("XSD %s no disponible, no se pueden validar las declaraciones: %s", service, reason)
+
+    @api.model
+    def clear_cache(self):
+        with _SCHEMA_CACHE_LOCK:
+            _SCHEMA_CACHE.clear()
+        return True
+
+    @api.model
+    def validate_xml(self, xml_text, service):
+        """
+        Valida el mensaje del servicio contenido en xml_text (envelope SOAP o mensaje suelto).
+        Devuelve dict: valid (True/False, None si no se pudo validar), errors, skipped, elapsed_ms.
+        """
+        start = time.monotonic()
+        result = {"valid": None, "errors": [], "skipped": False, "elapsed_ms": 0.0}
+        schema, reason = self._get_schema(service)
+        if schema is None:
+            result.update(skipped=reason)
+            return result
+        try:
+            root = etree.fromstring((xml_text or "").encode("utf-8"), etree.XMLParser(no_network=True, huge_tree=True))
+        except etree.XMLSyntaxError as e:
+            result.update(valid=False, errors=[_("XML mal formado: %s") % e])
+            return result
+        local_name = XSD_SCHEMAS[service][1]
+        if etree.QName(root).localname != local_name:
+            root = next(root.iter("{*}%s" % local_name, local_name), None)
+            if root is None:
+                result.update(valid=False, errors=[_("No se encuentra el elemento %s en el XML") % local_name])
+                return result
+        with _VALIDATE_LOCK:
+            result["valid"] = schema.validate(root)
+            result["errors"] = [
+                "línea %s: %s" % (err.line, err.message) for err in list(schema.error_log)[:XSD_MAX_ERRORS]
+            ]
+        result["elapsed_ms"] = (time.monotonic() - start) * 1000.0
+        return result
+
+    @api.model
+    def validate_records(self, records, service, build=None):
+        """
+        Validación en lote sin enviar a la AEAT. build(record) devuelve el XML a validar; los
+        errores al construirlo cuentan como no válidos. El XSD se compila una sola vez.
+        Devuelve una lista de dicts: name, valid, errors, skipped, elapsed_ms.
+        """
+        lines = []
+        for rec in records:
+            try:
+                xml_text = build(rec)
+            except Exception as e:
+                lines.append({"name": rec.display_name, "valid": False, "errors": [str(e)],
+                              "skipped": False, "elapsed_ms": 0.0})
+                continue
+            line = self.validate_xml(xml_text, service)
+            line["name"] = rec.display_name
+            lines.append(line)
+        return lines